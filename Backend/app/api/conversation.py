@@ -4,6 +4,7 @@ from fastapi.responses import StreamingResponse
 from typing import List, Optional
 from datetime import datetime
 from pydantic import BaseModel
+import asyncio
 import json
 from app.models.schemas import (
     ConversationCreate, ConversationResponse, ConversationListResponse,
@@ -12,6 +13,7 @@ from app.models.schemas import (
 from app.core.config import settings
 from app.core.database import db_manager
 from app.services.core.chat_service import ChatService
+from app.services.infrastructure.telemetry.tracing import span, trace_diagnostics
 from app.utils.logger import get_logger
 
 logger = get_logger(__name__)
@@ -337,22 +339,11 @@ async def create_message(conversation_id: int, request: MessageCreate):
 
 # ==================== 智能助手聊天API ====================
 
-@router.post("/{conversation_id}/chat")
-async def chat_with_assistant(conversation_id: int, request: AssistantChatRequest):
-    """
-    智能助手对话（支持多知识库、system_prompt、纯对话等功能）
-    
-    流程：
-    1. 获取对话关联的助手配置
-    2. 保存用户消息
-    3. 调用chat_service.chat_with_assistant()进行RAG对话
-    4. 保存AI回复
-    5. 返回结果
-    """
-    try:
-        with db_manager.get_connection() as conn:
-            cursor = conn.cursor()
-            
+def _load_chat_context_sync(conversation_id: int, query: str, max_messages: int) -> dict:
+    """读取对话/助手配置与历史消息并保存用户消息（同步，经 db_manager.run_sync 在数据库线程池执行）"""
+    with db_manager.get_connection() as conn:
+        cursor = conn.cursor()
+        try:
             # 1. 获取对话信息
             cursor.execute(
                 "SELECT assistant_id FROM conversations WHERE id = %s",
@@ -375,14 +366,45 @@ async def chat_with_assistant(conversation_id: int, request: AssistantChatReques
             if not assistant:
                 raise HTTPException(status_code=404, detail=f"助手ID {assistant_id} 不存在")
             
-            # 3. 解析知识库ID列表
-            kb_ids = None
-            if assistant['kb_ids']:
-                kb_ids = [int(id) for id in assistant['kb_ids'].split(',')]
+            # 3. 读取历史消息（用于上下文记忆）
+            cursor.execute(
+                """SELECT role, content 
+                   FROM messages 
+                   WHERE conversation_id = %s 
+                   ORDER BY created_at DESC 
+                   LIMIT %s""",
+                (conversation_id, max_messages)
+            )
+            history_rows = cursor.fetchall()
+            
+            # 4. 保存用户消息
+            cursor.execute(
+                """INSERT INTO messages (conversation_id, role, content) 
+                   VALUES (%s, %s, %s)""",
+                (conversation_id, 'user', query)
+            )
+        finally:
+            cursor.close()
+    return {"assistant": assistant, "history_rows": history_rows}
+
+
+def _load_stream_chat_context_sync(conversation_id: int, query: str, max_messages: int) -> Optional[dict]:
+    """流式对话：读取对话+助手配置与历史消息并保存用户消息；对话不存在时返回 None"""
+    with db_manager.get_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                """SELECT c.id, c.assistant_id, a.kb_ids, a.llm_model, 
+                          a.llm_provider, a.lora_model_id, a.system_prompt
+                   FROM conversations c
+                   JOIN assistants a ON c.assistant_id = a.id
+                   WHERE c.id = %s""",
+                (conversation_id,)
+            )
+            conv = cursor.fetchone()
+            if not conv:
+                return None
             
-            # 4. 读取历史消息（用于上下文记忆）
-            max_messages = request.max_history_turns * 2  # 每轮对话=2条消息
-            logger.info(f"准备读取历史消息: conversation_id={conversation_id}, max_messages={max_messages}")
             cursor.execute(
                 """SELECT role, content 
                    FROM messages 
@@ -392,19 +414,71 @@ async def chat_with_assistant(conversation_id: int, request: AssistantChatReques
                 (conversation_id, max_messages)
             )
             history_rows = cursor.fetchall()
-            logger.info(f"读取到历史消息数量: {len(history_rows)}")
-            if history_rows:
-                logger.info(f"历史消息预览: {[{'role': row['role'], 'content': row['content'][:30] + '...'} for row in history_rows[:3]]}")
-            history_messages = list(reversed(history_rows))  # 反转为时间正序
             
-            # 5. 保存用户消息
             cursor.execute(
                 """INSERT INTO messages (conversation_id, role, content) 
                    VALUES (%s, %s, %s)""",
-                (conversation_id, 'user', request.query)
+                (conversation_id, 'user', query)
+            )
+        finally:
+            cursor.close()
+    return {"conv": conv, "history_rows": history_rows}
+
+
+def _save_assistant_reply_sync(conversation_id: int, answer: str, sources_json: Optional[str]) -> None:
+    """保存AI回复并更新对话统计（同步，经 db_manager.run_sync 在数据库线程池执行）"""
+    with db_manager.get_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                """INSERT INTO messages (conversation_id, role, content, sources) 
+                   VALUES (%s, %s, %s, %s)""",
+                (conversation_id, 'assistant', answer, sources_json)
             )
             
+            # 更新对话统计
+            cursor.execute(
+                """UPDATE conversations 
+                   SET message_count = message_count + 2, 
+                       updated_at = CURRENT_TIMESTAMP 
+                   WHERE id = %s""",
+                (conversation_id,)
+            )
+        finally:
             cursor.close()
+
+
+@router.post("/{conversation_id}/chat")
+async def chat_with_assistant(conversation_id: int, request: AssistantChatRequest):
+    """
+    智能助手对话（支持多知识库、system_prompt、纯对话等功能）
+    
+    流程：
+    1. 获取对话关联的助手配置
+    2. 保存用户消息
+    3. 调用chat_service.chat_with_assistant()进行RAG对话
+    4. 保存AI回复
+    5. 返回结果
+    """
+    try:
+        # 1-5. 获取对话/助手配置、读取历史消息（用于上下文记忆）并保存用户消息
+        max_messages = request.max_history_turns * 2  # 每轮对话=2条消息
+        logger.info(f"准备读取历史消息: conversation_id={conversation_id}, max_messages={max_messages}")
+        with span("history_sql"):
+            context = await db_manager.run_sync(
+                _load_chat_context_sync, conversation_id, request.query, max_messages
+            )
+        assistant = context['assistant']
+        history_rows = context['history_rows']
+        
+        kb_ids = None
+        if assistant['kb_ids']:
+            kb_ids = [int(id) for id in assistant['kb_ids'].split(',')]
+        
+        logger.info(f"读取到历史消息数量: {len(history_rows)}")
+        if history_rows:
+            logger.info(f"历史消息预览: {[{'role': row['role'], 'content': row['content'][:30] + '...'} for row in history_rows[:3]]}")
+        history_messages = list(reversed(history_rows))  # 反转为时间正序
         
         # 6. 调用聊天服务（传递历史消息和LoRA模型ID）
         chat_top_k = max(3, int(getattr(settings.hybrid_retrieval, 'chat_top_k', 10) or 10))
@@ -431,31 +505,13 @@ async def chat_with_assistant(conversation_id: int, request: AssistantChatReques
         )
         
         # 7. 保存AI回复
-        with db_manager.get_connection() as conn:
-            cursor = conn.cursor()
-            
-            # 保存sources为JSON
-            sources_json = None
-            if result['sources']:
-                import json
-                sources_json = json.dumps(result['sources'], ensure_ascii=False)
-            
-            cursor.execute(
-                """INSERT INTO messages (conversation_id, role, content, sources) 
-                   VALUES (%s, %s, %s, %s)""",
-                (conversation_id, 'assistant', result['answer'], sources_json)
-            )
-            
-            # 更新对话统计
-            cursor.execute(
-                """UPDATE conversations 
-                   SET message_count = message_count + 2, 
-                       updated_at = CURRENT_TIMESTAMP 
-                   WHERE id = %s""",
-                (conversation_id,)
+        sources_json = None
+        if result['sources']:
+            sources_json = json.dumps(result['sources'], ensure_ascii=False)
+        with span("save_message_sql"):
+            await db_manager.run_sync(
+                _save_assistant_reply_sync, conversation_id, result['answer'], sources_json
             )
-            
-            cursor.close()
         
         # 8. 返回结果
         return {
@@ -463,7 +519,9 @@ async def chat_with_assistant(conversation_id: int, request: AssistantChatReques
             "sources": result['sources'],
             "embedding_model": result.get('embedding_model'),
             "retrieval_count": result.get('retrieval_count', 0),
-            "diagnostics": result.get('diagnostics')
+            "diagnostics": result.get('diagnostics'),
+            "cache": result.get('cache'),
+            "trace": trace_diagnostics()
         }
         
     except HTTPException:
@@ -483,7 +541,7 @@ async def chat_with_assistant_stream(conversation_id: int, request: AssistantCha
     返回格式：
     - data: {"type": "sources", "data": {...}}  # 检索结果
     - data: {"type": "text", "data": "文本片段"}  # 生成的文本
-    - data: {"type": "done", "data": {}}        # 完成信号
+    - data: {"type": "done", "data": {}}        # 完成信号（开启追踪时 data.trace 为阶段耗时明细）
     - data: {"type": "error", "data": {...}}    # 错误信息
     """
     
@@ -495,51 +553,24 @@ async def chat_with_assistant_stream(conversation_id: int, request: AssistantCha
         embedding_model = None
         
         try:
-            with db_manager.get_connection() as conn:
-                cursor = conn.cursor()
-                
-                # 获取对话和助手信息
-                cursor.execute(
-                    """SELECT c.id, c.assistant_id, a.kb_ids, a.llm_model, 
-                              a.llm_provider, a.lora_model_id, a.system_prompt
-                       FROM conversations c
-                       JOIN assistants a ON c.assistant_id = a.id
-                       WHERE c.id = %s""",
-                    (conversation_id,)
+            max_messages = request.max_history_turns * 2
+            logger.info(f"[流式]准备读取历史消息: conversation_id={conversation_id}, max_messages={max_messages}")
+            with span("history_sql"):
+                context = await db_manager.run_sync(
+                    _load_stream_chat_context_sync, conversation_id, request.query, max_messages
                 )
-                result = cursor.fetchone()
-                
-                if not result:
-                    yield f"data: {_safe_json_dumps({'type': 'error', 'data': {'error': '对话不存在'}})}\n\n"
-                    return
-                
-                conv = result
-                kb_ids = [int(id) for id in conv['kb_ids'].split(',')] if conv['kb_ids'] else None
-                
-                # 读取历史消息（用于上下文记忆）
-                max_messages = request.max_history_turns * 2
-                logger.info(f"[流式]准备读取历史消息: conversation_id={conversation_id}, max_messages={max_messages}")
-                cursor.execute(
-                    """SELECT role, content 
-                       FROM messages 
-                       WHERE conversation_id = %s 
-                       ORDER BY created_at DESC 
-                       LIMIT %s""",
-                    (conversation_id, max_messages)
-                )
-                history_rows = cursor.fetchall()
-                logger.info(f"[流式]读取到历史消息数量: {len(history_rows)}")
-                if history_rows:
-                    logger.info(f"[流式]历史消息预览: {[{'role': row['role'], 'content': row['content'][:30] + '...'} for row in history_rows[:3]]}")
-                history_messages = list(reversed(history_rows))  # 反转为时间正序
-                
-                # 保存用户消息
-                cursor.execute(
-                    """INSERT INTO messages (conversation_id, role, content) 
-                       VALUES (%s, %s, %s)""",
-                    (conversation_id, 'user', request.query)
-                )
-                cursor.close()
+            
+            if not context:
+                yield f"data: {_safe_json_dumps({'type': 'error', 'data': {'error': '对话不存在'}})}\n\n"
+                return
+            
+            conv = context['conv']
+            kb_ids = [int(id) for id in conv['kb_ids'].split(',')] if conv['kb_ids'] else None
+            history_rows = context['history_rows']
+            logger.info(f"[流式]读取到历史消息数量: {len(history_rows)}")
+            if history_rows:
+                logger.info(f"[流式]历史消息预览: {[{'role': row['role'], 'content': row['content'][:30] + '...'} for row in history_rows[:3]]}")
+            history_messages = list(reversed(history_rows))  # 反转为时间正序
             
             # 调用流式聊天服务（传递历史消息和LoRA模型ID）
             chat_top_k = max(3, int(getattr(settings.hybrid_retrieval, 'chat_top_k', 10) or 10))
@@ -580,35 +611,27 @@ async def chat_with_assistant_stream(conversation_id: int, request: AssistantCha
                 
                 elif chunk_type == 'done':
                     # 保存AI回复到数据库
-                    with db_manager.get_connection() as conn:
-                        cursor = conn.cursor()
-                        
-                        sources_json = None
-                        if sources_data:
-                            sources_json = _safe_json_dumps(sources_data)
-                        
-                        cursor.execute(
-                            """INSERT INTO messages (conversation_id, role, content, sources) 
-                               VALUES (%s, %s, %s, %s)""",
-                            (conversation_id, 'assistant', collected_text, sources_json)
-                        )
-                        
-                        # 更新对话统计
-                        cursor.execute(
-                            """UPDATE conversations 
-                               SET message_count = message_count + 2, 
-                                   updated_at = CURRENT_TIMESTAMP 
-                               WHERE id = %s""",
-                            (conversation_id,)
+                    sources_json = None
+                    if sources_data:
+                        sources_json = _safe_json_dumps(sources_data)
+                    with span("save_message_sql"):
+                        await db_manager.run_sync(
+                            _save_assistant_reply_sync, conversation_id, collected_text, sources_json
                         )
-                        cursor.close()
                     
+                    trace = trace_diagnostics()
+                    if trace is not None:
+                        chunk = {**chunk, 'data': {**(chunk_data or {}), 'trace': trace}}
                     yield f"data: {_safe_json_dumps(chunk)}\n\n"
                 
                 elif chunk_type == 'error':
                     yield f"data: {_safe_json_dumps(chunk)}\n\n"
                     return
         
+        except asyncio.CancelledError:
+            # 客户端断开：取消沿生成链传递，底层LLM流式请求随之断开，不保存半截回复
+            logger.info(f"流式对话客户端已断开: conversation_id={conversation_id}")
+            raise
         except Exception as e:
             logger.error(f"流式对话失败: {str(e)}", exc_info=True)
             error_chunk = {
@@ -1,11 +1,12 @@
 """知识库API路由"""
+import asyncio
+import functools
 import hashlib
-import json
 from typing import List, Optional
 from pathlib import Path
 import shutil
 from datetime import datetime
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, File as FastAPIFile, BackgroundTasks, Query
+from fastapi import APIRouter, Depends, HTTPException, UploadFile, File as FastAPIFile, Query
 from app.models.schemas import (
     KnowledgeBaseCreate,
     KnowledgeBaseResponse,
@@ -15,6 +16,9 @@ from app.models.schemas import (
     SearchResponse
 )
 from app.services import KnowledgeBaseService, FileService, EmbeddingService, VectorStoreService, MetadataService
+from app.services.domain.knowledge_base.ingestion_service import get_ingestion_service, IngestionQueueFullError
+from app.services.infrastructure.retrieval.keyword_index_service import get_keyword_index_service
+from app.services.infrastructure.telemetry.telemetry_sink import get_telemetry_sink
 from app.core.dependencies import (
     get_kb_service,
     get_file_service,
@@ -52,7 +56,8 @@ async def create_knowledge_base(
             name=kb_data.name,
             description=kb_data.description,
             embedding_model=kb_data.embedding_model,
-            embedding_provider=kb_data.embedding_provider
+            embedding_provider=kb_data.embedding_provider,
+            index_profile=kb_data.index_profile
         )
         
         if not kb:
@@ -72,6 +77,8 @@ async def create_knowledge_base(
         
     except HTTPException:
         raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"创建知识库失败: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -238,7 +245,7 @@ async def process_file_background(
                 document_type = 'text'
 
         splitter = TextSplitter(document_type=document_type)
-        chunks = splitter.split_text(content)
+        chunks = await asyncio.to_thread(splitter.split_text, content)
         logger.info(
             "使用规则切分: file_id=%s, content_len=%s, doc_type=%s, chunks=%s",
             file_id,
@@ -272,101 +279,49 @@ async def process_file_background(
                     "chunk_overlap": splitter.chunk_overlap
                 }
 
-                metrics_path = Path(settings.text_processing.split_quality_metrics_file)
-                metrics_path.parent.mkdir(parents=True, exist_ok=True)
-                with metrics_path.open('a', encoding='utf-8') as metrics_file:
-                    metrics_file.write(json.dumps(split_metrics, ensure_ascii=False) + "\n")
+                get_telemetry_sink().record(
+                    "split_quality",
+                    settings.text_processing.split_quality_metrics_file,
+                    split_metrics
+                )
             except Exception as metrics_error:
                 logger.warning(f"切分质量监控写入失败: {str(metrics_error)}")
 
-        # 3. 分批生成向量 + 分批入库
+        # 3. 分批生成向量 + 分批入库（线程池流水线：编码第N+1批时写入第N批）
         await ws_manager.send_progress(
             client_id, kb_id, "embedding", 50, f"正在生成向量 (共{len(chunks)}块, provider={embedding_provider})..."
         )
 
         total_chunks = len(chunks)
-        embedding_batch_size = max(1, int(getattr(settings.embedding, 'batch_size', 32) or 32))
-        ingest_batch_size = max(embedding_batch_size, min(256, embedding_batch_size * 4))
+        ids = [f"file_{file_id}_chunk_{i}" for i in range(total_chunks)]
+        chunk_hashes = [hashlib.sha1(chunk.encode('utf-8')).hexdigest() for chunk in chunks]
 
-        collection_name = f"kb_{kb_id}"
-        ids = [f"file_{file_id}_chunk_{i}" for i in range(len(chunks))]
-        inserted_vector_ids: List[str] = []
+        async def _embedding_progress(processed: int, total: int, cache_stats: dict):
+            progress_value = 50 + int(30 * processed / total)
+            await ws_manager.send_progress(
+                client_id,
+                kb_id,
+                "embedding",
+                progress_value,
+                (
+                    f"向量化进度 {processed}/{total} "
+                    f"(cache_hit={cache_stats.get('cache_hit', 0)}, "
+                    f"hit_rate={cache_stats.get('hit_rate', 0)})"
+                )
+            )
 
-        with db_manager.get_connection() as conn:
-            cursor = conn.cursor()
-            try:
-                for start in range(0, total_chunks, ingest_batch_size):
-                    end = min(start + ingest_batch_size, total_chunks)
-                    batch_chunks = chunks[start:end]
-                    batch_ids = ids[start:end]
-
-                    batch_embeddings, cache_stats = embedding_service.encode_with_cache(
-                        batch_chunks,
-                        embedding_model,
-                        provider=embedding_provider,
-                        batch_size=embedding_batch_size,
-                        show_progress=False
-                    )
-
-                    batch_metadatas = [
-                        {
-                            'kb_id': kb_id,
-                            'file_id': file_id,
-                            'chunk_index': start + offset,
-                            'text_hash': hashlib.sha1(chunk.encode('utf-8')).hexdigest()
-                        }
-                        for offset, chunk in enumerate(batch_chunks)
-                    ]
-
-                    vector_store.add_vectors(
-                        collection_name=collection_name,
-                        ids=batch_ids,
-                        embeddings=batch_embeddings,
-                        documents=batch_chunks,
-                        metadatas=batch_metadatas
-                    )
-                    inserted_vector_ids.extend(batch_ids)
-
-                    mysql_rows = [
-                        (kb_id, file_id, start + offset, chunk, batch_ids[offset])
-                        for offset, chunk in enumerate(batch_chunks)
-                    ]
-                    cursor.executemany(
-                        """INSERT INTO text_chunks (kb_id, file_id, chunk_index, content, vector_id)
-                           VALUES (%s, %s, %s, %s, %s)""",
-                        mysql_rows
-                    )
-
-                    processed = end
-                    progress_ratio = processed / total_chunks
-                    progress_value = 50 + int(30 * progress_ratio)
-                    await ws_manager.send_progress(
-                        client_id,
-                        kb_id,
-                        "embedding",
-                        progress_value,
-                        (
-                            f"向量化进度 {processed}/{total_chunks} "
-                            f"(cache_hit={cache_stats.get('cache_hit', 0)}, "
-                            f"hit_rate={cache_stats.get('hit_rate', 0)})"
-                        )
-                    )
-            except Exception:
-                # MySQL写入失败后，补偿删除本次已写入的向量，避免跨存储不一致
-                if inserted_vector_ids:
-                    try:
-                        vector_store.delete_by_ids(collection_name=collection_name, ids=inserted_vector_ids)
-                    except Exception as rollback_error:
-                        logger.error(
-                            "向量补偿删除失败: kb_id=%s, file_id=%s, vector_count=%s, error=%s",
-                            kb_id,
-                            file_id,
-                            len(inserted_vector_ids),
-                            str(rollback_error),
-                        )
-                raise
-            finally:
-                cursor.close()
+        await get_ingestion_service().embed_and_store(
+            kb_id=kb_id,
+            file_id=file_id,
+            chunks=chunks,
+            ids=ids,
+            chunk_hashes=chunk_hashes,
+            embedding_service=embedding_service,
+            vector_store=vector_store,
+            embedding_model=embedding_model,
+            embedding_provider=embedding_provider,
+            progress_callback=_embedding_progress
+        )
 
         await ws_manager.send_progress(
             client_id, kb_id, "storing", 80, "向量与文本块存储完成"
@@ -447,7 +402,6 @@ async def process_file_background(
 async def upload_file(
     kb_id: int,
     client_id: str,
-    background_tasks: BackgroundTasks,
     file: UploadFile = FastAPIFile(...),
     kb_service: KnowledgeBaseService = Depends(get_kb_service),
     file_service: FileService = Depends(get_file_service),
@@ -463,6 +417,11 @@ async def upload_file(
         
         # 验证文件扩展名
         file_type = validate_file_extension(file.filename)
+
+        # 入库队列已满时直接拒绝，避免先落盘再排队失败
+        ingestion_service = get_ingestion_service()
+        if ingestion_service.is_full():
+            raise HTTPException(status_code=429, detail="文件处理队列繁忙，请稍后重试")
         
         # 保存文件
         file_obj = await file_service.save_file(
@@ -495,19 +454,27 @@ async def upload_file(
                 status=file_obj.status
             )
         
-        # 添加后台任务处理文件
-        background_tasks.add_task(
-            process_file_background,
-            file_obj.id,
-            kb_id,
-            client_id,
-            file_service,
-            embedding_service,
-            vector_store,
-            kb_service,
-            kb.embedding_model,
-            kb.embedding_provider
-        )
+        # 提交到入库队列（线程池流水线处理，受按库并发与队列上限约束）
+        try:
+            await ingestion_service.submit(
+                kb_id,
+                functools.partial(
+                    process_file_background,
+                    file_obj.id,
+                    kb_id,
+                    client_id,
+                    file_service,
+                    embedding_service,
+                    vector_store,
+                    kb_service,
+                    kb.embedding_model,
+                    kb.embedding_provider
+                ),
+                job_name=f"file_{file_obj.id}"
+            )
+        except IngestionQueueFullError as e:
+            await file_service.update_file_status(file_obj.id, 'error', str(e))
+            raise HTTPException(status_code=429, detail=str(e))
         
         return FileUploadResponse(
             id=file_obj.id,
@@ -641,6 +608,13 @@ async def delete_file(
             )
         except Exception as e:
             logger.warning(f"删除text_chunks记录时出错: {str(e)}")
+
+        # 同步移除BM25关键词索引中的文本块
+        if settings.hybrid_retrieval.keyword_index_enabled:
+            try:
+                await asyncio.to_thread(get_keyword_index_service().remove_file, kb_id, file_id)
+            except Exception as e:
+                logger.warning(f"移除关键词索引时出错: {str(e)}")
         
         # 删除文件记录和磁盘文件
         success = await file_service.delete_file(file_id)
@@ -721,7 +695,8 @@ async def search_knowledge_base(
             kb_id=kb_id,
             query=request.query,
             top_k=request.top_k or 5,
-            score_threshold=request.score_threshold or 0.0
+            score_threshold=request.score_threshold or 0.0,
+            search_ef=request.search_ef
         )
         
         # 获取知识库信息
@@ -745,6 +720,12 @@ async def search_knowledge_base(
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@router.get("/ingestion/stats")
+async def get_ingestion_stats():
+    """获取文件入库队列状态"""
+    return get_ingestion_service().get_stats()
+
+
 @router.get("/embedding/models")
 async def list_embedding_models(
     provider: Optional[str] = Query(None, description="过滤特定provider的模型: transformers, ollama"),
@@ -851,3 +832,33 @@ async def cleanup_graph_facts(
     except Exception as e:
         logger.error(f"清理Fact节点失败: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/{kb_id}/keyword-index")
+async def get_keyword_index_stats(kb_id: int):
+    """获取知识库BM25关键词索引状态"""
+    try:
+        return await asyncio.to_thread(get_keyword_index_service().get_stats, kb_id)
+    except Exception as e:
+        logger.error(f"获取关键词索引状态失败: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.post("/{kb_id}/keyword-index/rebuild", response_model=MessageResponse)
+async def rebuild_keyword_index(
+    kb_id: int,
+    kb_service: KnowledgeBaseService = Depends(get_kb_service)
+):
+    """从text_chunks全量重建BM25关键词索引"""
+    try:
+        kb = await kb_service.get_knowledge_base(kb_id)
+        if not kb:
+            raise HTTPException(status_code=404, detail="知识库不存在")
+
+        total = await asyncio.to_thread(get_keyword_index_service().rebuild, kb_id)
+        return MessageResponse(message=f"关键词索引重建完成，共 {total} 个文本块")
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"重建关键词索引失败: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
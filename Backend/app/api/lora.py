@@ -103,6 +103,10 @@ async def delete_lora_model(
         if not result["success"]:
             raise HTTPException(status_code=404, detail=result["message"])
         
+        # 从已加载的基座模型上卸载该 Adapter（基座模型保持常驻）
+        from app.services.infrastructure.lora.lora_inference_service import get_lora_inference_service
+        await get_lora_inference_service().unload_lora_model(lora_id)
+        
         return LoRAMessageResponse(
             message=result["message"],
             success=True
@@ -115,6 +119,20 @@ async def delete_lora_model(
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@router.get("/serving-stats")
+async def get_lora_serving_stats():
+    """获取 LoRA 推理状态（已加载的基座模型、各 Adapter 占用与调度器指标）"""
+    try:
+        from app.services.infrastructure.lora.lora_inference_service import get_lora_inference_service
+        return {
+            "success": True,
+            "stats": get_lora_inference_service().get_stats()
+        }
+    except Exception as e:
+        logger.error(f"获取 LoRA 推理状态失败: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 @router.get("/base-models", response_model=BaseModelListResponse)
 async def list_base_models():
     """
@@ -486,3 +486,151 @@ async def get_model_statistics(db: DatabaseManager = Depends(get_database)):
     except Exception as e:
         logger.error(f"获取统计信息失败: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/embedding-cache")
+async def get_embedding_cache_stats():
+    """获取嵌入向量缓存命中率（内存 + 持久化）"""
+    try:
+        from app.services.infrastructure.embedding.embedding_service import get_embedding_service
+        stats = await asyncio.to_thread(get_embedding_service().get_cache_stats)
+        return {
+            "success": True,
+            "cache": stats
+        }
+    except Exception as e:
+        logger.error(f"获取嵌入缓存指标失败: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/semantic-cache")
+async def get_semantic_cache_stats():
+    """获取对话语义缓存（检索结果 / 回答）命中率"""
+    try:
+        from app.services.core.semantic_cache import get_semantic_cache
+        return {
+            "success": True,
+            "cache": get_semantic_cache().get_stats()
+        }
+    except Exception as e:
+        logger.error(f"获取语义缓存指标失败: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/metadata-cache")
+async def get_metadata_cache_stats():
+    """获取检索热路径元数据缓存（集合句柄 / 知识库记录）命中率"""
+    try:
+        from app.services.infrastructure.retrieval.metadata_registry import get_metadata_registry
+        return {
+            "success": True,
+            "cache": get_metadata_registry().get_stats()
+        }
+    except Exception as e:
+        logger.error(f"获取元数据缓存指标失败: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/reranker")
+async def get_reranker_stats():
+    """获取交叉编码重排服务的批处理、缓存与提前退出统计"""
+    try:
+        from app.services.infrastructure.retrieval.reranker_service import get_reranker_service
+        return {
+            "success": True,
+            "reranker": get_reranker_service().get_stats()
+        }
+    except Exception as e:
+        logger.error(f"获取重排服务指标失败: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/telemetry")
+async def get_telemetry_stats():
+    """获取分阶段延迟分位数（p50/p95/p99）与遥测缓冲写入统计"""
+    try:
+        from app.services.infrastructure.telemetry.telemetry_sink import get_telemetry_sink
+        sink = get_telemetry_sink()
+        return {
+            "success": True,
+            "latency": sink.get_histograms(),
+            "sink": sink.get_stats()
+        }
+    except Exception as e:
+        logger.error(f"获取遥测指标失败: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/ollama-metrics")
+async def get_ollama_metrics(recent: int = 10):
+    """获取Ollama请求耗时与流式首token延迟（TTFT）统计"""
+    try:
+        from app.services.infrastructure.llm.ollama_llm_service import get_ollama_llm_service
+        return {
+            "success": True,
+            "metrics": get_ollama_llm_service().get_metrics(recent=recent)
+        }
+    except Exception as e:
+        logger.error(f"获取Ollama请求指标失败: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/generation-scheduler")
+async def get_generation_scheduler_stats():
+    """获取本地模型生成调度器状态（排队深度、平均批大小、tokens/s、排队等待与首token延迟）"""
+    try:
+        from app.services.infrastructure.llm.transformers_service import get_transformers_service
+        return {
+            "success": True,
+            "scheduler": get_transformers_service().get_scheduler_stats()
+        }
+    except Exception as e:
+        logger.error(f"获取生成调度器状态失败: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.delete("/semantic-cache")
+async def clear_semantic_cache():
+    """清空对话语义缓存"""
+    try:
+        from app.services.core.semantic_cache import get_semantic_cache
+        get_semantic_cache().clear()
+        return {"success": True}
+    except Exception as e:
+        logger.error(f"清空语义缓存失败: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+# ==================== 常驻模型API ====================
+
+@router.get("/resident")
+async def get_resident_models():
+    """获取当前常驻内存的模型及其内存占用"""
+    try:
+        from app.services.infrastructure.model.residency_manager import get_model_residency_manager
+        return {
+            "success": True,
+            "residency": get_model_residency_manager().get_stats()
+        }
+    except Exception as e:
+        logger.error(f"获取常驻模型失败: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.delete("/resident/{model_key:path}")
+async def evict_resident_model(model_key: str):
+    """手动卸载常驻模型（如 embedding:bge-m3）"""
+    try:
+        from app.services.infrastructure.model.residency_manager import get_model_residency_manager
+        evicted = await asyncio.to_thread(get_model_residency_manager().evict, model_key)
+        if not evicted:
+            raise HTTPException(status_code=404, detail=f"模型未常驻或正在使用: {model_key}")
+        return {
+            "success": True,
+            "message": f"已卸载模型: {model_key}"
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"卸载常驻模型失败: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
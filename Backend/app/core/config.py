@@ -2,7 +2,7 @@
 import os
 import yaml
 from pathlib import Path
-from typing import List, Dict
+from typing import Any, List, Dict
 from pydantic import BaseModel
 from pydantic_settings import BaseSettings
 from dotenv import load_dotenv
@@ -82,11 +82,29 @@ class TextProcessingConfig(BaseModel):
     semantic_split: SemanticSplitConfig = SemanticSplitConfig()
 
 
+class IngestionConfig(BaseModel):
+    """文件入库流水线配置"""
+    max_concurrent_jobs: int = 2  # 同时处理的文件数
+    per_kb_concurrency: int = 1  # 单个知识库同时处理的文件数
+    max_queue_size: int = 32  # 等待队列上限，超出后拒绝上传
+    executor_workers: int = 4  # 向量化/写入线程数
+    pipeline_depth: int = 2  # 已编码待写入的批次数上限
+    batch_multiplier: int = 4  # 入库批次 = embedding.batch_size * multiplier
+    max_batch_size: int = 256
+
+
 class VectorDBConfig(BaseModel):
     """向量数据库配置"""
     type: str = "chroma"
     persist_dir: str = str(BASE_DIR / "data" / "vector_db")
     collection_name_prefix: str = "kb_"
+    # HNSW 索引档位：建知识库时选择并写入集合元数据（已有集合不受影响，修改需离线重建）
+    default_index_profile: str = "balanced"
+    index_profiles: Dict[str, Dict[str, Any]] = {
+        "fast": {"space": "cosine", "m": 12, "construction_ef": 64, "search_ef": 64},
+        "balanced": {"space": "cosine", "m": 16, "construction_ef": 128, "search_ef": 96},
+        "high_recall": {"space": "cosine", "m": 32, "construction_ef": 256, "search_ef": 256},
+    }
 
 
 class EmbeddingConfig(BaseModel):
@@ -98,17 +116,31 @@ class EmbeddingConfig(BaseModel):
     max_length: int = 512
     vector_cache_size: int = 5000
     enable_e5_prefix: bool = True
+    disk_cache_enabled: bool = True  # 持久化向量缓存（跨重启/跨进程共享）
+    disk_cache_file: str = str(BASE_DIR / "data" / "cache" / "embedding_cache.sqlite3")
+    disk_cache_max_size_mb: int = 2048
     ollama: dict = {
         "base_url": "http://localhost:11434",
         "timeout": 30,
         "default_model": "nomic-embed-text",
-        "max_workers": 4
+        "max_workers": 4,
+        "batch_enabled": True,  # 使用 /api/embed 多输入批量接口，旧版服务自动回退逐条请求
+        "batch_max_tokens": 8192,  # 单个子批次的估算 token 上限
+        "max_retries": 2  # 子批次失败重试次数
     }
     
     class Config:
         protected_namespaces = ()  # 允许 model_ 开头的字段
 
 
+class ModelResidencyConfig(BaseModel):
+    """模型常驻管理配置（嵌入模型/CrossEncoder/本地LLM）"""
+    memory_budget_mb: int = 8192  # 常驻模型总内存预算，<=0 表示不限
+    min_available_mb: int = 1024  # 系统可用内存低于此值时按 LRU 淘汰，<=0 关闭
+    idle_ttl_seconds: int = 0  # 空闲超过该时长后淘汰，<=0 关闭
+    pinned_models: List[str] = []  # 固定常驻的模型名或键（如 embedding:bge-m3）
+
+
 class LoggingConfig(BaseModel):
     """日志配置"""
     level: str = "INFO"
@@ -137,10 +169,21 @@ class LLMConfig(BaseModel):
     max_tokens: int = 256  # 与config.yaml同步
     transformers_generation_timeout_seconds: int = 480
     transformers_assumed_tokens_per_second: float = 5.0
+    transformers_scheduler_enabled: bool = True  # 连续批处理调度（causal_lm 模型）
+    transformers_max_batch_size: int = 4  # 同时解码的请求数上限
+    transformers_max_queue_depth: int = 32  # 等待队列上限，超出直接拒绝
+    transformers_max_batch_tokens: int = 16384  # 批内 行数×序列长度 上限（KV Cache 显存预算）
+    transformers_prefix_cache_enabled: bool = True  # 复用多轮对话/相同系统提示词的前缀 KV Cache
+    transformers_prefix_cache_max_mb: int = 512  # 前缀 KV Cache 内存池上限(MB)，与模型同设备
+    transformers_prefix_cache_block_size: int = 32  # 前缀按块对齐匹配的 token 数
+    transformers_prefix_cache_min_tokens: int = 64  # 复用前缀的最小长度
     ollama: Dict[str, str | int] = {
         "base_url": "http://localhost:11434",
         "timeout": 120,
-        "default_model": "deepseek-v3.1:671b-cloud"
+        "default_model": "deepseek-v3.1:671b-cloud",
+        "max_connections": 20,  # 共享连接池上限
+        "max_keepalive_connections": 10,
+        "availability_ttl": 30  # 可用性检查结果缓存秒数
     }
 
 
@@ -179,7 +222,8 @@ class EntityExtractionConfig(BaseModel):
     adaptive_concurrency_enabled: bool = True
     target_latency_ms: int = 2500
     timeout_step_seconds: int = 30
-    queue_batch_size: int = 24
+    queue_batch_size: int = 24  # 自适应并发的滑动窗口长度（最近N次抽取调用的延迟/失败，长文本块按层计）
+    stream_import_window: int = 48  # 每累计N个文本块增量导入一次Neo4j（<=0 表示抽取完成后一次性导入）
     min_text_length: int = 50
     max_text_length: int = 9000
     layered_extraction_enabled: bool = True
@@ -236,6 +280,11 @@ class HybridRetrievalConfig(BaseModel):
     enable_by_default: bool = False
     enable_query_normalization: bool = True
     enable_compound_entity_split: bool = True
+    entity_linker_enabled: bool = True  # 查询实体先走知识库实体词典（Aho-Corasick）
+    entity_linker_llm_fallback: bool = True  # 词典未命中时回退 LLM 抽取
+    entity_linker_min_pattern_length: int = 2
+    entity_linker_max_matches: int = 8
+    entity_linker_refresh_seconds: int = 600  # 定期从 Neo4j 全量刷新词典，<=0 表示只增量更新
     graph_min_results: int = 1
     graph_min_quality_score: float = 0.12
     diagnostics_enabled: bool = True
@@ -245,6 +294,10 @@ class HybridRetrievalConfig(BaseModel):
     keyword_min_candidates: int = 60
     keyword_use_fulltext_first: bool = True
     keyword_score_power: float = 1.0
+    keyword_index_enabled: bool = True  # 进程内 BM25 倒排索引（SQLite 持久化），未就绪时回退 MySQL
+    keyword_index_dir: str = str(BASE_DIR / "data" / "keyword_index")
+    keyword_bm25_k1: float = 1.2
+    keyword_bm25_b: float = 0.75
 
     enable_vector_query_rewrite: bool = True
     vector_query_max_variants: int = 3
@@ -284,6 +337,7 @@ class HybridRetrievalConfig(BaseModel):
     multi_kb_dedup_enabled: bool = True
     multi_kb_max_per_kb: int = 4
     multi_kb_max_same_source_ratio: float = 0.8
+    multi_kb_search_timeout: float = 8.0  # 单库混合检索超时(秒)，<=0 表示不限
 
     monitoring_enabled: bool = True
     hybrid_metrics_log_file: str = str(BASE_DIR / "data" / "logs" / "hybrid_retrieval_metrics.jsonl")
@@ -333,19 +387,83 @@ class VectorRetrievalConfig(BaseModel):
     cross_encoder_model: str = "BAAI/bge-reranker-base"
     cross_encoder_top_n: int = 20
     cross_encoder_alpha: float = 0.7
+    cross_encoder_backend: str = "auto"  # auto|torch|int8|onnx（int8/onnx 仅用于 CPU；auto 在 CPU 上使用 int8）
+    cross_encoder_max_chars: int = 1500
+    cross_encoder_max_batch_size: int = 64  # 后台线程合并并发查询后单次前向的最大 pair 数
+    cross_encoder_batch_wait_ms: float = 2.0  # 凑批最长等待时间
+    cross_encoder_cache_size: int = 20000  # (查询, chunk_id) 分数缓存条数，0 关闭
+    cross_encoder_stage_size: int = 8  # 分段打分的每段大小，<=0 一次打完 top_n
+    cross_encoder_early_exit_margin: float = 0.0  # 提前退出容差，0 时结果与全部打分一致
 
     monitoring_enabled: bool = True
     metrics_log_file: str = str(BASE_DIR / "data" / "logs" / "retrieval_metrics.jsonl")
 
 
+class LoRAServingConfig(BaseModel):
+    """LoRA 推理配置（多个 Adapter 共享同一基座模型）"""
+    max_base_models: int = 2  # 同时常驻的基座模型数
+    max_adapters_per_base: int = 8  # 单个基座模型上加载的 Adapter 数，超出按 LRU 单独卸载 Adapter 权重
+    max_batch_size: int = 4  # 不同 Adapter 的请求合并解码的批大小上限
+    max_queue_depth: int = 32
+
+
+class SemanticCacheConfig(BaseModel):
+    """对话语义缓存配置（检索结果 / 回答）"""
+    enabled: bool = True
+    max_entries: int = 1024
+    ttl_seconds: int = 1800  # <=0 表示不过期，仅按 LRU 淘汰
+    semantic_match_enabled: bool = False  # 精确未命中时按查询向量近似匹配，仅作用于检索结果；回答始终精确匹配
+    similarity_threshold: float = 0.95
+    answer_cache_enabled: bool = True  # 关闭后只缓存检索结果
+    replay_chunk_chars: int = 24  # 流式接口回放缓存回答时的分片字数
+
+
+class MetadataCacheConfig(BaseModel):
+    """检索热路径元数据缓存配置（向量集合句柄 / 知识库记录）"""
+    enabled: bool = True
+    max_entries: int = 1024
+    collection_ttl_seconds: int = 300  # 集合句柄由 delete_collection 主动失效，TTL 兜底其他进程删除/重建集合
+    kb_ttl_seconds: int = 30  # 知识库记录由更新/删除主动失效，TTL 限制多 worker 部署下其他进程修改的可见延迟（<=0 不过期）
+
+
+class TelemetryConfig(BaseModel):
+    """遥测配置（检索/混合检索/图谱构建/切分质量指标的缓冲写入与阶段延迟直方图）"""
+    buffered: bool = True  # False 时在请求路径同步追加（旧行为）
+    buffer_size: int = 10000  # 环形缓冲容量，满时丢弃最旧事件
+    flush_interval_seconds: float = 2.0
+    flush_batch_size: int = 500  # 缓冲达到该条数时立即刷盘
+    max_file_mb: float = 50.0  # 单个 JSONL 文件上限，<=0 不按大小轮转
+    backup_count: int = 5  # 轮转保留份数（.1 ~ .N）
+    rotate_interval_hours: float = 24.0  # 按时间轮转间隔，<=0 关闭
+    sample_rates: Dict[str, float] = {  # 各事件流写文件的采样率（直方图不采样）
+        "retrieval": 1.0,
+        "hybrid": 1.0,
+        "graph_build": 1.0,
+        "split_quality": 1.0
+    }
+    histogram_window: int = 2048  # 计算 p50/p95/p99 的最近样本数
+
+
+class TracingConfig(BaseModel):
+    """请求分阶段耗时追踪配置"""
+    enabled: bool = False  # 关闭时各阶段 span 为空操作
+    path_prefixes: List[str] = ["/api/"]  # 需要追踪的请求路径前缀
+    response_header: bool = True  # 响应头返回 X-Trace-Id 与 Server-Timing（流式响应只含首包前完成的阶段）
+    include_diagnostics: bool = True  # 对话响应（含流式 done 事件）附带 trace 阶段明细
+    max_spans_per_trace: int = 256
+    slow_trace_log_ms: float = 0  # 总耗时超过该值时记录阶段明细日志，<=0 关闭
+
+
 class Settings(BaseSettings):
     """全局配置"""
     app: AppConfig = AppConfig()
     database: DatabaseConfig = DatabaseConfig()
     file: FileConfig = FileConfig()
     text_processing: TextProcessingConfig = TextProcessingConfig()
+    ingestion: IngestionConfig = IngestionConfig()
     vector_db: VectorDBConfig = VectorDBConfig()
     embedding: EmbeddingConfig = EmbeddingConfig()
+    model_residency: ModelResidencyConfig = ModelResidencyConfig()
     logging: LoggingConfig = LoggingConfig()
     websocket: WebSocketConfig = WebSocketConfig()
     llm: LLMConfig = LLMConfig()
@@ -353,6 +471,11 @@ class Settings(BaseSettings):
     knowledge_graph: KnowledgeGraphConfig = KnowledgeGraphConfig()
     hybrid_retrieval: HybridRetrievalConfig = HybridRetrievalConfig()
     vector_retrieval: VectorRetrievalConfig = VectorRetrievalConfig()
+    semantic_cache: SemanticCacheConfig = SemanticCacheConfig()
+    metadata_cache: MetadataCacheConfig = MetadataCacheConfig()
+    telemetry: TelemetryConfig = TelemetryConfig()
+    tracing: TracingConfig = TracingConfig()
+    lora_serving: LoRAServingConfig = LoRAServingConfig()
 
     class Config:
         env_file = str(BACKEND_ENV_FILE)
@@ -437,7 +560,7 @@ def load_config() -> Settings:
                         target_key = 'persist_dir'
 
                     # 处理路径配置:将相对路径转换为绝对路径
-                    if target_key in ['local_models_dir', 'upload_dir', 'persist_dir', 'model_dir', 'file', 'log_dir', 'metrics_log_file', 'split_quality_metrics_file', 'extraction_cache_file', 'run_metrics_file', 'hybrid_metrics_log_file']:
+                    if target_key in ['local_models_dir', 'upload_dir', 'persist_dir', 'model_dir', 'file', 'log_dir', 'metrics_log_file', 'split_quality_metrics_file', 'extraction_cache_file', 'run_metrics_file', 'hybrid_metrics_log_file', 'disk_cache_file', 'keyword_index_dir']:
                         if isinstance(v, str) and not Path(v).is_absolute():
                             clean_path = v.replace('../', '')
                             v = str((BASE_DIR / clean_path).resolve())
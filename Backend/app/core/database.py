@@ -1,9 +1,13 @@
 """数据库连接池管理"""
+import asyncio
+import threading
+import time
 import pymysql
 from pymysql.cursors import DictCursor
 from dbutils.pooled_db import PooledDB
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
-from typing import Generator, Optional
+from typing import Any, Callable, Dict, Generator, Optional
 from app.core.config import settings
 from app.utils.logger import get_logger
 
@@ -15,6 +19,23 @@ class DatabaseManager:
     
     def __init__(self):
         self.pool: Optional[PooledDB] = None
+        self.pool_size = max(1, int(settings.database.pool_size or 1))
+        # 执行线程数与连接池上限一致。连接池还被入库线程、关键词索引重建线程共用，
+        # PooledDB(blocking=True) 在连接耗尽时会阻塞调用线程等待归还，
+        # 因此事件循环内不得直接 get_connection/get_cursor，须经 run_sync/execute_* 进入本线程池
+        self._executor = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix="db-worker")
+        self._stats_lock = threading.Lock()
+        self._stats: Dict[str, float] = {
+            "submitted": 0,
+            "completed": 0,
+            "failed": 0,
+            "in_flight": 0,
+            "waiting": 0,
+            "total_wait_ms": 0.0,
+            "max_wait_ms": 0.0,
+            "total_exec_ms": 0.0,
+            "max_exec_ms": 0.0
+        }
         self._initialize_pool()
     
     def _initialize_pool(self):
@@ -24,7 +45,7 @@ class DatabaseManager:
             
             self.pool = PooledDB(
                 creator=pymysql,
-                maxconnections=db_config.pool_size,
+                maxconnections=self.pool_size,
                 mincached=2,
                 maxcached=5,
                 maxshared=3,
@@ -89,9 +110,71 @@ class DatabaseManager:
             finally:
                 cursor.close()
     
+    def _execute_query_sync(self, query: str, params: tuple = None) -> list:
+        with self.get_cursor() as cursor:
+            cursor.execute(query, params or ())
+            return cursor.fetchall()
+
+    def _execute_update_sync(self, query: str, params: tuple = None) -> int:
+        with self.get_cursor() as cursor:
+            return cursor.execute(query, params or ())
+
+    def _execute_insert_sync(self, query: str, params: tuple = None) -> int:
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(query, params or ())
+                return cursor.lastrowid
+            finally:
+                cursor.close()
+
+    async def run_sync(self, func: Callable[..., Any], *args: Any) -> Any:
+        """
+        在数据库线程池中执行同步函数，避免阻塞事件循环
+
+        适用于需要在同一连接内执行多条语句的场景（如 executemany + 事务）。
+
+        Args:
+            func: 同步函数（内部自行通过 get_connection/get_cursor 获取连接）
+            *args: 函数参数
+
+        Returns:
+            函数返回值
+        """
+        submitted_at = time.perf_counter()
+        with self._stats_lock:
+            self._stats["submitted"] += 1
+            self._stats["waiting"] += 1
+
+        def _invoke():
+            started_at = time.perf_counter()
+            wait_ms = (started_at - submitted_at) * 1000
+            with self._stats_lock:
+                self._stats["waiting"] -= 1
+                self._stats["in_flight"] += 1
+                self._stats["total_wait_ms"] += wait_ms
+                self._stats["max_wait_ms"] = max(self._stats["max_wait_ms"], wait_ms)
+
+            failed = False
+            try:
+                return func(*args)
+            except Exception:
+                failed = True
+                raise
+            finally:
+                exec_ms = (time.perf_counter() - started_at) * 1000
+                with self._stats_lock:
+                    self._stats["in_flight"] -= 1
+                    self._stats["failed" if failed else "completed"] += 1
+                    self._stats["total_exec_ms"] += exec_ms
+                    self._stats["max_exec_ms"] = max(self._stats["max_exec_ms"], exec_ms)
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, _invoke)
+
     async def execute_query(self, query: str, params: tuple = None) -> list:
         """
-        执行查询语句（异步包装）
+        执行查询语句（在数据库线程池中执行，不阻塞事件循环）
         
         Args:
             query: SQL查询语句
@@ -100,9 +183,7 @@ class DatabaseManager:
         Returns:
             查询结果列表
         """
-        with self.get_cursor() as cursor:
-            cursor.execute(query, params or ())
-            return cursor.fetchall()
+        return await self.run_sync(self._execute_query_sync, query, params)
     
     async def execute_update(self, query: str, params: tuple = None) -> int:
         """
@@ -115,9 +196,7 @@ class DatabaseManager:
         Returns:
             影响的行数
         """
-        with self.get_cursor() as cursor:
-            affected_rows = cursor.execute(query, params or ())
-            return affected_rows
+        return await self.run_sync(self._execute_update_sync, query, params)
     
     async def execute_insert(self, query: str, params: tuple = None) -> int:
         """
@@ -130,16 +209,36 @@ class DatabaseManager:
         Returns:
             插入记录的ID
         """
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            try:
-                cursor.execute(query, params or ())
-                return cursor.lastrowid
-            finally:
-                cursor.close()
+        return await self.run_sync(self._execute_insert_sync, query, params)
+
+    def get_pool_stats(self) -> Dict[str, Any]:
+        """
+        获取连接池/执行线程池指标
+
+        Returns:
+            池大小、排队数、执行中数量及等待/执行耗时统计
+        """
+        with self._stats_lock:
+            stats = dict(self._stats)
+
+        finished = max(1, int(stats["completed"] + stats["failed"]))
+        started = max(1, int(stats["submitted"] - stats["waiting"]))
+        return {
+            "pool_size": self.pool_size,
+            "in_flight": int(stats["in_flight"]),
+            "waiting": int(stats["waiting"]),
+            "submitted": int(stats["submitted"]),
+            "completed": int(stats["completed"]),
+            "failed": int(stats["failed"]),
+            "avg_wait_ms": round(stats["total_wait_ms"] / started, 3),
+            "max_wait_ms": round(stats["max_wait_ms"], 3),
+            "avg_exec_ms": round(stats["total_exec_ms"] / finished, 3),
+            "max_exec_ms": round(stats["max_exec_ms"], 3)
+        }
     
     def close(self):
         """关闭连接池"""
+        self._executor.shutdown(wait=True)
         if self.pool:
             self.pool.close()
             logger.info("数据库连接池已关闭")
@@ -12,6 +12,7 @@ class KnowledgeBaseCreate(BaseModel):
     embedding_model: str = Field(..., description="嵌入模型")
     embedding_provider: str = Field("transformers", description="嵌入提供方: transformers, ollama")
     description: Optional[str] = Field(None, description="描述", max_length=500)
+    index_profile: Optional[str] = Field(None, description="向量索引档位: fast, balanced, high_recall（为空使用默认档位）")
     
     @validator('name')
     def validate_name(cls, v):
@@ -208,6 +209,7 @@ class SearchRequest(BaseModel):
     query: str = Field(..., min_length=1, max_length=1000, description="查询文本")
     top_k: Optional[int] = Field(5, ge=1, le=20, description="返回结果数量")
     score_threshold: Optional[float] = Field(0.0, ge=0.0, le=1.0, description="相似度阈值")
+    search_ef: Optional[int] = Field(None, ge=1, le=2048, description="单次查询的 HNSW ef（为空使用知识库索引档位的默认值）")
 
 
 class SearchResult(BaseModel):
@@ -4,5 +4,6 @@
 """
 from .agent_service import AgentService
 from .chat_service import ChatService
+from .semantic_cache import SemanticCache, get_semantic_cache
 
-__all__ = ['AgentService', 'ChatService']
+__all__ = ['AgentService', 'ChatService', 'SemanticCache', 'get_semantic_cache']
@@ -1,9 +1,11 @@
 """智能助手对话服务"""
+import asyncio
 import hashlib
 from typing import List, Dict, Any, Optional, AsyncGenerator
 from app.services.domain.knowledge_base.knowledge_base_service import KnowledgeBaseService
 from app.core.database import DatabaseManager
 from app.core.config import settings
+from app.services.infrastructure.telemetry.tracing import span, traced
 from app.utils.logger import get_logger
 
 logger = get_logger(__name__)
@@ -18,6 +20,7 @@ class ChatService:
     
     # ==================== 公共方法 ====================
     
+    @traced("prompt_build")
     def _build_context(self, search_results: List[Dict]) -> str:
         """
         构建LLM上下文
@@ -178,18 +181,16 @@ class ChatService:
         copied.insert(0, {"role": "system", "content": instruction})
         return copied
     
-    async def _release_embedding_memory(self):
-        """释放embedding模型显存"""
+    @traced("memory_relief")
+    async def _relieve_model_memory_pressure(self):
+        """按常驻管理器的预算/TTL淘汰模型，未超预算时保持嵌入模型常驻"""
         try:
-            from app.services.infrastructure.embedding.embedding_service import get_embedding_service
-            embedding_service = get_embedding_service()
-            embedding_service.unload_model()
-            import torch
-            if torch.cuda.is_available():
-                torch.cuda.empty_cache()
-            logger.info("已释放embedding模型显存")
+            from app.services.infrastructure.model.residency_manager import get_model_residency_manager
+            evicted = await asyncio.to_thread(get_model_residency_manager().enforce)
+            if evicted:
+                logger.info(f"内存压力下已淘汰模型: {evicted}")
         except Exception as e:
-            logger.warning(f"释放embedding显存失败: {e}")
+            logger.warning(f"常驻模型淘汰检查失败: {e}")
 
     def _to_json_safe(self, value: Any) -> Any:
         """将复杂对象转换为可JSON序列化结构。"""
@@ -221,6 +222,132 @@ class ChatService:
 
         return str(value)
 
+    # ==================== 语义缓存 ====================
+
+    def _encode_cache_query(self, query: str, kb: Any) -> Optional[Any]:
+        """用知识库的嵌入模型编码查询，供近似问题匹配（复用嵌入缓存）"""
+        from app.services.infrastructure.embedding.embedding_service import get_embedding_service
+        vectors, _ = get_embedding_service().encode_with_cache(
+            [query],
+            model_name=kb.embedding_model,
+            provider=getattr(kb, 'embedding_provider', 'transformers'),
+            text_role='query'
+        )
+        return vectors[0] if len(vectors) else None
+
+    @traced("semantic_cache")
+    async def _open_semantic_cache(
+        self,
+        kb_ids: Optional[List[int]],
+        kb: Any,
+        query: str,
+        top_k: int,
+        use_hybrid_retrieval: bool,
+        generation_params: Dict[str, Any]
+    ) -> Optional[Dict[str, Any]]:
+        """
+        计算本次对话的缓存作用域（检索层 / 回答层）与查询向量
+
+        未启用、纯对话模式或计算失败时返回 None，对话按未命中继续
+        """
+        cache_config = settings.semantic_cache
+        if not cache_config.enabled or not kb_ids:
+            return None
+        try:
+            from app.services.core.semantic_cache import get_semantic_cache
+            cache = get_semantic_cache()
+            version_token = await cache.kb_version_token(self.db, kb_ids)
+            retrieval_params = {
+                'top_k': int(top_k),
+                'method': 'hybrid' if use_hybrid_retrieval else 'vector'
+            }
+            answer_scope = None
+            if cache_config.answer_cache_enabled:
+                answer_scope = cache.make_scope(kb_ids, version_token, {**retrieval_params, **generation_params})
+
+            query_vector = None
+            if cache_config.semantic_match_enabled and kb is not None:
+                try:
+                    query_vector = await asyncio.to_thread(self._encode_cache_query, query, kb)
+                except Exception as e:
+                    logger.warning(f"语义缓存查询向量编码失败，仅使用精确匹配: {e}")
+
+            return {
+                'cache': cache,
+                'kb_ids': list(kb_ids),
+                'query': query,
+                'query_vector': query_vector,
+                'retrieval_scope': cache.make_scope(kb_ids, version_token, retrieval_params),
+                'answer_scope': answer_scope
+            }
+        except Exception as e:
+            logger.warning(f"语义缓存不可用，按未命中处理: {e}")
+            return None
+
+    def _answer_cache_params(
+        self,
+        history_messages: Optional[List[Dict[str, str]]],
+        system_prompt: Optional[str],
+        llm_model: Optional[str],
+        llm_provider: str,
+        lora_model_id: Optional[int],
+        temperature: float,
+        enable_deep_thinking: bool
+    ) -> Dict[str, Any]:
+        """回答层缓存的生成参数：同一问题在不同模型/提示词/历史下不共享回答"""
+        from app.services.core.semantic_cache import hash_payload
+        return {
+            'provider': llm_provider,
+            'model': llm_model,
+            'lora_model_id': lora_model_id,
+            'temperature': temperature,
+            'deep_thinking': bool(enable_deep_thinking),
+            'system_prompt': hash_payload(system_prompt or ''),
+            'history': hash_payload(history_messages or [])
+        }
+
+    def _cache_lookup(self, cache_ctx: Optional[Dict[str, Any]], namespace: str):
+        if not cache_ctx or not cache_ctx.get(f'{namespace}_scope'):
+            return None
+        return cache_ctx['cache'].get(
+            namespace,
+            cache_ctx[f'{namespace}_scope'],
+            cache_ctx['query'],
+            cache_ctx['query_vector']
+        )
+
+    def _cache_store(self, cache_ctx: Optional[Dict[str, Any]], namespace: str, value: Any) -> None:
+        if not cache_ctx or not cache_ctx.get(f'{namespace}_scope'):
+            return
+        try:
+            cache_ctx['cache'].put(
+                namespace,
+                cache_ctx[f'{namespace}_scope'],
+                cache_ctx['query'],
+                value,
+                kb_ids=cache_ctx['kb_ids'],
+                query_vector=cache_ctx['query_vector']
+            )
+        except Exception as e:
+            logger.warning(f"写入语义缓存失败: {e}")
+
+    def _cache_info(self, namespace: Optional[str], hit: Any = None) -> Dict[str, Any]:
+        if hit is None:
+            return {'hit': False}
+        info = {
+            'hit': True,
+            'layer': namespace,
+            'match': hit.match,
+            'age_seconds': round(hit.age_seconds, 1)
+        }
+        if hit.match == 'semantic':
+            info['similarity'] = hit.similarity
+            info['matched_query'] = hit.extra.get('matched_query')
+        return info
+
+    def _is_cacheable_answer(self, answer: Optional[str]) -> bool:
+        return bool(answer and answer.strip()) and not answer.lstrip().startswith('[错误]')
+
     def _build_source_items(self, search_results: List[Dict[str, Any]], limit: int) -> List[Dict[str, Any]]:
         """构建来源列表，并提供稳定的展示权重（display_weight）。"""
         selected = search_results[:max(0, int(limit or 0))]
@@ -358,17 +485,36 @@ class ChatService:
             )
             
             # 1. 如果指定了知识库，进行检索
+            cache_ctx = None
+            retrieval_cache_hit = None
             if kb_ids and len(kb_ids) > 0:
                 # 获取第一个知识库信息
                 kb = await self.kb_service.get_knowledge_base(kb_ids[0])
                 if kb:
                     embedding_model = kb.embedding_model
-                
-                # 判断使用哪种检索方式
-                if use_hybrid_retrieval:
+                retrieval_method = "hybrid" if use_hybrid_retrieval else "vector"
+
+                # 语义缓存：先查回答层，再查检索层
+                cache_ctx = await self._open_semantic_cache(
+                    kb_ids, kb, query, top_k, use_hybrid_retrieval,
+                    self._answer_cache_params(
+                        history_messages, system_prompt, llm_model, llm_provider,
+                        lora_model_id, temperature, enable_deep_thinking
+                    )
+                )
+                answer_hit = self._cache_lookup(cache_ctx, "answer")
+                if answer_hit is not None:
+                    logger.info(f"命中回答缓存: kb_ids={kb_ids}, match={answer_hit.match}, query='{query}'")
+                    return {**answer_hit.value, 'cache': self._cache_info("answer", answer_hit)}
+
+                retrieval_cache_hit = self._cache_lookup(cache_ctx, "retrieval")
+                if retrieval_cache_hit is not None:
+                    logger.info(f"命中检索缓存: kb_ids={kb_ids}, match={retrieval_cache_hit.match}, query='{query}'")
+                    search_results = retrieval_cache_hit.value['results']
+                    retrieval_diagnostics = retrieval_cache_hit.value['diagnostics']
+                elif use_hybrid_retrieval:
                     # 混合检索（向量+图谱）
                     logger.info(f"开始混合检索: kb_ids={kb_ids}, query='{query}'")
-                    retrieval_method = "hybrid"
                     hybrid_payload = await self._hybrid_search(
                         kb_ids=kb_ids,
                         query=query,
@@ -379,7 +525,6 @@ class ChatService:
                 else:
                     # 纯向量检索
                     logger.info(f"开始向量检索: kb_ids={kb_ids}, query='{query}'")
-                    retrieval_method = "vector"
                     search_results = await self.kb_service.search_knowledge_bases(
                         kb_ids=kb_ids,
                         query=query,
@@ -387,9 +532,15 @@ class ChatService:
                         score_threshold=0.2
                     )
 
-                search_results = self._filter_retrieval_results(search_results)
+                if retrieval_cache_hit is None:
+                    search_results = self._filter_retrieval_results(search_results)
+                    self._cache_store(cache_ctx, "retrieval", {
+                        'results': search_results,
+                        'diagnostics': retrieval_diagnostics
+                    })
             else:
                 logger.info(f"纯对话模式: query='{query}'")
+            cache_info = self._cache_info("retrieval", retrieval_cache_hit)
             
             # 2. 如果没有检索到结果但有知识库
             if kb_ids and not search_results:
@@ -400,15 +551,16 @@ class ChatService:
                     'embedding_model': embedding_model,
                     'retrieval_count': 0,
                     'retrieval_method': retrieval_method,
-                    'diagnostics': retrieval_diagnostics
+                    'diagnostics': retrieval_diagnostics,
+                    'cache': cache_info
                 }
             
             # 3. 构建上下文
             context = self._build_context(search_results) if search_results else None
             
-            # 4. 释放embedding模型显存（为LLM腾出空间）
+            # 4. 仅在内存压力下淘汰常驻模型（为LLM腾出空间）
             if search_results:
-                await self._release_embedding_memory()
+                await self._relieve_model_memory_pressure()
             
             # 5. 调用LLM生成回答（传递历史消息和LoRA模型ID）
             answer = await self._generate_answer(
@@ -423,15 +575,18 @@ class ChatService:
                 enable_deep_thinking=enable_deep_thinking
             )
             
-            # 6. 返回结果
+            # 6. 返回结果（并写入回答缓存）
             source_limit = max(1, int(getattr(settings.hybrid_retrieval, 'chat_context_max_results', 10) or 10))
-            return {
+            result = {
                 'answer': answer,
                 'sources': self._build_source_items(search_results, limit=source_limit),
                 'embedding_model': embedding_model,
                 'retrieval_count': len(search_results),
                 'diagnostics': retrieval_diagnostics
             }
+            if self._is_cacheable_answer(answer):
+                self._cache_store(cache_ctx, "answer", result)
+            return {**result, 'cache': cache_info}
             
         except ValueError:
             raise
@@ -496,12 +651,13 @@ class ChatService:
         Returns:
             生成的回答
         """
-        # 构建用户消息
-        user_message = self._build_user_message(query, context, history_messages)
-        
-        # 构建完整消息列表
-        messages = self._build_messages(user_message, history_messages, system_prompt)
-        messages = self._apply_deep_thinking_instruction(messages, llm_provider, enable_deep_thinking)
+        with span("prompt_build"):
+            # 构建用户消息
+            user_message = self._build_user_message(query, context, history_messages)
+
+            # 构建完整消息列表
+            messages = self._build_messages(user_message, history_messages, system_prompt)
+            messages = self._apply_deep_thinking_instruction(messages, llm_provider, enable_deep_thinking)
         
         # 如果指定了LoRA模型，使用LoRA推理服务
         if lora_model_id and llm_provider in ['local', 'transformers']:
@@ -611,11 +767,37 @@ class ChatService:
             )
             
             # 1. 如果指定了知识库，进行RAG检索
+            source_limit = max(1, int(getattr(settings.hybrid_retrieval, 'chat_context_max_results', 10) or 10))
+            cache_ctx = None
+            retrieval_cache_hit = None
             if kb_ids and len(kb_ids) > 0:
                 logger.info(f"开始多知识库RAG对话（流式）: kb_ids={kb_ids}, query='{query}', hybrid={use_hybrid_retrieval}")
                 
-                # 判断使用哪种检索方式
-                if use_hybrid_retrieval:
+                kb = await self.kb_service.get_knowledge_base(kb_ids[0])
+                if kb:
+                    embedding_model = kb.embedding_model
+
+                # 语义缓存：命中回答层时按原事件顺序回放（sources -> text -> done）
+                cache_ctx = await self._open_semantic_cache(
+                    kb_ids, kb, query, top_k, use_hybrid_retrieval,
+                    self._answer_cache_params(
+                        history_messages, system_prompt, llm_model, llm_provider,
+                        lora_model_id, temperature, enable_deep_thinking
+                    )
+                )
+                answer_hit = self._cache_lookup(cache_ctx, "answer")
+                if answer_hit is not None:
+                    logger.info(f"命中回答缓存（流式回放）: kb_ids={kb_ids}, match={answer_hit.match}, query='{query}'")
+                    async for event in self._replay_cached_answer(answer_hit):
+                        yield event
+                    return
+
+                retrieval_cache_hit = self._cache_lookup(cache_ctx, "retrieval")
+                if retrieval_cache_hit is not None:
+                    logger.info(f"命中检索缓存（流式）: kb_ids={kb_ids}, match={retrieval_cache_hit.match}, query='{query}'")
+                    search_results = retrieval_cache_hit.value['results']
+                    retrieval_diagnostics = retrieval_cache_hit.value['diagnostics']
+                elif use_hybrid_retrieval:
                     # 混合检索（向量+图谱）
                     hybrid_payload = await self._hybrid_search(
                         kb_ids=kb_ids,
@@ -633,17 +815,18 @@ class ChatService:
                         score_threshold=0.2
                     )
 
-                search_results = self._filter_retrieval_results(search_results)
-                
-                kb = await self.kb_service.get_knowledge_base(kb_ids[0])
-                if kb:
-                    embedding_model = kb.embedding_model
+                if retrieval_cache_hit is None:
+                    search_results = self._filter_retrieval_results(search_results)
+                    self._cache_store(cache_ctx, "retrieval", {
+                        'results': search_results,
+                        'diagnostics': retrieval_diagnostics
+                    })
             else:
                 logger.info(f"纯对话模式（流式）: query='{query}'")
             
             # 2. 发送检索结果（如果有）
+            sources = []
             if search_results:
-                source_limit = max(1, int(getattr(settings.hybrid_retrieval, 'chat_context_max_results', 10) or 10))
                 sources = self._build_source_items(search_results, limit=source_limit)
                 yield {
                     "type": "sources",
@@ -658,11 +841,13 @@ class ChatService:
             # 3. 构建上下文
             context = self._build_context(search_results) if search_results else None
             
-            # 4. 释放embedding模型显存
+            # 4. 仅在内存压力下淘汰常驻模型
             if search_results:
-                await self._release_embedding_memory()
+                await self._relieve_model_memory_pressure()
             
             # 5. 流式调用LLM生成回答（传递历史消息和LoRA模型ID）
+            answer_parts: List[str] = []
+            answer_failed = False
             async for text_chunk in self._generate_answer_stream(
                 query=query,
                 context=context,
@@ -674,15 +859,27 @@ class ChatService:
                 temperature=temperature,
                 enable_deep_thinking=enable_deep_thinking
             ):
+                if text_chunk.startswith("[错误]"):
+                    answer_failed = True
+                answer_parts.append(text_chunk)
                 yield {
                     "type": "text",
                     "data": text_chunk
                 }
             
-            # 6. 发送完成信号
+            # 6. 完整生成后写入回答缓存，再发送完成信号
+            answer = "".join(answer_parts)
+            if search_results and not answer_failed and self._is_cacheable_answer(answer):
+                self._cache_store(cache_ctx, "answer", {
+                    'answer': answer,
+                    'sources': sources,
+                    'embedding_model': embedding_model,
+                    'retrieval_count': len(search_results),
+                    'diagnostics': retrieval_diagnostics
+                })
             yield {
                 "type": "done",
-                "data": {}
+                "data": {"cache": self._cache_info("retrieval", retrieval_cache_hit)}
             }
             
         except Exception as e:
@@ -692,6 +889,34 @@ class ChatService:
                 "data": {"error": str(e)}
             }
     
+    async def _replay_cached_answer(self, hit: Any):
+        """按流式事件格式回放缓存回答，前端无需区分是否命中缓存"""
+        cached = hit.value
+        if cached.get('sources'):
+            yield {
+                "type": "sources",
+                "data": {
+                    "sources": cached.get('sources', []),
+                    "retrieval_count": cached.get('retrieval_count', 0),
+                    "embedding_model": cached.get('embedding_model'),
+                    "diagnostics": cached.get('diagnostics')
+                }
+            }
+
+        answer = cached.get('answer') or ''
+        step = max(1, int(settings.semantic_cache.replay_chunk_chars or 1))
+        for offset in range(0, len(answer), step):
+            yield {
+                "type": "text",
+                "data": answer[offset:offset + step]
+            }
+            await asyncio.sleep(0)
+
+        yield {
+            "type": "done",
+            "data": {"cache": self._cache_info("answer", hit)}
+        }
+    
     async def _generate_answer_stream(
         self,
         query: str,
@@ -710,12 +935,13 @@ class ChatService:
         Yields:
             str: 生成的文本片段
         """
-        # 构建用户消息（复用公共方法）
-        user_message = self._build_user_message(query, context, history_messages)
-        
-        # 构建完整消息列表（复用公共方法）
-        messages = self._build_messages(user_message, history_messages, system_prompt)
-        messages = self._apply_deep_thinking_instruction(messages, llm_provider, enable_deep_thinking)
+        with span("prompt_build"):
+            # 构建用户消息（复用公共方法）
+            user_message = self._build_user_message(query, context, history_messages)
+
+            # 构建完整消息列表（复用公共方法）
+            messages = self._build_messages(user_message, history_messages, system_prompt)
+            messages = self._apply_deep_thinking_instruction(messages, llm_provider, enable_deep_thinking)
         
         # 如果指定了LoRA模型，使用LoRA推理服务（流式暂不支持，回退到非流式）
         if lora_model_id and llm_provider in ['local', 'transformers']:
@@ -782,6 +1008,7 @@ class ChatService:
     
     # ==================== 混合检索方法 ====================
     
+    @traced("hybrid_retrieval")
     async def _hybrid_search(
         self,
         kb_ids: List[int],
@@ -823,17 +1050,35 @@ class ChatService:
             
             hybrid_service = get_hybrid_retrieval_service()
             
-            # 如果有多个知识库，对每个库分别检索后合并
-            all_results = []
-            all_diagnostics = []
-            
-            for kb_id in kb_ids:
-                payload = await hybrid_service.hybrid_search(
+            # 多个知识库并发检索，单库超时/失败时丢弃该库，其余结果照常合并
+            timeout = float(getattr(settings.hybrid_retrieval, 'multi_kb_search_timeout', 0) or 0)
+
+            async def _search_one(kb_id: int) -> Dict[str, Any]:
+                search = hybrid_service.hybrid_search(
                     kb_id=kb_id,
                     query=query,
                     top_k=top_k,
                     enable_graph=True
                 )
+                if timeout > 0:
+                    return await asyncio.wait_for(search, timeout=timeout)
+                return await search
+
+            payloads = await asyncio.gather(
+                *[_search_one(kb_id) for kb_id in kb_ids],
+                return_exceptions=True
+            )
+
+            all_results = []
+            all_diagnostics = []
+            dropped_kbs = []
+
+            for kb_id, payload in zip(kb_ids, payloads):
+                if isinstance(payload, BaseException):
+                    reason = 'timeout' if isinstance(payload, asyncio.TimeoutError) else str(payload)
+                    logger.warning(f"知识库 {kb_id} 混合检索未完成，已跳过: {reason}")
+                    dropped_kbs.append({'kb_id': kb_id, 'reason': reason})
+                    continue
                 results = payload.get('results', [])
                 diagnostics = payload.get('diagnostics', {})
                 all_results.extend(results)
@@ -842,6 +1087,9 @@ class ChatService:
                     **diagnostics
                 })
 
+            if len(dropped_kbs) == len(kb_ids):
+                raise RuntimeError(f"所有知识库混合检索均未完成: {dropped_kbs}")
+
             # 跨知识库去重与多样性控制
             if len(kb_ids) > 1 and getattr(settings.hybrid_retrieval, 'multi_kb_dedup_enabled', True):
                 all_results.sort(key=lambda x: x.get('final_score', x.get('score', 0)), reverse=True)
@@ -914,7 +1162,8 @@ class ChatService:
                 'results': formatted_results,
                 'diagnostics': {
                     'query': query,
-                    'kb_diagnostics': all_diagnostics
+                    'kb_diagnostics': all_diagnostics,
+                    'dropped_kbs': dropped_kbs
                 }
             }
             
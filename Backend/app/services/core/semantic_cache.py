@@ -0,0 +1,285 @@
+"""对话语义缓存：检索结果 / 回答缓存（TTL + LRU + 近似查询匹配）"""
+import hashlib
+import json
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, Optional, Tuple
+import numpy as np
+from app.core.config import settings
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+# 全局单例实例
+_semantic_cache_instance = None
+
+NAMESPACE_RETRIEVAL = "retrieval"
+NAMESPACE_ANSWER = "answer"
+# 允许近似匹配的命名空间
+SEMANTIC_NAMESPACES = (NAMESPACE_RETRIEVAL,)
+
+
+def normalize_cache_query(query: str) -> str:
+    """查询归一化：NFKC + 小写 + 折叠空白 + 去除首尾标点"""
+    text = unicodedata.normalize("NFKC", str(query or "")).lower()
+    text = re.sub(r"\s+", " ", text).strip()
+    return text.strip(" ?？!！.。,，;；~～")
+
+
+def hash_payload(value: Any) -> str:
+    """对任意可 JSON 序列化的参数求稳定摘要"""
+    raw = json.dumps(value, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def _unit_vector(vector: Any) -> Optional[np.ndarray]:
+    if vector is None:
+        return None
+    array = np.asarray(vector, dtype=np.float32).reshape(-1)
+    norm = float(np.linalg.norm(array))
+    return array / norm if norm > 0 else None
+
+
+@dataclass
+class _CacheEntry:
+    namespace: str
+    scope: str
+    query: str
+    value: Any
+    kb_ids: Tuple[int, ...]
+    created_at: float
+    vector: Optional[np.ndarray] = None
+    hits: int = 0
+
+
+@dataclass
+class CacheHit:
+    value: Any
+    match: str
+    similarity: float = 1.0
+    age_seconds: float = 0.0
+    extra: Dict[str, Any] = field(default_factory=dict)
+
+
+class SemanticCache:
+    """
+    对话语义缓存
+
+    - 键: (命名空间, 作用域, 归一化查询)；作用域由知识库ID + 内容版本 + 检索/生成参数摘要构成
+    - 内容版本 = 进程内版本号 + knowledge_bases 的 file_count/chunk_count/updated_at，
+      文件增删后作用域自然变化，旧条目不再命中并被主动清理
+    - 精确未命中时，可在同一作用域内按查询向量余弦相似度查找近似问题（默认关闭）；
+      近似匹配只用于检索结果，回答层始终要求精确命中——向量相近但语义相反的问题
+      （如“怎么开机”/“怎么关机”）复用检索结果仍会重新生成回答，复用回答则会答非所问
+    - TTL 过期 + LRU 淘汰，命中/未命中按命名空间计数
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        ttl_seconds: float = 1800,
+        semantic_match_enabled: bool = False,
+        similarity_threshold: float = 0.95
+    ):
+        self.max_entries = max(1, int(max_entries))
+        self.ttl_seconds = float(ttl_seconds or 0)
+        self.semantic_match_enabled = bool(semantic_match_enabled)
+        self.similarity_threshold = float(similarity_threshold)
+        self._entries: "OrderedDict[Tuple[str, str, str], _CacheEntry]" = OrderedDict()
+        self._kb_versions: Dict[int, int] = {}
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Dict[str, int]] = {}
+
+    # ==================== 版本与作用域 ====================
+
+    async def kb_version_token(self, db, kb_ids: Iterable[int]) -> str:
+        """读取知识库内容版本（多 worker 之间通过 MySQL 统计字段对齐）"""
+        ids = sorted({int(kb_id) for kb_id in kb_ids or []})
+        if not ids:
+            return ""
+        placeholders = ",".join(["%s"] * len(ids))
+        rows = await db.execute_query(
+            f"SELECT id, file_count, chunk_count, updated_at FROM knowledge_bases WHERE id IN ({placeholders})",
+            tuple(ids)
+        )
+        by_id = {int(row["id"]): row for row in rows or []}
+        with self._lock:
+            local_versions = {kb_id: self._kb_versions.get(kb_id, 0) for kb_id in ids}
+        parts = []
+        for kb_id in ids:
+            row = by_id.get(kb_id) or {}
+            parts.append(
+                f"{kb_id}:{local_versions[kb_id]}:{row.get('file_count')}:{row.get('chunk_count')}:{row.get('updated_at')}"
+            )
+        return "|".join(parts)
+
+    def make_scope(self, kb_ids: Iterable[int], version_token: str, params: Dict[str, Any]) -> str:
+        return hash_payload({
+            "kb_ids": sorted({int(kb_id) for kb_id in kb_ids or []}),
+            "version": version_token,
+            "params": params
+        })
+
+    # ==================== 读写 ====================
+
+    def _record(self, namespace: str, name: str) -> None:
+        bucket = self._stats.setdefault(namespace, {"hits": 0, "semantic_hits": 0, "misses": 0, "stores": 0, "evictions": 0})
+        bucket[name] = bucket.get(name, 0) + 1
+
+    def _is_expired(self, entry: _CacheEntry, now: float) -> bool:
+        return self.ttl_seconds > 0 and now - entry.created_at > self.ttl_seconds
+
+    def get(
+        self,
+        namespace: str,
+        scope: str,
+        query: str,
+        query_vector: Optional[np.ndarray] = None
+    ) -> Optional[CacheHit]:
+        """精确匹配；未命中且提供了查询向量时，在同一作用域内做近似匹配（仅检索结果命名空间）"""
+        key = (namespace, scope, normalize_cache_query(query))
+        query_vector = _unit_vector(query_vector)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._is_expired(entry, now):
+                self._entries.pop(key, None)
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                entry.hits += 1
+                self._record(namespace, "hits")
+                return CacheHit(value=entry.value, match="exact", age_seconds=now - entry.created_at)
+
+            if query_vector is not None and self.semantic_match_enabled and namespace in SEMANTIC_NAMESPACES:
+                hit = self._get_similar_locked(namespace, scope, query_vector, now)
+                if hit is not None:
+                    self._record(namespace, "semantic_hits")
+                    return hit
+
+            self._record(namespace, "misses")
+            return None
+
+    def _get_similar_locked(
+        self,
+        namespace: str,
+        scope: str,
+        query_vector: np.ndarray,
+        now: float
+    ) -> Optional[CacheHit]:
+        candidates = [
+            (key, entry)
+            for key, entry in self._entries.items()
+            if entry.namespace == namespace
+            and entry.scope == scope
+            and entry.vector is not None
+            and entry.vector.shape == query_vector.shape
+            and not self._is_expired(entry, now)
+        ]
+        if not candidates:
+            return None
+
+        matrix = np.stack([entry.vector for _, entry in candidates])
+        similarities = matrix @ query_vector
+        best = int(np.argmax(similarities))
+        best_similarity = float(similarities[best])
+        if best_similarity < self.similarity_threshold:
+            return None
+
+        key, entry = candidates[best]
+        self._entries.move_to_end(key)
+        entry.hits += 1
+        return CacheHit(
+            value=entry.value,
+            match="semantic",
+            similarity=round(best_similarity, 4),
+            age_seconds=now - entry.created_at,
+            extra={"matched_query": entry.query}
+        )
+
+    def put(
+        self,
+        namespace: str,
+        scope: str,
+        query: str,
+        value: Any,
+        kb_ids: Iterable[int] = (),
+        query_vector: Optional[np.ndarray] = None
+    ) -> None:
+        normalized_query = normalize_cache_query(query)
+        key = (namespace, scope, normalized_query)
+        vector = _unit_vector(query_vector) if namespace in SEMANTIC_NAMESPACES else None
+
+        with self._lock:
+            self._entries[key] = _CacheEntry(
+                namespace=namespace,
+                scope=scope,
+                query=normalized_query,
+                value=value,
+                kb_ids=tuple(sorted({int(kb_id) for kb_id in kb_ids or []})),
+                created_at=time.time(),
+                vector=vector
+            )
+            self._entries.move_to_end(key)
+            self._record(namespace, "stores")
+            while len(self._entries) > self.max_entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._record(evicted.namespace, "evictions")
+
+    # ==================== 失效 ====================
+
+    def invalidate_kb(self, kb_id: int) -> int:
+        """知识库内容变化：递增版本号并清理涉及该知识库的条目"""
+        kb_id = int(kb_id)
+        with self._lock:
+            self._kb_versions[kb_id] = self._kb_versions.get(kb_id, 0) + 1
+            stale_keys = [key for key, entry in self._entries.items() if kb_id in entry.kb_ids]
+            for key in stale_keys:
+                self._entries.pop(key, None)
+        if stale_keys:
+            logger.info(f"语义缓存失效: kb_id={kb_id}, removed={len(stale_keys)}")
+        return len(stale_keys)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            namespaces: Dict[str, Dict[str, Any]] = {}
+            for namespace, bucket in self._stats.items():
+                stats = dict(bucket)
+                lookups = stats.get("hits", 0) + stats.get("semantic_hits", 0) + stats.get("misses", 0)
+                stats["hit_rate"] = round((stats.get("hits", 0) + stats.get("semantic_hits", 0)) / lookups, 4) if lookups else 0.0
+                namespaces[namespace] = stats
+            size_by_namespace: Dict[str, int] = {}
+            for entry in self._entries.values():
+                size_by_namespace[entry.namespace] = size_by_namespace.get(entry.namespace, 0) + 1
+        for namespace, size in size_by_namespace.items():
+            namespaces.setdefault(namespace, {})["size"] = size
+        return {
+            "entries": sum(size_by_namespace.values()),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "semantic_match_enabled": self.semantic_match_enabled,
+            "similarity_threshold": self.similarity_threshold,
+            "namespaces": namespaces
+        }
+
+
+def get_semantic_cache() -> SemanticCache:
+    """获取语义缓存单例"""
+    global _semantic_cache_instance
+    if _semantic_cache_instance is None:
+        config = settings.semantic_cache
+        _semantic_cache_instance = SemanticCache(
+            max_entries=config.max_entries,
+            ttl_seconds=config.ttl_seconds,
+            semantic_match_enabled=config.semantic_match_enabled,
+            similarity_threshold=config.similarity_threshold
+        )
+    return _semantic_cache_instance
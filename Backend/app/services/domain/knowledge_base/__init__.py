@@ -2,9 +2,11 @@
 from app.services.domain.knowledge_base.knowledge_base_service import KnowledgeBaseService
 from app.services.domain.knowledge_base.file_service import FileService
 from app.services.domain.knowledge_base.metadata_service import MetadataService
+from app.services.domain.knowledge_base.ingestion_service import IngestionService, get_ingestion_service
 
 __all__ = [
     'KnowledgeBaseService',
     'FileService',
     'MetadataService',
+    'IngestionService', 'get_ingestion_service',
 ]
@@ -1,4 +1,5 @@
 """文件服务"""
+import asyncio
 import os
 import hashlib
 from typing import List, Optional, BinaryIO
@@ -117,8 +118,8 @@ class FileService:
             # 获取解析器
             parser = get_file_parser(file_obj.file_type)
             
-            # 解析文件
-            content = parser.parse(file_obj.storage_path)
+            # 解析文件（PDF/DOCX 解析较重，放到线程中执行）
+            content = await asyncio.to_thread(parser.parse, file_obj.storage_path)
 
             if not content or not str(content).strip():
                 raise ValueError(
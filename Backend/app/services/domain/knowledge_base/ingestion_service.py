@@ -0,0 +1,389 @@
+"""文件入库流水线服务"""
+import asyncio
+import functools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+import numpy as np
+from app.core.config import settings
+from app.core.database import db_manager
+from app.services.infrastructure.retrieval.keyword_index_service import get_keyword_index_service
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+# 全局单例实例
+_ingestion_service_instance = None
+
+
+class IngestionQueueFullError(RuntimeError):
+    """入库队列已满（背压）"""
+
+
+class IngestionService:
+    """
+    文件入库服务
+
+    - 有界任务队列 + 固定数量的调度协程，队列满时拒绝新任务（背压）
+    - 每个知识库独立的待处理队列与并发上限：只有所属知识库有空闲名额的任务才会派发给调度协程，
+      单库大批量上传不会占住调度位，其他知识库的任务照常执行；各库轮转派发
+    - 向量化/向量写入/MySQL写入在专用线程池执行，不阻塞事件循环
+    - 编码与存储两级流水线：第 N 批写入时并行编码第 N+1 批
+    """
+
+    def __init__(self):
+        self.config = settings.ingestion
+        self.max_concurrent_jobs = max(1, int(self.config.max_concurrent_jobs or 1))
+        self.per_kb_concurrency = max(1, int(self.config.per_kb_concurrency or 1))
+        self.max_queue_size = max(1, int(self.config.max_queue_size or 1))
+        self.pipeline_depth = max(1, int(self.config.pipeline_depth or 1))
+
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(1, int(self.config.executor_workers or 1)),
+            thread_name_prefix="ingest-worker"
+        )
+        # 就绪队列中的每个 kb_id 代表该库一个可立即执行的任务；
+        # _active_by_kb = 就绪队列中该库的条目数 + 正在执行数，始终不超过 per_kb_concurrency
+        self._ready: Optional[asyncio.Queue] = None
+        self._pending: Dict[int, Deque[Tuple[Callable[[], Awaitable[Any]], str]]] = {}
+        self._queued = 0
+        self._workers: List[asyncio.Task] = []
+        self._active_by_kb: Dict[int, int] = {}
+        self._running_by_kb: Dict[int, int] = {}
+        self._stats: Dict[str, int] = {
+            "submitted": 0,
+            "rejected": 0,
+            "completed": 0,
+            "failed": 0,
+            "running": 0
+        }
+
+        logger.info(
+            "入库服务初始化: jobs=%s, per_kb=%s, queue=%s, executor_workers=%s, pipeline_depth=%s",
+            self.max_concurrent_jobs,
+            self.per_kb_concurrency,
+            self.max_queue_size,
+            self.config.executor_workers,
+            self.pipeline_depth
+        )
+
+    # ==================== 任务调度 ====================
+
+    def _ensure_started(self) -> None:
+        if self._ready is None:
+            self._ready = asyncio.Queue()
+        self._workers = [task for task in self._workers if not task.done()]
+        while len(self._workers) < self.max_concurrent_jobs:
+            index = len(self._workers)
+            self._workers.append(asyncio.create_task(self._worker_loop(index)))
+
+    def _dispatch(self, kb_id: int) -> None:
+        """该库仍有待处理任务且有空闲名额时，向就绪队列放入一个条目"""
+        active = self._active_by_kb.get(kb_id, 0)
+        if active < self.per_kb_concurrency and len(self._pending.get(kb_id, ())) > active - self._running_by_kb.get(kb_id, 0):
+            self._active_by_kb[kb_id] = active + 1
+            self._ready.put_nowait(kb_id)
+
+    def is_full(self) -> bool:
+        """队列是否已满"""
+        return self._queued >= self.max_queue_size
+
+    async def submit(
+        self,
+        kb_id: int,
+        job_factory: Callable[[], Awaitable[Any]],
+        job_name: str = ""
+    ) -> int:
+        """
+        提交入库任务
+
+        Args:
+            kb_id: 知识库ID（用于按库限流）
+            job_factory: 无参协程工厂，调度时才创建协程
+            job_name: 任务名称（日志用）
+
+        Returns:
+            提交后的队列长度
+
+        Raises:
+            IngestionQueueFullError: 队列已满
+        """
+        self._ensure_started()
+        if self.is_full():
+            self._stats["rejected"] += 1
+            raise IngestionQueueFullError(f"入库队列已满({self.max_queue_size})，请稍后重试")
+
+        self._pending.setdefault(kb_id, deque()).append((job_factory, job_name))
+        self._queued += 1
+        self._dispatch(kb_id)
+
+        self._stats["submitted"] += 1
+        queue_size = self._queued
+        logger.info("入库任务已提交: kb_id=%s, job=%s, queued=%s", kb_id, job_name, queue_size)
+        return queue_size
+
+    async def _worker_loop(self, index: int) -> None:
+        while True:
+            kb_id = await self._ready.get()
+            pending = self._pending[kb_id]
+            job_factory, job_name = pending.popleft()
+            if not pending:
+                del self._pending[kb_id]
+            self._queued -= 1
+            self._stats["running"] += 1
+            self._running_by_kb[kb_id] = self._running_by_kb.get(kb_id, 0) + 1
+            try:
+                await job_factory()
+                self._stats["completed"] += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as error:
+                self._stats["failed"] += 1
+                logger.error("入库任务执行失败: worker=%s, kb_id=%s, job=%s, error=%s", index, kb_id, job_name, str(error))
+            finally:
+                self._stats["running"] -= 1
+                self._running_by_kb[kb_id] = max(0, self._running_by_kb.get(kb_id, 1) - 1)
+                self._active_by_kb[kb_id] = max(0, self._active_by_kb.get(kb_id, 1) - 1)
+                if not self._active_by_kb[kb_id]:
+                    del self._active_by_kb[kb_id]
+                # 名额归还后按需把该库下一个任务放回就绪队列末尾（各库轮转）
+                self._dispatch(kb_id)
+
+    async def run_in_executor(self, func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """在入库线程池中执行阻塞函数"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取入库队列指标"""
+        return {
+            **self._stats,
+            "queued": self._queued,
+            "max_queue_size": self.max_queue_size,
+            "max_concurrent_jobs": self.max_concurrent_jobs,
+            "per_kb_concurrency": self.per_kb_concurrency,
+            "running_by_kb": {kb_id: count for kb_id, count in self._running_by_kb.items() if count > 0},
+            "queued_by_kb": {kb_id: len(jobs) for kb_id, jobs in self._pending.items()}
+        }
+
+    async def shutdown(self) -> None:
+        """停止调度协程并关闭线程池"""
+        for task in self._workers:
+            task.cancel()
+        if self._workers:
+            await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._executor.shutdown(wait=False)
+        logger.info("入库服务已关闭")
+
+    # ==================== 编码/存储流水线 ====================
+
+    def _resolve_batch_size(self) -> Tuple[int, int]:
+        embedding_batch_size = max(1, int(getattr(settings.embedding, 'batch_size', 32) or 32))
+        multiplier = max(1, int(self.config.batch_multiplier or 1))
+        max_batch_size = max(1, int(self.config.max_batch_size or 256))
+        ingest_batch_size = max(embedding_batch_size, min(max_batch_size, embedding_batch_size * multiplier))
+        return embedding_batch_size, ingest_batch_size
+
+    def _store_batch(
+        self,
+        vector_store,
+        collection_name: str,
+        kb_id: int,
+        file_id: int,
+        start: int,
+        batch_chunks: List[str],
+        batch_ids: List[str],
+        batch_embeddings: np.ndarray,
+        batch_metadatas: List[Dict[str, Any]]
+    ) -> None:
+        vector_store.add_vectors(
+            collection_name=collection_name,
+            ids=batch_ids,
+            embeddings=batch_embeddings,
+            documents=batch_chunks,
+            metadatas=batch_metadatas
+        )
+
+        mysql_rows = [
+            (kb_id, file_id, start + offset, chunk, batch_ids[offset])
+            for offset, chunk in enumerate(batch_chunks)
+        ]
+        try:
+            with db_manager.get_cursor() as cursor:
+                cursor.executemany(
+                    """INSERT INTO text_chunks (kb_id, file_id, chunk_index, content, vector_id)
+                       VALUES (%s, %s, %s, %s, %s)""",
+                    mysql_rows
+                )
+        except Exception:
+            # 本批MySQL写入已回滚，同步撤销本批向量
+            vector_store.delete_by_ids(collection_name=collection_name, ids=batch_ids)
+            raise
+
+        if settings.hybrid_retrieval.keyword_index_enabled:
+            get_keyword_index_service().add_chunks(kb_id, [
+                {'chunk_id': vector_id, 'file_id': file_id, 'chunk_index': chunk_index, 'content': content}
+                for (_, _, chunk_index, content, vector_id) in mysql_rows
+            ])
+
+    def _rollback_batches(
+        self,
+        vector_store,
+        collection_name: str,
+        kb_id: int,
+        file_id: int,
+        vector_ids: List[str]
+    ) -> None:
+        vector_store.delete_by_ids(collection_name=collection_name, ids=vector_ids)
+        if settings.hybrid_retrieval.keyword_index_enabled:
+            get_keyword_index_service().remove_chunks(kb_id, vector_ids)
+        for start in range(0, len(vector_ids), 500):
+            batch = vector_ids[start:start + 500]
+            placeholders = ','.join(['%s'] * len(batch))
+            with db_manager.get_cursor() as cursor:
+                cursor.execute(
+                    f"DELETE FROM text_chunks WHERE file_id = %s AND vector_id IN ({placeholders})",
+                    (file_id, *batch)
+                )
+
+    async def embed_and_store(
+        self,
+        kb_id: int,
+        file_id: int,
+        chunks: List[str],
+        ids: List[str],
+        chunk_hashes: List[str],
+        embedding_service,
+        vector_store,
+        embedding_model: str,
+        embedding_provider: str = "transformers",
+        progress_callback: Optional[Callable[[int, int, Dict[str, Any]], Awaitable[None]]] = None
+    ) -> Dict[str, Any]:
+        """
+        分批向量化并写入向量库与 text_chunks（两级流水线）
+
+        Args:
+            kb_id: 知识库ID
+            file_id: 文件ID
+            chunks: 文本块
+            ids: 文本块对应的向量ID
+            chunk_hashes: 文本块哈希（写入向量元数据）
+            embedding_service: 嵌入服务
+            vector_store: 向量存储服务
+            embedding_model: 嵌入模型
+            embedding_provider: 嵌入提供方
+            progress_callback: async cb(processed, total, cache_stats)
+
+        Returns:
+            入库统计
+        """
+        total_chunks = len(chunks)
+        if total_chunks == 0:
+            return {"total": 0, "batches": 0}
+
+        embedding_batch_size, ingest_batch_size = self._resolve_batch_size()
+        collection_name = f"kb_{kb_id}"
+        batch_ranges = [
+            (start, min(start + ingest_batch_size, total_chunks))
+            for start in range(0, total_chunks, ingest_batch_size)
+        ]
+
+        store_queue: asyncio.Queue = asyncio.Queue(maxsize=self.pipeline_depth)
+        inserted_vector_ids: List[str] = []
+        cache_hit_total = 0
+
+        async def _produce() -> None:
+            try:
+                for start, end in batch_ranges:
+                    batch_embeddings, cache_stats = await self.run_in_executor(
+                        embedding_service.encode_with_cache,
+                        chunks[start:end],
+                        embedding_model,
+                        provider=embedding_provider,
+                        batch_size=embedding_batch_size,
+                        show_progress=False
+                    )
+                    await store_queue.put((start, end, batch_embeddings, cache_stats))
+                await store_queue.put(None)
+            except asyncio.CancelledError:
+                raise
+            except Exception as error:
+                await store_queue.put(error)
+
+        producer = asyncio.create_task(_produce())
+        try:
+            while True:
+                item = await store_queue.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+
+                start, end, batch_embeddings, cache_stats = item
+                batch_ids = ids[start:end]
+                batch_metadatas = [
+                    {
+                        'kb_id': kb_id,
+                        'file_id': file_id,
+                        'chunk_index': start + offset,
+                        'text_hash': chunk_hashes[start + offset]
+                    }
+                    for offset in range(end - start)
+                ]
+                await self.run_in_executor(
+                    self._store_batch,
+                    vector_store,
+                    collection_name,
+                    kb_id,
+                    file_id,
+                    start,
+                    chunks[start:end],
+                    batch_ids,
+                    batch_embeddings,
+                    batch_metadatas
+                )
+                inserted_vector_ids.extend(batch_ids)
+                cache_hit_total += int(cache_stats.get('cache_hit', 0) or 0)
+
+                if progress_callback:
+                    await progress_callback(end, total_chunks, cache_stats)
+        except BaseException:
+            producer.cancel()
+            await asyncio.gather(producer, return_exceptions=True)
+            # 已提交批次的补偿删除，避免跨存储不一致
+            if inserted_vector_ids:
+                try:
+                    await self.run_in_executor(
+                        self._rollback_batches,
+                        vector_store,
+                        collection_name,
+                        kb_id,
+                        file_id,
+                        list(inserted_vector_ids)
+                    )
+                except Exception as rollback_error:
+                    logger.error(
+                        "入库补偿删除失败: kb_id=%s, file_id=%s, vector_count=%s, error=%s",
+                        kb_id,
+                        file_id,
+                        len(inserted_vector_ids),
+                        str(rollback_error),
+                    )
+            raise
+
+        await producer
+        return {
+            "total": total_chunks,
+            "batches": len(batch_ranges),
+            "batch_size": ingest_batch_size,
+            "cache_hit": cache_hit_total
+        }
+
+
+def get_ingestion_service() -> IngestionService:
+    """获取 IngestionService 单例"""
+    global _ingestion_service_instance
+    if _ingestion_service_instance is None:
+        _ingestion_service_instance = IngestionService()
+    return _ingestion_service_instance
@@ -1,28 +1,25 @@
 """知识库服务"""
 import asyncio
+import copy
 import hashlib
-import json
-import math
 import re
 import time
 import unicodedata
 from typing import List, Optional, Dict, Any, Tuple, Callable
 from datetime import datetime
-from pathlib import Path
 from uuid import uuid4
+import numpy as np
 from app.core.database import DatabaseManager
 from app.models.knowledge_base import KnowledgeBase
 from app.core.config import settings
+from app.services.infrastructure.retrieval.metadata_registry import NAMESPACE_KNOWLEDGE_BASE, get_metadata_registry
+from app.services.infrastructure.telemetry.telemetry_sink import get_telemetry_sink
+from app.services.infrastructure.telemetry.tracing import current_trace_id, span, traced
 from app.utils.logger import get_logger
+from app.utils.similarity import mmr_select
 
 logger = get_logger(__name__)
 
-_cross_encoder_cache: Dict[str, Any] = {
-    "name": None,
-    "model": None
-}
-
-
 class KnowledgeBaseService:
     """知识库服务"""
     
@@ -36,22 +33,20 @@ class KnowledgeBaseService:
 
     def _append_graph_metrics(self, payload: Dict[str, Any]) -> None:
         metrics_path_raw = str(getattr(settings.knowledge_graph, "run_metrics_file", "") or "").strip()
-        if not metrics_path_raw:
-            return
-        metrics_path = Path(metrics_path_raw)
-        try:
-            metrics_path.parent.mkdir(parents=True, exist_ok=True)
-            with metrics_path.open("a", encoding="utf-8") as handle:
-                handle.write(json.dumps(payload, ensure_ascii=False) + "\n")
-        except Exception as error:
-            logger.warning("图谱构建指标写入失败: %s", str(error))
+        get_telemetry_sink().record(
+            "graph_build",
+            metrics_path_raw,
+            payload,
+            observations={"graph_build.run": payload.get("elapsed_ms")}
+        )
     
     async def create_knowledge_base(
         self,
         name: str,
         description: Optional[str] = None,
         embedding_model: str = "paraphrase-multilingual-MiniLM-L12-v2",
-        embedding_provider: str = "transformers"
+        embedding_provider: str = "transformers",
+        index_profile: Optional[str] = None
     ) -> Optional[KnowledgeBase]:
         """
         创建知识库
@@ -61,11 +56,15 @@ class KnowledgeBaseService:
             description: 描述
             embedding_model: 嵌入模型
             embedding_provider: 嵌入提供方
+            index_profile: 向量索引档位（fast / balanced / high_recall），为空时使用默认档位
             
         Returns:
             创建的知识库对象
         """
         try:
+            from app.services.infrastructure.retrieval.index_profiles import get_index_profile
+            profile = get_index_profile(index_profile)
+            
             sql = """
                 INSERT INTO knowledge_bases (name, description, embedding_model, embedding_provider, status)
                 VALUES (%s, %s, %s, %s, %s)
@@ -77,7 +76,19 @@ class KnowledgeBaseService:
             )
             
             if kb_id:
-                logger.info(f"知识库创建成功: id={kb_id}, name={name}, provider={embedding_provider}")
+                # 按索引档位创建向量集合，HNSW 参数写入集合元数据（集合创建后不可修改）。
+                # 失败时回滚知识库记录：否则首次入库会按 Chroma 默认参数建集合，所选档位静默丢失
+                from app.services.infrastructure.retrieval.vector_store_service import get_vector_store_service
+                try:
+                    await asyncio.to_thread(get_vector_store_service().ensure_collection, f"kb_{kb_id}", profile)
+                except Exception as error:
+                    logger.error(f"创建向量集合失败，回滚知识库记录: kb_id={kb_id}, error={error}")
+                    await self.db.execute_update("DELETE FROM knowledge_bases WHERE id = %s", (kb_id,))
+                    raise RuntimeError(f"创建向量集合失败(index_profile={profile.name}): {error}") from error
+                
+                logger.info(
+                    f"知识库创建成功: id={kb_id}, name={name}, provider={embedding_provider}, index_profile={profile.name}"
+                )
                 return await self.get_knowledge_base(kb_id)
             
             return None
@@ -88,7 +99,7 @@ class KnowledgeBaseService:
     
     async def get_knowledge_base(self, kb_id: int) -> Optional[KnowledgeBase]:
         """
-        获取知识库
+        获取知识库（优先读取进程内元数据缓存，由更新/删除主动失效）
         
         Args:
             kb_id: 知识库ID
@@ -97,11 +108,19 @@ class KnowledgeBaseService:
             知识库对象
         """
         try:
+            registry = get_metadata_registry()
+            cached = registry.get(NAMESPACE_KNOWLEDGE_BASE, int(kb_id))
+            if cached is not None:
+                return copy.copy(cached)
+            
+            version = registry.version(NAMESPACE_KNOWLEDGE_BASE, int(kb_id))
             sql = "SELECT * FROM knowledge_bases WHERE id = %s"
             result = await self.db.execute_query(sql, (kb_id,))
             
             if result:
-                return KnowledgeBase.from_dict(result[0])
+                kb = KnowledgeBase.from_dict(result[0])
+                registry.put(NAMESPACE_KNOWLEDGE_BASE, int(kb_id), kb, version=version)
+                return copy.copy(kb)
             
             return None
             
@@ -170,6 +189,7 @@ class KnowledgeBaseService:
             """
             
             rows_affected = await self.db.execute_update(sql, tuple(values))
+            get_metadata_registry().invalidate(NAMESPACE_KNOWLEDGE_BASE, int(kb_id))
             
             logger.info(f"知识库更新成功: id={kb_id}, fields={list(kwargs.keys())}")
             return rows_affected > 0
@@ -204,6 +224,15 @@ class KnowledgeBaseService:
                 "DELETE FROM knowledge_bases WHERE id = %s",
                 (kb_id,)
             )
+            get_metadata_registry().invalidate(NAMESPACE_KNOWLEDGE_BASE, int(kb_id))
+            
+            # 删除BM25关键词索引文件
+            from app.services.infrastructure.retrieval.keyword_index_service import get_keyword_index_service
+            get_keyword_index_service().drop_index(kb_id)
+            
+            # 清理该知识库的对话语义缓存
+            from app.services.core.semantic_cache import get_semantic_cache
+            get_semantic_cache().invalidate_kb(kb_id)
             
             logger.info(f"知识库删除成功: id={kb_id}")
             return rows_affected > 0
@@ -243,6 +272,10 @@ class KnowledgeBaseService:
                 chunk_count=chunk_count
             )
             
+            # 文件增删后知识库内容变化，使对话语义缓存失效
+            from app.services.core.semantic_cache import get_semantic_cache
+            get_semantic_cache().invalidate_kb(kb_id)
+            
             logger.info(f"知识库统计更新成功: kb_id={kb_id}, files={file_count}, chunks={chunk_count}")
             return True
             
@@ -289,6 +322,7 @@ class KnowledgeBaseService:
                 tokens.append(current)
         return tokens
 
+    @traced("query_rewrite")
     def _rewrite_query_variants(self, query: str) -> List[str]:
         query = (query or "").strip()
         if not query:
@@ -316,6 +350,23 @@ class KnowledgeBaseService:
         max_variants = max(1, int(self.retrieval_config.query_rewrite_max_variants or 1))
         return variants[:max_variants]
 
+    def _encode_query_variants(
+        self,
+        query_variants: List[str],
+        model_name: str,
+        provider: str
+    ) -> np.ndarray:
+        """一次批量编码全部查询变体（与 _rewrite_query_variants 的顺序一一对应），返回 float32 矩阵。"""
+        if not query_variants:
+            return np.zeros((0, 0), dtype=np.float32)
+        from app.services.infrastructure.embedding.embedding_service import get_embedding_service
+        return get_embedding_service().encode_array(
+            query_variants,
+            model_name=model_name,
+            provider=provider,
+            text_role='query'
+        )
+
     def _compute_recall_k(self, top_k: int) -> int:
         target_top_k = max(1, int(top_k or 1))
         if not self.retrieval_config.enable_two_stage:
@@ -455,14 +506,6 @@ class KnowledgeBaseService:
         reranked.sort(key=lambda x: x.get('_rerank_score', x.get('similarity', 0.0)), reverse=True)
         return reranked
 
-    def _vector_cosine_similarity(self, vec_a: List[float], vec_b: List[float]) -> float:
-        if vec_a is None or vec_b is None:
-            return 0.0
-        if len(vec_a) == 0 or len(vec_b) == 0 or len(vec_a) != len(vec_b):
-            return 0.0
-        dot = sum(a * b for a, b in zip(vec_a, vec_b))
-        return max(-1.0, min(1.0, dot))
-
     def _has_embedding_vector(self, vector: Any) -> bool:
         if vector is None:
             return False
@@ -473,7 +516,7 @@ class KnowledgeBaseService:
 
     def _apply_mmr(
         self,
-        query_vector: Optional[List[float]],
+        query_vector: Optional[np.ndarray],
         results: List[Dict[str, Any]],
         top_k: int
     ) -> List[Dict[str, Any]]:
@@ -494,32 +537,14 @@ class KnowledgeBaseService:
         lambda_value = max(0.0, min(1.0, lambda_value))
 
         target_count = max(top_k, min(len(with_embedding), self._compute_recall_k(top_k)))
-        selected: List[Dict[str, Any]] = []
-        remaining = with_embedding.copy()
-
-        while remaining and len(selected) < target_count:
-            best_idx = 0
-            best_score = -1e9
-            for index, candidate in enumerate(remaining):
-                relevance = float(candidate.get('similarity', 0.0) or 0.0)
-                diversity_penalty = 0.0
-                if selected:
-                    candidate_embedding = candidate.get('_embedding') if self._has_embedding_vector(candidate.get('_embedding')) else []
-                    diversity_penalty = max(
-                        self._vector_cosine_similarity(
-                            candidate_embedding,
-                            chosen.get('_embedding') if self._has_embedding_vector(chosen.get('_embedding')) else []
-                        )
-                        for chosen in selected
-                    )
-                mmr_score = lambda_value * relevance - (1 - lambda_value) * diversity_penalty
-                if mmr_score > best_score:
-                    best_score = mmr_score
-                    best_idx = index
-
-            selected.append(remaining.pop(best_idx))
-
-        selected.extend(remaining)
+        order = mmr_select(
+            relevance=[float(item.get('similarity', 0.0) or 0.0) for item in with_embedding],
+            embeddings=[item.get('_embedding') for item in with_embedding],
+            lambda_value=lambda_value,
+            target_count=target_count
+        )
+
+        selected = [with_embedding[index] for index in order]
         selected.extend(without_embedding)
         return selected
 
@@ -584,65 +609,53 @@ class KnowledgeBaseService:
         merged_clusters.sort(key=lambda x: x.get('_cluster_score', x.get('_rerank_score', x.get('similarity', 0.0))), reverse=True)
         return merged_clusters
 
-    def _get_cross_encoder(self):
-        if not self.retrieval_config.enable_cross_encoder_rerank:
-            return None
-
-        model_name = str(self.retrieval_config.cross_encoder_model or '').strip()
-        if not model_name:
-            return None
-
-        if _cross_encoder_cache.get('model') is not None and _cross_encoder_cache.get('name') == model_name:
-            return _cross_encoder_cache.get('model')
-
-        try:
-            from sentence_transformers import CrossEncoder
-            device = 'cpu'
-            try:
-                import torch
-                if torch.cuda.is_available():
-                    device = 'cuda'
-            except Exception:
-                device = 'cpu'
-
-            model = CrossEncoder(model_name, device=device)
-            _cross_encoder_cache['name'] = model_name
-            _cross_encoder_cache['model'] = model
-            logger.info(f"CrossEncoder加载成功: model={model_name}, device={device}")
-            return model
-        except Exception as error:
-            logger.warning(f"CrossEncoder加载失败，跳过交叉重排: {str(error)}")
-            return None
-
-    def _cross_encoder_rerank(self, query: str, results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    async def _cross_encoder_rerank(
+        self,
+        query: str,
+        results: List[Dict[str, Any]],
+        top_k: int,
+        diagnostics: Optional[Dict[str, Any]] = None
+    ) -> List[Dict[str, Any]]:
         if not results or not self.retrieval_config.enable_cross_encoder_rerank:
             return results
-
-        model = self._get_cross_encoder()
-        if model is None or len(results) < 2:
+        if not str(self.retrieval_config.cross_encoder_model or '').strip() or len(results) < 2:
             return results
 
         try:
+            from app.services.infrastructure.retrieval.reranker_service import get_reranker_service
+
             top_n = min(max(1, int(self.retrieval_config.cross_encoder_top_n or 1)), len(results))
             alpha = float(self.retrieval_config.cross_encoder_alpha or 0.7)
             alpha = max(0.0, min(1.0, alpha))
 
             target = results[:top_n]
-            pairs = [[query, str(item.get('content', '') or '')[:1500]] for item in target]
-            raw_scores = model.predict(pairs)
+            outcome = await get_reranker_service().rerank(
+                query=query,
+                passages=[str(item.get('content', '') or '') for item in target],
+                base_scores=[float(item.get('_rerank_score', item.get('similarity', 0.0)) or 0.0) for item in target],
+                alpha=alpha,
+                top_k=top_k,
+                keys=[item.get('chunk_id') for item in target]
+            )
+            if diagnostics is not None:
+                diagnostics['cross_encoder_scored'] = outcome.scored
+                diagnostics['cross_encoder_cache_hits'] = outcome.cache_hits
+                diagnostics['cross_encoder_early_exit'] = outcome.early_exit
 
             rescored = []
-            for item, score in zip(target, raw_scores):
-                normalized_score = 1.0 / (1.0 + math.exp(-float(score)))
-                base_score = float(item.get('_rerank_score', item.get('similarity', 0.0)) or 0.0)
-                final_score = alpha * normalized_score + (1 - alpha) * base_score
+            unscored = []
+            for item, cross_score, final_score in zip(target, outcome.cross_scores, outcome.final_scores):
+                if cross_score is None:
+                    # 提前退出未打分的候选不可能进入前 top_k，保持一阶段顺序排在已打分候选之后
+                    unscored.append(item)
+                    continue
                 updated = dict(item)
-                updated['_cross_score'] = normalized_score
+                updated['_cross_score'] = cross_score
                 updated['_cross_final_score'] = final_score
                 rescored.append(updated)
 
             rescored.sort(key=lambda x: x.get('_cross_final_score', 0.0), reverse=True)
-            return rescored + results[top_n:]
+            return rescored + unscored + results[top_n:]
         except Exception as error:
             logger.warning(f"CrossEncoder重排失败，回退轻量结果: {str(error)}")
             return results
@@ -661,20 +674,20 @@ class KnowledgeBaseService:
     def _record_retrieval_metrics(self, payload: Dict[str, Any]) -> None:
         if not self.retrieval_config.monitoring_enabled:
             return
-        try:
-            metrics_file = Path(self.retrieval_config.metrics_log_file)
-            metrics_file.parent.mkdir(parents=True, exist_ok=True)
-
-            line = json.dumps(payload, ensure_ascii=False)
-            with metrics_file.open('a', encoding='utf-8') as file_obj:
-                file_obj.write(line + "\n")
-        except Exception as error:
-            logger.warning(f"记录检索监控指标失败: {str(error)}")
-
-    def _postprocess_retrieval_results(
+        trace_id = current_trace_id()
+        if trace_id:
+            payload = {**payload, 'trace_id': trace_id}
+        get_telemetry_sink().record(
+            "retrieval",
+            self.retrieval_config.metrics_log_file,
+            payload,
+            observations={f"retrieval.{payload.get('scope', 'unknown')}": payload.get("elapsed_ms")}
+        )
+
+    async def _postprocess_retrieval_results(
         self,
         query: str,
-        query_vector: Optional[List[float]],
+        query_vector: Optional[np.ndarray],
         candidates: List[Dict[str, Any]],
         top_k: int,
         score_threshold: float
@@ -691,21 +704,26 @@ class KnowledgeBaseService:
         diagnostics['effective_threshold'] = effective_threshold
         diagnostics['after_threshold'] = len(filtered)
 
-        reranked = self._light_rerank(query, filtered)
-        reranked = self._cross_encoder_rerank(query, reranked)
-        reranked = self._apply_mmr(query_vector, reranked, top_k)
-        reranked = self._cluster_and_merge_results(reranked)
+        with span("rerank"):
+            reranked = self._light_rerank(query, filtered)
+            reranked = await self._cross_encoder_rerank(query, reranked, top_k, diagnostics)
+        with span("mmr"):
+            reranked = self._apply_mmr(query_vector, reranked, top_k)
+        with span("cluster_merge"):
+            reranked = self._cluster_and_merge_results(reranked)
         diagnostics['after_rerank'] = len(reranked)
 
         final_results = self._sanitize_results(reranked[:top_k])
         return final_results, diagnostics
     
+    @traced("vector_retrieval")
     async def search_knowledge_bases(
         self,
         kb_ids: List[int],
         query: str,
         top_k: int = 5,
-        score_threshold: float = 0.0
+        score_threshold: float = 0.0,
+        search_ef: Optional[int] = None
     ) -> List[Dict[str, Any]]:
         """
         多知识库联合检索
@@ -717,6 +735,7 @@ class KnowledgeBaseService:
             query: 查询文本
             top_k: 总共返回结果数量(从所有库中选top_k)
             score_threshold: 相似度阈值(0-1)
+            search_ef: 单次查询的 HNSW ef（为空时使用各集合档位的默认值）
             
         Returns:
             合并后的检索结果列表(按相似度排序)
@@ -724,6 +743,7 @@ class KnowledgeBaseService:
         try:
             if not kb_ids:
                 return []
+            start_time = datetime.utcnow()
             
             # 1. 检查所有知识库使用相同embedding配置
             embedding_configs = set()
@@ -742,7 +762,19 @@ class KnowledgeBaseService:
             if not valid_kb_ids:
                 return []
 
-            # 2. 并发检索所有知识库（每库先取候选，最后做全局重排）
+            # 2. 所有知识库共享同一 (provider, model)，查询变体只编码一次
+            first_provider, first_model = next(iter(embedding_configs))
+            shared_query_vectors: Optional[np.ndarray] = None
+            try:
+                shared_query_vectors = self._encode_query_variants(
+                    self._rewrite_query_variants(query),
+                    model_name=first_model,
+                    provider=first_provider
+                )
+            except Exception as error:
+                logger.warning(f"共享查询向量生成失败，回退为各库独立编码: {str(error)}")
+
+            # 3. 并发检索所有知识库（每库先取候选，最后做全局重排）
             recall_k = self._compute_recall_k(top_k)
             per_kb_top_k = max(top_k, min(recall_k, max(top_k * 2, recall_k // max(1, len(valid_kb_ids)))))
 
@@ -752,14 +784,16 @@ class KnowledgeBaseService:
                     query=query,
                     top_k=per_kb_top_k,
                     score_threshold=score_threshold,
-                    apply_postprocess=False
+                    apply_postprocess=False,
+                    query_vectors=shared_query_vectors,
+                    search_ef=search_ef
                 )
                 for kb_id in valid_kb_ids
             ]
             
             results_list = await asyncio.gather(*search_tasks, return_exceptions=True)
             
-            # 3. 合并结果并过滤异常
+            # 4. 合并结果并过滤异常
             all_results = []
             for kb_id, results in zip(valid_kb_ids, results_list):
                 if isinstance(results, Exception):
@@ -770,22 +804,25 @@ class KnowledgeBaseService:
             if not all_results:
                 return []
 
-            # 4. 全局后处理（重排/去重/裁剪）
-            first_provider, first_model = next(iter(embedding_configs))
-            query_vector = None
-            try:
-                from app.services.infrastructure.embedding.embedding_service import get_embedding_service
-                embedding_service = get_embedding_service()
-                query_vector = embedding_service.encode_single(
-                    query,
-                    model_name=first_model,
-                    provider=first_provider,
-                    text_role='query'
-                )
-            except Exception as error:
-                logger.warning(f"全局重排查询向量生成失败，继续使用无MMR路径: {str(error)}")
+            # 5. 全局后处理（重排/去重/裁剪），MMR 复用共享的原始查询向量
+            query_vector = (
+                shared_query_vectors[0]
+                if shared_query_vectors is not None and len(shared_query_vectors) > 0
+                else None
+            )
+            if query_vector is None:
+                try:
+                    from app.services.infrastructure.embedding.embedding_service import get_embedding_service
+                    query_vector = get_embedding_service().encode_array(
+                        [query],
+                        model_name=first_model,
+                        provider=first_provider,
+                        text_role='query'
+                    )[0]
+                except Exception as error:
+                    logger.warning(f"全局重排查询向量生成失败，继续使用无MMR路径: {str(error)}")
 
-            final_results, diagnostics = self._postprocess_retrieval_results(
+            final_results, diagnostics = await self._postprocess_retrieval_results(
                 query=query,
                 query_vector=query_vector,
                 candidates=all_results,
@@ -802,6 +839,7 @@ class KnowledgeBaseService:
                 'score_threshold': score_threshold,
                 'candidate_count': len(all_results),
                 'returned_count': len(final_results),
+                'elapsed_ms': int((datetime.utcnow() - start_time).total_seconds() * 1000),
                 **diagnostics
             })
 
@@ -817,7 +855,9 @@ class KnowledgeBaseService:
         query: str,
         top_k: int = 5,
         score_threshold: float = 0.0,
-        apply_postprocess: bool = True
+        apply_postprocess: bool = True,
+        query_vectors: Optional[np.ndarray] = None,
+        search_ef: Optional[int] = None
     ) -> List[Dict[str, Any]]:
         """
         检索知识库
@@ -829,6 +869,9 @@ class KnowledgeBaseService:
             query: 查询文本
             top_k: 返回结果数量
             score_threshold: 相似度阈值(0-1)
+            apply_postprocess: 是否执行重排/去重等后处理
+            query_vectors: 预先编码的查询变体向量（多库检索时共享，需与本库嵌入配置一致）
+            search_ef: 单次查询的 HNSW ef（为空时使用集合档位的默认值）
             
         Returns:
             检索结果列表
@@ -842,11 +885,9 @@ class KnowledgeBaseService:
                 raise ValueError(f"知识库不存在: {kb_id}")
             
             # 2. 使用知识库的嵌入模型编码查询
-            from app.services.infrastructure.embedding.embedding_service import get_embedding_service
             from app.services.infrastructure.retrieval.vector_store_service import get_vector_store_service
-            from app.utils.similarity import format_search_results
+            from app.utils.similarity import format_multi_query_results
 
-            embedding_service = get_embedding_service()
             vector_store = get_vector_store_service()
 
             query_variants = self._rewrite_query_variants(query)
@@ -855,60 +896,50 @@ class KnowledgeBaseService:
 
             recall_k = self._compute_recall_k(top_k)
             collection_name = f"kb_{kb_id}"
+            index_profile = vector_store.get_index_profile(collection_name)
 
             logger.info(
-                "向量检索开始: kb_id=%s, model=%s, provider=%s, variants=%s, recall_k=%s",
+                "向量检索开始: kb_id=%s, model=%s, provider=%s, variants=%s, recall_k=%s, index_profile=%s, search_ef=%s",
                 kb_id,
                 kb.embedding_model,
                 kb.embedding_provider,
                 len(query_variants),
-                recall_k
+                recall_k,
+                index_profile.name,
+                search_ef or index_profile.search_ef
             )
 
-            variant_results: List[List[Dict[str, Any]]] = []
-            file_ids = set()
-            base_query_vector: Optional[List[float]] = None
-
-            for index, variant_query in enumerate(query_variants):
-                query_vector = embedding_service.encode_single(
-                    variant_query,
+            # 所有改写变体一次批量编码（或复用调用方共享的向量），并以多行 query_embeddings 单次检索
+            if query_vectors is None or len(query_vectors) != len(query_variants):
+                query_vectors = self._encode_query_variants(
+                    query_variants,
                     model_name=kb.embedding_model,
-                    provider=kb.embedding_provider,
-                    text_role='query'
+                    provider=kb.embedding_provider
                 )
-                if index == 0:
-                    base_query_vector = query_vector
+            base_query_vector: Optional[np.ndarray] = query_vectors[0] if len(query_vectors) > 0 else None
 
+            with span("chroma"):
                 raw_results = vector_store.search(
                     collection_name=collection_name,
-                    query_embeddings=[query_vector],
+                    query_embeddings=query_vectors,
                     n_results=recall_k,
-                    include=['documents', 'metadatas', 'distances', 'embeddings']
+                    include=['documents', 'metadatas', 'distances', 'embeddings'],
+                    search_ef=search_ef
                 )
 
-                metadatas = raw_results.get('metadatas')
-                if metadatas is None:
-                    metadatas = []
-                if metadatas and len(metadatas) > 0:
-                    for metadata in metadatas[0]:
-                        if metadata and 'file_id' in metadata:
-                            try:
-                                file_ids.add(int(metadata['file_id']))
-                            except Exception:
-                                continue
-
-                variant_results.append(format_search_results(
-                    results=raw_results,
-                    file_info_map={},
-                    kb_id=kb_id,
-                    score_threshold=0.0
-                ))
-
-                embeddings = raw_results.get('embeddings')
-                if embeddings is not None and len(embeddings) > 0:
-                    for row_idx, vector in enumerate(embeddings[0]):
-                        if row_idx < len(variant_results[-1]):
-                            variant_results[-1][row_idx]['_embedding'] = vector
+            variant_results: List[List[Dict[str, Any]]] = format_multi_query_results(
+                results=raw_results,
+                file_info_map={},
+                kb_id=kb_id,
+                score_threshold=0.0,
+                space=index_profile.space
+            )
+            file_ids = {
+                item['metadata']['file_id']
+                for result_set in variant_results
+                for item in result_set
+                if item['metadata'].get('file_id')
+            }
 
             # 查询文件名映射
             file_info_map = {}
@@ -916,7 +947,8 @@ class KnowledgeBaseService:
                 try:
                     placeholders = ','.join(['%s'] * len(file_ids))
                     file_query = f"SELECT id, filename FROM files WHERE id IN ({placeholders})"
-                    file_rows = await self.db.execute_query(file_query, tuple(file_ids))
+                    with span("file_lookup_sql"):
+                        file_rows = await self.db.execute_query(file_query, tuple(file_ids))
                     file_info_map = {row['id']: row['filename'] for row in file_rows}
                 except Exception as error:
                     logger.warning(f"获取文件信息失败: {error}")
@@ -936,7 +968,7 @@ class KnowledgeBaseService:
             )
 
             if apply_postprocess:
-                final_results, diagnostics = self._postprocess_retrieval_results(
+                final_results, diagnostics = await self._postprocess_retrieval_results(
                     query=query,
                     query_vector=base_query_vector,
                     candidates=fused_results,
@@ -961,6 +993,8 @@ class KnowledgeBaseService:
                 'query_variants': query_variants,
                 'top_k': top_k,
                 'recall_k': recall_k,
+                'index_profile': index_profile.name,
+                'search_ef': search_ef or index_profile.search_ef,
                 'score_threshold': score_threshold,
                 'candidate_count': len(fused_results),
                 'returned_count': len(final_results),
@@ -989,6 +1023,102 @@ class KnowledgeBaseService:
     
     # ==================== 知识图谱相关方法 ====================
     
+    def _new_graph_totals(self) -> Dict[str, Any]:
+        return {
+            'windows': 0,
+            'entities': {},
+            'relations': {},
+            'imported_entities': set(),
+            'imported_relations': set(),
+            'reclassify_stats': {'entity_updates': 0, 'relation_updates': 0},
+            'relation_import_stats': {}
+        }
+
+    async def _import_graph_window(
+        self,
+        graph_service,
+        entity_service,
+        kb_id: int,
+        run_id: str,
+        window_results: List[Dict[str, Any]],
+        pending_lookup: Dict[str, Dict[str, Any]],
+        totals: Dict[str, Any]
+    ) -> None:
+        """合并一个窗口的抽取结果并增量导入Neo4j，同时累计整次构建的统计。"""
+        entities, relations = entity_service.merge_extraction_results(window_results)
+        if not entities:
+            return
+
+        window_reclassify = await entity_service.reclassify_unknowns(entities, relations)
+        for key, value in window_reclassify.items():
+            totals['reclassify_stats'][key] = totals['reclassify_stats'].get(key, 0) + int(value or 0)
+
+        # 为关系补充证据预览，增强可解释性
+        for relation in relations:
+            chunk_ids = relation.get('chunk_ids', []) or []
+            previews: List[str] = []
+            for chunk_id in chunk_ids[:5]:
+                detail = pending_lookup.get(str(chunk_id))
+                if detail and detail.get('preview'):
+                    previews.append(detail['preview'])
+            if previews:
+                attrs = relation.get('attributes') if isinstance(relation.get('attributes'), dict) else {}
+                attrs['evidence_previews'] = previews
+                relation['attributes'] = attrs
+
+        imported_entities = await asyncio.to_thread(graph_service.batch_import_entities, kb_id, entities, run_id)
+        imported_relations = await asyncio.to_thread(
+            graph_service.batch_import_relations,
+            kb_id,
+            relations,
+            run_id,
+            settings.knowledge_graph.enable_fact_nodes
+        )
+        for key, value in (graph_service.get_last_relation_import_stats() or {}).items():
+            if isinstance(value, (int, float)):
+                totals['relation_import_stats'][key] = totals['relation_import_stats'].get(key, 0) + value
+
+        unknown_entity_type = settings.knowledge_graph.entity_extraction.unknown_entity_type
+        for entity in entities:
+            name = entity.get('canonical_name') or entity.get('name')
+            mention_count = int((entity.get('attributes') or {}).get('mention_count', 1) or 1)
+            confidence = float(entity.get('confidence', 0.0) or 0.0)
+            existing = totals['entities'].get(name)
+            if existing is None:
+                totals['entities'][name] = {
+                    'type': entity.get('type'),
+                    'confidence': confidence,
+                    'mention_count': mention_count
+                }
+            else:
+                existing['mention_count'] += mention_count
+                existing['confidence'] = max(existing['confidence'], confidence)
+                if existing.get('type') == unknown_entity_type and entity.get('type'):
+                    existing['type'] = entity.get('type')
+            if imported_entities:
+                totals['imported_entities'].add(name)
+
+        for relation in relations:
+            key = (relation.get('source'), relation.get('target'), relation.get('relation'))
+            confidence = float(relation.get('confidence', 0.0) or 0.0)
+            existing = totals['relations'].get(key)
+            if existing is None:
+                totals['relations'][key] = {'relation': relation.get('relation'), 'confidence': confidence}
+            else:
+                existing['confidence'] = max(existing['confidence'], confidence)
+            if imported_relations:
+                totals['imported_relations'].add(key)
+
+        totals['windows'] += 1
+        logger.info(
+            "图谱窗口导入完成: kb_id=%s, window=%s, chunks=%s, entities=%s, relations=%s",
+            kb_id,
+            totals['windows'],
+            len(window_results),
+            len(entities),
+            len(relations)
+        )
+
     async def build_knowledge_graph(
         self,
         kb_id: int,
@@ -1119,13 +1249,72 @@ class KnowledgeBaseService:
                 self._append_graph_metrics({"kb_id": kb_id, **result})
                 return result
             
-            # 批量提取实体和关系
+            # 流式抽取 + 增量导入：每凑满一个窗口就合并并导入Neo4j，导入与后续抽取并行
             if progress_callback:
                 await progress_callback("extracting_entities", 91, f"正在抽取实体关系 ({len(pending_texts)} 个文本块)...")
-            extraction_results = await entity_service.batch_extract(
-                texts=pending_texts,
-                concurrency=settings.knowledge_graph.entity_extraction.batch_size
-            )
+            stream_window = int(getattr(settings.knowledge_graph.entity_extraction, 'stream_import_window', 0) or 0)
+            if stream_window <= 0:
+                stream_window = len(pending_texts)
+
+            extraction_results: List[Dict[str, Any]] = []
+            graph_totals = self._new_graph_totals()
+            import_queue: asyncio.Queue = asyncio.Queue(maxsize=2)
+
+            async def _importer() -> None:
+                while True:
+                    window_results = await import_queue.get()
+                    if window_results is None:
+                        return
+                    await self._import_graph_window(
+                        graph_service=graph_service,
+                        entity_service=entity_service,
+                        kb_id=kb_id,
+                        run_id=run_id,
+                        window_results=window_results,
+                        pending_lookup=pending_lookup,
+                        totals=graph_totals
+                    )
+
+            importer_task = asyncio.create_task(_importer())
+
+            async def _enqueue(item: Optional[List[Dict[str, Any]]]) -> None:
+                put_task = asyncio.create_task(import_queue.put(item))
+                done, _ = await asyncio.wait({put_task, importer_task}, return_when=asyncio.FIRST_COMPLETED)
+                if put_task not in done:
+                    put_task.cancel()
+                    importer_task.result()
+                    raise RuntimeError("图谱增量导入已提前结束")
+
+            window_buffer: List[Dict[str, Any]] = []
+            try:
+                async for _, result_item in entity_service.iter_extract(
+                    texts=pending_texts,
+                    concurrency=settings.knowledge_graph.entity_extraction.batch_size
+                ):
+                    extraction_results.append(result_item)
+                    window_buffer.append(result_item)
+                    if len(window_buffer) >= stream_window:
+                        await _enqueue(window_buffer)
+                        window_buffer = []
+                        if progress_callback:
+                            done_ratio = len(extraction_results) / max(1, len(pending_texts))
+                            await progress_callback(
+                                "extracting_entities",
+                                91 + int(4 * done_ratio),
+                                f"已抽取 {len(extraction_results)}/{len(pending_texts)} 个文本块，"
+                                f"已导入 {len(graph_totals['imported_entities'])} 个实体"
+                            )
+                if window_buffer:
+                    await _enqueue(window_buffer)
+                await _enqueue(None)
+                if progress_callback:
+                    await progress_callback("importing_graph", 95, "正在完成图谱导入...")
+                await importer_task
+            except BaseException:
+                if not importer_task.done():
+                    importer_task.cancel()
+                await asyncio.gather(importer_task, return_exceptions=True)
+                raise
 
             extraction_metrics = {
                 'dropped_relation_endpoints': sum(int((item.get('metrics') or {}).get('dropped_relation_endpoints', 0)) for item in extraction_results),
@@ -1136,31 +1325,17 @@ class KnowledgeBaseService:
                 'parse_failed_chunk_count': sum(1 for item in extraction_results if bool((item.get('metrics') or {}).get('parse_failed'))),
                 'llm_empty_chunk_count': sum(1 for item in extraction_results if bool((item.get('metrics') or {}).get('llm_empty')))
             }
-            
-            # 合并提取结果
-            all_entities, all_relations = entity_service.merge_extraction_results(extraction_results)
-
-            reclassify_stats = await entity_service.reclassify_unknowns(all_entities, all_relations)
 
-            # 为关系补充证据预览，增强可解释性
-            for relation in all_relations:
-                chunk_ids = relation.get('chunk_ids', []) or []
-                previews: List[str] = []
-                for chunk_id in chunk_ids[:5]:
-                    detail = pending_lookup.get(str(chunk_id))
-                    if detail and detail.get('preview'):
-                        previews.append(detail['preview'])
-                if previews:
-                    attrs = relation.get('attributes') if isinstance(relation.get('attributes'), dict) else {}
-                    attrs['evidence_previews'] = previews
-                    relation['attributes'] = attrs
+            all_entities = list(graph_totals['entities'].values())
+            all_relations = list(graph_totals['relations'].values())
+            reclassify_stats = graph_totals['reclassify_stats']
 
             unknown_entity_type = settings.knowledge_graph.entity_extraction.unknown_entity_type
             unknown_relation_type = settings.knowledge_graph.entity_extraction.unknown_relation_type
             unknown_entity_count = sum(1 for entity in all_entities if entity.get('type') == unknown_entity_type)
             unknown_relation_count = sum(1 for relation in all_relations if relation.get('relation') == unknown_relation_type)
             normalized_merge_count = sum(
-                max(0, int(entity.get('attributes', {}).get('mention_count', 1)) - 1)
+                max(0, int(entity.get('mention_count', 1)) - 1)
                 for entity in all_entities
             )
             
@@ -1188,18 +1363,10 @@ class KnowledgeBaseService:
                 graph_service.finish_graph_build_run(kb_id, run_id, result)
                 self._append_graph_metrics({'kb_id': kb_id, **result})
                 return result
-            
-            # 批量导入到Neo4j
-            if progress_callback:
-                await progress_callback("importing_graph", 95, f"正在导入图谱: {len(all_entities)} 个实体, {len(all_relations)} 个关系...")
-            entity_count = graph_service.batch_import_entities(kb_id, all_entities, run_id=run_id)
-            relation_count = graph_service.batch_import_relations(
-                kb_id,
-                all_relations,
-                run_id=run_id,
-                include_fact_nodes=settings.knowledge_graph.enable_fact_nodes
-            )
-            relation_import_stats = graph_service.get_last_relation_import_stats()
+
+            entity_count = len(graph_totals['imported_entities'])
+            relation_count = len(graph_totals['imported_relations'])
+            relation_import_stats = graph_totals['relation_import_stats']
 
             deleted_fact_count = 0
             if (
@@ -1221,7 +1388,10 @@ class KnowledgeBaseService:
             relation_unknown_ratio = round(unknown_relation_count / max(1, len(all_relations)), 4)
             relation_density = round(len(all_relations) / max(1, len(pending_texts)), 4)
             
-            logger.info(f"图谱构建完成: kb_id={kb_id}, entities={entity_count}, relations={relation_count}")
+            logger.info(
+                f"图谱构建完成: kb_id={kb_id}, entities={entity_count}, relations={relation_count}, "
+                f"import_windows={graph_totals['windows']}"
+            )
 
             result = {
                 'status': 'success',
@@ -1242,11 +1412,16 @@ class KnowledgeBaseService:
                 'entity_unknown_ratio': entity_unknown_ratio,
                 'relation_unknown_ratio': relation_unknown_ratio,
                 'relation_density': relation_density,
+                'import_windows': graph_totals['windows'],
                 'elapsed_ms': elapsed_ms
             }
 
             graph_service.finish_graph_build_run(kb_id, run_id, result)
             self._append_graph_metrics({'kb_id': kb_id, **result})
+
+            # 图谱变化会影响混合检索结果，使对话语义缓存失效
+            from app.services.core.semantic_cache import get_semantic_cache
+            get_semantic_cache().invalidate_kb(kb_id)
             return result
             
         except Exception as e:
@@ -1,8 +1,10 @@
 """知识图谱服务"""
 from app.services.domain.knowledge_graph.neo4j_graph_service import Neo4jGraphService, get_neo4j_graph_service
 from app.services.domain.knowledge_graph.entity_extraction_service import EntityExtractionService, get_entity_extraction_service
+from app.services.domain.knowledge_graph.entity_linker import EntityLinker, get_entity_linker
 
 __all__ = [
     'Neo4jGraphService', 'get_neo4j_graph_service',
     'EntityExtractionService', 'get_entity_extraction_service',
+    'EntityLinker', 'get_entity_linker',
 ]
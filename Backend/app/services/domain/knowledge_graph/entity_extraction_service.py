@@ -4,9 +4,11 @@ import copy
 import hashlib
 import json
 import time
+import weakref
 from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Set, Tuple
+from collections import deque
+from typing import Any, AsyncGenerator, Callable, Deque, Dict, List, Optional, Set, Tuple
 import httpx
 
 from app.core.config import settings
@@ -21,6 +23,33 @@ except Exception:  # pragma: no cover - 环境未安装时允许回退
 logger = get_logger(__name__)
 
 
+class _AdaptiveLimiter:
+    """可动态调整上限的并发限制器（下调时不打断进行中的任务）"""
+
+    def __init__(self, limit: int):
+        self.limit = max(1, int(limit))
+        self._active = 0
+        self._condition = asyncio.Condition()
+
+    def set_limit(self, limit: int) -> None:
+        self.limit = max(1, int(limit))
+
+    @property
+    def idle(self) -> bool:
+        return self._active == 0
+
+    async def __aenter__(self) -> "_AdaptiveLimiter":
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._active < self.limit)
+            self._active += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        async with self._condition:
+            self._active -= 1
+            self._condition.notify_all()
+
+
 class EntityExtractionService:
     """实体提取服务 - 通用实体/关系抽取与归一化"""
 
@@ -42,6 +71,8 @@ class EntityExtractionService:
 
         self._cache_lock = asyncio.Lock()
         self._cache_map: Dict[str, Dict[str, Any]] = {}
+        # 全局抽取并发预算：同一事件循环内所有批量抽取与其分层调用共用一个自适应限流器
+        self._limiters: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, _AdaptiveLimiter]" = weakref.WeakKeyDictionary()
         self._cache_file = Path(self.config.extraction_cache_file)
         self._load_extraction_cache()
 
@@ -738,6 +769,41 @@ class EntityExtractionService:
             },
         }
 
+    def _get_limiter(self) -> _AdaptiveLimiter:
+        loop = asyncio.get_running_loop()
+        limiter = self._limiters.get(loop)
+        if limiter is None:
+            min_cc = max(1, int(self.config.min_concurrency or 1))
+            max_cc = max(min_cc, int(self.config.max_concurrency or min_cc))
+            limiter = _AdaptiveLimiter(max(min_cc, min(max_cc, int(self.config.batch_size or min_cc))))
+            self._limiters[loop] = limiter
+        return limiter
+
+    async def _extract_layer(
+        self,
+        layer_text: str,
+        timeout: int,
+        limiter: Optional[_AdaptiveLimiter],
+        on_layer_done: Optional[Callable[[int, bool], None]],
+    ) -> Dict[str, Any]:
+        """单层抽取：占用一个并发名额，名额内计时（不含排队）并在释放前回报延迟/失败"""
+        if limiter is None:
+            return await self._extract_once(layer_text, chunk_id=None, timeout=timeout)
+
+        async with limiter:
+            st = time.perf_counter()
+            try:
+                one = await self._extract_once(layer_text, chunk_id=None, timeout=timeout)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                if on_layer_done:
+                    on_layer_done(int((time.perf_counter() - st) * 1000), True)
+                raise
+            if on_layer_done:
+                on_layer_done(int((time.perf_counter() - st) * 1000), False)
+            return one
+
     def _slice_layers(self, text: str) -> List[str]:
         if not self.config.layered_extraction_enabled:
             return [text]
@@ -765,8 +831,15 @@ class EntityExtractionService:
         chunk_id: Optional[str] = None,
         min_length_override: Optional[int] = None,
         timeout_override: Optional[int] = None,
+        limiter: Optional[_AdaptiveLimiter] = None,
+        on_layer_done: Optional[Callable[[int, bool], None]] = None,
     ) -> Dict[str, Any]:
-        """从单个文本块提取实体和关系。"""
+        """
+        从单个文本块提取实体和关系。
+
+        长文本按层切分后各层并发抽取；传入 limiter 时每层调用各占一个并发名额，
+        与其他文本块共享同一并发预算。每层结果完成即写入分层缓存，任一层失败时其余层仍会完成并缓存。
+        """
         min_length = min_length_override if min_length_override is not None else self.config.min_text_length
         if len(text or "") < min_length:
             return {
@@ -797,18 +870,33 @@ class EntityExtractionService:
 
         timeout = int(timeout_override or self.config.timeout or 300)
         layers = self._slice_layers(normalized_text)
-        layer_results: List[Dict[str, Any]] = []
+        slots: List[Optional[Dict[str, Any]]] = [None] * len(layers)
+        pending: List[Tuple[int, str, str]] = []
 
-        for layer_text in layers:
+        for index, layer_text in enumerate(layers):
             layer_key = self._cache_key(layer_text, stage="layer")
             layer_cached = self._get_cached(layer_key)
             if layer_cached is not None:
-                layer_results.append(self._bind_chunk_context(layer_cached, chunk_id))
-                continue
+                slots[index] = self._bind_chunk_context(layer_cached, chunk_id)
+            else:
+                pending.append((index, layer_text, layer_key))
 
-            one = await self._extract_once(layer_text, chunk_id=None, timeout=timeout)
+        async def _run_layer(index: int, layer_text: str, layer_key: str) -> None:
+            one = await self._extract_layer(layer_text, timeout, limiter, on_layer_done)
             await self._append_cache(layer_key, one)
-            layer_results.append(self._bind_chunk_context(one, chunk_id))
+            slots[index] = self._bind_chunk_context(one, chunk_id)
+
+        if pending:
+            outcomes = await asyncio.gather(
+                *(_run_layer(index, layer_text, layer_key) for index, layer_text, layer_key in pending),
+                return_exceptions=True,
+            )
+            errors = [outcome for outcome in outcomes if isinstance(outcome, BaseException)]
+            if errors:
+                raise errors[0]
+
+        # 按层序合并，保证与顺序抽取的结果一致
+        layer_results: List[Dict[str, Any]] = [item for item in slots if item is not None]
 
         merged_entities, merged_relations = self.merge_extraction_results(layer_results)
         metrics = {
@@ -836,112 +924,137 @@ class EntityExtractionService:
         await self._append_cache(cache_key, self._bind_chunk_context(payload, chunk_id=None))
         return payload
 
-    async def batch_extract(
+    def _empty_result(self, chunk_id: Optional[str], failed: bool = False, error: Optional[str] = None) -> Dict[str, Any]:
+        payload: Dict[str, Any] = {
+            "entities": [],
+            "relations": [],
+            "chunk_id": chunk_id,
+            "metrics": {
+                "dropped_relation_endpoints": 0,
+                "raw_entity_count": 0,
+                "raw_relation_count": 0,
+                "failed": failed,
+                "parse_failed": False,
+                "llm_empty": False,
+            },
+        }
+        if error is not None:
+            payload["error"] = error
+        return payload
+
+    async def iter_extract(
         self,
         texts: List[Tuple[str, Optional[str]]],
         concurrency: int = None,
-    ) -> List[Dict[str, Any]]:
-        """批量并发提取实体和关系（异步队列 + 自适应并发/超时）。"""
+    ) -> AsyncGenerator[Tuple[int, Dict[str, Any]], None]:
+        """
+        流式并发抽取：按完成顺序产出 (原始下标, 抽取结果)。
+
+        - 所有文本进入同一个共享队列，空闲 worker 立即领取下一条（无批次屏障）
+        - 并发名额按 LLM 调用计：长文本块的各层并发抽取，与其他文本块共用服务级限流器
+        - 并发上限与超时基于最近 queue_batch_size 次调用（名额内耗时，不含排队）的滑动窗口自适应调整，
+          每次调整后至少再观察一个窗口长度才会再次调整
+        """
         if not texts:
-            return []
+            return
 
         min_cc = max(1, int(self.config.min_concurrency or 1))
         max_cc = max(min_cc, int(self.config.max_concurrency or min_cc))
-        current_cc = int(concurrency or self.config.batch_size or min_cc)
-        current_cc = max(min_cc, min(max_cc, current_cc))
-        current_timeout = int(self.config.timeout or 300)
-        queue_batch_size = max(1, int(self.config.queue_batch_size or 16))
-
-        results: List[Dict[str, Any]] = [
-            {
-                "entities": [],
-                "relations": [],
-                "chunk_id": chunk_id,
-                "metrics": {
-                    "dropped_relation_endpoints": 0,
-                    "raw_entity_count": 0,
-                    "raw_relation_count": 0,
-                    "failed": False,
-                    "parse_failed": False,
-                    "llm_empty": False,
-                },
-            }
-            for _, chunk_id in texts
-        ]
-
-        for offset in range(0, len(texts), queue_batch_size):
-            batch_items = texts[offset: offset + queue_batch_size]
-            queue: asyncio.Queue = asyncio.Queue()
-            for index, item in enumerate(batch_items, start=offset):
-                await queue.put((index, item[0], item[1]))
-
-            errors = 0
-            latencies: List[int] = []
+        limiter = self._get_limiter()
+        if concurrency and limiter.idle:
+            limiter.set_limit(max(min_cc, min(max_cc, int(concurrency))))
+        window_size = max(1, int(self.config.queue_batch_size or 16))
+        target_latency = int(self.config.target_latency_ms or 2500)
+        timeout_step = int(self.config.timeout_step_seconds or 30)
+
+        state = {
+            "timeout": int(self.config.timeout or 300),
+            "since_adjust": 0,
+        }
+        window: Deque[Tuple[int, bool]] = deque(maxlen=window_size)
 
-            async def worker() -> None:
-                nonlocal errors
-                while True:
-                    try:
-                        index, item_text, chunk_id = queue.get_nowait()
-                    except asyncio.QueueEmpty:
-                        return
+        work_queue: asyncio.Queue = asyncio.Queue()
+        for index, (item_text, chunk_id) in enumerate(texts):
+            work_queue.put_nowait((index, item_text, chunk_id))
+        done_queue: asyncio.Queue = asyncio.Queue()
 
-                    st = time.perf_counter()
-                    try:
-                        result_item = await self.extract_from_text(
-                            item_text,
-                            chunk_id,
-                            timeout_override=current_timeout,
-                        )
-                        results[index] = result_item
-                    except Exception as error:
-                        errors += 1
-                        logger.error("批量抽取任务失败: idx=%s, chunk_id=%s, error=%s", index, chunk_id, str(error))
-                        results[index] = {
-                            "entities": [],
-                            "relations": [],
-                            "chunk_id": chunk_id,
-                            "metrics": {
-                                "dropped_relation_endpoints": 0,
-                                "raw_entity_count": 0,
-                                "raw_relation_count": 0,
-                                "failed": True,
-                                "parse_failed": False,
-                                "llm_empty": False,
-                            },
-                            "error": str(error),
-                        }
-                    finally:
-                        latencies.append(int((time.perf_counter() - st) * 1000))
-                        queue.task_done()
+        def _on_layer_done(latency_ms: int, failed: bool) -> None:
+            # 在释放名额前调整上限，释放时的 notify 即可让等待者按新上限放行
+            window.append((latency_ms, failed))
+            _adjust()
 
-            workers = [asyncio.create_task(worker()) for _ in range(current_cc)]
-            await queue.join()
-            await asyncio.gather(*workers, return_exceptions=True)
+        def _adjust() -> None:
+            if not self.config.adaptive_concurrency_enabled:
+                return
+            state["since_adjust"] += 1
+            if len(window) < window_size or state["since_adjust"] < window_size:
+                return
 
-            if self.config.adaptive_concurrency_enabled:
-                avg_latency = int(sum(latencies) / len(latencies)) if latencies else 0
-                err_ratio = errors / max(1, len(batch_items))
-                target_latency = int(self.config.target_latency_ms or 2500)
-                timeout_step = int(self.config.timeout_step_seconds or 30)
+            latencies = [latency for latency, _ in window]
+            avg_latency = int(sum(latencies) / len(latencies)) if latencies else 0
+            err_ratio = sum(1 for _, failed in window if failed) / len(window)
+            previous = (limiter.limit, state["timeout"])
 
-                if err_ratio > 0.2 or (avg_latency and avg_latency > int(target_latency * 1.4)):
-                    current_cc = max(min_cc, current_cc - 1)
-                    current_timeout = min(600, current_timeout + timeout_step)
-                elif err_ratio == 0 and avg_latency and avg_latency < int(target_latency * 0.7):
-                    current_cc = min(max_cc, current_cc + 1)
-                    current_timeout = max(60, current_timeout - timeout_step)
+            if err_ratio > 0.2 or (avg_latency and avg_latency > int(target_latency * 1.4)):
+                limiter.set_limit(max(min_cc, limiter.limit - 1))
+                state["timeout"] = min(600, state["timeout"] + timeout_step)
+            elif err_ratio == 0 and avg_latency and avg_latency < int(target_latency * 0.7):
+                limiter.set_limit(min(max_cc, limiter.limit + 1))
+                state["timeout"] = max(60, state["timeout"] - timeout_step)
 
+            if (limiter.limit, state["timeout"]) != previous:
+                state["since_adjust"] = 0
                 logger.info(
-                    "抽取队列批次完成: offset=%s, size=%s, cc=%s, timeout=%s, avg_latency_ms=%s, err_ratio=%.2f",
-                    offset,
-                    len(batch_items),
-                    current_cc,
-                    current_timeout,
+                    "抽取并发调整: cc=%s, timeout=%s, window_avg_latency_ms=%s, err_ratio=%.2f",
+                    limiter.limit,
+                    state["timeout"],
                     avg_latency,
                     err_ratio,
                 )
 
+        async def worker() -> None:
+            while True:
+                try:
+                    index, item_text, chunk_id = work_queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+
+                try:
+                    result_item = await self.extract_from_text(
+                        item_text,
+                        chunk_id,
+                        timeout_override=state["timeout"],
+                        limiter=limiter,
+                        on_layer_done=_on_layer_done,
+                    )
+                except asyncio.CancelledError:
+                    raise
+                except Exception as error:
+                    logger.error("批量抽取任务失败: idx=%s, chunk_id=%s, error=%s", index, chunk_id, str(error))
+                    result_item = self._empty_result(chunk_id, failed=True, error=str(error))
+                await done_queue.put((index, result_item))
+
+        workers = [asyncio.create_task(worker()) for _ in range(min(max_cc, len(texts)))]
+        try:
+            for _ in range(len(texts)):
+                yield await done_queue.get()
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+    async def batch_extract(
+        self,
+        texts: List[Tuple[str, Optional[str]]],
+        concurrency: int = None,
+    ) -> List[Dict[str, Any]]:
+        """批量并发提取实体和关系（共享队列 + 滑动窗口自适应并发/超时），结果与输入顺序一致。"""
+        if not texts:
+            return []
+
+        results: List[Dict[str, Any]] = [self._empty_result(chunk_id) for _, chunk_id in texts]
+        async for index, result_item in self.iter_extract(texts, concurrency=concurrency):
+            results[index] = result_item
         return results
 
     async def reclassify_unknowns(
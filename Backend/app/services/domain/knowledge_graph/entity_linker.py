@@ -0,0 +1,352 @@
+"""基于词典的查询实体链接（Aho-Corasick 多模式匹配）"""
+import re
+import threading
+import time
+import unicodedata
+from collections import deque
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+from app.core.config import settings
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+# 实体归一化时去除的分隔符（HybridRetrievalService / Neo4jGraphService 均经 normalize_entity_text 复用）
+_SEPARATOR_PATTERN = re.compile(r"[\s\-_/\\|·•,，。！？!?:：;；'\"“”‘’()（）\[\]{}<>《》、]")
+
+
+def normalize_entity_text(value: str) -> str:
+    """实体归一化：NFKC + 小写 + 去除常见分隔符"""
+    if not value:
+        return ""
+
+    text = unicodedata.normalize("NFKC", str(value)).strip().lower()
+    text = text.replace("（", "(").replace("）", ")")
+    return _SEPARATOR_PATTERN.sub("", text)
+
+
+def _normalize_with_offsets(value: str) -> Tuple[str, List[int]]:
+    """逐字符归一化查询，同时记录每个归一化字符在原文中的位置"""
+    chars: List[str] = []
+    offsets: List[int] = []
+    for index, raw_char in enumerate(str(value or "")):
+        for char in unicodedata.normalize("NFKC", raw_char).lower():
+            if _SEPARATOR_PATTERN.match(char):
+                continue
+            chars.append(char)
+            offsets.append(index)
+    return "".join(chars), offsets
+
+
+def _is_ascii_word_char(char: str) -> bool:
+    return bool(char) and char.isascii() and char.isalnum()
+
+
+class _AhoCorasickAutomaton:
+    """
+    字符级 Aho-Corasick 自动机
+
+    - 插入只修改字典树并标记 dirty，失败指针在下一次匹配前统一重建
+    - 匹配为单次线性扫描，输出 (end_index, pattern)
+    """
+
+    def __init__(self):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._output: List[Optional[str]] = [None]
+        self._fail: List[int] = [0]
+        self._dict_link: List[int] = [0]
+        self._dirty = False
+        self.pattern_count = 0
+
+    def add(self, pattern: str) -> bool:
+        node = 0
+        for char in pattern:
+            next_node = self._goto[node].get(char)
+            if next_node is None:
+                next_node = len(self._goto)
+                self._goto[node][char] = next_node
+                self._goto.append({})
+                self._output.append(None)
+            node = next_node
+        if self._output[node] is not None:
+            return False
+        self._output[node] = pattern
+        self.pattern_count += 1
+        self._dirty = True
+        return True
+
+    def build(self) -> None:
+        if not self._dirty:
+            return
+        node_count = len(self._goto)
+        fail = [0] * node_count
+        dict_link = [0] * node_count
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                fallback = fail[node]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = fail[fallback]
+                target = self._goto[fallback].get(char, 0)
+                fail[child] = target
+                # 沿失败链最近的一个终止节点，匹配时只需跳跃输出节点
+                dict_link[child] = target if self._output[target] is not None else dict_link[target]
+                queue.append(child)
+        self._fail = fail
+        self._dict_link = dict_link
+        self._dirty = False
+
+    def iter_matches(self, text: str) -> Iterable[Tuple[int, str]]:
+        node = 0
+        goto = self._goto
+        for index, char in enumerate(text):
+            while node and char not in goto[node]:
+                node = self._fail[node]
+            node = goto[node].get(char, 0)
+            current = node
+            while current:
+                pattern = self._output[current]
+                if pattern is not None:
+                    yield index, pattern
+                current = self._dict_link[current]
+
+
+class _EntityDictionary:
+    """单个知识库的实体词典"""
+
+    def __init__(self):
+        self.automaton = _AhoCorasickAutomaton()
+        self.targets: Dict[str, Dict[str, str]] = {}
+        self.entity_names: set = set()
+        self.loaded_at = time.time()
+        self.lock = threading.Lock()
+
+
+class EntityLinker:
+    """
+    查询实体链接器
+
+    - 每个知识库一份内存词典，由 Neo4j Entity 的 name/canonical_name/normalized_name/aliases 构成
+    - 查询经同一归一化后做 Aho-Corasick 扫描，取最长且不重叠的匹配
+    - batch_import_entities 导入后增量加入；删除/回滚时整库失效，下次查询重新加载
+    - 定期全量刷新，兼容多 worker 进程各自导入的情况
+    """
+
+    def __init__(
+        self,
+        loader: Optional[Callable[[int], List[Dict[str, Any]]]] = None,
+        min_pattern_length: int = 2,
+        refresh_seconds: float = 600,
+        max_matches: int = 8
+    ):
+        self._loader = loader
+        self.min_pattern_length = max(1, int(min_pattern_length))
+        self.refresh_seconds = float(refresh_seconds or 0)
+        self.max_matches = max(1, int(max_matches))
+        self._dictionaries: Dict[int, _EntityDictionary] = {}
+        self._lock = threading.Lock()
+        self._load_locks: Dict[int, threading.Lock] = {}
+
+    # ==================== 词典维护 ====================
+
+    def _load_entities(self, kb_id: int) -> List[Dict[str, Any]]:
+        if self._loader is not None:
+            return self._loader(kb_id)
+        from app.services.domain.knowledge_graph.neo4j_graph_service import get_neo4j_graph_service
+        return get_neo4j_graph_service().get_entity_dictionary(kb_id)
+
+    def _entity_patterns(self, entity: Dict[str, Any]) -> List[str]:
+        attributes = entity.get("attributes") if isinstance(entity.get("attributes"), dict) else {}
+        aliases = entity.get("aliases") or attributes.get("aliases") or []
+        if isinstance(aliases, str):
+            aliases = [aliases]
+        raw_values = [
+            entity.get("canonical_name"),
+            entity.get("name"),
+            entity.get("normalized_name"),
+            *aliases
+        ]
+        patterns: List[str] = []
+        for value in raw_values:
+            pattern = normalize_entity_text(value or "")
+            if len(pattern) < self.min_pattern_length or pattern.isdigit():
+                continue
+            if pattern not in patterns:
+                patterns.append(pattern)
+        return patterns
+
+    def _add_to_dictionary(self, dictionary: _EntityDictionary, entities: Iterable[Dict[str, Any]]) -> int:
+        added = 0
+        for entity in entities:
+            if not isinstance(entity, dict):
+                continue
+            name = str(entity.get("name") or entity.get("canonical_name") or "").strip()
+            if not name:
+                continue
+            canonical_name = str(entity.get("canonical_name") or name).strip()
+            target = {"name": name, "canonical_name": canonical_name}
+            for pattern in self._entity_patterns(entity):
+                existing = dictionary.targets.get(pattern)
+                # 同一模式对应多个实体时，优先保留规范名与模式一致的实体
+                if existing is not None and normalize_entity_text(existing["canonical_name"]) == pattern:
+                    continue
+                dictionary.targets[pattern] = target
+                dictionary.automaton.add(pattern)
+            if canonical_name not in dictionary.entity_names:
+                dictionary.entity_names.add(canonical_name)
+                added += 1
+        return added
+
+    def _is_expired(self, dictionary: _EntityDictionary) -> bool:
+        return self.refresh_seconds > 0 and time.time() - dictionary.loaded_at > self.refresh_seconds
+
+    def is_loaded(self, kb_id: int) -> bool:
+        with self._lock:
+            dictionary = self._dictionaries.get(kb_id)
+        return dictionary is not None and not self._is_expired(dictionary)
+
+    def ensure_loaded(self, kb_id: int) -> _EntityDictionary:
+        """加载（或刷新）知识库词典；同一知识库并发调用只加载一次"""
+        with self._lock:
+            dictionary = self._dictionaries.get(kb_id)
+            if dictionary is not None and not self._is_expired(dictionary):
+                return dictionary
+            load_lock = self._load_locks.setdefault(kb_id, threading.Lock())
+
+        with load_lock:
+            with self._lock:
+                dictionary = self._dictionaries.get(kb_id)
+                if dictionary is not None and not self._is_expired(dictionary):
+                    return dictionary
+
+            start = time.perf_counter()
+            fresh = _EntityDictionary()
+            entities = self._load_entities(kb_id)
+            self._add_to_dictionary(fresh, entities)
+            with fresh.lock:
+                fresh.automaton.build()
+            with self._lock:
+                self._dictionaries[kb_id] = fresh
+            logger.info(
+                "实体词典加载完成: kb_id=%s, entities=%s, patterns=%s, elapsed_ms=%.1f",
+                kb_id,
+                len(fresh.entity_names),
+                fresh.automaton.pattern_count,
+                (time.perf_counter() - start) * 1000
+            )
+            return fresh
+
+    def add_entities(self, kb_id: int, entities: List[Dict[str, Any]]) -> int:
+        """增量加入新导入的实体；词典尚未加载时跳过（首次查询时会全量加载）"""
+        with self._lock:
+            dictionary = self._dictionaries.get(kb_id)
+        if dictionary is None or not entities:
+            return 0
+        with dictionary.lock:
+            added = self._add_to_dictionary(dictionary, entities)
+            dictionary.automaton.build()
+        if added:
+            logger.debug("实体词典增量更新: kb_id=%s, added=%s", kb_id, added)
+        return added
+
+    def invalidate(self, kb_id: Optional[int] = None) -> None:
+        """使词典失效（实体被删除/回滚后调用）"""
+        with self._lock:
+            if kb_id is None:
+                self._dictionaries.clear()
+            else:
+                self._dictionaries.pop(kb_id, None)
+
+    # ==================== 链接 ====================
+
+    def link(self, kb_id: int, query: str, max_matches: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        在查询中识别知识库已有实体
+
+        Returns:
+            [{'name', 'canonical_name', 'matched_text', 'start'}]，按出现顺序排列
+        """
+        normalized, offsets = _normalize_with_offsets(query)
+        if not normalized:
+            return []
+
+        dictionary = self.ensure_loaded(kb_id)
+        with dictionary.lock:
+            dictionary.automaton.build()
+            raw_matches = [
+                (end - len(pattern) + 1, end, pattern)
+                for end, pattern in dictionary.automaton.iter_matches(normalized)
+            ]
+            targets = dictionary.targets
+
+        source = str(query)
+        candidates: List[Tuple[int, int, str]] = []
+        for start, end, pattern in raw_matches:
+            # 英文/数字模式要求原文词边界，避免 "ai" 命中 "said"
+            if _is_ascii_word_char(pattern[0]):
+                before = offsets[start] - 1
+                if before >= 0 and _is_ascii_word_char(source[before]):
+                    continue
+            if _is_ascii_word_char(pattern[-1]):
+                after = offsets[end] + 1
+                if after < len(source) and _is_ascii_word_char(source[after]):
+                    continue
+            candidates.append((start, end, pattern))
+
+        # 最长优先、不重叠
+        candidates.sort(key=lambda item: (-(item[1] - item[0]), item[0]))
+        occupied = [False] * len(normalized)
+        selected: List[Tuple[int, int, str]] = []
+        for start, end, pattern in candidates:
+            if any(occupied[start:end + 1]):
+                continue
+            for position in range(start, end + 1):
+                occupied[position] = True
+            selected.append((start, end, pattern))
+        selected.sort(key=lambda item: item[0])
+
+        limit = max_matches or self.max_matches
+        linked: List[Dict[str, Any]] = []
+        seen = set()
+        for start, end, pattern in selected:
+            target = targets.get(pattern)
+            if target is None or target["canonical_name"] in seen:
+                continue
+            seen.add(target["canonical_name"])
+            linked.append({
+                "name": target["name"],
+                "canonical_name": target["canonical_name"],
+                "matched_text": source[offsets[start]:offsets[end] + 1],
+                "start": offsets[start]
+            })
+            if len(linked) >= limit:
+                break
+        return linked
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            dictionaries = dict(self._dictionaries)
+        return {
+            str(kb_id): {
+                "entities": len(dictionary.entity_names),
+                "patterns": dictionary.automaton.pattern_count,
+                "age_seconds": round(time.time() - dictionary.loaded_at, 1)
+            }
+            for kb_id, dictionary in dictionaries.items()
+        }
+
+
+_entity_linker_instance: Optional[EntityLinker] = None
+
+
+def get_entity_linker() -> EntityLinker:
+    """获取实体链接器单例"""
+    global _entity_linker_instance
+    if _entity_linker_instance is None:
+        config = settings.hybrid_retrieval
+        _entity_linker_instance = EntityLinker(
+            min_pattern_length=getattr(config, "entity_linker_min_pattern_length", 2),
+            refresh_seconds=getattr(config, "entity_linker_refresh_seconds", 600),
+            max_matches=getattr(config, "entity_linker_max_matches", 8)
+        )
+    return _entity_linker_instance
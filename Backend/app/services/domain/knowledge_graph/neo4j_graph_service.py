@@ -1,14 +1,17 @@
 """Neo4j图数据库服务"""
 import json
 import re
-import unicodedata
 from typing import List, Dict, Any, Optional
-from neo4j import GraphDatabase, Driver, Session
+from neo4j import GraphDatabase, Driver
 from app.core.config import settings
+from app.services.domain.knowledge_graph.entity_linker import get_entity_linker, normalize_entity_text
 from app.utils.logger import get_logger
 
 logger = get_logger(__name__)
 
+# 实体匹配阶段（按优先级）
+_MATCH_STAGES = ("exact", "normalized", "split", "code_contains")
+
 
 class Neo4jGraphService:
     """Neo4j图谱服务"""
@@ -102,13 +105,7 @@ class Neo4jGraphService:
 
     def _normalize_lookup_key(self, value: str) -> str:
         """归一化实体匹配键：大小写折叠+全半角兼容+去除常见分隔符。"""
-        if not value:
-            return ""
-
-        text = unicodedata.normalize("NFKC", str(value)).strip().lower()
-        text = text.replace("（", "(").replace("）", ")")
-        text = re.sub(r"[\s\-_/\\|·•,，。！？!?:：;；'\"“”‘’()（）\[\]{}<>《》、]+", "", text)
-        return text
+        return normalize_entity_text(value)
 
     def _build_match_candidates(self, name: str, candidates: Optional[List[str]] = None) -> Dict[str, List[str]]:
         """构建实体匹配候选（原始+标准化）。"""
@@ -148,44 +145,177 @@ class Neo4jGraphService:
                 code_keys.append(key)
         return code_keys
 
-    def _query_entity_with_relations(self, session: Session, kb_id: int, where_clause: str, params: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    # 各匹配阶段的过滤条件（顺序即 _MATCH_STAGES），以及该阶段要求请求中非空的字段
+    _RESOLVE_STAGE_FILTERS = (
+        ("e.name = req.name OR e.canonical_name = req.name OR req.name IN coalesce(e.aliases, [])", None),
+        ("e.normalized_name IN req.normalized", "normalized"),
+        ("e.name IN req.raw OR e.canonical_name IN req.raw "
+         "OR any(alias IN coalesce(e.aliases, []) WHERE alias IN req.raw)", "raw"),
+        ("any(code_key IN req.code_keys WHERE e.normalized_name CONTAINS code_key)", "code_keys"),
+    )
+
+    def _resolve_entities_tx(self, tx, kb_id: int, requests: List[Dict[str, Any]]) -> Dict[int, Dict[str, Any]]:
+        """
+        按 exact/normalized/split/code_contains 顺序逐阶段匹配，每个阶段一次 UNWIND
+
+        后续阶段只对仍未命中的请求执行：常见的精确命中只需一次查询，不会再触发 CONTAINS 等全量扫描
+        """
+        resolved: Dict[int, Dict[str, Any]] = {}
+        for stage_rank, (condition, required_field) in enumerate(self._RESOLVE_STAGE_FILTERS):
+            pending = [
+                item for item in requests
+                if item['idx'] not in resolved and (required_field is None or item.get(required_field))
+            ]
+            if not pending:
+                continue
+
+            query = f"""
+            UNWIND $requests AS req
+            MATCH (e:Entity {{kb_id: $kb_id}})
+            WHERE {condition}
+            WITH req, e
+            ORDER BY req.idx ASC, coalesce(e.mention_count, 0) DESC,
+                     coalesce(e.confidence, 0.0) DESC, size(coalesce(e.name, "")) ASC
+            WITH req.idx AS idx, collect(e)[0] AS e
+            OPTIONAL MATCH (e)-[r_out:RELATES]->(target:Entity)
+            WITH idx, e, collect(DISTINCT {{target: target.name, relation: r_out.type}}) AS out_relations
+            OPTIONAL MATCH (source:Entity)-[r_in:RELATES]->(e)
+            WITH idx, e, out_relations, collect(DISTINCT {{source: source.name, relation: r_in.type}}) AS in_relations
+            RETURN idx,
+                   e.name as name,
+                   e.canonical_name as canonical_name,
+                   e.normalized_name as normalized_name,
+                   e.type as type,
+                   e.labels as labels,
+                   properties(e) as attributes,
+                   out_relations,
+                   in_relations
+            """
+
+            for record in tx.run(query, kb_id=kb_id, requests=pending):
+                resolved[int(record['idx'])] = {
+                    'name': record['name'],
+                    'canonical_name': record.get('canonical_name'),
+                    'normalized_name': record.get('normalized_name'),
+                    'type': record['type'],
+                    'labels': record.get('labels', []),
+                    'attributes': dict(record['attributes']),
+                    'out_relations': [r for r in record['out_relations'] if r['target'] is not None],
+                    'in_relations': [r for r in record['in_relations'] if r['source'] is not None],
+                    'match_stage': _MATCH_STAGES[stage_rank],
+                    'matched_entity': record['name']
+                }
+            if len(resolved) == len(requests):
+                break
+        return resolved
+
+    def _find_neighbors_tx(
+        self,
+        tx,
+        kb_id: int,
+        anchors: List[str],
+        max_hops: int,
+        max_results: int
+    ) -> Dict[str, List[Dict[str, Any]]]:
+        """一次 UNWIND 为多个锚点实体做 1..N 跳遍历，每个锚点各自限制返回数量。"""
         query = f"""
-         MATCH (e:Entity {{kb_id: $kb_id}})
-         WHERE {where_clause}
-        OPTIONAL MATCH (e)-[r_out:RELATES]->(target:Entity)
-        OPTIONAL MATCH (source:Entity)-[r_in:RELATES]->(e)
-                WITH e,
-                         collect(DISTINCT {{target: target.name, relation: r_out.type}}) as out_relations,
-                         collect(DISTINCT {{source: source.name, relation: r_in.type}}) as in_relations
-        RETURN e.name as name,
-             e.canonical_name as canonical_name,
-             e.normalized_name as normalized_name,
-               e.type as type,
-             e.labels as labels,
-               properties(e) as attributes,
-                             out_relations,
-                             in_relations
-                ORDER BY coalesce(e.mention_count, 0) DESC, coalesce(e.confidence, 0.0) DESC, size(coalesce(e.name, "")) ASC
-        LIMIT 1
+        UNWIND $anchors AS anchor
+        CALL {{
+            WITH anchor
+            MATCH (e:Entity {{kb_id: $kb_id}})
+            WHERE e.name = anchor OR e.canonical_name = anchor OR anchor IN coalesce(e.aliases, [])
+            MATCH path = (e)-[r:RELATES*1..{max_hops}]-(related:Entity)
+            WHERE related.name <> e.name
+            WITH DISTINCT related,
+                 [rel in relationships(path) | rel.type] as relations,
+                 reduce(chunks = [], rel IN relationships(path) | chunks + coalesce(rel.chunk_ids, [])) as evidence_chunks,
+                 length(path) as hop
+            RETURN related.name as entity,
+                   related.type as type,
+                   related.labels as labels,
+                   relations,
+                   evidence_chunks,
+                   hop
+            ORDER BY hop ASC, entity ASC
+            LIMIT $limit
+        }}
+        RETURN anchor, entity, type, labels, relations, evidence_chunks, hop
         """
 
-        record = session.run(query, kb_id=kb_id, **params).single()
-        if not record:
-            return None
+        neighbors: Dict[str, List[Dict[str, Any]]] = {anchor: [] for anchor in anchors}
+        for record in tx.run(query, kb_id=kb_id, anchors=anchors, limit=max_results):
+            neighbors.setdefault(record['anchor'], []).append({
+                'entity': record['entity'],
+                'type': record['type'],
+                'labels': record.get('labels', []),
+                'relations': record['relations'],
+                'evidence_chunks': list(dict.fromkeys(record.get('evidence_chunks') or []))[:5],
+                'hop': record['hop']
+            })
+        return neighbors
+
+    def resolve_entities(
+        self,
+        kb_id: int,
+        queries: List[Dict[str, Any]],
+        max_hops: int = 2,
+        max_related: int = 5
+    ) -> List[Optional[Dict[str, Any]]]:
+        """
+        批量解析查询实体并展开邻居（单个读事务；匹配按阶段逐次查询，仅未命中的请求进入下一阶段）
 
-        out_relations = [r for r in record['out_relations'] if r['target'] is not None]
-        in_relations = [r for r in record['in_relations'] if r['source'] is not None]
+        Args:
+            kb_id: 知识库ID
+            queries: [{'entity': 实体名, 'candidates': [拆分候选...]}, ...]
+            max_hops: 邻居最大跳数（<=0 不展开）
+            max_related: 每个实体最多返回的邻居数
 
-        return {
-            'name': record['name'],
-            'canonical_name': record.get('canonical_name'),
-            'normalized_name': record.get('normalized_name'),
-            'type': record['type'],
-            'labels': record.get('labels', []),
-            'attributes': dict(record['attributes']),
-            'out_relations': out_relations,
-            'in_relations': in_relations
-        }
+        Returns:
+            与 queries 对齐的列表；命中项同 get_entity_info 结构，并附带 related 邻居列表
+        """
+        requests: List[Dict[str, Any]] = []
+        for index, item in enumerate(queries):
+            entity = str(item.get('entity') or '').strip()
+            if not entity:
+                continue
+            candidate_pack = self._build_match_candidates(entity, item.get('candidates'))
+            requests.append({
+                'idx': index,
+                'name': entity,
+                'normalized': candidate_pack['normalized'],
+                'raw': candidate_pack['raw'],
+                'code_keys': self._extract_code_like_keys(candidate_pack['normalized'])
+            })
+
+        results: List[Optional[Dict[str, Any]]] = [None] * len(queries)
+        if not requests:
+            return results
+
+        def _work(tx):
+            resolved = self._resolve_entities_tx(tx, kb_id, requests)
+            anchors = list(dict.fromkeys(item['name'] for item in resolved.values() if item.get('name')))
+            neighbors: Dict[str, List[Dict[str, Any]]] = {}
+            if anchors and max_hops > 0:
+                neighbors = self._find_neighbors_tx(tx, kb_id, anchors, int(max_hops), int(max_related))
+            return resolved, neighbors
+
+        try:
+            with self.driver.session() as session:
+                resolved, neighbors = session.execute_read(_work)
+        except Exception as e:
+            logger.error(f"批量解析实体失败: {str(e)}")
+            return results
+
+        for index, entity_data in resolved.items():
+            entity_data['related'] = neighbors.get(entity_data.get('name'), [])
+            results[index] = entity_data
+        logger.debug(
+            "批量解析实体完成: kb_id=%s, requested=%s, resolved=%s",
+            kb_id,
+            len(requests),
+            len(resolved)
+        )
+        return results
     
     def is_available(self) -> bool:
         """
@@ -232,19 +362,24 @@ class Neo4jGraphService:
             if not prepared_entities:
                 return 0
 
+            unknown_type = settings.knowledge_graph.entity_extraction.unknown_entity_type
+
+            # 同一 run 内可能分多次增量导入同一实体：mention_count 累加、标签/别名/chunk 取并集、
+            # 置信度取最大、已知类型不被 Unknown 覆盖；不同 run 之间仍以本次结果覆盖
             query = """
             UNWIND $entities AS entity
             MERGE (e:Entity {canonical_name: coalesce(entity.canonical_name, entity.name), kb_id: $kb_id})
+            WITH entity, e,
+                 coalesce(e.last_run_id = $run_id, false) AS same_run,
+                 e.type AS prev_type,
+                 coalesce(e.labels, []) AS prev_labels,
+                 coalesce(e.aliases, []) AS prev_aliases,
+                 coalesce(e.chunk_ids, []) AS prev_chunk_ids,
+                 coalesce(e.mention_count, 0) AS prev_mentions,
+                 coalesce(e.confidence, 0.0) AS prev_confidence
             SET e.name = coalesce(entity.name, e.name),
-                e.type = entity.type,
-                e.labels = coalesce(entity.labels, e.labels, [entity.type]),
-                e.aliases = coalesce(entity.attributes.aliases, e.aliases, []),
                 e.normalized_name = coalesce(entity.normalized_name, e.normalized_name),
-                e.first_run_id = coalesce(e.first_run_id, $run_id),
-                e.confidence = coalesce(entity.confidence, e.confidence, 0.7),
-                e.mention_count = coalesce(entity.attributes.mention_count, e.mention_count, 0),
-                e.last_run_id = $run_id,
-                e.updated_at = datetime()
+                e.first_run_id = coalesce(e.first_run_id, $run_id)
             """
             
             # 处理属性
@@ -256,6 +391,40 @@ class Neo4jGraphService:
                     ELSE {} 
                 END
                 """
+
+            query += """
+            WITH entity, e, same_run, prev_type, prev_labels, prev_aliases, prev_chunk_ids, prev_mentions, prev_confidence,
+                 coalesce(entity.labels, [entity.type]) AS new_labels,
+                 coalesce(entity.attributes.aliases, []) AS new_aliases,
+                 coalesce(entity.attributes.chunk_ids, []) AS new_chunk_ids,
+                 coalesce(entity.confidence, 0.7) AS new_confidence
+            SET e.type = CASE
+                    WHEN same_run AND entity.type = $unknown_type AND prev_type IS NOT NULL THEN prev_type
+                    ELSE entity.type
+                END,
+                e.labels = CASE
+                    WHEN same_run THEN prev_labels + [label IN new_labels WHERE NOT label IN prev_labels]
+                    ELSE new_labels
+                END,
+                e.aliases = CASE
+                    WHEN same_run THEN prev_aliases + [alias IN new_aliases WHERE NOT alias IN prev_aliases]
+                    ELSE new_aliases
+                END,
+                e.chunk_ids = CASE
+                    WHEN same_run THEN prev_chunk_ids + [chunk_id IN new_chunk_ids WHERE NOT chunk_id IN prev_chunk_ids]
+                    ELSE new_chunk_ids
+                END,
+                e.confidence = CASE
+                    WHEN same_run AND prev_confidence > new_confidence THEN prev_confidence
+                    ELSE new_confidence
+                END,
+                e.mention_count = CASE
+                    WHEN same_run THEN prev_mentions + coalesce(entity.attributes.mention_count, 1)
+                    ELSE coalesce(entity.attributes.mention_count, prev_mentions)
+                END,
+                e.last_run_id = $run_id,
+                e.updated_at = datetime()
+            """
             
             count = 0
             batch_size = 1000
@@ -267,7 +436,7 @@ class Neo4jGraphService:
                     # 使用显式事务确保提交
                     tx = session.begin_transaction()
                     try:
-                        result = tx.run(query, entities=batch, kb_id=kb_id, run_id=run_id)
+                        result = tx.run(query, entities=batch, kb_id=kb_id, run_id=run_id, unknown_type=unknown_type)
                         # 消费结果确保查询执行完成
                         summary = result.consume()
 
@@ -297,6 +466,9 @@ class Neo4jGraphService:
                 result = session.run(verify_query, kb_id=kb_id)
                 actual_count = result.single()["cnt"]
                 logger.info(f"批量导入实体成功: kb_id={kb_id}, 声称导入={count}, Neo4j实际={actual_count}")
+
+            # 查询实体词典增量更新
+            get_entity_linker().add_entities(kb_id, prepared_entities)
             return count
             
         except Exception as e:
@@ -362,9 +534,16 @@ class Neo4jGraphService:
             MERGE (s)-[r:RELATES {type: rel.relation}]->(t)
             SET r.updated_at = datetime(),
                 r.first_run_id = coalesce(r.first_run_id, $run_id),
-                r.confidence = coalesce(rel.confidence, r.confidence, 0.6),
+                r.confidence = CASE
+                    WHEN r.last_run_id = $run_id AND r.confidence > coalesce(rel.confidence, 0.6) THEN r.confidence
+                    ELSE coalesce(rel.confidence, r.confidence, 0.6)
+                END,
                 r.evidence_count = coalesce(r.evidence_count, 0) + coalesce(rel.evidence_count, 1),
-                r.chunk_ids = coalesce(rel.chunk_ids, r.chunk_ids, []),
+                r.chunk_ids = CASE
+                    WHEN r.last_run_id = $run_id
+                        THEN coalesce(r.chunk_ids, []) + [chunk_id IN coalesce(rel.chunk_ids, []) WHERE NOT chunk_id IN coalesce(r.chunk_ids, [])]
+                    ELSE coalesce(rel.chunk_ids, r.chunk_ids, [])
+                END,
                 r.attributes_json = coalesce(rel.attributes_json, r.attributes_json, '{}'),
                 r.last_run_id = $run_id
             """
@@ -400,9 +579,16 @@ class Neo4jGraphService:
             MERGE (s)-[r:RELATES {type: rel.relation}]->(t)
             SET r.updated_at = datetime(),
                 r.first_run_id = coalesce(r.first_run_id, $run_id),
-                r.confidence = coalesce(rel.confidence, r.confidence, 0.6),
+                r.confidence = CASE
+                    WHEN r.last_run_id = $run_id AND r.confidence > coalesce(rel.confidence, 0.6) THEN r.confidence
+                    ELSE coalesce(rel.confidence, r.confidence, 0.6)
+                END,
                 r.evidence_count = coalesce(r.evidence_count, 0) + coalesce(rel.evidence_count, 1),
-                r.chunk_ids = coalesce(rel.chunk_ids, r.chunk_ids, []),
+                r.chunk_ids = CASE
+                    WHEN r.last_run_id = $run_id
+                        THEN coalesce(r.chunk_ids, []) + [chunk_id IN coalesce(rel.chunk_ids, []) WHERE NOT chunk_id IN coalesce(r.chunk_ids, [])]
+                    ELSE coalesce(rel.chunk_ids, r.chunk_ids, [])
+                END,
                 r.attributes_json = coalesce(rel.attributes_json, r.attributes_json, '{}'),
                 r.last_run_id = $run_id
             """
@@ -643,6 +829,7 @@ class Neo4jGraphService:
                 ).single()
                 counters["chunks"] = int(chunk_record["deleted"]) if chunk_record else 0
 
+            get_entity_linker().invalidate(kb_id)
             logger.warning("图构建 run 回滚完成: kb_id=%s, run_id=%s, counters=%s", kb_id, run_id, counters)
             return counters
         except Exception as error:
@@ -673,49 +860,14 @@ class Neo4jGraphService:
             相关实体列表
         """
         try:
-            query = f"""
-             MATCH (e:Entity {{kb_id: $kb_id}})
-             WHERE e.name = $name OR e.canonical_name = $name OR $name IN coalesce(e.aliases, [])
-             MATCH path = (e)
-                         -[r:RELATES*1..{max_hops}]-
-                         (related:Entity)
-             WHERE related.name <> e.name
-            WITH DISTINCT related, 
-                 [rel in relationships(path) | rel.type] as relations,
-                                 reduce(chunks = [], rel IN relationships(path) | chunks + coalesce(rel.chunk_ids, [])) as evidence_chunks,
-                 length(path) as hop
-            RETURN related.name as entity,
-                   related.type as type,
-                 related.labels as labels,
-                   relations,
-                                     evidence_chunks,
-                   hop
-            ORDER BY hop ASC, entity ASC
-            LIMIT $limit
-            """
-            
             with self.driver.session() as session:
-                result = session.run(
-                    query,
-                    name=entity,
-                    kb_id=kb_id,
-                    limit=max_results
+                neighbors = session.execute_read(
+                    self._find_neighbors_tx, kb_id, [entity], int(max_hops), int(max_results)
                 )
-                
-                entities = []
-                for record in result:
-                    entities.append({
-                        'entity': record['entity'],
-                        'type': record['type'],
-                        'labels': record.get('labels', []),
-                        'relations': record['relations'],
-                        'evidence_chunks': list(dict.fromkeys(record.get('evidence_chunks') or []))[:5],
-                        'hop': record['hop']
-                    })
-                
-                logger.debug(f"图遍历完成: entity={entity}, found={len(entities)}")
-                return entities
-            
+            entities = neighbors.get(entity, [])
+            logger.debug(f"图遍历完成: entity={entity}, found={len(entities)}")
+            return entities
+
         except Exception as e:
             logger.error(f"图遍历失败: {str(e)}")
             return []
@@ -765,65 +917,35 @@ class Neo4jGraphService:
         Returns:
             实体信息字典
         """
+        results = self.resolve_entities(
+            kb_id,
+            [{'entity': entity, 'candidates': candidates}],
+            max_hops=0
+        )
+        entity_data = results[0] if results else None
+        if entity_data:
+            entity_data.pop('related', None)
+        return entity_data
+
+    def get_entity_dictionary(self, kb_id: int) -> List[Dict[str, Any]]:
+        """读取知识库全部实体的名称/规范名/别名，用于构建查询实体词典。"""
         try:
-            candidate_pack = self._build_match_candidates(entity, candidates)
-
             with self.driver.session() as session:
-                exact = self._query_entity_with_relations(
-                    session=session,
-                    kb_id=kb_id,
-                    where_clause="e.name = $name OR e.canonical_name = $name OR $name IN coalesce(e.aliases, [])",
-                    params={"name": entity}
+                records = session.run(
+                    """
+                    MATCH (e:Entity {kb_id: $kb_id})
+                    RETURN e.name as name,
+                           e.canonical_name as canonical_name,
+                           e.normalized_name as normalized_name,
+                           coalesce(e.aliases, []) as aliases
+                    """,
+                    kb_id=kb_id
                 )
-                if exact:
-                    exact['match_stage'] = 'exact'
-                    exact['matched_entity'] = exact.get('name')
-                    return exact
-
-                normalized_candidates = candidate_pack['normalized']
-                if normalized_candidates:
-                    normalized_match = self._query_entity_with_relations(
-                        session=session,
-                        kb_id=kb_id,
-                        where_clause="e.normalized_name IN $normalized_candidates",
-                        params={"normalized_candidates": normalized_candidates}
-                    )
-                    if normalized_match:
-                        normalized_match['match_stage'] = 'normalized'
-                        normalized_match['matched_entity'] = normalized_match.get('name')
-                        return normalized_match
-
-                split_candidates = candidate_pack['raw']
-                if split_candidates:
-                    split_match = self._query_entity_with_relations(
-                        session=session,
-                        kb_id=kb_id,
-                        where_clause="e.name IN $split_candidates OR e.canonical_name IN $split_candidates OR any(alias IN coalesce(e.aliases, []) WHERE alias IN $split_candidates)",
-                        params={"split_candidates": split_candidates}
-                    )
-                    if split_match:
-                        split_match['match_stage'] = 'split'
-                        split_match['matched_entity'] = split_match.get('name')
-                        return split_match
-
-                code_like_keys = self._extract_code_like_keys(normalized_candidates)
-                if code_like_keys:
-                    code_match = self._query_entity_with_relations(
-                        session=session,
-                        kb_id=kb_id,
-                        where_clause="any(code_key IN $code_like_keys WHERE e.normalized_name CONTAINS code_key)",
-                        params={"code_like_keys": code_like_keys}
-                    )
-                    if code_match:
-                        code_match['match_stage'] = 'code_contains'
-                        code_match['matched_entity'] = code_match.get('name')
-                        return code_match
-
-                return None
-
-        except Exception as e:
-            logger.error(f"获取实体信息失败: {str(e)}")
-            return None
+                return [dict(record) for record in records]
+        except Exception as error:
+            # 不返回空列表，避免把空词典缓存下来；由调用方回退到 LLM 抽取
+            logger.warning("读取实体词典失败: kb_id=%s, error=%s", kb_id, str(error))
+            raise
 
     def refresh_entity_normalized_names(self, kb_id: Optional[int] = None) -> int:
         """补写历史实体的 normalized_name 字段。"""
@@ -889,6 +1011,7 @@ class Neo4jGraphService:
                     deleted = summary.counters.nodes_deleted
                     tx.commit()
                     logger.info(f"删除图谱数据成功: kb_id={kb_id}, nodes={deleted}")
+                    get_entity_linker().invalidate(kb_id)
                     return deleted
                 except Exception as e:
                     tx.rollback()
@@ -987,6 +1110,7 @@ class Neo4jGraphService:
                     counters["entities_deleted"] = int(deleted_entity_record.get("deleted") or 0) if deleted_entity_record else 0
 
                     tx.commit()
+                    get_entity_linker().invalidate(kb_id)
                     logger.info(
                         "按文件清理图谱完成: kb_id=%s, file_id=%s, counters=%s",
                         kb_id,
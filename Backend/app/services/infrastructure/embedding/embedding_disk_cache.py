@@ -0,0 +1,226 @@
+"""持久化嵌入向量缓存（SQLite + float32 BLOB）"""
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional
+import numpy as np
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+# 单条 SQL 参数上限（SQLite 默认 999）
+_SQL_BATCH_SIZE = 500
+
+
+class EmbeddingDiskCache:
+    """
+    按内容寻址的持久化向量缓存
+
+    - 键为 EmbeddingService._build_cache_key（provider/model/role/文本哈希）
+    - 向量以 float32 BLOB 存储，读取时批量 IN 查询
+    - WAL 模式 + busy_timeout，多个 uvicorn worker / 脚本进程可安全并发读写
+    - 超出容量上限时按最近访问时间淘汰最旧的条目
+    - 任何存储错误只记录告警，调用方退化为直接编码
+    """
+
+    def __init__(self, path: str, max_size_mb: int = 2048, touch_interval_seconds: float = 300.0):
+        self.path = path
+        self.max_size_bytes = max(0, int(max_size_mb or 0)) * 1024 * 1024
+        self.touch_interval_seconds = max(0.0, float(touch_interval_seconds))
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self._evict_lock = threading.Lock()
+        self._writes_since_check = 0
+        self._stats: Dict[str, int] = {
+            "lookups": 0,
+            "hits": 0,
+            "misses": 0,
+            "writes": 0,
+            "evictions": 0,
+            "errors": 0
+        }
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._init_schema()
+        logger.info(f"持久化嵌入缓存: path={self.path}, max_size_mb={max_size_mb}")
+
+    # ==================== 连接 ====================
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("PRAGMA busy_timeout=30000")
+            self._local.connection = connection
+        return connection
+
+    def _init_schema(self) -> None:
+        connection = self._connect()
+        connection.execute(
+            """CREATE TABLE IF NOT EXISTS embeddings (
+                   cache_key TEXT PRIMARY KEY,
+                   dimension INTEGER NOT NULL,
+                   vector BLOB NOT NULL,
+                   last_access REAL NOT NULL
+               )"""
+        )
+        connection.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_access ON embeddings(last_access)")
+
+    def _record(self, **deltas: int) -> None:
+        with self._stats_lock:
+            for name, delta in deltas.items():
+                self._stats[name] = self._stats.get(name, 0) + delta
+
+    # ==================== 读写 ====================
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, np.ndarray]:
+        """批量查询，返回命中的 key -> float32 向量（只读）"""
+        unique_keys = list(dict.fromkeys(keys))
+        if not unique_keys:
+            return {}
+
+        found: Dict[str, np.ndarray] = {}
+        stale_keys: List[str] = []
+        now = time.time()
+        try:
+            connection = self._connect()
+            for start in range(0, len(unique_keys), _SQL_BATCH_SIZE):
+                batch = unique_keys[start:start + _SQL_BATCH_SIZE]
+                placeholders = ",".join("?" * len(batch))
+                rows = connection.execute(
+                    f"SELECT cache_key, vector, last_access FROM embeddings WHERE cache_key IN ({placeholders})",
+                    batch
+                ).fetchall()
+                for cache_key, blob, last_access in rows:
+                    found[cache_key] = np.frombuffer(blob, dtype=np.float32)
+                    if now - float(last_access) >= self.touch_interval_seconds:
+                        stale_keys.append(cache_key)
+
+            # 命中时刷新访问时间（按间隔节流，避免读路径频繁写库）
+            if stale_keys:
+                connection.executemany(
+                    "UPDATE embeddings SET last_access = ? WHERE cache_key = ?",
+                    [(now, cache_key) for cache_key in stale_keys]
+                )
+        except Exception as error:
+            self._record(errors=1)
+            logger.warning(f"持久化嵌入缓存读取失败: {str(error)}")
+            return found
+
+        self._record(lookups=len(unique_keys), hits=len(found), misses=len(unique_keys) - len(found))
+        return found
+
+    def put_many(self, items: Dict[str, Any]) -> None:
+        """批量写入（已存在则覆盖）"""
+        if not items:
+            return
+
+        now = time.time()
+        rows = []
+        for cache_key, vector in items.items():
+            array = np.asarray(vector, dtype=np.float32)
+            if array.size == 0:
+                continue
+            rows.append((cache_key, int(array.size), array.tobytes(), now))
+        if not rows:
+            return
+
+        try:
+            connection = self._connect()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                connection.executemany(
+                    "INSERT OR REPLACE INTO embeddings (cache_key, dimension, vector, last_access) VALUES (?, ?, ?, ?)",
+                    rows
+                )
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+        except Exception as error:
+            self._record(errors=1)
+            logger.warning(f"持久化嵌入缓存写入失败: {str(error)}")
+            return
+
+        self._record(writes=len(rows))
+        with self._evict_lock:
+            self._writes_since_check += len(rows)
+            should_check = self._writes_since_check >= 1000
+            if should_check:
+                self._writes_since_check = 0
+        if should_check:
+            self.evict_if_needed()
+
+    # ==================== 容量控制 ====================
+
+    def size_bytes(self) -> int:
+        """估算数据占用（已用页数 x 页大小；删除后的空闲页会被复用，不计入）"""
+        try:
+            connection = self._connect()
+            page_count = connection.execute("PRAGMA page_count").fetchone()[0]
+            freelist_count = connection.execute("PRAGMA freelist_count").fetchone()[0]
+            page_size = connection.execute("PRAGMA page_size").fetchone()[0]
+            return max(0, int(page_count) - int(freelist_count)) * int(page_size)
+        except Exception:
+            return 0
+
+    def evict_if_needed(self) -> int:
+        """超出容量时淘汰最久未访问的条目，返回淘汰数量"""
+        if self.max_size_bytes <= 0:
+            return 0
+
+        current_size = self.size_bytes()
+        if current_size <= self.max_size_bytes:
+            return 0
+
+        try:
+            connection = self._connect()
+            total_rows = connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            if not total_rows:
+                return 0
+            # 按比例淘汰到容量上限的 90%
+            ratio = 1.0 - (self.max_size_bytes * 0.9) / current_size
+            evict_count = max(1, int(total_rows * ratio))
+            connection.execute(
+                """DELETE FROM embeddings WHERE cache_key IN (
+                       SELECT cache_key FROM embeddings ORDER BY last_access ASC LIMIT ?
+                   )""",
+                (evict_count,)
+            )
+        except Exception as error:
+            self._record(errors=1)
+            logger.warning(f"持久化嵌入缓存淘汰失败: {str(error)}")
+            return 0
+
+        self._record(evictions=evict_count)
+        logger.info(f"持久化嵌入缓存淘汰: removed={evict_count}, size_before={current_size / 1024 / 1024:.1f}MB")
+        return evict_count
+
+    def clear(self) -> None:
+        """清空缓存"""
+        try:
+            self._connect().execute("DELETE FROM embeddings")
+        except Exception as error:
+            logger.warning(f"持久化嵌入缓存清空失败: {str(error)}")
+
+    def get_stats(self) -> Dict[str, object]:
+        """累计命中指标与容量"""
+        with self._stats_lock:
+            stats: Dict[str, object] = dict(self._stats)
+        lookups = int(stats.get("lookups", 0) or 0)
+        stats["hit_rate"] = round(int(stats.get("hits", 0) or 0) / lookups, 4) if lookups else 0.0
+        stats["size_mb"] = round(self.size_bytes() / 1024 / 1024, 1)
+        stats["max_size_mb"] = round(self.max_size_bytes / 1024 / 1024, 1)
+        stats["path"] = self.path
+        return stats
+
+    def close(self) -> None:
+        connection: Optional[sqlite3.Connection] = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
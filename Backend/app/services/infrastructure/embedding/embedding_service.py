@@ -1,9 +1,12 @@
 """嵌入模型服务"""
 import hashlib
 import os
+import threading
 from collections import OrderedDict
 from typing import Any, Dict, List, Optional, TYPE_CHECKING, Tuple
+import numpy as np
 from app.core.config import settings
+from app.services.infrastructure.telemetry.tracing import traced
 from app.utils.logger import get_logger
 
 if TYPE_CHECKING:
@@ -34,7 +37,19 @@ class EmbeddingService:
         self.default_batch_size = max(1, int(getattr(settings.embedding, 'batch_size', 32) or 32))
         self.max_length = max(1, int(getattr(settings.embedding, 'max_length', 512) or 512))
         self.vector_cache_size = max(0, int(getattr(settings.embedding, 'vector_cache_size', 5000) or 5000))
-        self._vector_cache: OrderedDict[str, List[float]] = OrderedDict()
+        # 缓存 float32 行向量（比 Python float 列表省约 8 倍内存）
+        self._vector_cache: OrderedDict[str, np.ndarray] = OrderedDict()
+        # 入库线程池与请求协程会并发编码，缓存与模型加载需加锁
+        self._cache_lock = threading.Lock()
+        self._model_lock = threading.RLock()
+        self._disk_cache = None
+        self._disk_cache_enabled = bool(getattr(settings.embedding, 'disk_cache_enabled', False))
+        self._cache_counters: Dict[str, int] = {
+            "requests": 0,
+            "memory_hit": 0,
+            "disk_hit": 0,
+            "encoded": 0
+        }
         
         # 确保模型目录存在
         os.makedirs(self.model_dir, exist_ok=True)
@@ -44,9 +59,35 @@ class EmbeddingService:
             f"max_length={self.max_length}, vector_cache_size={self.vector_cache_size}"
         )
 
-    def _build_cache_key(self, provider: str, model_name: str, text: str) -> str:
+    def _build_cache_key(self, provider: str, model_name: str, text: str, text_role: str = "document") -> str:
         digest = hashlib.sha1(text.encode('utf-8')).hexdigest()
-        return f"{provider}::{model_name}::{digest}"
+        # e5 类模型 query/passage 前缀不同，向量不可混用
+        role = text_role if self._needs_e5_prefix(model_name) else "any"
+        return f"{provider}::{model_name}::{role}::{digest}"
+
+    def _get_disk_cache(self):
+        """延迟初始化持久化缓存，初始化失败时关闭该层缓存"""
+        if not self._disk_cache_enabled:
+            return None
+        if self._disk_cache is None:
+            with self._cache_lock:
+                if self._disk_cache is None:
+                    try:
+                        from app.services.infrastructure.embedding.embedding_disk_cache import EmbeddingDiskCache
+                        self._disk_cache = EmbeddingDiskCache(
+                            path=str(settings.embedding.disk_cache_file),
+                            max_size_mb=int(getattr(settings.embedding, 'disk_cache_max_size_mb', 2048) or 0)
+                        )
+                    except Exception as error:
+                        logger.warning(f"持久化嵌入缓存初始化失败，仅使用内存缓存: {str(error)}")
+                        self._disk_cache_enabled = False
+                        return None
+        return self._disk_cache
+
+    def _count_cache(self, **deltas: int) -> None:
+        with self._cache_lock:
+            for name, delta in deltas.items():
+                self._cache_counters[name] = self._cache_counters.get(name, 0) + delta
 
     def _needs_e5_prefix(self, model_name: str) -> bool:
         return bool(getattr(settings.embedding, 'enable_e5_prefix', True)) and 'e5' in (model_name or '').lower()
@@ -67,20 +108,24 @@ class EmbeddingService:
             return [f"query: {text}" for text in texts]
         return [f"passage: {text}" for text in texts]
 
-    def _cache_get(self, key: str) -> Optional[List[float]]:
-        cached = self._vector_cache.get(key)
-        if cached is None:
-            return None
-        self._vector_cache.move_to_end(key)
-        return cached
+    def _cache_get(self, key: str) -> Optional[np.ndarray]:
+        with self._cache_lock:
+            cached = self._vector_cache.get(key)
+            if cached is None:
+                return None
+            self._vector_cache.move_to_end(key)
+            return cached
 
-    def _cache_set(self, key: str, embedding: List[float]) -> None:
+    def _cache_set(self, key: str, embedding: Any) -> None:
         if self.vector_cache_size <= 0:
             return
-        self._vector_cache[key] = embedding
-        self._vector_cache.move_to_end(key)
-        while len(self._vector_cache) > self.vector_cache_size:
-            self._vector_cache.popitem(last=False)
+        # 复制为独立行，避免行视图让整批矩阵常驻
+        embedding = np.array(embedding, dtype=np.float32)
+        with self._cache_lock:
+            self._vector_cache[key] = embedding
+            self._vector_cache.move_to_end(key)
+            while len(self._vector_cache) > self.vector_cache_size:
+                self._vector_cache.popitem(last=False)
     
     def _get_device(self) -> str:
         """获取可用设备（延迟导入torch）"""
@@ -93,6 +138,14 @@ class EmbeddingService:
         else:
             return 'cpu'
     
+    def _residency_key(self, model_name: str) -> str:
+        return f"embedding:{model_name}"
+
+    def _drop_model(self, model_name: str) -> None:
+        """常驻管理器淘汰回调：仅移除模型引用，保留向量缓存"""
+        with self._model_lock:
+            self.models.pop(model_name, None)
+
     def load_model(self, model_name: str) -> 'SentenceTransformer':
         """
         加载嵌入模型
@@ -104,35 +157,53 @@ class EmbeddingService:
             模型实例
         """
         from sentence_transformers import SentenceTransformer
-        
-        if model_name in self.models:
+        from app.services.infrastructure.model.residency_manager import get_model_residency_manager
+
+        residency_key = self._residency_key(model_name)
+        cached_model = self.models.get(model_name)
+        if cached_model is not None:
             logger.debug(f"使用缓存的模型: {model_name}")
-            return self.models[model_name]
+            get_model_residency_manager().touch(residency_key)
+            return cached_model
         
-        try:
-            logger.info(f"加载嵌入模型: {model_name}")
-            
-            # 模型路径
-            model_path = os.path.join(self.model_dir, model_name)
-            
-            # 如果本地存在则加载本地，否则从HuggingFace下载
-            if os.path.exists(model_path):
-                model = SentenceTransformer(model_path, device=self.device)
-                logger.info(f"从本地加载模型: {model_path}")
-            else:
-                model = SentenceTransformer(model_name, device=self.device)
-                # 保存到本地
-                model.save(model_path)
-                logger.info(f"从HuggingFace下载并保存模型: {model_path}")
-            
-            # 缓存模型
-            self.models[model_name] = model
-            
-            return model
-            
-        except Exception as e:
-            logger.error(f"加载模型失败: {str(e)}")
-            raise
+        with self._model_lock:
+            cached_model = self.models.get(model_name)
+            if cached_model is not None:
+                return cached_model
+
+            try:
+                logger.info(f"加载嵌入模型: {model_name}")
+                
+                # 模型路径
+                model_path = os.path.join(self.model_dir, model_name)
+                
+                # 如果本地存在则加载本地，否则从HuggingFace下载
+                if os.path.exists(model_path):
+                    model = SentenceTransformer(model_path, device=self.device)
+                    logger.info(f"从本地加载模型: {model_path}")
+                else:
+                    model = SentenceTransformer(model_name, device=self.device)
+                    # 保存到本地
+                    model.save(model_path)
+                    logger.info(f"从HuggingFace下载并保存模型: {model_path}")
+                
+                self.models[model_name] = model
+                
+            except Exception as e:
+                logger.error(f"加载模型失败: {str(e)}")
+                raise
+
+        # 在模型锁外登记常驻（超出内存预算时由常驻管理器按 LRU 淘汰）：
+        # register 会同步调用其它服务的卸载回调，持锁调用会与其它服务的模型锁形成死锁
+        get_model_residency_manager().register(
+            key=residency_key,
+            kind="embedding",
+            name=model_name,
+            model=model,
+            unload_fn=lambda: self._drop_model(model_name),
+            device=self.device
+        )
+        return model
     
     def encode(
         self,
@@ -154,11 +225,44 @@ class EmbeddingService:
             show_progress: 是否显示进度
             
         Returns:
-            向量列表
+            向量列表（需要 JSON 序列化的调用方使用；内部流水线请用 encode_array）
+        """
+        return self.encode_array(
+            texts,
+            model_name,
+            provider=provider,
+            batch_size=batch_size,
+            show_progress=show_progress,
+            text_role=text_role
+        ).tolist()
+
+    @traced("embedding")
+    def encode_array(
+        self,
+        texts: List[str],
+        model_name: str,
+        provider: str = "transformers",
+        batch_size: Optional[int] = None,
+        show_progress: bool = False,
+        text_role: str = "document"
+    ) -> np.ndarray:
+        """
+        将文本编码为 float32 矩阵 (n, d)
+        
+        Args:
+            texts: 文本列表
+            model_name: 模型名称
+            provider: 嵌入提供方，transformers或ollama，默认transformers
+            batch_size: 批次大小
+            show_progress: 是否显示进度
+            text_role: query|document（e5 前缀）
+            
+        Returns:
+            连续存储的 float32 矩阵
         """
         try:
             if not texts:
-                return []
+                return np.zeros((0, 0), dtype=np.float32)
             
             effective_batch_size = max(1, int(batch_size or self.default_batch_size))
 
@@ -170,7 +274,7 @@ class EmbeddingService:
             # 根据provider路由到不同的实现
             if provider == "ollama":
                 ollama_service = get_ollama_service()
-                return ollama_service.encode(texts, model_name, effective_batch_size, show_progress)
+                return ollama_service.encode_array(texts, model_name, effective_batch_size, show_progress)
             else:
                 # 默认使用transformers
                 prepared_texts = self._prepare_texts_for_model(texts, model_name, text_role)
@@ -186,7 +290,7 @@ class EmbeddingService:
         model_name: str,
         batch_size: int = 32,
         show_progress: bool = False
-    ) -> List[List[float]]:
+    ) -> np.ndarray:
         """
         使用Transformers编码文本
         
@@ -197,7 +301,7 @@ class EmbeddingService:
             show_progress: 是否显示进度
             
         Returns:
-            向量列表（已归一化）
+            float32 向量矩阵（已归一化）
         """
         import torch
         
@@ -216,15 +320,15 @@ class EmbeddingService:
                     convert_to_numpy=True,
                     normalize_embeddings=True
                 )
-                embeddings_list = embeddings.tolist()
+                embeddings = np.asarray(embeddings, dtype=np.float32)
 
                 logger.info(
-                    f"Transformers编码完成: vectors={len(embeddings_list)}, "
-                    f"dimension={len(embeddings_list[0]) if embeddings_list else 0}, "
+                    f"Transformers编码完成: vectors={embeddings.shape[0]}, "
+                    f"dimension={embeddings.shape[1] if embeddings.ndim == 2 else 0}, "
                     f"batch_size={current_batch_size}, max_seq_length={model.max_seq_length}"
                 )
 
-                return embeddings_list
+                return embeddings
 
             except RuntimeError as error:
                 last_error = error
@@ -247,7 +351,7 @@ class EmbeddingService:
         
         if last_error:
             raise last_error
-        return []
+        return np.zeros((0, 0), dtype=np.float32)
 
     def encode_with_cache(
         self,
@@ -257,39 +361,51 @@ class EmbeddingService:
         batch_size: Optional[int] = None,
         show_progress: bool = False,
         text_role: str = "document"
-    ) -> Tuple[List[List[float]], Dict[str, Any]]:
-        """编码文本并复用内存缓存，避免重复向量化。"""
+    ) -> Tuple[np.ndarray, Dict[str, Any]]:
+        """编码文本并复用缓存（内存 LRU -> 持久化缓存 -> 实际编码），返回 float32 矩阵与命中统计。"""
         if not texts:
-            return [], {
+            return np.zeros((0, 0), dtype=np.float32), {
                 "total": 0,
                 "cache_hit": 0,
+                "memory_hit": 0,
+                "disk_hit": 0,
                 "cache_miss": 0,
                 "unique_miss": 0,
                 "hit_rate": 0.0
             }
 
-        embeddings: List[Optional[List[float]]] = [None] * len(texts)
+        embeddings: List[Optional[np.ndarray]] = [None] * len(texts)
         miss_index_by_key: Dict[str, List[int]] = {}
         miss_text_by_key: Dict[str, str] = {}
-        cache_hit = 0
+        memory_hit = 0
+        disk_hit = 0
 
         for index, text in enumerate(texts):
             current_text = text or ""
-            cache_key = self._build_cache_key(provider, model_name, current_text)
+            cache_key = self._build_cache_key(provider, model_name, current_text, text_role)
             cached = self._cache_get(cache_key)
             if cached is not None:
                 embeddings[index] = cached
-                cache_hit += 1
+                memory_hit += 1
                 continue
 
             miss_index_by_key.setdefault(cache_key, []).append(index)
             if cache_key not in miss_text_by_key:
                 miss_text_by_key[cache_key] = current_text
 
+        disk_cache = self._get_disk_cache() if miss_text_by_key else None
+        if disk_cache is not None:
+            for key, vector in disk_cache.get_many(miss_text_by_key.keys()).items():
+                self._cache_set(key, vector)
+                for target_index in miss_index_by_key.pop(key, []):
+                    embeddings[target_index] = vector
+                    disk_hit += 1
+                miss_text_by_key.pop(key, None)
+
         if miss_text_by_key:
             miss_keys = list(miss_text_by_key.keys())
             miss_texts = [miss_text_by_key[key] for key in miss_keys]
-            miss_vectors = self.encode(
+            miss_vectors = self.encode_array(
                 miss_texts,
                 model_name=model_name,
                 provider=provider,
@@ -303,16 +419,47 @@ class EmbeddingService:
                 for target_index in miss_index_by_key.get(key, []):
                     embeddings[target_index] = vector
 
-        resolved_embeddings = [vector or [] for vector in embeddings]
+            if disk_cache is not None:
+                disk_cache.put_many(dict(zip(miss_keys, miss_vectors)))
+
+        resolved_embeddings = np.stack(embeddings).astype(np.float32, copy=False)
+        cache_hit = memory_hit + disk_hit
         cache_miss = len(texts) - cache_hit
+        self._count_cache(
+            requests=len(texts),
+            memory_hit=memory_hit,
+            disk_hit=disk_hit,
+            encoded=len(miss_text_by_key)
+        )
 
         return resolved_embeddings, {
             "total": len(texts),
             "cache_hit": cache_hit,
+            "memory_hit": memory_hit,
+            "disk_hit": disk_hit,
             "cache_miss": cache_miss,
             "unique_miss": len(miss_text_by_key),
             "hit_rate": round(cache_hit / len(texts), 4)
         }
+
+    def get_cache_stats(self) -> Dict[str, Any]:
+        """累计缓存命中指标（内存层 + 持久化层）"""
+        with self._cache_lock:
+            counters = dict(self._cache_counters)
+            memory_entries = len(self._vector_cache)
+
+        requests = counters.get("requests", 0)
+        hits = counters.get("memory_hit", 0) + counters.get("disk_hit", 0)
+        stats: Dict[str, Any] = {
+            **counters,
+            "hit_rate": round(hits / requests, 4) if requests else 0.0,
+            "memory_entries": memory_entries,
+            "memory_capacity": self.vector_cache_size
+        }
+        disk_cache = self._get_disk_cache()
+        if disk_cache is not None:
+            stats["disk"] = disk_cache.get_stats()
+        return stats
     
     def encode_single(
         self,
@@ -450,15 +597,22 @@ class EmbeddingService:
             model_name: 模型名称，None则卸载所有模型
         """
         import torch
+        from app.services.infrastructure.model.residency_manager import get_model_residency_manager
         
         try:
+            residency_manager = get_model_residency_manager()
             if model_name:
                 if model_name in self.models:
-                    del self.models[model_name]
+                    self._drop_model(model_name)
+                    residency_manager.unregister(self._residency_key(model_name))
                     logger.info(f"已卸载嵌入模型: {model_name}")
             else:
-                self.models.clear()
-                self._vector_cache.clear()
+                with self._model_lock:
+                    for loaded_name in list(self.models.keys()):
+                        residency_manager.unregister(self._residency_key(loaded_name))
+                    self.models.clear()
+                with self._cache_lock:
+                    self._vector_cache.clear()
                 logger.info("已卸载所有嵌入模型")
             
             # 清理GPU缓存
@@ -1,13 +1,45 @@
 """Ollama嵌入模型服务"""
+import re
+import threading
+import time
 from concurrent.futures import ThreadPoolExecutor, as_completed
-import requests
 import numpy as np
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple
 from app.core.config import settings
+from app.services.infrastructure.llm.ollama_http_client import OllamaAPIError, get_ollama_http_client
 from app.utils.logger import get_logger
 
 logger = get_logger(__name__)
 
+_CJK_PATTERN = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]")
+
+# 旧版 Ollama 没有 /api/embed，返回这些状态码时回退到逐条 /api/embeddings
+_LEGACY_STATUS_CODES = (404, 405, 501)
+
+
+def _is_missing_endpoint(error: OllamaAPIError) -> bool:
+    """
+    是否为 /api/embed 路由不存在（旧版 Ollama）
+
+    新版 Ollama 在模型不存在时同样返回 404，但响应体是 {"error": "model ... not found"}；
+    这种情况不能据此判定服务端不支持批量接口
+    """
+    if error.status_code not in _LEGACY_STATUS_CODES:
+        return False
+    return error.status_code != 404 or error.ollama_error is None
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算 token 数：CJK 字符按 1 个计，其余按约 4 字符 1 个计"""
+    cjk_count = len(_CJK_PATTERN.findall(text))
+    return max(1, cjk_count + (len(text) - cjk_count + 3) // 4)
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
 
 class OllamaEmbeddingService:
     """Ollama嵌入模型服务"""
@@ -21,29 +53,36 @@ class OllamaEmbeddingService:
             self.default_model = ollama_config.get('default_model', 'nomic-embed-text')
             self.max_workers = max(1, int(ollama_config.get('max_workers', 4) or 4))
         else:
+            ollama_config = {}
             self.base_url = 'http://localhost:11434'
             self.timeout = 30
             self.default_model = 'nomic-embed-text'
             self.max_workers = 4
         
-        logger.info(f"Ollama嵌入服务初始化: base_url={self.base_url}, max_workers={self.max_workers}")
+        # 批量嵌入（/api/embed 多输入）：按估算 token 数切分子批次，失败只重试该子批次
+        self.batch_enabled = bool(ollama_config.get('batch_enabled', True))
+        self.batch_max_tokens = max(1, int(ollama_config.get('batch_max_tokens', 8192) or 8192))
+        self.max_retries = max(0, int(ollama_config.get('max_retries', 2) or 0))
+        self._batch_supported: Optional[bool] = None
+        self._batch_support_lock = threading.Lock()
+        
+        # 与LLM服务共享同一 base_url 的连接池
+        self.http = get_ollama_http_client(self.base_url, timeout=self.timeout)
+        
+        logger.info(
+            f"Ollama嵌入服务初始化: base_url={self.base_url}, max_workers={self.max_workers}, "
+            f"batch={self.batch_enabled}, batch_max_tokens={self.batch_max_tokens}"
+        )
 
     def _request_embedding(self, text: str, model_name: str) -> List[float]:
-        response = requests.post(
-            f"{self.base_url}/api/embeddings",
-            json={
+        result = self.http.post_json_sync(
+            "/api/embeddings",
+            {
                 "model": model_name,
                 "prompt": text
             },
             timeout=self.timeout
         )
-
-        if response.status_code != 200:
-            error_msg = f"Ollama API返回错误: {response.status_code} - {response.text}"
-            logger.error(error_msg)
-            raise RuntimeError(error_msg)
-
-        result = response.json()
         embedding = result.get('embedding')
 
         if not embedding:
@@ -58,20 +97,12 @@ class OllamaEmbeddingService:
     
     def is_available(self) -> bool:
         """
-        检查Ollama服务是否可用
+        检查Ollama服务是否可用（结果按TTL缓存）
         
         Returns:
             是否可用
         """
-        try:
-            response = requests.get(
-                f"{self.base_url}/api/tags",
-                timeout=5
-            )
-            return response.status_code == 200
-        except Exception as e:
-            logger.warning(f"Ollama服务不可用: {str(e)}")
-            return False
+        return self.http.is_available()
     
     def encode(
         self,
@@ -86,61 +117,182 @@ class OllamaEmbeddingService:
         Args:
             texts: 文本列表
             model_name: 模型名称
-            batch_size: 批次大小（Ollama不支持批处理，此参数仅为接口兼容）
-            show_progress: 是否显示进度（Ollama不支持，此参数仅为接口兼容）
+            batch_size: 每个子批次的最大文本数（同时受 batch_max_tokens 约束）
+            show_progress: 是否显示进度（此参数仅为接口兼容）
             
         Returns:
             向量列表
         """
+        return self.encode_array(texts, model_name, batch_size, show_progress).tolist()
+    
+    def encode_array(
+        self,
+        texts: List[str],
+        model_name: str,
+        batch_size: int = 32,
+        show_progress: bool = False
+    ) -> np.ndarray:
+        """
+        将文本编码为归一化的 float32 矩阵 (n, d)
+        
+        优先使用 /api/embed 批量接口，子批次在线程池中并发请求；
+        服务端不支持时自动回退为逐条 /api/embeddings
+        """
         try:
             if not texts:
-                return []
+                return np.zeros((0, 0), dtype=np.float32)
             
             # 检查服务可用性
             if not self.is_available():
                 raise RuntimeError("Ollama服务不可用，请确保Ollama已启动")
             
-            logger.info(f"使用Ollama编码文本: count={len(texts)}, model={model_name}")
-            
-            if len(texts) == 1:
-                return [self._request_embedding(texts[0], model_name)]
-
-            embeddings: List[Optional[List[float]]] = [None] * len(texts)
-            max_workers = min(self.max_workers, len(texts))
-
-            with ThreadPoolExecutor(max_workers=max_workers) as executor:
-                future_map = {
-                    executor.submit(self._request_embedding, text, model_name): index
-                    for index, text in enumerate(texts)
-                }
-
-                done = 0
-                for future in as_completed(future_map):
-                    index = future_map[future]
-                    try:
-                        embeddings[index] = future.result()
-                        done += 1
-                        if done % 10 == 0 or done == len(texts):
-                            logger.info(f"编码进度: {done}/{len(texts)}")
-                    except requests.exceptions.Timeout:
-                        logger.error(f"Ollama请求超时: text_index={index}")
-                        raise RuntimeError("Ollama请求超时，请检查服务状态或增加timeout配置")
-                    except requests.exceptions.RequestException as error:
-                        logger.error(f"Ollama请求失败: {str(error)}")
-                        raise RuntimeError(f"Ollama请求失败: {str(error)}")
-
-            ordered_embeddings = [embedding if embedding is not None else [] for embedding in embeddings]
+            start = time.perf_counter()
+            if self.batch_enabled and self._batch_supported is not False:
+                try:
+                    matrix, request_count = self._encode_batched(texts, model_name, batch_size)
+                    mode = "batch"
+                except OllamaAPIError as error:
+                    if not _is_missing_endpoint(error):
+                        raise
+                    with self._batch_support_lock:
+                        self._batch_supported = False
+                    logger.warning(f"Ollama不支持 /api/embed（{error.status_code}），回退到逐条嵌入")
+                    matrix, request_count = self._encode_per_text(texts, model_name)
+                    mode = "per_text"
+            else:
+                matrix, request_count = self._encode_per_text(texts, model_name)
+                mode = "per_text"
             
-            logger.info(f"Ollama编码完成: vectors={len(ordered_embeddings)}, "
-                       f"dimension={len(ordered_embeddings[0]) if ordered_embeddings else 0}, "
-                       f"workers={max_workers}")
-            
-            return ordered_embeddings
+            logger.info(
+                f"Ollama编码完成: vectors={matrix.shape[0]}, dimension={matrix.shape[1] if matrix.ndim == 2 else 0}, "
+                f"mode={mode}, requests={request_count}, elapsed={time.perf_counter() - start:.2f}s"
+            )
+            return matrix
             
         except Exception as e:
             logger.error(f"Ollama文本编码失败: {str(e)}")
             raise
     
+    def _plan_batches(self, texts: List[str], batch_size: int) -> List[Tuple[int, int]]:
+        """按文本数与估算 token 数贪心切分为连续区间 [start, end)"""
+        max_items = max(1, int(batch_size or 1))
+        batches: List[Tuple[int, int]] = []
+        batch_start = 0
+        batch_tokens = 0
+        for index, text in enumerate(texts):
+            tokens = estimate_tokens(text)
+            if index > batch_start and (
+                index - batch_start >= max_items or batch_tokens + tokens > self.batch_max_tokens
+            ):
+                batches.append((batch_start, index))
+                batch_start = index
+                batch_tokens = 0
+            batch_tokens += tokens
+        batches.append((batch_start, len(texts)))
+        return batches
+    
+    def _request_batch(self, texts: List[str], model_name: str) -> np.ndarray:
+        result = self.http.post_json_sync(
+            "/api/embed",
+            {
+                "model": model_name,
+                "input": texts,
+                "truncate": True
+            },
+            timeout=self.timeout
+        )
+        embeddings = result.get('embeddings')
+        if not embeddings or len(embeddings) != len(texts):
+            raise RuntimeError(
+                f"Ollama批量嵌入返回数量不符: expected={len(texts)}, got={len(embeddings or [])}"
+            )
+        with self._batch_support_lock:
+            self._batch_supported = True
+        return _normalize_rows(np.asarray(embeddings, dtype=np.float32))
+    
+    def _request_batch_with_retry(self, texts: List[str], model_name: str) -> Tuple[np.ndarray, int]:
+        """单个子批次失败时只重试该子批次（指数退避），返回 (矩阵, 请求次数)"""
+        attempts = 0
+        while True:
+            attempts += 1
+            try:
+                return self._request_batch(texts, model_name), attempts
+            except OllamaAPIError as error:
+                # 接口不存在交给上层回退；其余 4xx（含模型不存在）重试无意义
+                if _is_missing_endpoint(error) or 400 <= error.status_code < 500:
+                    raise
+                if attempts > self.max_retries:
+                    raise
+                last_error = error
+            except RuntimeError as error:
+                if attempts > self.max_retries:
+                    raise
+                last_error = error
+            logger.warning(
+                f"Ollama批量嵌入子批次失败，重试 {attempts}/{self.max_retries}: size={len(texts)}, error={last_error}"
+            )
+            time.sleep(min(2.0, 0.2 * (2 ** (attempts - 1))))
+    
+    def _encode_batched(self, texts: List[str], model_name: str, batch_size: int) -> Tuple[np.ndarray, int]:
+        batches = self._plan_batches(texts, batch_size)
+        results: Dict[int, np.ndarray] = {}
+        request_count = 0
+        
+        if len(batches) == 1:
+            matrix, request_count = self._request_batch_with_retry(texts, model_name)
+            return matrix, request_count
+        
+        max_workers = min(self.max_workers, len(batches))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            future_map = {
+                executor.submit(self._request_batch_with_retry, texts[begin:end], model_name): (begin, end)
+                for begin, end in batches
+            }
+            done = 0
+            for future in as_completed(future_map):
+                begin, end = future_map[future]
+                try:
+                    matrix, attempts = future.result()
+                except RuntimeError as error:
+                    logger.error(f"Ollama批量嵌入失败: range=[{begin}, {end}), error={str(error)}")
+                    for pending in future_map:
+                        pending.cancel()
+                    raise
+                results[begin] = matrix
+                request_count += attempts
+                done += end - begin
+                logger.info(f"编码进度: {done}/{len(texts)}")
+        
+        return np.ascontiguousarray(np.vstack([results[begin] for begin, _ in batches])), request_count
+    
+    def _encode_per_text(self, texts: List[str], model_name: str) -> Tuple[np.ndarray, int]:
+        """旧版接口：每条文本一次 /api/embeddings 请求，线程池并发"""
+        if len(texts) == 1:
+            return np.asarray([self._request_embedding(texts[0], model_name)], dtype=np.float32), 1
+
+        embeddings: List[Optional[List[float]]] = [None] * len(texts)
+        max_workers = min(self.max_workers, len(texts))
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            future_map = {
+                executor.submit(self._request_embedding, text, model_name): index
+                for index, text in enumerate(texts)
+            }
+
+            done = 0
+            for future in as_completed(future_map):
+                index = future_map[future]
+                try:
+                    embeddings[index] = future.result()
+                    done += 1
+                    if done % 10 == 0 or done == len(texts):
+                        logger.info(f"编码进度: {done}/{len(texts)}")
+                except RuntimeError as error:
+                    logger.error(f"Ollama嵌入请求失败: text_index={index}, error={str(error)}")
+                    raise
+
+        return np.asarray(embeddings, dtype=np.float32), len(texts)
+    
     def encode_single(self, text: str, model_name: str) -> List[float]:
         """
         编码单个文本
@@ -167,16 +319,7 @@ class OllamaEmbeddingService:
                 logger.warning("Ollama服务不可用，返回空模型列表")
                 return []
             
-            response = requests.get(
-                f"{self.base_url}/api/tags",
-                timeout=5
-            )
-            
-            if response.status_code != 200:
-                logger.error(f"获取Ollama模型列表失败: {response.status_code}")
-                return []
-            
-            data = response.json()
+            data = self.http.get_json_sync("/api/tags", timeout=5)
             all_models = data.get('models', [])
             
             # 过滤出嵌入模型（名称包含embed）
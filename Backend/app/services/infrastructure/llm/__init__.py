@@ -1,8 +1,19 @@
 """LLM 推理服务"""
+from app.services.infrastructure.llm.generation_scheduler import (
+    GenerationParams,
+    GenerationScheduler,
+    SchedulerClosedError,
+    SchedulerQueueFullError,
+)
+from app.services.infrastructure.llm.ollama_http_client import OllamaHttpClient, get_ollama_http_client
+from app.services.infrastructure.llm.prefix_cache import PrefixKVCache
 from app.services.infrastructure.llm.ollama_llm_service import OllamaLLMService, get_ollama_llm_service
 from app.services.infrastructure.llm.transformers_service import TransformersService, get_transformers_service
 
 __all__ = [
+    'GenerationParams', 'GenerationScheduler', 'SchedulerClosedError', 'SchedulerQueueFullError',
+    'PrefixKVCache',
+    'OllamaHttpClient', 'get_ollama_http_client',
     'OllamaLLMService', 'get_ollama_llm_service',
     'TransformersService', 'get_transformers_service',
 ]
@@ -0,0 +1,713 @@
+"""
+本地模型生成调度器（连续批处理）
+多个会话的生成请求排队后合并为一个动态批次逐 token 解码，各自流式返回
+"""
+import asyncio
+import inspect
+import threading
+import time
+import uuid
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, AsyncGenerator, Deque, Dict, Iterable, List, Optional, Sequence, Tuple
+import torch
+from app.services.infrastructure.llm.prefix_cache import PrefixKVCache
+from app.utils.logger import logger
+
+
+# PEFT 混合批次中表示"不使用 Adapter"的行
+BASE_ADAPTER_NAME = "__base__"
+
+
+class SchedulerQueueFullError(RuntimeError):
+    """等待队列已满（准入控制拒绝）"""
+
+
+class SchedulerClosedError(RuntimeError):
+    """调度器已关闭（模型被卸载或切换）"""
+
+
+@dataclass
+class GenerationParams:
+    """单个请求的采样参数（与 HF generate 的 repetition_penalty → temperature → top_k → top_p 顺序一致）"""
+    max_new_tokens: int = 256
+    temperature: float = 0.7
+    top_p: float = 0.9
+    top_k: int = 50
+    repetition_penalty: float = 1.1
+
+
+def _percentile(values: List[float], ratio: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(ratio * (len(ordered) - 1)))))
+    return round(ordered[index], 1)
+
+
+# ==================== KV Cache 兼容层 ====================
+# transformers 4.4x: DynamicCache.key_cache/value_cache；4.5x+/5.x: DynamicCache.layers[i].keys/values；
+# 部分旧模型仍返回 tuple 形式。统一读写每层 (key, value)，原地替换以保留各层类型。
+
+def get_cache_layers(cache: Any) -> List[Tuple[torch.Tensor, torch.Tensor]]:
+    if isinstance(cache, (tuple, list)):
+        return [(layer[0], layer[1]) for layer in cache]
+    layers = getattr(cache, "layers", None)
+    if layers is not None:
+        return [(layer.keys, layer.values) for layer in layers]
+    return list(zip(cache.key_cache, cache.value_cache))
+
+
+def set_cache_layers(cache: Any, layers: Sequence[Tuple[torch.Tensor, torch.Tensor]]) -> Any:
+    if isinstance(cache, (tuple, list)):
+        return tuple((key, value) for key, value in layers)
+    cache_layers = getattr(cache, "layers", None)
+    if cache_layers is not None:
+        for layer, (key, value) in zip(cache_layers, layers):
+            layer.keys = key
+            layer.values = value
+        return cache
+    for index, (key, value) in enumerate(layers):
+        cache.key_cache[index] = key
+        cache.value_cache[index] = value
+    return cache
+
+
+def build_cache(layers: Sequence[Tuple[torch.Tensor, torch.Tensor]], config: Any = None) -> Any:
+    """由各层 (key, value) 构造新的 DynamicCache（update 会拼接出新张量，不修改传入张量）"""
+    from transformers import DynamicCache
+
+    try:
+        cache = DynamicCache(config=config)
+    except TypeError:
+        cache = DynamicCache()
+    for index, (key, value) in enumerate(layers):
+        cache.update(key, value, index)
+    return cache
+
+
+def _left_pad(tensor: torch.Tensor, length: int, dim: int) -> torch.Tensor:
+    pad = length - tensor.shape[dim]
+    if pad <= 0:
+        return tensor
+    shape = list(tensor.shape)
+    shape[dim] = pad
+    return torch.cat([tensor.new_zeros(shape), tensor], dim=dim)
+
+
+class _IncrementalDetokenizer:
+    """增量解码：只解码最近窗口，遇到不完整的多字节字符时暂缓输出"""
+
+    def __init__(self, tokenizer: Any):
+        self.tokenizer = tokenizer
+        self.token_ids: List[int] = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+
+    def _decode(self, ids: List[int]) -> str:
+        return self.tokenizer.decode(ids, skip_special_tokens=True)
+
+    def push(self, token_id: int) -> str:
+        self.token_ids.append(token_id)
+        prefix_text = self._decode(self.token_ids[self.prefix_offset:self.read_offset])
+        new_text = self._decode(self.token_ids[self.prefix_offset:])
+        if len(new_text) > len(prefix_text) and not new_text.endswith("�"):
+            self.prefix_offset = self.read_offset
+            self.read_offset = len(self.token_ids)
+            return new_text[len(prefix_text):]
+        return ""
+
+    def flush(self) -> str:
+        if self.read_offset >= len(self.token_ids):
+            return ""
+        prefix_text = self._decode(self.token_ids[self.prefix_offset:self.read_offset])
+        new_text = self._decode(self.token_ids[self.prefix_offset:])
+        self.prefix_offset = self.read_offset = len(self.token_ids)
+        return new_text[len(prefix_text):]
+
+
+class GenerationRequest:
+    """调度中的单个生成请求；事件通过所属事件循环的队列回传"""
+
+    def __init__(
+        self,
+        prompt_ids: List[int],
+        params: GenerationParams,
+        loop: asyncio.AbstractEventLoop,
+        tokenizer: Any
+    ):
+        self.request_id = uuid.uuid4().hex[:12]
+        self.prompt_ids = list(prompt_ids)
+        self.params = params
+        self.loop = loop
+        self.events: asyncio.Queue = asyncio.Queue()
+        self.detokenizer = _IncrementalDetokenizer(tokenizer)
+        self.generated_ids: List[int] = []
+        self.adapter_name: Optional[str] = None
+        self.cache_namespace = ""
+        self.cached_tokens = 0
+        self.seen_mask: Optional[torch.Tensor] = None
+        self.finished = False
+        self.finish_reason: Optional[str] = None
+        self.enqueued_at = time.perf_counter()
+        self.admitted_at: Optional[float] = None
+        self.first_token_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self._cancel_event = threading.Event()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel_event.is_set()
+
+    def cancel(self) -> None:
+        self._cancel_event.set()
+
+    def emit(self, kind: str, payload: Any) -> None:
+        try:
+            self.loop.call_soon_threadsafe(self.events.put_nowait, (kind, payload))
+        except RuntimeError:
+            # 事件循环已关闭（调用方已离开）
+            self.cancel()
+
+    def metrics(self) -> Dict[str, Any]:
+        finished_at = self.finished_at or time.perf_counter()
+        decode_seconds = (finished_at - self.first_token_at) if self.first_token_at else 0.0
+        return {
+            "request_id": self.request_id,
+            "status": self.finish_reason,
+            "prompt_tokens": len(self.prompt_ids),
+            "cached_tokens": self.cached_tokens,
+            "generated_tokens": len(self.generated_ids),
+            "queue_wait_ms": round(((self.admitted_at or finished_at) - self.enqueued_at) * 1000, 1),
+            "ttft_ms": round((self.first_token_at - self.enqueued_at) * 1000, 1) if self.first_token_at else None,
+            "total_ms": round((finished_at - self.enqueued_at) * 1000, 1),
+            "tokens_per_second": round((len(self.generated_ids) - 1) / decode_seconds, 2)
+            if decode_seconds > 0 and len(self.generated_ids) > 1 else None
+        }
+
+
+class GenerationScheduler:
+    """
+    连续批处理生成调度器（每个已加载模型一个，单后台线程执行前向）
+
+    - 新请求单独 prefill 后并入运行中的批次（左侧补齐 KV 与 attention_mask），无需等待其他请求结束
+    - 每步对整批做一次解码前向，按行独立采样；结束/取消的行立即移出批次
+    - 准入控制：运行批次上限 max_batch_size，批内 (行数 × 序列长度) 上限 max_batch_tokens，
+      等待队列上限 max_queue_depth，超出时 submit 直接拒绝
+    - 记录排队等待、首 token 延迟与 tokens/s 指标
+    - 可选前缀 KV Cache：prefill 前复用最长已缓存前缀，请求结束后缓存 prompt + 回答的 KV 供下一轮对话使用
+    - PEFT 多 Adapter 模型：每个请求可指定 Adapter，同一批次内不同 Adapter 的行通过 adapter_names 一起解码；
+      加载/卸载 Adapter 等修改模型结构的操作需持有 model_lock（调度线程每一步前向都持有该锁）
+    """
+
+    def __init__(
+        self,
+        model: Any,
+        tokenizer: Any,
+        max_batch_size: int = 4,
+        max_queue_depth: int = 32,
+        max_batch_tokens: int = 16384,
+        eos_token_ids: Optional[Iterable[int]] = None,
+        name: str = "",
+        prefix_cache: Optional[PrefixKVCache] = None,
+        model_lock: Optional[threading.RLock] = None
+    ):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.name = name
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_queue_depth = max(0, int(max_queue_depth))
+        self.max_batch_tokens = max(1, int(max_batch_tokens))
+        self.device = model.get_input_embeddings().weight.device
+        self.eos_token_ids = set(eos_token_ids if eos_token_ids is not None else self._default_eos_ids())
+        self.supports_adapters = hasattr(model, "peft_config")
+        self.model_lock = model_lock or threading.RLock()
+        self._logits_kwarg = self._detect_logits_kwarg()
+        self.prefix_cache = prefix_cache if self._supports_prefix_cache() else None
+
+        self._cond = threading.Condition()
+        self._waiting: Deque[GenerationRequest] = deque()
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+        self._close_reason = ""
+
+        # 运行中批次（仅调度线程读写）
+        self._rows: List[GenerationRequest] = []
+        self._cache: Any = None
+        self._attention_mask: Optional[torch.Tensor] = None
+        self._next_tokens: Optional[torch.Tensor] = None
+
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "submitted": 0,
+            "rejected": 0,
+            "completed": 0,
+            "cancelled": 0,
+            "failed": 0,
+            "decode_steps": 0,
+            "batched_rows": 0,
+            "max_batch_observed": 0,
+            "generated_tokens": 0,
+            "busy_seconds": 0.0
+        }
+        self._recent: Deque[Dict[str, Any]] = deque(maxlen=256)
+
+    # ==================== 初始化辅助 ====================
+
+    def _default_eos_ids(self) -> List[int]:
+        eos_ids: List[int] = []
+        generation_config = getattr(self.model, "generation_config", None)
+        configured = getattr(generation_config, "eos_token_id", None)
+        if isinstance(configured, int):
+            eos_ids.append(configured)
+        elif isinstance(configured, (list, tuple)):
+            eos_ids.extend(int(item) for item in configured)
+        tokenizer_eos = getattr(self.tokenizer, "eos_token_id", None)
+        if tokenizer_eos is not None:
+            eos_ids.append(int(tokenizer_eos))
+        return eos_ids
+
+    def _detect_logits_kwarg(self) -> Optional[str]:
+        """prefill 只需最后一个位置的 logits，避免 (T × V) 的大张量"""
+        # PeftModel.forward 以 **kwargs 透传，参数以基座模型为准
+        target = self.model.get_base_model() if self.supports_adapters else self.model
+        try:
+            parameters = inspect.signature(target.forward).parameters
+        except (TypeError, ValueError):
+            return None
+        for name in ("logits_to_keep", "num_logits_to_keep"):
+            if name in parameters:
+                return name
+        return None
+
+    def _supports_prefix_cache(self) -> bool:
+        """滑动窗口注意力层只保留窗口内 KV，无法按前缀截取复用"""
+        config = getattr(self.model, "config", None)
+        layer_types = getattr(config, "layer_types", None) or []
+        if any(layer_type != "full_attention" for layer_type in layer_types):
+            logger.info(f"模型包含非全注意力层，禁用前缀 KV Cache: {self.name}")
+            return False
+        return True
+
+    # ==================== 对外接口 ====================
+
+    def submit(
+        self,
+        prompt_ids: List[int],
+        params: GenerationParams,
+        adapter_name: Optional[str] = None,
+        cache_namespace: Optional[str] = None
+    ) -> GenerationRequest:
+        """提交请求（需在事件循环中调用）；队列已满或已关闭时抛出异常"""
+        if not prompt_ids:
+            raise ValueError("prompt 不能为空")
+        if adapter_name and not self.supports_adapters:
+            raise ValueError(f"当前模型未加载 Adapter，无法使用: {adapter_name}")
+        request = GenerationRequest(prompt_ids, params, asyncio.get_running_loop(), self.tokenizer)
+        request.adapter_name = adapter_name
+        request.cache_namespace = cache_namespace if cache_namespace is not None else (adapter_name or "")
+        with self._cond:
+            if self._closed:
+                raise SchedulerClosedError(f"生成调度器已关闭: {self._close_reason}")
+            if len(self._waiting) >= self.max_queue_depth:
+                with self._stats_lock:
+                    self._stats["rejected"] += 1
+                raise SchedulerQueueFullError(
+                    f"生成请求排队已满({self.max_queue_depth})，请稍后重试"
+                )
+            self._waiting.append(request)
+            with self._stats_lock:
+                self._stats["submitted"] += 1
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run,
+                    name=f"generation-scheduler-{self.name or 'model'}",
+                    daemon=True
+                )
+                self._thread.start()
+            self._cond.notify()
+        return request
+
+    async def stream(self, request: GenerationRequest) -> AsyncGenerator[str, None]:
+        """逐段返回生成文本；调用方提前停止消费（断开/取消）时取消该请求"""
+        try:
+            while True:
+                kind, payload = await request.events.get()
+                if kind == "text":
+                    yield payload
+                elif kind == "done":
+                    return
+                elif kind == "error":
+                    raise payload
+        finally:
+            if not request.finished:
+                request.cancel()
+                with self._cond:
+                    self._cond.notify()
+
+    async def generate(
+        self,
+        prompt_ids: List[int],
+        params: GenerationParams,
+        adapter_name: Optional[str] = None,
+        cache_namespace: Optional[str] = None
+    ) -> str:
+        request = self.submit(prompt_ids, params, adapter_name, cache_namespace)
+        try:
+            return "".join([chunk async for chunk in self.stream(request)])
+        finally:
+            # 超时/取消时异步生成器不一定立即收尾，这里直接取消请求
+            if not request.finished:
+                request.cancel()
+
+    def shutdown(self, reason: str = "", wait: bool = False) -> None:
+        """关闭调度器：排队请求立即失败，运行中的请求由调度线程在下一步终止；wait=True 时等待线程退出"""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._close_reason = reason
+            waiting = list(self._waiting)
+            self._waiting.clear()
+            self._cond.notify_all()
+        for request in waiting:
+            self._finish(request, "failed", SchedulerClosedError(f"生成调度器已关闭: {reason}"))
+        if wait and self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        logger.info(f"生成调度器已关闭: model={self.name}, reason={reason}, dropped={len(waiting)}")
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            stats = dict(self._stats)
+            recent = list(self._recent)
+        with self._cond:
+            queue_depth = len(self._waiting)
+        completed = [item for item in recent if item["status"] in ("stop", "length")]
+        queue_waits = [item["queue_wait_ms"] for item in recent]
+        ttfts = [item["ttft_ms"] for item in recent if item["ttft_ms"] is not None]
+        per_request_tps = [item["tokens_per_second"] for item in completed if item["tokens_per_second"]]
+        busy_seconds = stats.pop("busy_seconds")
+        batched_rows = stats.pop("batched_rows")
+        return {
+            "model": self.name,
+            "closed": self._closed,
+            "queue_depth": queue_depth,
+            "active": len(self._rows),
+            "max_batch_size": self.max_batch_size,
+            "max_queue_depth": self.max_queue_depth,
+            "max_batch_tokens": self.max_batch_tokens,
+            **stats,
+            "avg_batch_size": round(batched_rows / stats["decode_steps"], 2) if stats["decode_steps"] else 0.0,
+            "aggregate_tokens_per_second": round(stats["generated_tokens"] / busy_seconds, 2) if busy_seconds > 0 else 0.0,
+            "request_tokens_per_second_p50": _percentile(per_request_tps, 0.5),
+            "queue_wait_ms_p50": _percentile(queue_waits, 0.5),
+            "queue_wait_ms_p95": _percentile(queue_waits, 0.95),
+            "ttft_ms_p50": _percentile(ttfts, 0.5),
+            "ttft_ms_p95": _percentile(ttfts, 0.95),
+            "prefix_cache": self.prefix_cache.get_stats() if self.prefix_cache is not None else None
+        }
+
+    # ==================== 调度线程 ====================
+
+    def _current_length(self) -> int:
+        return int(self._attention_mask.shape[1]) if self._attention_mask is not None else 0
+
+    def _admit_locked(self) -> List[GenerationRequest]:
+        admitted: List[GenerationRequest] = []
+        longest = self._current_length()
+        while self._waiting and len(self._rows) + len(admitted) < self.max_batch_size:
+            request = self._waiting[0]
+            if request.cancelled:
+                self._waiting.popleft()
+                self._finish(request, "cancelled")
+                continue
+            rows_after = len(self._rows) + len(admitted) + 1
+            length_after = max(longest, len(request.prompt_ids) + 1)
+            if (self._rows or admitted) and rows_after * length_after > self.max_batch_tokens:
+                break
+            self._waiting.popleft()
+            request.admitted_at = time.perf_counter()
+            longest = length_after
+            admitted.append(request)
+        return admitted
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._closed and not self._waiting and not self._rows:
+                    self._cond.wait()
+                if self._closed:
+                    break
+                admitted = self._admit_locked()
+
+            step_start = time.perf_counter()
+            with self.model_lock, torch.inference_mode():
+                for request in admitted:
+                    try:
+                        self._prefill(request)
+                    except Exception as e:
+                        logger.error(f"生成请求 prefill 失败: {e}", exc_info=True)
+                        self._finish(request, "failed", e)
+
+                self._drop_finished_rows()
+                if self._rows:
+                    try:
+                        self._decode_step()
+                    except Exception as e:
+                        logger.error(f"批量解码失败，终止当前批次: {e}", exc_info=True)
+                        for request in self._rows:
+                            self._finish(request, "failed", e)
+                        self._reset_batch()
+            with self._stats_lock:
+                self._stats["busy_seconds"] += time.perf_counter() - step_start
+
+        error = SchedulerClosedError(f"生成调度器已关闭: {self._close_reason}")
+        for request in self._rows:
+            self._finish(request, "failed", error)
+        self._reset_batch()
+
+    def _forward(
+        self,
+        input_ids: torch.Tensor,
+        attention_mask: torch.Tensor,
+        position_ids: torch.Tensor,
+        past_key_values: Any,
+        rows: Sequence[GenerationRequest],
+        last_logits_only: bool = False
+    ) -> Any:
+        kwargs: Dict[str, Any] = {
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            "position_ids": position_ids,
+            "past_key_values": past_key_values,
+            "use_cache": True
+        }
+        if last_logits_only and self._logits_kwarg:
+            kwargs[self._logits_kwarg] = 1
+        if self.supports_adapters:
+            kwargs["adapter_names"] = [request.adapter_name or BASE_ADAPTER_NAME for request in rows]
+        return self.model(**kwargs)
+
+    def _prefill(self, request: GenerationRequest) -> None:
+        prompt_length = len(request.prompt_ids)
+        past_key_values = None
+        if self.prefix_cache is not None:
+            match = self.prefix_cache.lookup(request.prompt_ids, request.cache_namespace)
+            if match is not None:
+                past_key_values = build_cache(match.layers, getattr(self.model, "config", None))
+                request.cached_tokens = match.length
+
+        start = request.cached_tokens
+        input_ids = torch.tensor([request.prompt_ids[start:]], dtype=torch.long, device=self.device)
+        attention_mask = torch.ones((1, prompt_length), dtype=torch.long, device=self.device)
+        position_ids = torch.arange(start, prompt_length, device=self.device).unsqueeze(0)
+        outputs = self._forward(input_ids, attention_mask, position_ids, past_key_values, [request], last_logits_only=True)
+        logits = outputs.logits[:, -1, :]
+
+        request.seen_mask = torch.zeros(logits.shape[-1], dtype=torch.bool, device=self.device)
+        request.seen_mask[torch.tensor(request.prompt_ids, dtype=torch.long, device=self.device)] = True
+        next_token = self._sample(logits, [request])
+        self._accept_token(request, int(next_token[0]))
+        if request.finished:
+            self._store_prefix(request, get_cache_layers(outputs.past_key_values), prompt_length)
+            return
+        self._merge_into_batch(request, outputs.past_key_values, attention_mask, next_token.view(1, 1))
+
+    def _merge_into_batch(
+        self,
+        request: GenerationRequest,
+        cache: Any,
+        attention_mask: torch.Tensor,
+        next_tokens: torch.Tensor
+    ) -> None:
+        if not self._rows:
+            self._rows = [request]
+            self._cache = cache
+            self._attention_mask = attention_mask
+            self._next_tokens = next_tokens
+            return
+
+        length = max(self._attention_mask.shape[1], attention_mask.shape[1])
+        merged_layers = []
+        for (batch_key, batch_value), (new_key, new_value) in zip(get_cache_layers(self._cache), get_cache_layers(cache)):
+            merged_layers.append((
+                torch.cat([_left_pad(batch_key, length, -2), _left_pad(new_key, length, -2)], dim=0),
+                torch.cat([_left_pad(batch_value, length, -2), _left_pad(new_value, length, -2)], dim=0)
+            ))
+        self._cache = set_cache_layers(self._cache, merged_layers)
+        self._attention_mask = torch.cat([
+            _left_pad(self._attention_mask, length, 1),
+            _left_pad(attention_mask, length, 1)
+        ], dim=0)
+        self._next_tokens = torch.cat([self._next_tokens, next_tokens], dim=0)
+        self._rows.append(request)
+
+    def _decode_step(self) -> None:
+        batch_size = len(self._rows)
+        attention_mask = torch.cat([
+            self._attention_mask,
+            self._attention_mask.new_ones((batch_size, 1))
+        ], dim=1)
+        position_ids = attention_mask.sum(dim=1, keepdim=True) - 1
+        outputs = self._forward(self._next_tokens, attention_mask, position_ids, self._cache, self._rows)
+        self._cache = outputs.past_key_values
+        self._attention_mask = attention_mask
+
+        next_tokens = self._sample(outputs.logits[:, -1, :], self._rows)
+        for row, request in enumerate(self._rows):
+            self._accept_token(request, int(next_tokens[row]))
+        self._next_tokens = next_tokens.view(batch_size, 1)
+
+        with self._stats_lock:
+            self._stats["decode_steps"] += 1
+            self._stats["batched_rows"] += batch_size
+            self._stats["max_batch_observed"] = max(self._stats["max_batch_observed"], batch_size)
+        self._drop_finished_rows()
+
+    def _drop_finished_rows(self) -> None:
+        """移出已结束/已取消的行，并裁掉所有行都为填充的左侧列"""
+        for request in self._rows:
+            if request.cancelled and not request.finished:
+                self._finish(request, "cancelled")
+        keep = [index for index, request in enumerate(self._rows) if not request.finished]
+        if len(keep) == len(self._rows):
+            return
+        if self.prefix_cache is not None:
+            for row, request in enumerate(self._rows):
+                if request.finished:
+                    self._store_row_prefix(row, request)
+        if not keep:
+            self._reset_batch()
+            return
+
+        index_tensor = torch.tensor(keep, dtype=torch.long, device=self.device)
+        attention_mask = self._attention_mask.index_select(0, index_tensor)
+        first_column = int(attention_mask.any(dim=0).nonzero()[0])
+        attention_mask = attention_mask[:, first_column:]
+        layers = []
+        for key, value in get_cache_layers(self._cache):
+            layer_index = index_tensor.to(key.device)
+            layers.append((
+                key.index_select(0, layer_index)[..., first_column:, :],
+                value.index_select(0, layer_index)[..., first_column:, :]
+            ))
+        self._cache = set_cache_layers(self._cache, layers)
+        self._attention_mask = attention_mask
+        self._next_tokens = self._next_tokens.index_select(0, index_tensor)
+        self._rows = [self._rows[index] for index in keep]
+
+    def _store_row_prefix(self, row: int, request: GenerationRequest) -> None:
+        """取出该行去掉左侧填充后的 KV（prompt + 已输入模型的回答 token）存入前缀缓存"""
+        kv_length = int(self._attention_mask[row].sum())
+        start = self._attention_mask.shape[1] - kv_length
+        layers = [
+            (key[row:row + 1, :, start:, :], value[row:row + 1, :, start:, :])
+            for key, value in get_cache_layers(self._cache)
+        ]
+        self._store_prefix(request, layers, kv_length)
+
+    def _store_prefix(
+        self,
+        request: GenerationRequest,
+        layers: List[Tuple[torch.Tensor, torch.Tensor]],
+        kv_length: int
+    ) -> None:
+        if self.prefix_cache is None or request.finish_reason not in ("stop", "length"):
+            return
+        token_ids = (request.prompt_ids + request.generated_ids)[:kv_length]
+        try:
+            self.prefix_cache.put(token_ids, layers, request.cache_namespace)
+        except Exception as e:
+            logger.warning(f"写入前缀 KV Cache 失败: {e}")
+
+    def _reset_batch(self) -> None:
+        self._rows = []
+        self._cache = None
+        self._attention_mask = None
+        self._next_tokens = None
+        if self.device.type == "cuda":
+            torch.cuda.empty_cache()
+
+    # ==================== 采样与输出 ====================
+
+    def _sample(self, logits: torch.Tensor, rows: Sequence[GenerationRequest]) -> torch.Tensor:
+        logits = logits.float()
+        device = logits.device
+
+        penalties = torch.tensor([request.params.repetition_penalty for request in rows], device=device).unsqueeze(1)
+        if bool((penalties != 1.0).any()):
+            seen = torch.stack([request.seen_mask.to(device) for request in rows])
+            penalized = torch.where(logits < 0, logits * penalties, logits / penalties)
+            logits = torch.where(seen, penalized, logits)
+
+        next_tokens = logits.argmax(dim=-1)
+        sample_rows = [index for index, request in enumerate(rows) if request.params.temperature > 0]
+        if not sample_rows:
+            return next_tokens
+
+        vocab_size = logits.shape[-1]
+        row_index = torch.tensor(sample_rows, dtype=torch.long, device=device)
+        temperatures = torch.tensor([rows[index].params.temperature for index in sample_rows], device=device)
+        scaled = logits.index_select(0, row_index) / temperatures.unsqueeze(1)
+
+        top_ks = [
+            min(vocab_size, rows[index].params.top_k) if rows[index].params.top_k and rows[index].params.top_k > 0 else vocab_size
+            for index in sample_rows
+        ]
+        values, indices = torch.topk(scaled, max(top_ks), dim=-1)
+        ranks = torch.arange(values.shape[1], device=device).unsqueeze(0)
+        values = values.masked_fill(ranks >= torch.tensor(top_ks, device=device).unsqueeze(1), float("-inf"))
+
+        probs = torch.softmax(values, dim=-1)
+        top_ps = torch.tensor([float(rows[index].params.top_p or 1.0) for index in sample_rows], device=device)
+        cumulative = probs.cumsum(dim=-1)
+        probs = probs.masked_fill((cumulative - probs) >= top_ps.unsqueeze(1), 0.0)
+
+        choices = torch.multinomial(probs, 1)
+        next_tokens[row_index] = indices.gather(1, choices).squeeze(1)
+        return next_tokens
+
+    def _accept_token(self, request: GenerationRequest, token_id: int) -> None:
+        if request.first_token_at is None:
+            request.first_token_at = time.perf_counter()
+        if token_id in self.eos_token_ids:
+            self._finish(request, "stop")
+            return
+
+        request.generated_ids.append(token_id)
+        if request.seen_mask is not None and token_id < request.seen_mask.shape[0]:
+            request.seen_mask[token_id] = True
+        with self._stats_lock:
+            self._stats["generated_tokens"] += 1
+
+        text = request.detokenizer.push(token_id)
+        if text:
+            request.emit("text", text)
+        if len(request.generated_ids) >= request.params.max_new_tokens:
+            self._finish(request, "length")
+
+    def _finish(self, request: GenerationRequest, reason: str, error: Optional[BaseException] = None) -> None:
+        if request.finished:
+            return
+        request.finished = True
+        request.finish_reason = reason
+        request.finished_at = time.perf_counter()
+        if error is None and reason != "cancelled":
+            tail = request.detokenizer.flush()
+            if tail:
+                request.emit("text", tail)
+
+        metrics = request.metrics()
+        counter = {"stop": "completed", "length": "completed", "cancelled": "cancelled"}.get(reason, "failed")
+        with self._stats_lock:
+            self._stats[counter] += 1
+            self._recent.append(metrics)
+
+        if error is not None:
+            request.emit("error", error)
+        else:
+            request.emit("done", metrics)
@@ -0,0 +1,369 @@
+"""Ollama HTTP客户端：共享连接池 + 异步流式 + 可用性缓存 + 请求指标"""
+import asyncio
+import json
+import threading
+import time
+import weakref
+from collections import deque
+from typing import Any, AsyncGenerator, Dict, List, Optional
+import httpx
+from app.core.config import settings
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+# 按 base_url 共享的客户端实例
+_ollama_http_clients: Dict[str, "OllamaHttpClient"] = {}
+_ollama_http_clients_lock = threading.Lock()
+
+# 不可用结果的最长缓存时间（秒），避免 Ollama 恢复后长时间误判
+_NEGATIVE_AVAILABILITY_TTL = 5.0
+
+
+class OllamaAPIError(RuntimeError):
+    """Ollama 返回非 200 状态码"""
+
+    def __init__(self, status_code: int, message: str, body: str = ""):
+        super().__init__(message)
+        self.status_code = status_code
+        self.body = body or ""
+
+    @property
+    def ollama_error(self) -> Optional[str]:
+        """Ollama 业务错误信息（响应体为 {"error": ...} 时），如模型不存在；路由不存在等非 JSON 响应返回 None"""
+        try:
+            payload = json.loads(self.body)
+        except (TypeError, ValueError):
+            return None
+        if isinstance(payload, dict) and payload.get("error"):
+            return str(payload["error"])
+        return None
+
+
+def _percentile(values: List[float], ratio: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(ratio * (len(ordered) - 1)))))
+    return round(ordered[index], 1)
+
+
+class OllamaHttpClient:
+    """
+    Ollama HTTP客户端
+
+    - 同步调用（线程池中的嵌入请求、模型列表）共享一个 httpx.Client 连接池
+    - 异步调用按事件循环各持有一个 httpx.AsyncClient，keep-alive 复用连接
+    - 流式接口逐行异步读取，不阻塞事件循环；调用方关闭生成器或任务被取消时立即断开连接，
+      Ollama 随之停止生成
+    - is_available 结果按 TTL 缓存，请求成功/连接失败时顺带刷新
+    - 记录最近请求的耗时与首 token 延迟（TTFT）
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        timeout: float = 120,
+        max_connections: int = 20,
+        max_keepalive_connections: int = 10,
+        keepalive_expiry: float = 30.0,
+        availability_ttl: float = 30.0,
+        metrics_window: int = 256
+    ):
+        self.base_url = str(base_url).rstrip('/')
+        self.timeout = float(timeout)
+        self.availability_ttl = max(0.0, float(availability_ttl))
+        self._limits = httpx.Limits(
+            max_connections=max(1, int(max_connections)),
+            max_keepalive_connections=max(0, int(max_keepalive_connections)),
+            keepalive_expiry=float(keepalive_expiry)
+        )
+        self._lock = threading.Lock()
+        self._sync_client: Optional[httpx.Client] = None
+        self._async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = weakref.WeakKeyDictionary()
+        self._available: Optional[bool] = None
+        self._available_checked_at = 0.0
+        self._metrics: deque = deque(maxlen=max(16, int(metrics_window)))
+        self._counters = {"requests": 0, "errors": 0, "cancelled": 0}
+
+    # ==================== 客户端管理 ====================
+
+    def _make_timeout(self, timeout: Optional[float]) -> httpx.Timeout:
+        value = float(timeout if timeout is not None else self.timeout)
+        return httpx.Timeout(value, connect=min(10.0, value))
+
+    def _get_sync_client(self) -> httpx.Client:
+        with self._lock:
+            if self._sync_client is None or self._sync_client.is_closed:
+                self._sync_client = httpx.Client(
+                    base_url=self.base_url,
+                    limits=self._limits,
+                    timeout=self._make_timeout(None)
+                )
+            return self._sync_client
+
+    def _get_async_client(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            client = self._async_clients.get(loop)
+            if client is None or client.is_closed:
+                client = httpx.AsyncClient(
+                    base_url=self.base_url,
+                    limits=self._limits,
+                    timeout=self._make_timeout(None)
+                )
+                self._async_clients[loop] = client
+            return client
+
+    async def aclose(self) -> None:
+        """关闭当前事件循环的异步连接池与同步连接池"""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        with self._lock:
+            async_client = self._async_clients.pop(loop, None) if loop is not None else None
+            sync_client, self._sync_client = self._sync_client, None
+        if async_client is not None:
+            await async_client.aclose()
+        if sync_client is not None:
+            sync_client.close()
+
+    # ==================== 可用性 ====================
+
+    def _mark_available(self, available: bool) -> None:
+        with self._lock:
+            self._available = available
+            self._available_checked_at = time.monotonic()
+
+    def _cached_availability(self) -> Optional[bool]:
+        with self._lock:
+            if self._available is None:
+                return None
+            ttl = self.availability_ttl if self._available else min(self.availability_ttl, _NEGATIVE_AVAILABILITY_TTL)
+            if time.monotonic() - self._available_checked_at > ttl:
+                return None
+            return self._available
+
+    def is_available(self) -> bool:
+        """检查Ollama服务是否可用（TTL 内复用上次结果）"""
+        cached = self._cached_availability()
+        if cached is not None:
+            return cached
+        try:
+            response = self._get_sync_client().get("/api/tags", timeout=self._make_timeout(5))
+            available = response.status_code == 200
+        except httpx.HTTPError as e:
+            logger.warning(f"Ollama服务不可用: {str(e)}")
+            available = False
+        self._mark_available(available)
+        return available
+
+    async def is_available_async(self) -> bool:
+        """异步检查Ollama服务是否可用（TTL 内复用上次结果）"""
+        cached = self._cached_availability()
+        if cached is not None:
+            return cached
+        try:
+            response = await self._get_async_client().get("/api/tags", timeout=self._make_timeout(5))
+            available = response.status_code == 200
+        except httpx.HTTPError as e:
+            logger.warning(f"Ollama服务不可用: {str(e)}")
+            available = False
+        self._mark_available(available)
+        return available
+
+    # ==================== 指标 ====================
+
+    def _record(self, metric: Dict[str, Any]) -> None:
+        with self._lock:
+            self._metrics.append(metric)
+            self._counters["requests"] += 1
+            if metric["status"] == "error":
+                self._counters["errors"] += 1
+            elif metric["status"] == "cancelled":
+                self._counters["cancelled"] += 1
+
+    def get_metrics(self, recent: int = 10) -> Dict[str, Any]:
+        """最近请求的耗时分布（流式请求含首 token 延迟）"""
+        with self._lock:
+            metrics = list(self._metrics)
+            counters = dict(self._counters)
+            available = self._available
+        stream_metrics = [item for item in metrics if item.get("stream")]
+        ttft_values = [item["ttft_ms"] for item in stream_metrics if item.get("ttft_ms") is not None]
+        total_values = [item["total_ms"] for item in metrics if item["status"] == "ok"]
+        return {
+            "base_url": self.base_url,
+            "available": available,
+            **counters,
+            "window": len(metrics),
+            "ttft_ms_p50": _percentile(ttft_values, 0.5),
+            "ttft_ms_p95": _percentile(ttft_values, 0.95),
+            "total_ms_p50": _percentile(total_values, 0.5),
+            "total_ms_p95": _percentile(total_values, 0.95),
+            "recent": metrics[-max(0, int(recent)):] if recent else []
+        }
+
+    def _new_metric(self, path: str, payload: Optional[Dict[str, Any]], stream: bool) -> Dict[str, Any]:
+        return {
+            "path": path,
+            "model": (payload or {}).get("model"),
+            "stream": stream,
+            "status": "ok",
+            "ttft_ms": None,
+            "total_ms": None,
+            "chunks": 0,
+            "started_at": time.time()
+        }
+
+    def _raise_transport_error(self, error: httpx.HTTPError) -> None:
+        if isinstance(error, httpx.TimeoutException):
+            raise RuntimeError("Ollama请求超时，请检查服务状态或增加timeout配置") from error
+        if isinstance(error, httpx.TransportError):
+            self._mark_available(False)
+        raise RuntimeError(f"Ollama请求失败: {str(error)}") from error
+
+    def _check_response(self, response: httpx.Response) -> Dict[str, Any]:
+        if response.status_code != 200:
+            error_msg = f"Ollama API返回错误: {response.status_code} - {response.text}"
+            logger.error(error_msg)
+            raise OllamaAPIError(response.status_code, error_msg, body=response.text)
+        self._mark_available(True)
+        return response.json()
+
+    # ==================== 请求 ====================
+
+    def get_json_sync(self, path: str, timeout: Optional[float] = None) -> Dict[str, Any]:
+        metric = self._new_metric(path, None, stream=False)
+        start = time.perf_counter()
+        try:
+            response = self._get_sync_client().get(path, timeout=self._make_timeout(timeout))
+            return self._check_response(response)
+        except httpx.HTTPError as error:
+            metric["status"] = "error"
+            self._raise_transport_error(error)
+        except Exception:
+            metric["status"] = "error"
+            raise
+        finally:
+            metric["total_ms"] = round((time.perf_counter() - start) * 1000, 1)
+            self._record(metric)
+
+    def post_json_sync(self, path: str, payload: Dict[str, Any], timeout: Optional[float] = None) -> Dict[str, Any]:
+        metric = self._new_metric(path, payload, stream=False)
+        start = time.perf_counter()
+        try:
+            response = self._get_sync_client().post(path, json=payload, timeout=self._make_timeout(timeout))
+            return self._check_response(response)
+        except httpx.HTTPError as error:
+            metric["status"] = "error"
+            self._raise_transport_error(error)
+        except Exception:
+            metric["status"] = "error"
+            raise
+        finally:
+            metric["total_ms"] = round((time.perf_counter() - start) * 1000, 1)
+            self._record(metric)
+
+    async def post_json(self, path: str, payload: Dict[str, Any], timeout: Optional[float] = None) -> Dict[str, Any]:
+        metric = self._new_metric(path, payload, stream=False)
+        start = time.perf_counter()
+        try:
+            response = await self._get_async_client().post(path, json=payload, timeout=self._make_timeout(timeout))
+            return self._check_response(response)
+        except asyncio.CancelledError:
+            metric["status"] = "cancelled"
+            raise
+        except httpx.HTTPError as error:
+            metric["status"] = "error"
+            self._raise_transport_error(error)
+        except Exception:
+            metric["status"] = "error"
+            raise
+        finally:
+            metric["total_ms"] = round((time.perf_counter() - start) * 1000, 1)
+            self._record(metric)
+
+    async def stream_json_lines(
+        self,
+        path: str,
+        payload: Dict[str, Any],
+        timeout: Optional[float] = None
+    ) -> AsyncGenerator[Dict[str, Any], None]:
+        """
+        流式 POST，逐行解析 JSON
+
+        timeout 作用于建连与相邻两行之间的等待，而非整次生成
+        """
+        metric = self._new_metric(path, payload, stream=True)
+        start = time.perf_counter()
+        try:
+            client = self._get_async_client()
+            async with client.stream("POST", path, json=payload, timeout=self._make_timeout(timeout)) as response:
+                if response.status_code != 200:
+                    body = (await response.aread()).decode("utf-8", errors="ignore")
+                    error_msg = f"Ollama API返回错误: {response.status_code} - {body}"
+                    logger.error(error_msg)
+                    raise OllamaAPIError(response.status_code, error_msg, body=body)
+                self._mark_available(True)
+
+                async for line in response.aiter_lines():
+                    if not line:
+                        continue
+                    try:
+                        data = json.loads(line)
+                    except json.JSONDecodeError as e:
+                        logger.warning(f"解析Ollama流式响应失败: {e}")
+                        continue
+
+                    if metric["ttft_ms"] is None:
+                        metric["ttft_ms"] = round((time.perf_counter() - start) * 1000, 1)
+                    metric["chunks"] += 1
+                    yield data
+
+                    if data.get("done", False):
+                        break
+        except (asyncio.CancelledError, GeneratorExit):
+            metric["status"] = "cancelled"
+            raise
+        except httpx.HTTPError as error:
+            metric["status"] = "error"
+            self._raise_transport_error(error)
+        except Exception:
+            metric["status"] = "error"
+            raise
+        finally:
+            metric["total_ms"] = round((time.perf_counter() - start) * 1000, 1)
+            self._record(metric)
+            if metric["status"] == "cancelled":
+                logger.info(f"Ollama流式请求已取消: model={metric['model']}, chunks={metric['chunks']}")
+
+
+def get_ollama_http_client(base_url: str, timeout: float = 120) -> OllamaHttpClient:
+    """按 base_url 获取共享的Ollama HTTP客户端"""
+    key = str(base_url).rstrip('/')
+    with _ollama_http_clients_lock:
+        client = _ollama_http_clients.get(key)
+        if client is None:
+            ollama_config = getattr(settings.llm, 'ollama', None) or {}
+            client = OllamaHttpClient(
+                base_url=key,
+                timeout=timeout,
+                max_connections=int(ollama_config.get('max_connections', 20) or 20),
+                max_keepalive_connections=int(ollama_config.get('max_keepalive_connections', 10) or 10),
+                availability_ttl=float(ollama_config.get('availability_ttl', 30) or 0)
+            )
+            _ollama_http_clients[key] = client
+        return client
+
+
+async def close_ollama_http_clients() -> None:
+    """应用关闭时释放所有Ollama连接池"""
+    with _ollama_http_clients_lock:
+        clients = list(_ollama_http_clients.values())
+    for client in clients:
+        try:
+            await client.aclose()
+        except Exception as e:
+            logger.warning(f"关闭Ollama连接池失败: {e}")
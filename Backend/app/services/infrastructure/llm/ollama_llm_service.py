@@ -1,8 +1,9 @@
 """Ollama LLM服务"""
-import asyncio
-import requests
-from typing import List, Dict, Optional, AsyncGenerator
+import time
+from typing import List, Dict, Optional, AsyncGenerator, Any
 from app.core.config import settings
+from app.services.infrastructure.llm.ollama_http_client import get_ollama_http_client
+from app.services.infrastructure.telemetry.tracing import record_span, span, traced
 from app.utils.logger import get_logger
 
 logger = get_logger(__name__)
@@ -24,24 +25,27 @@ class OllamaLLMService:
             self.base_url = 'http://localhost:11434'
             self.timeout = 30
         
+        # 共享连接池（同一 base_url 的LLM/嵌入请求复用 keep-alive 连接）
+        self.http = get_ollama_http_client(self.base_url, timeout=self.timeout)
+        
         logger.info(f"Ollama LLM服务初始化: base_url={self.base_url}")
     
     def is_available(self) -> bool:
         """
-        检查Ollama服务是否可用
+        检查Ollama服务是否可用（结果按TTL缓存）
         
         Returns:
             是否可用
         """
-        try:
-            response = requests.get(
-                f"{self.base_url}/api/tags",
-                timeout=5
-            )
-            return response.status_code == 200
-        except Exception as e:
-            logger.warning(f"Ollama服务不可用: {str(e)}")
-            return False
+        return self.http.is_available()
+    
+    async def is_available_async(self) -> bool:
+        """异步检查Ollama服务是否可用（结果按TTL缓存）"""
+        return await self.http.is_available_async()
+    
+    def get_metrics(self, recent: int = 10) -> Dict[str, Any]:
+        """获取最近请求耗时与首token延迟（TTFT）统计"""
+        return self.http.get_metrics(recent=recent)
     
     def list_available_models(self) -> List[Dict]:
         """
@@ -51,20 +55,7 @@ class OllamaLLMService:
             模型信息列表 [{"name": "qwen2.5:7b", "size": 4.7, "type": "Qwen", ...}, ...]
         """
         try:
-            if not self.is_available():
-                logger.warning("Ollama服务不可用")
-                return []
-            
-            response = requests.get(
-                f"{self.base_url}/api/tags",
-                timeout=10
-            )
-            
-            if response.status_code != 200:
-                logger.error(f"获取Ollama模型列表失败: {response.status_code}")
-                return []
-            
-            data = response.json()
+            data = self.http.get_json_sync("/api/tags", timeout=10)
             models = data.get('models', [])
             
             # 过滤掉embedding模型，只保留LLM模型
@@ -126,6 +117,7 @@ class OllamaLLMService:
         else:
             return 'Unknown'
     
+    @traced("llm_generate")
     async def chat(
         self,
         model: str,
@@ -166,20 +158,12 @@ class OllamaLLMService:
             if max_tokens:
                 payload["options"]["num_predict"] = max_tokens
             
-            # 调用Ollama Chat API
-            response = await asyncio.to_thread(
-                requests.post,
-                f"{self.base_url}/api/chat",
-                json=payload,
+            # 调用Ollama Chat API（共享连接池）
+            result = await self.http.post_json(
+                "/api/chat",
+                payload,
                 timeout=timeout if timeout is not None else self.timeout
             )
-            
-            if response.status_code != 200:
-                error_msg = f"Ollama API返回错误: {response.status_code} - {response.text}"
-                logger.error(error_msg)
-                raise RuntimeError(error_msg)
-            
-            result = response.json()
             message = result.get('message', {})
             answer = message.get('content', '')
             
@@ -213,7 +197,7 @@ class OllamaLLMService:
             生成的文本片段
         """
         try:
-            if not self.is_available():
+            if not await self.http.is_available_async():
                 raise RuntimeError("Ollama服务不可用，请确保Ollama已启动")
             
             logger.info(f"Ollama流式对话开始: model={model}, messages={len(messages)}条")
@@ -231,38 +215,21 @@ class OllamaLLMService:
             if max_tokens:
                 payload["options"]["num_predict"] = max_tokens
             
-            # 调用Ollama Chat API (流式)
-            response = requests.post(
-                f"{self.base_url}/api/chat",
-                json=payload,
-                stream=True,
-                timeout=self.timeout
-            )
-            
-            if response.status_code != 200:
-                error_msg = f"Ollama API返回错误: {response.status_code}"
-                logger.error(error_msg)
-                raise RuntimeError(error_msg)
-            
-            # 逐行解析流式响应
-            for line in response.iter_lines():
-                if line:
-                    try:
-                        import json
-                        data = json.loads(line)
-                        message = data.get('message', {})
-                        content = message.get('content', '')
-                        
+            # 调用Ollama Chat API (异步流式)；调用方停止消费时显式关闭，及时断开连接
+            started = time.perf_counter()
+            first_token = True
+            stream = self.http.stream_json_lines("/api/chat", payload, timeout=self.timeout)
+            try:
+                with span("llm_generate"):
+                    async for data in stream:
+                        content = data.get('message', {}).get('content', '')
                         if content:
+                            if first_token:
+                                first_token = False
+                                record_span("llm_ttft", started)
                             yield content
-                        
-                        # 检查是否完成
-                        if data.get('done', False):
-                            break
-                            
-                    except json.JSONDecodeError as e:
-                        logger.warning(f"解析Ollama流式响应失败: {e}")
-                        continue
+            finally:
+                await stream.aclose()
             
             logger.info("Ollama流式对话完成")
             
@@ -0,0 +1,174 @@
+"""
+本地模型前缀 KV Cache 复用
+按 token 前缀（块对齐）的链式哈希索引 past_key_values，新请求复用最长已缓存前缀，只对剩余 token 做 prefill
+"""
+import hashlib
+import threading
+from array import array
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+import torch
+from app.utils.logger import logger
+
+KVLayers = List[Tuple[torch.Tensor, torch.Tensor]]
+
+
+def prefix_block_hashes(token_ids: Sequence[int], block_size: int, namespace: str = "") -> List[str]:
+    """链式块哈希：第 i 个哈希对应前 (i + 1) * block_size 个 token；namespace 区分同一模型的不同 adapter 等"""
+    digest = hashlib.blake2b(namespace.encode("utf-8"), digest_size=16).digest()
+    hashes: List[str] = []
+    for end in range(block_size, len(token_ids) + 1, block_size):
+        block = array("q", token_ids[end - block_size:end]).tobytes()
+        digest = hashlib.blake2b(digest + block, digest_size=16).digest()
+        hashes.append(digest.hex())
+    return hashes
+
+
+@dataclass
+class _PrefixEntry:
+    entry_id: int
+    token_ids: Tuple[int, ...]
+    layers: KVLayers
+    hashes: List[str]
+    nbytes: int
+    hits: int = 0
+
+
+@dataclass
+class PrefixMatch:
+    """命中的前缀：length 个 token 的各层 KV（条目张量的切片视图，不可原地修改）"""
+    length: int
+    layers: KVLayers
+
+
+class PrefixKVCache:
+    """
+    前缀 KV Cache 内存池（每个已加载模型一个）
+
+    - 条目保存一段块对齐 token 序列的各层 KV（batch=1），并以其每个块边界的前缀哈希建立索引，
+      查询时从最长块边界向前匹配，命中后再逐 token 校验防止哈希碰撞
+    - 新条目完整包含的旧条目（上一轮对话）直接移除，避免同一会话的多轮前缀重复占用显存
+    - 按字节数上限做 LRU 淘汰
+    """
+
+    def __init__(self, max_bytes: int, block_size: int = 32, min_prefix_tokens: int = 64):
+        self.max_bytes = max(0, int(max_bytes))
+        self.block_size = max(1, int(block_size))
+        self.min_prefix_tokens = max(self.block_size, int(min_prefix_tokens))
+        self._entries: "OrderedDict[int, _PrefixEntry]" = OrderedDict()
+        self._index: Dict[str, int] = {}
+        self._next_id = 0
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {
+            "lookups": 0,
+            "hits": 0,
+            "reused_tokens": 0,
+            "prompt_tokens": 0,
+            "stores": 0,
+            "evictions": 0
+        }
+
+    def lookup(self, token_ids: Sequence[int], namespace: str = "") -> Optional[PrefixMatch]:
+        """查找最长已缓存前缀；至少保留最后 1 个 token 做 prefill 以获得下一个 token 的 logits"""
+        hashes = prefix_block_hashes(token_ids[:len(token_ids) - 1], self.block_size, namespace)
+        with self._lock:
+            self._stats["lookups"] += 1
+            self._stats["prompt_tokens"] += len(token_ids)
+            for index in range(len(hashes) - 1, -1, -1):
+                length = (index + 1) * self.block_size
+                if length < self.min_prefix_tokens:
+                    break
+                entry_id = self._index.get(hashes[index])
+                if entry_id is None:
+                    continue
+                entry = self._entries[entry_id]
+                if entry.token_ids[:length] != tuple(token_ids[:length]):
+                    continue
+                self._entries.move_to_end(entry_id)
+                entry.hits += 1
+                self._stats["hits"] += 1
+                self._stats["reused_tokens"] += length
+                return PrefixMatch(
+                    length=length,
+                    layers=[(key[..., :length, :], value[..., :length, :]) for key, value in entry.layers]
+                )
+        return None
+
+    def put(self, token_ids: Sequence[int], layers: KVLayers, namespace: str = "") -> bool:
+        """保存一段序列的 KV（只取块对齐部分并复制，调用方的张量可继续被修改）"""
+        usable = len(token_ids) // self.block_size * self.block_size
+        if usable < self.min_prefix_tokens or not layers:
+            return False
+        hashes = prefix_block_hashes(token_ids[:usable], self.block_size, namespace)
+        with self._lock:
+            existing_id = self._index.get(hashes[-1])
+            if existing_id is not None:
+                self._entries.move_to_end(existing_id)
+                return False
+
+        copied = [(key[..., :usable, :].clone(), value[..., :usable, :].clone()) for key, value in layers]
+        nbytes = sum(key.numel() * key.element_size() + value.numel() * value.element_size() for key, value in copied)
+        if nbytes > self.max_bytes:
+            return False
+
+        with self._lock:
+            if hashes[-1] in self._index:
+                return False
+            # 新条目完整包含的旧条目（同一会话的上一轮）直接移除
+            for block_hash in hashes:
+                entry_id = self._index.get(block_hash)
+                if entry_id is not None and self._entries[entry_id].hashes[-1] == block_hash:
+                    self._remove_locked(entry_id)
+
+            entry = _PrefixEntry(
+                entry_id=self._next_id,
+                token_ids=tuple(int(token_id) for token_id in token_ids[:usable]),
+                layers=copied,
+                hashes=hashes,
+                nbytes=nbytes
+            )
+            self._next_id += 1
+            self._entries[entry.entry_id] = entry
+            for block_hash in hashes:
+                self._index[block_hash] = entry.entry_id
+            self._total_bytes += nbytes
+            self._stats["stores"] += 1
+
+            while self._total_bytes > self.max_bytes and self._entries:
+                self._remove_locked(next(iter(self._entries)))
+                self._stats["evictions"] += 1
+        return True
+
+    def _remove_locked(self, entry_id: int) -> None:
+        entry = self._entries.pop(entry_id, None)
+        if entry is None:
+            return
+        for block_hash in entry.hashes:
+            if self._index.get(block_hash) == entry_id:
+                self._index.pop(block_hash, None)
+        self._total_bytes -= entry.nbytes
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._index.clear()
+            self._total_bytes = 0
+        logger.info("前缀 KV Cache 已清空")
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+            entries = len(self._entries)
+            total_bytes = self._total_bytes
+        return {
+            "entries": entries,
+            "memory_mb": round(total_bytes / 1024 ** 2, 2),
+            "max_memory_mb": round(self.max_bytes / 1024 ** 2, 2),
+            "block_size": self.block_size,
+            "min_prefix_tokens": self.min_prefix_tokens,
+            **stats,
+            "hit_rate": round(stats["hits"] / stats["lookups"], 4) if stats["lookups"] else 0.0,
+            "reused_token_ratio": round(stats["reused_tokens"] / stats["prompt_tokens"], 4) if stats["prompt_tokens"] else 0.0
+        }
@@ -5,6 +5,7 @@ Transformers本地推理服务
 """
 import os
 import json
+import time
 import asyncio
 from typing import Optional, Dict, List, Any, AsyncGenerator
 from pathlib import Path
@@ -23,6 +24,10 @@ from transformers.models.auto.configuration_auto import CONFIG_MAPPING
 from transformers.models.auto import modeling_auto
 from threading import Thread
 from app.core.config import settings
+from app.services.infrastructure.model.residency_manager import get_model_residency_manager
+from app.services.infrastructure.llm.generation_scheduler import GenerationParams, GenerationScheduler
+from app.services.infrastructure.llm.prefix_cache import PrefixKVCache
+from app.services.infrastructure.telemetry.tracing import record_span, traced
 from app.utils.logger import logger
 
 
@@ -40,6 +45,7 @@ class TransformersService:
         self.current_processor = None
         self.current_model_name = None
         self.current_model_loader = "causal_lm"
+        self._scheduler: Optional[GenerationScheduler] = None
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
         self.models_dir = Path(settings.llm.local_models_dir) / "LLM"
         
@@ -341,6 +347,87 @@ class TransformersService:
         )
         return self._post_process_response(response, model_name)
     
+    def _residency_key(self, model_name: Optional[str]) -> str:
+        return f"llm:{model_name}"
+
+    def _release_current_model(self) -> None:
+        """释放当前模型引用（常驻管理器淘汰回调与 unload_model 共用）"""
+        if self._scheduler is not None:
+            self._scheduler.shutdown(f"模型已卸载: {self.current_model_name}")
+            self._scheduler = None
+        self.current_model = None
+        self.current_tokenizer = None
+        self.current_processor = None
+        self.current_model_name = None
+        self.current_model_loader = "causal_lm"
+        if self.device == "cuda":
+            torch.cuda.empty_cache()
+
+    def _get_scheduler(self) -> Optional[GenerationScheduler]:
+        """当前 causal_lm 模型的连续批处理调度器；image_text 模型或关闭调度时返回 None（走 generate）"""
+        if not getattr(settings.llm, "transformers_scheduler_enabled", True):
+            return None
+        if self.current_model is None or self.current_tokenizer is None or self.current_model_loader != "causal_lm":
+            return None
+        if self._scheduler is None or self._scheduler.closed or self._scheduler.model is not self.current_model:
+            self._scheduler = GenerationScheduler(
+                model=self.current_model,
+                tokenizer=self.current_tokenizer,
+                max_batch_size=getattr(settings.llm, "transformers_max_batch_size", 4),
+                max_queue_depth=getattr(settings.llm, "transformers_max_queue_depth", 32),
+                max_batch_tokens=getattr(settings.llm, "transformers_max_batch_tokens", 16384),
+                name=self.current_model_name or "",
+                prefix_cache=self._create_prefix_cache()
+            )
+            logger.info(
+                f"生成调度器已创建: model={self.current_model_name}, "
+                f"max_batch_size={self._scheduler.max_batch_size}, max_queue_depth={self._scheduler.max_queue_depth}"
+            )
+        return self._scheduler
+
+    def _create_prefix_cache(self) -> Optional[PrefixKVCache]:
+        if not getattr(settings.llm, "transformers_prefix_cache_enabled", True):
+            return None
+        return PrefixKVCache(
+            max_bytes=int(getattr(settings.llm, "transformers_prefix_cache_max_mb", 512)) * 1024 ** 2,
+            block_size=getattr(settings.llm, "transformers_prefix_cache_block_size", 32),
+            min_prefix_tokens=getattr(settings.llm, "transformers_prefix_cache_min_tokens", 64)
+        )
+
+    def _build_generation_params(self, temperature: float, max_tokens: int) -> GenerationParams:
+        return GenerationParams(
+            max_new_tokens=max_tokens,
+            temperature=temperature,
+            top_p=0.9,
+            top_k=50,
+            repetition_penalty=1.1
+        )
+
+    def _generation_timeout(self, max_tokens: int) -> int:
+        """生成超时: 取配置基线与按token估算的较大值，避免长回答被过早中断"""
+        configured_timeout = max(
+            1,
+            int(getattr(settings.llm, "transformers_generation_timeout_seconds", 480))
+        )
+        assumed_tps = max(
+            0.1,
+            float(getattr(settings.llm, "transformers_assumed_tokens_per_second", 5.0))
+        )
+        estimated_timeout = max(60, int(max_tokens / assumed_tps))
+        return max(configured_timeout, estimated_timeout)
+
+    def get_scheduler_stats(self) -> Dict[str, Any]:
+        """生成调度器状态（排队深度、批大小、tokens/s、排队等待与首 token 延迟）"""
+        stats: Dict[str, Any] = {
+            "enabled": bool(getattr(settings.llm, "transformers_scheduler_enabled", True)),
+            "current_model": self.current_model_name,
+            "loader": self.current_model_loader
+        }
+        if self._scheduler is not None:
+            stats.update(self._scheduler.get_stats())
+        return stats
+
+    @traced("llm_load_model")
     async def load_model(self, model_name: str, quantize: bool = True) -> bool:
         """
         加载模型到内存
@@ -375,19 +462,14 @@ class TransformersService:
             # 如果已加载相同模型,跳过
             if self.current_model_name == model_name:
                 logger.info(f"模型{model_name}已加载,跳过重复加载")
+                get_model_residency_manager().touch(self._residency_key(model_name))
                 return True
             
             # 清理之前的模型
             if self.current_model is not None:
                 logger.info(f"卸载旧模型: {self.current_model_name}")
-                del self.current_model
-                if self.current_tokenizer is not None:
-                    del self.current_tokenizer
-                if self.current_processor is not None:
-                    del self.current_processor
-                torch.cuda.empty_cache()
-                self.current_tokenizer = None
-                self.current_processor = None
+                get_model_residency_manager().unregister(self._residency_key(self.current_model_name))
+                self._release_current_model()
             
             # 加载tokenizer/processor
             if loader_kind == "image_text":
@@ -465,6 +547,21 @@ class TransformersService:
             
             self.current_model_name = model_name
             self.current_model_loader = loader_kind
+
+            loaded_model = self.current_model
+
+            def _unload_if_current() -> None:
+                if self.current_model is loaded_model:
+                    self._release_current_model()
+
+            get_model_residency_manager().register(
+                key=self._residency_key(model_name),
+                kind="llm",
+                name=model_name,
+                model=loaded_model,
+                unload_fn=_unload_if_current,
+                device=self.device
+            )
             
             # 显示显存使用（加载后）
             if self.device == "cuda":
@@ -526,68 +623,87 @@ class TransformersService:
                 if not success:
                     raise RuntimeError(f"无法加载模型: {model}")
             
-            inputs = self._prepare_model_inputs(messages, max_length=4096)
-            inputs = self._move_inputs_to_model_device(inputs)
+            with get_model_residency_manager().use(self._residency_key(model)):
+                return await self._generate_response(model, messages, temperature, max_tokens)
             
-            logger.info(f"输入准备完成")
+        except Exception as e:
+            logger.error(f"聊天生成失败: {e}", exc_info=True)
+            raise
 
-            
-            # 生成配置
-            generation_config = {
-                "max_new_tokens": max_tokens,
-                "temperature": temperature,
-                "do_sample": temperature > 0,
-                "top_p": 0.9,
-                "top_k": 50,
-                "repetition_penalty": 1.1,
-                "pad_token_id": self.current_tokenizer.eos_token_id,
-            }
-            
-            logger.info(f"开始生成回复，max_new_tokens: {max_tokens}")
-            # 同步生成(异步包装，添加超时保护)
-            loop = asyncio.get_event_loop()
-            
+    @traced("llm_generate")
+    async def _generate_response(
+        self,
+        model: str,
+        messages: List[Dict[str, str]],
+        temperature: float,
+        max_tokens: int
+    ) -> str:
+        """非流式生成（调用方已确保模型加载并标记为使用中）"""
+        inputs = self._prepare_model_inputs(messages, max_length=4096)
+        timeout = self._generation_timeout(max_tokens)
+
+        scheduler = self._get_scheduler()
+        if scheduler is not None:
+            logger.info(f"提交到生成调度器，max_new_tokens: {max_tokens}")
             try:
-                with torch.no_grad():
-                    # 生成超时: 取配置基线与按token估算的较大值，避免长回答被过早中断
-                    configured_timeout = max(
-                        1,
-                        int(getattr(settings.llm, "transformers_generation_timeout_seconds", 480))
-                    )
-                    assumed_tps = max(
-                        0.1,
-                        float(getattr(settings.llm, "transformers_assumed_tokens_per_second", 5.0))
-                    )
-                    estimated_timeout = max(60, int(max_tokens / assumed_tps))
-                    timeout = max(configured_timeout, estimated_timeout)
-                    output_ids = await asyncio.wait_for(
-                        loop.run_in_executor(
-                            None,
-                            lambda: self.current_model.generate(
-                                **inputs,
-                                **generation_config
-                            )
-                        ),
-                        timeout=timeout
-                    )
+                response = await asyncio.wait_for(
+                    scheduler.generate(
+                        inputs["input_ids"][0].tolist(),
+                        self._build_generation_params(temperature, max_tokens)
+                    ),
+                    timeout=timeout
+                )
             except asyncio.TimeoutError:
-                logger.error(f"生成超时({timeout}秒)，返回部分结果")
+                logger.error(f"生成超时({timeout}秒)，已取消调度中的请求")
                 return "抱歉，生成回复超时。请尝试缩短问题或降低max_tokens。"
-            
-            logger.info("生成完成，开始解码")
-            
-            # 解码输出（注意：inputs现在是dict）
-            response = self._decode_generated_text(output_ids, inputs, model)
-            
-            # 显存回收
-            if self.device == "cuda":
-                torch.cuda.empty_cache()
-            
-            return response.strip()
-            
-        except Exception as e:
-            logger.error(f"聊天生成失败: {e}", exc_info=True)
-            raise
+            return self._post_process_response(response, model).strip()
+
+        inputs = self._move_inputs_to_model_device(inputs)
+        
+        logger.info(f"输入准备完成")
+
+        
+        # 生成配置
+        generation_config = {
+            "max_new_tokens": max_tokens,
+            "temperature": temperature,
+            "do_sample": temperature > 0,
+            "top_p": 0.9,
+            "top_k": 50,
+            "repetition_penalty": 1.1,
+            "pad_token_id": self.current_tokenizer.eos_token_id,
+        }
+        
+        logger.info(f"开始生成回复，max_new_tokens: {max_tokens}")
+        # 同步生成(异步包装，添加超时保护)
+        loop = asyncio.get_event_loop()
+        
+        try:
+            with torch.no_grad():
+                output_ids = await asyncio.wait_for(
+                    loop.run_in_executor(
+                        None,
+                        lambda: self.current_model.generate(
+                            **inputs,
+                            **generation_config
+                        )
+                    ),
+                    timeout=timeout
+                )
+        except asyncio.TimeoutError:
+            logger.error(f"生成超时({timeout}秒)，返回部分结果")
+            return "抱歉，生成回复超时。请尝试缩短问题或降低max_tokens。"
+        
+        logger.info("生成完成，开始解码")
+        
+        # 解码输出（注意：inputs现在是dict）
+        response = self._decode_generated_text(output_ids, inputs, model)
+        
+        # 显存回收
+        if self.device == "cuda":
+            torch.cuda.empty_cache()
+        
+        return response.strip()
     
     async def _chat_stream(
         self,
@@ -615,56 +731,81 @@ class TransformersService:
                 if not success:
                     raise RuntimeError(f"无法加载模型: {model}")
             
-            inputs = self._prepare_model_inputs(messages, max_length=4096)
-            inputs = self._move_inputs_to_model_device(inputs)
-            
-            # 生成配置
-            generation_config = {
-                "max_new_tokens": max_tokens,
-                "temperature": temperature,
-                "do_sample": temperature > 0,
-                "top_p": 0.9,
-                "top_k": 50,
-                "repetition_penalty": 1.1,
-                "pad_token_id": self.current_tokenizer.eos_token_id,
-            }
-            
-            # 创建流式输出器
-            streamer = TextIteratorStreamer(
-                self._get_chat_template_tokenizer(),
-                skip_prompt=True,
-                skip_special_tokens=True
-            )
+            # 生成线程运行期间禁止常驻管理器淘汰该模型
+            generate_started = time.perf_counter()
+            first_token = True
+            with get_model_residency_manager().use(self._residency_key(model)):
+                inputs = self._prepare_model_inputs(messages, max_length=4096)
+
+                # 连续批处理：与其他会话合并解码；调用方断开时 stream 会取消该请求
+                scheduler = self._get_scheduler()
+                if scheduler is not None:
+                    request = scheduler.submit(
+                        inputs["input_ids"][0].tolist(),
+                        self._build_generation_params(temperature, max_tokens)
+                    )
+                    async for text_chunk in scheduler.stream(request):
+                        if first_token:
+                            first_token = False
+                            record_span("llm_ttft", generate_started)
+                        yield text_chunk
+                    record_span("llm_generate", generate_started)
+                    logger.info(f"流式生成完成: {request.metrics()}")
+                    return
+
+                inputs = self._move_inputs_to_model_device(inputs)
+            
+                # 生成配置
+                generation_config = {
+                    "max_new_tokens": max_tokens,
+                    "temperature": temperature,
+                    "do_sample": temperature > 0,
+                    "top_p": 0.9,
+                    "top_k": 50,
+                    "repetition_penalty": 1.1,
+                    "pad_token_id": self.current_tokenizer.eos_token_id,
+                }
+            
+                # 创建流式输出器
+                streamer = TextIteratorStreamer(
+                    self._get_chat_template_tokenizer(),
+                    skip_prompt=True,
+                    skip_special_tokens=True
+                )
             
-            # 在后台线程中运行生成
-            import asyncio
-            from threading import Thread
+                # 在后台线程中运行生成
+                import asyncio
+                from threading import Thread
             
-            generation_kwargs = dict(
-                **inputs,
-                **generation_config,
-                streamer=streamer
-            )
+                generation_kwargs = dict(
+                    **inputs,
+                    **generation_config,
+                    streamer=streamer
+                )
             
-            # 启动生成线程
-            thread = Thread(target=self.current_model.generate, kwargs=generation_kwargs)
-            thread.start()
-            
-            # 流式输出（累积文本用于后处理）
-            loop = asyncio.get_event_loop()
-            accumulated_text = ""
-            for text_chunk in streamer:
-                await asyncio.sleep(0)  # 让出控制权
-                accumulated_text += text_chunk
-                # 实时后处理（移除可能的思考标签）
-                processed_chunk = self._post_process_response(accumulated_text, model)
-                if processed_chunk != accumulated_text:
-                    # 有变化，说明遇到了思考标签，重新生成输出
-                    accumulated_text = processed_chunk
-                yield text_chunk
-            
-            # 等待线程结束
-            thread.join()
+                # 启动生成线程
+                thread = Thread(target=self.current_model.generate, kwargs=generation_kwargs)
+                thread.start()
+            
+                # 流式输出（累积文本用于后处理）
+                loop = asyncio.get_event_loop()
+                accumulated_text = ""
+                for text_chunk in streamer:
+                    await asyncio.sleep(0)  # 让出控制权
+                    if first_token:
+                        first_token = False
+                        record_span("llm_ttft", generate_started)
+                    accumulated_text += text_chunk
+                    # 实时后处理（移除可能的思考标签）
+                    processed_chunk = self._post_process_response(accumulated_text, model)
+                    if processed_chunk != accumulated_text:
+                        # 有变化，说明遇到了思考标签，重新生成输出
+                        accumulated_text = processed_chunk
+                    yield text_chunk
+            
+                # 等待线程结束
+                thread.join()
+                record_span("llm_generate", generate_started)
             
             # 显存回收
             if self.device == "cuda":
@@ -813,7 +954,8 @@ class TransformersService:
                 "status": "healthy",
                 "device": self.device,
                 "current_model": self.current_model_name,
-                "models_available": len(await self.list_models())
+                "models_available": len(await self.list_models()),
+                "generation_scheduler": self.get_scheduler_stats()
             }
             
             if self.device == "cuda":
@@ -848,19 +990,9 @@ class TransformersService:
             
             logger.info(f"卸载模型: {self.current_model_name}")
             
-            del self.current_model
-            if self.current_tokenizer is not None:
-                del self.current_tokenizer
-            if self.current_processor is not None:
-                del self.current_processor
-            self.current_model = None
-            self.current_tokenizer = None
-            self.current_processor = None
-            self.current_model_name = None
-            self.current_model_loader = "causal_lm"
-            
+            get_model_residency_manager().unregister(self._residency_key(self.current_model_name))
+            self._release_current_model()
             if self.device == "cuda":
-                torch.cuda.empty_cache()
                 logger.info("显存已清理")
             
             return True
@@ -1,12 +1,14 @@
 """LoRA 微调服务"""
 from app.services.infrastructure.lora.lora_service import LoRAService
 from app.services.infrastructure.lora.lora_inference_service import LoRAInferenceService, get_lora_inference_service
+from app.services.infrastructure.lora.multi_adapter_manager import MultiAdapterModel
 from app.services.infrastructure.lora.lora_training_service import LoRATrainingService
 from app.services.infrastructure.lora.dataset_validator_service import DatasetValidatorService
 
 __all__ = [
     'LoRAService',
     'LoRAInferenceService', 'get_lora_inference_service',
+    'MultiAdapterModel',
     'LoRATrainingService',
     'DatasetValidatorService',
 ]
@@ -1,32 +1,35 @@
 """LoRA 推理服务"""
+import asyncio
 import torch
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Optional, List, Tuple
 from pathlib import Path
 from collections import OrderedDict
 
 from transformers import AutoModelForCausalLM, AutoTokenizer
-from peft import PeftModel
 
+from app.core.config import settings
 from app.core.database import DatabaseManager
+from app.services.infrastructure.llm.generation_scheduler import GenerationParams
+from app.services.infrastructure.lora.multi_adapter_manager import AdapterSlot, MultiAdapterModel
 from app.utils.logger import get_logger
 
 logger = get_logger(__name__)
 
 
 class LoRAInferenceService:
-    """LoRA 推理引擎"""
+    """LoRA 推理引擎（同一基座模型上的多个 Adapter 共享基座权重与生成调度器）"""
     
     def __init__(self, db_manager: DatabaseManager):
         self.db = db_manager
         
-        # 模型缓存 (LRU)
-        self.base_model_cache: OrderedDict = OrderedDict()
-        self.lora_model_cache: OrderedDict = OrderedDict()
+        # 模型缓存 (LRU)：基座模型名 -> MultiAdapterModel（Adapter 在其内部单独做 LRU）
+        self.base_model_cache: "OrderedDict[str, MultiAdapterModel]" = OrderedDict()
         self.tokenizer_cache: OrderedDict = OrderedDict()
         
         # 缓存大小限制
-        self.max_base_models = 2  # 最多缓存 2 个基座模型
-        self.max_lora_models = 5  # 最多缓存 5 个 LoRA 模型
+        self.config = settings.lora_serving
+        self.max_base_models = max(1, int(self.config.max_base_models))
+        self.max_adapters_per_base = max(1, int(self.config.max_adapters_per_base))
         
         # 目录配置
         self.llm_dir = Path("Models/LLM")
@@ -36,27 +39,20 @@ class LoRAInferenceService:
         self,
         lora_model_id: int,
         base_model_name: str
-    ) -> tuple:
+    ) -> Tuple[MultiAdapterModel, Optional[AdapterSlot]]:
         """
-        加载 LoRA 模型
+        加载 LoRA Adapter 到共享的基座模型上
         
         Args:
             lora_model_id: LoRA 模型 ID
             base_model_name: 基座模型名称
             
         Returns:
-            (model, tokenizer)
+            (基座模型, Adapter)；加载 Adapter 失败时 Adapter 为 None（回退到基座模型）。
+            返回时基座模型与 Adapter 均已登记占用，生成结束后由 _generate_with_adapter 释放
         """
+        base = await self._get_or_load_base_model(base_model_name)
         try:
-            cache_key = f"{base_model_name}_{lora_model_id}"
-            
-            # 检查缓存
-            if cache_key in self.lora_model_cache:
-                logger.info(f"从缓存加载 LoRA 模型: {cache_key}")
-                # 移到最后（LRU）
-                self.lora_model_cache.move_to_end(cache_key)
-                return self.lora_model_cache[cache_key]
-            
             # 获取 LoRA 模型信息
             sql = "SELECT * FROM lora_models WHERE id = %s"
             result = await self.db.execute_query(sql, (lora_model_id,))
@@ -70,33 +66,18 @@ class LoRAInferenceService:
             if not lora_path.exists():
                 raise FileNotFoundError(f"LoRA 权重文件不存在: {lora_path}")
             
-            # 加载或获取基座模型
-            base_model, tokenizer = await self._get_or_load_base_model(base_model_name)
-            
-            # 加载 LoRA 权重
-            logger.info(f"加载 LoRA 权重: {lora_path}")
-            model = PeftModel.from_pretrained(base_model, str(lora_path))
-            model.eval()
-            
-            # 添加到缓存
-            self.lora_model_cache[cache_key] = (model, tokenizer)
-            
-            # LRU 淘汰
-            if len(self.lora_model_cache) > self.max_lora_models:
-                oldest_key = next(iter(self.lora_model_cache))
-                logger.info(f"淘汰 LoRA 模型缓存: {oldest_key}")
-                del self.lora_model_cache[oldest_key]
-            
-            logger.info(f"LoRA 模型加载完成: {cache_key}")
-            return model, tokenizer
+            # 已加载时直接占用并返回；否则加载到基座模型上（磁盘读取与模型修改放到线程池）
+            loop = asyncio.get_running_loop()
+            slot = await loop.run_in_executor(None, base.ensure_adapter, lora_model_id, str(lora_path))
+            return base, slot
             
         except Exception as e:
             logger.error(f"加载 LoRA 模型失败: {str(e)}")
             # 回退到基座模型
             logger.warning(f"回退到基座模型: {base_model_name}")
-            return await self._get_or_load_base_model(base_model_name)
+            return base, None
     
-    async def _get_or_load_base_model(self, model_name: str) -> tuple:
+    async def _get_or_load_base_model(self, model_name: str) -> MultiAdapterModel:
         """
         获取或加载基座模型
         
@@ -104,7 +85,7 @@ class LoRAInferenceService:
             model_name: 模型名称
             
         Returns:
-            (model, tokenizer)
+            MultiAdapterModel（已 acquire，调用方负责 release）
         """
         try:
             # 检查缓存
@@ -112,7 +93,9 @@ class LoRAInferenceService:
                 logger.info(f"从缓存加载基座模型: {model_name}")
                 # 移到最后（LRU）
                 self.base_model_cache.move_to_end(model_name)
-                return self.base_model_cache[model_name]
+                base = self.base_model_cache[model_name]
+                base.acquire()
+                return base
             
             # 加载模型
             model_path = self.llm_dir / model_name
@@ -140,17 +123,36 @@ class LoRAInferenceService:
             )
             model.eval()
             
+            base = MultiAdapterModel(
+                name=model_name,
+                base_model=model,
+                tokenizer=tokenizer,
+                max_adapters=self.max_adapters_per_base,
+                max_batch_size=self.config.max_batch_size,
+                max_queue_depth=self.config.max_queue_depth,
+                prefix_cache_bytes=self._prefix_cache_bytes()
+            )
+            
             # 添加到缓存
-            self.base_model_cache[model_name] = (model, tokenizer)
+            self.base_model_cache[model_name] = base
+            base.acquire()
             
-            # LRU 淘汰
-            if len(self.base_model_cache) > self.max_base_models:
-                oldest_key = next(iter(self.base_model_cache))
-                logger.info(f"淘汰基座模型缓存: {oldest_key}")
-                del self.base_model_cache[oldest_key]
+            # LRU 淘汰（连同其上的全部 Adapter）；仍有生成进行中的基座模型跳过，关闭会终止其调度器
+            while len(self.base_model_cache) > self.max_base_models:
+                victim_key = next(
+                    (key for key, cached in self.base_model_cache.items() if key != model_name and not cached.is_busy()),
+                    None
+                )
+                if victim_key is None:
+                    logger.warning(f"基座模型数超过上限但均在使用中: count={len(self.base_model_cache)}")
+                    break
+                logger.info(f"淘汰基座模型缓存: {victim_key}")
+                self.base_model_cache.pop(victim_key).close()
+                if torch.cuda.is_available():
+                    torch.cuda.empty_cache()
             
             logger.info(f"基座模型加载完成: {model_name}")
-            return model, tokenizer
+            return base
             
         except Exception as e:
             logger.error(f"加载基座模型失败: {str(e)}")
@@ -190,8 +192,15 @@ class LoRAInferenceService:
             # 兼容 chat_service 调用路径：传入 lora_model_id + messages
             if lora_model_id is not None and messages is not None:
                 resolved_base_model_name = base_model_name or await self._resolve_base_model_name(lora_model_id)
-                model, tokenizer = await self.load_lora_model(lora_model_id, resolved_base_model_name)
-                prompt = self._build_prompt_from_messages(messages)
+                base, slot = await self.load_lora_model(lora_model_id, resolved_base_model_name)
+                return await self._generate_with_adapter(
+                    base=base,
+                    slot=slot,
+                    prompt=self._build_prompt_from_messages(messages),
+                    max_length=max_length,
+                    temperature=temperature,
+                    top_p=top_p
+                )
 
             if model is None or tokenizer is None or prompt is None:
                 raise ValueError("generate 调用参数不完整，需要 model/tokenizer/prompt 或 lora_model_id/messages")
@@ -210,6 +219,45 @@ class LoRAInferenceService:
             logger.error(f"生成响应失败: {str(e)}")
             raise
 
+    async def _generate_with_adapter(
+        self,
+        base: MultiAdapterModel,
+        slot: Optional[AdapterSlot],
+        prompt: str,
+        max_length: int = 512,
+        temperature: float = 0.7,
+        top_p: float = 0.9
+    ) -> str:
+        """
+        经基座模型的生成调度器生成；不同 Adapter 的并发请求在同一批次解码
+
+        结束时释放 load_lora_model 登记的基座模型与 Adapter 占用
+        """
+        try:
+            prompt_ids = base.tokenizer(prompt)["input_ids"]
+            params = GenerationParams(
+                # max_length 沿用 generate 语义：包含 prompt 的总长度
+                max_new_tokens=max(1, max_length - len(prompt_ids)),
+                temperature=temperature,
+                top_p=top_p
+            )
+            scheduler = base.get_scheduler()
+            generated_text = await scheduler.generate(
+                prompt_ids,
+                params,
+                adapter_name=slot.name if slot is not None else None,
+                cache_namespace=slot.cache_namespace if slot is not None else None
+            )
+        finally:
+            base.release_adapter(slot)
+            base.release()
+        return generated_text.strip()
+
+    def _prefix_cache_bytes(self) -> int:
+        if not getattr(settings.llm, "transformers_prefix_cache_enabled", True):
+            return 0
+        return int(getattr(settings.llm, "transformers_prefix_cache_max_mb", 512)) * 1024 ** 2
+
     async def _generate_with_model(
         self,
         model,
@@ -274,28 +322,37 @@ class LoRAInferenceService:
         lines.append("Assistant:")
         return "\n\n".join(lines)
     
-    async def unload_lora_model(self, lora_model_id: int, base_model_name: str):
+    async def unload_lora_model(self, lora_model_id: int, base_model_name: Optional[str] = None):
         """
-        卸载 LoRA 模型
+        卸载 LoRA Adapter（基座模型保持常驻）
         
         Args:
             lora_model_id: LoRA 模型 ID
-            base_model_name: 基座模型名称
+            base_model_name: 基座模型名称，为空时从所有基座模型上卸载
         """
         try:
-            cache_key = f"{base_model_name}_{lora_model_id}"
-            
-            if cache_key in self.lora_model_cache:
-                del self.lora_model_cache[cache_key]
-                logger.info(f"LoRA 模型已卸载: {cache_key}")
+            for name, base in list(self.base_model_cache.items()):
+                if base_model_name and name != base_model_name:
+                    continue
+                if base.unload_adapter(lora_model_id):
+                    logger.info(f"LoRA 模型已卸载: {name}_{lora_model_id}")
             
         except Exception as e:
             logger.error(f"卸载 LoRA 模型失败: {str(e)}")
     
+    def get_stats(self) -> Dict[str, Any]:
+        """已加载的基座模型、各自的 Adapter 与调度器状态"""
+        return {
+            "max_base_models": self.max_base_models,
+            "max_adapters_per_base": self.max_adapters_per_base,
+            "base_models": [base.get_stats() for base in self.base_model_cache.values()]
+        }
+    
     def clear_cache(self):
         """清空所有缓存"""
+        for base in self.base_model_cache.values():
+            base.close()
         self.base_model_cache.clear()
-        self.lora_model_cache.clear()
         self.tokenizer_cache.clear()
         logger.info("模型缓存已清空")
 
@@ -0,0 +1,307 @@
+"""多 LoRA Adapter 管理：同一基座模型上按名称加载多个 Adapter，按请求选择 Adapter 并合并批次解码"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, List, Optional
+
+from peft import PeftModel
+
+from app.services.infrastructure.llm.generation_scheduler import GenerationScheduler
+from app.services.infrastructure.llm.prefix_cache import PrefixKVCache
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+def adapter_name_for(lora_model_id: int, path: Optional[str] = None) -> str:
+    """Adapter 名称；给出 path 时附加路径摘要，用于旧权重仍在使用时并存加载新权重"""
+    name = f"lora_{int(lora_model_id)}"
+    if path is None:
+        return name
+    return f"{name}_{hashlib.sha1(str(path).encode('utf-8')).hexdigest()[:8]}"
+
+
+@dataclass
+class AdapterSlot:
+    """已加载到基座模型上的 Adapter"""
+    name: str
+    lora_model_id: int
+    path: str
+    nbytes: int
+    loaded_at: float
+    last_used: float
+    in_use: int = 0
+    requests: int = 0
+    # 同一 LoRA 已加载了新路径的权重；占用释放后由 _evict_adapters 删除
+    stale: bool = False
+
+    @property
+    def cache_namespace(self) -> str:
+        # 同名 Adapter 重新加载（权重可能已更新）后不再复用旧的前缀 KV
+        return f"{self.name}@{self.loaded_at:.6f}"
+
+
+class MultiAdapterModel:
+    """
+    单个基座模型 + 其上的多个 LoRA Adapter
+
+    - 第一个 Adapter 通过 PeftModel.from_pretrained 包装基座模型，之后的 Adapter 以 load_adapter 按名称加入，
+      不再为每个 (基座, LoRA) 组合各自包装一次
+    - 不切换全局激活 Adapter：生成时每个请求携带 adapter_name，由调度器按行传入 adapter_names，
+      不同 Adapter 的请求可在同一批次解码
+    - Adapter 数超过上限时按 LRU 用 delete_adapter 单独卸载权重，基座模型不受影响；使用中的 Adapter 不会被淘汰
+    - 同一 LoRA 的权重路径变化时，旧 Adapter 若仍在使用则以带路径摘要的新名称加载新权重，
+      旧 Adapter 标记为过期，占用释放后再删除，进行中的请求不受影响
+    - ensure_adapter 在 _lock 内登记占用后返回，调用方生成结束后 release_adapter；
+      acquire/release 记录基座模型上的进行中请求，有请求时基座模型不会被淘汰
+    """
+
+    def __init__(
+        self,
+        name: str,
+        base_model: Any,
+        tokenizer: Any,
+        max_adapters: int = 8,
+        max_batch_size: int = 4,
+        max_queue_depth: int = 32,
+        prefix_cache_bytes: int = 0
+    ):
+        self.name = name
+        self.base_model = base_model
+        self.tokenizer = tokenizer
+        self.max_adapters = max(1, int(max_adapters))
+        self.max_batch_size = max_batch_size
+        self.max_queue_depth = max_queue_depth
+        self.prefix_cache_bytes = prefix_cache_bytes
+        self.peft_model: Optional[PeftModel] = None
+        self.adapters: "OrderedDict[str, AdapterSlot]" = OrderedDict()
+        self.evictions = 0
+        self._leases = 0
+        self._scheduler: Optional[GenerationScheduler] = None
+        self._lock = threading.Lock()
+        # 与调度线程共用：修改模型结构（加载/卸载 Adapter）时不能有前向在执行
+        self._model_lock = threading.RLock()
+
+    @property
+    def model(self) -> Any:
+        return self.peft_model if self.peft_model is not None else self.base_model
+
+    # ==================== Adapter 管理 ====================
+
+    def _find_slot(self, lora_model_id: int, path: str) -> Optional[AdapterSlot]:
+        # 调用方持有 _lock
+        for slot in self.adapters.values():
+            if slot.lora_model_id == int(lora_model_id) and slot.path == path:
+                return slot
+        return None
+
+    def _lease_slot(self, slot: AdapterSlot) -> AdapterSlot:
+        # 调用方持有 _lock
+        if slot.stale:
+            # 权重路径改回了仍在内存中的旧版本：重新启用它，同一 LoRA 的其它版本改为过期
+            for other in self.adapters.values():
+                if other.lora_model_id == slot.lora_model_id and other is not slot:
+                    other.stale = True
+            slot.stale = False
+        self.adapters.move_to_end(slot.name)
+        slot.in_use += 1
+        slot.requests += 1
+        slot.last_used = time.time()
+        return slot
+
+    def ensure_adapter(self, lora_model_id: int, path: str) -> AdapterSlot:
+        """
+        确保 Adapter 已加载并占用（阻塞调用，加载期间暂停该基座模型上的解码）
+
+        返回的 Adapter 已登记为使用中，不会被并发加载其它 Adapter 时的淘汰删除；调用方用完后须 release_adapter
+        """
+        with self._lock:
+            slot = self._find_slot(lora_model_id, path)
+            if slot is not None:
+                return self._lease_slot(slot)
+
+        with self._model_lock:
+            with self._lock:
+                # 等待模型锁期间可能已被其它线程加载
+                slot = self._find_slot(lora_model_id, path)
+                if slot is not None:
+                    return self._lease_slot(slot)
+                # 同一 LoRA 的权重路径变化（重新训练）：空闲的旧权重直接卸载，使用中的标记过期待释放后删除
+                outdated = [item for item in self.adapters.values() if item.lora_model_id == int(lora_model_id)]
+                for item in outdated:
+                    item.stale = True
+                idle_outdated = [item.name for item in outdated if item.in_use == 0]
+                for outdated_name in idle_outdated:
+                    self.adapters.pop(outdated_name, None)
+                name = adapter_name_for(lora_model_id)
+                if name in self.adapters:
+                    name = adapter_name_for(lora_model_id, path)
+            for outdated_name in idle_outdated:
+                self._delete_adapter(outdated_name)
+
+            start = time.perf_counter()
+            if self.peft_model is None:
+                self.peft_model = PeftModel.from_pretrained(self.base_model, path, adapter_name=name)
+            else:
+                self.peft_model.load_adapter(path, adapter_name=name)
+            self.peft_model.eval()
+            nbytes = sum(
+                parameter.numel() * parameter.element_size()
+                for parameter_name, parameter in self.peft_model.named_parameters()
+                if f".{name}." in parameter_name
+            )
+            now = time.time()
+            slot = AdapterSlot(
+                name=name,
+                lora_model_id=int(lora_model_id),
+                path=path,
+                nbytes=nbytes,
+                loaded_at=now,
+                last_used=now,
+                in_use=1,
+                requests=1
+            )
+            with self._lock:
+                self.adapters[name] = slot
+            logger.info(
+                f"Adapter 已加载: base={self.name}, adapter={name}, "
+                f"size={nbytes / 1024 ** 2:.1f}MB, elapsed={(time.perf_counter() - start) * 1000:.0f}ms"
+            )
+            self._evict_adapters(keep=name)
+        return slot
+
+    def _evict_adapters(self, keep: str) -> None:
+        with self._model_lock:
+            while True:
+                with self._lock:
+                    idle = [slot for slot in self.adapters.values() if slot.name != keep and slot.in_use == 0]
+                    # 已释放的过期 Adapter 总是先删除，其余仅在超过上限时按 LRU 淘汰
+                    victim = next((slot.name for slot in idle if slot.stale), None)
+                    if victim is None and len(self.adapters) <= self.max_adapters:
+                        return
+                    if victim is None:
+                        victim = next((slot.name for slot in idle), None)
+                    # 选中与移出在同一次加锁内完成，之后 ensure_adapter 不会再占用该 Adapter
+                    if victim is not None:
+                        self.adapters.pop(victim, None)
+                if victim is None:
+                    logger.warning(f"Adapter 数超过上限但均在使用中: base={self.name}, count={len(self.adapters)}")
+                    return
+                self._delete_adapter(victim)
+                self.evictions += 1
+                logger.info(f"淘汰 Adapter: base={self.name}, adapter={victim}")
+
+    def _delete_adapter(self, name: str) -> None:
+        with self._model_lock:
+            with self._lock:
+                self.adapters.pop(name, None)
+            if self.peft_model is not None and name in self.peft_model.peft_config:
+                self.peft_model.delete_adapter(name)
+
+    def unload_adapter(self, lora_model_id: int) -> bool:
+        unloaded = False
+        with self._model_lock:
+            with self._lock:
+                slots = [slot for slot in self.adapters.values() if slot.lora_model_id == int(lora_model_id)]
+                idle = [slot.name for slot in slots if slot.in_use == 0]
+                for slot in slots:
+                    if slot.in_use:
+                        logger.warning(f"Adapter 使用中，跳过卸载: base={self.name}, adapter={slot.name}")
+                for name in idle:
+                    self.adapters.pop(name, None)
+            for name in idle:
+                self._delete_adapter(name)
+                logger.info(f"Adapter 已卸载: base={self.name}, adapter={name}")
+                unloaded = True
+        return unloaded
+
+    def release_adapter(self, slot: Optional[AdapterSlot]) -> None:
+        """释放 ensure_adapter 登记的占用"""
+        if slot is None:
+            return
+        with self._lock:
+            slot.in_use = max(0, slot.in_use - 1)
+            slot.last_used = time.time()
+
+    def acquire(self) -> None:
+        """登记基座模型上的一个进行中请求（请求结束后 release）"""
+        with self._lock:
+            self._leases += 1
+
+    def release(self) -> None:
+        with self._lock:
+            self._leases = max(0, self._leases - 1)
+
+    def is_busy(self) -> bool:
+        """是否有进行中的请求或被占用的 Adapter（此时不能卸载基座模型）"""
+        with self._lock:
+            return self._leases > 0 or any(slot.in_use for slot in self.adapters.values())
+
+    @contextmanager
+    def lease(self, slot: Optional[AdapterSlot]) -> Iterator[None]:
+        """生成期间占用基座模型与 Adapter，防止被淘汰"""
+        with self._lock:
+            self._leases += 1
+            if slot is not None:
+                slot.in_use += 1
+                slot.requests += 1
+                slot.last_used = time.time()
+        try:
+            yield
+        finally:
+            self.release_adapter(slot)
+            self.release()
+
+    # ==================== 生成 ====================
+
+    def get_scheduler(self) -> GenerationScheduler:
+        """基座模型上所有 Adapter 共用一个调度器（模型对象变化时重建）"""
+        model = self.model
+        if self._scheduler is None or self._scheduler.closed or self._scheduler.model is not model:
+            if self._scheduler is not None:
+                self._scheduler.shutdown("基座模型已包装为 PeftModel")
+            self._scheduler = GenerationScheduler(
+                model=model,
+                tokenizer=self.tokenizer,
+                max_batch_size=self.max_batch_size,
+                max_queue_depth=self.max_queue_depth,
+                name=f"lora:{self.name}",
+                prefix_cache=PrefixKVCache(self.prefix_cache_bytes) if self.prefix_cache_bytes > 0 else None,
+                model_lock=self._model_lock
+            )
+        return self._scheduler
+
+    def close(self) -> None:
+        if self._scheduler is not None:
+            self._scheduler.shutdown(f"基座模型已卸载: {self.name}")
+            self._scheduler = None
+        with self._lock:
+            self.adapters.clear()
+        self.peft_model = None
+        self.base_model = None
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            adapters: List[Dict[str, Any]] = [
+                {
+                    "name": slot.name,
+                    "lora_model_id": slot.lora_model_id,
+                    "size_mb": round(slot.nbytes / 1024 ** 2, 2),
+                    "in_use": slot.in_use,
+                    "requests": slot.requests,
+                    "stale": slot.stale,
+                    "idle_seconds": round(time.time() - slot.last_used, 1)
+                }
+                for slot in self.adapters.values()
+            ]
+        return {
+            "base_model": self.name,
+            "adapters": adapters,
+            "max_adapters": self.max_adapters,
+            "adapter_evictions": self.evictions,
+            "active_requests": self._leases,
+            "scheduler": self._scheduler.get_stats() if self._scheduler is not None else None
+        }
@@ -1,8 +1,13 @@
 """模型管理服务"""
 from app.services.infrastructure.model.model_manager import ModelManager, get_model_manager
 from app.services.infrastructure.model.model_scanner import ModelScanner, model_scanner
+from app.services.infrastructure.model.residency_manager import (
+    ModelResidencyManager,
+    get_model_residency_manager,
+)
 
 __all__ = [
     'ModelManager', 'get_model_manager',
     'ModelScanner', 'model_scanner',
+    'ModelResidencyManager', 'get_model_residency_manager',
 ]
@@ -0,0 +1,357 @@
+"""模型常驻管理 - 内存预算、LRU/TTL 淘汰与固定常驻"""
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+from app.core.config import settings
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+# 全局单例实例
+_model_residency_manager_instance = None
+
+
+def estimate_module_bytes(module: Any) -> int:
+    """估算 torch 模块（含参数与 buffer）占用的字节数"""
+    if module is None:
+        return 0
+
+    footprint = getattr(module, "get_memory_footprint", None)
+    if callable(footprint):
+        try:
+            return int(footprint())
+        except Exception:
+            pass
+
+    # CrossEncoder 等包装类把真实模型放在 .model 上
+    target = module if hasattr(module, "parameters") else getattr(module, "model", None)
+    if target is None or not hasattr(target, "parameters"):
+        return 0
+
+    total = 0
+    try:
+        for tensor in target.parameters():
+            total += tensor.numel() * tensor.element_size()
+        for tensor in target.buffers():
+            total += tensor.numel() * tensor.element_size()
+    except Exception:
+        return total
+    return total
+
+
+class _ResidentModel:
+    """常驻模型记录"""
+
+    __slots__ = ("key", "kind", "name", "size_bytes", "device", "unload_fn",
+                 "pinned", "loaded_at", "last_used", "hits", "in_use")
+
+    def __init__(
+        self,
+        key: str,
+        kind: str,
+        name: str,
+        size_bytes: int,
+        device: str,
+        unload_fn: Callable[[], None],
+        pinned: bool
+    ):
+        now = time.time()
+        self.key = key
+        self.kind = kind
+        self.name = name
+        self.size_bytes = max(0, int(size_bytes or 0))
+        self.device = device
+        self.unload_fn = unload_fn
+        self.pinned = pinned
+        self.loaded_at = now
+        self.last_used = now
+        self.hits = 0
+        self.in_use = 0
+
+
+class ModelResidencyManager:
+    """
+    模型常驻管理器
+
+    - 嵌入模型、CrossEncoder、本地LLM 加载后登记到此处，使用时刷新 LRU 位置
+    - 仅在超出内存预算或系统可用内存不足时按 LRU 淘汰；可选空闲 TTL
+    - 固定常驻(pinned)与正在使用中的模型不会被淘汰
+    - 卸载回调在锁外执行，避免与各服务自身的模型锁形成死锁
+    """
+
+    def __init__(self):
+        self.config = settings.model_residency
+        self.memory_budget_bytes = max(0, int(self.config.memory_budget_mb or 0)) * 1024 * 1024
+        self.min_available_bytes = max(0, int(self.config.min_available_mb or 0)) * 1024 * 1024
+        self.idle_ttl_seconds = max(0.0, float(self.config.idle_ttl_seconds or 0))
+        self.pinned_names = {str(item) for item in (self.config.pinned_models or [])}
+
+        self._entries: Dict[str, _ResidentModel] = {}
+        self._lock = threading.RLock()
+        self._stats: Dict[str, int] = {
+            "loads": 0,
+            "hits": 0,
+            "evictions": 0,
+            "ttl_evictions": 0,
+            "pressure_evictions": 0
+        }
+
+        logger.info(
+            "模型常驻管理初始化: budget_mb=%s, min_available_mb=%s, idle_ttl=%ss, pinned=%s",
+            self.config.memory_budget_mb,
+            self.config.min_available_mb,
+            self.idle_ttl_seconds,
+            sorted(self.pinned_names)
+        )
+
+    # ==================== 登记/使用 ====================
+
+    def _is_pinned_by_config(self, key: str, name: str) -> bool:
+        return key in self.pinned_names or name in self.pinned_names
+
+    def register(
+        self,
+        key: str,
+        kind: str,
+        name: str,
+        model: Any,
+        unload_fn: Callable[[], None],
+        device: str = "cpu",
+        size_bytes: Optional[int] = None,
+        pinned: bool = False
+    ) -> None:
+        """
+        登记已加载的模型，并在超出预算时淘汰其它模型
+
+        Args:
+            key: 唯一键，如 embedding:bge-m3
+            kind: 模型类别 embedding|cross_encoder|llm
+            name: 模型名称
+            model: 模型对象（用于估算内存）
+            unload_fn: 同步卸载回调，淘汰时调用
+            device: 所在设备
+            size_bytes: 已知的内存占用，None 则自动估算
+            pinned: 是否固定常驻
+        """
+        if size_bytes is None:
+            size_bytes = estimate_module_bytes(model)
+
+        with self._lock:
+            entry = _ResidentModel(
+                key=key,
+                kind=kind,
+                name=name,
+                size_bytes=size_bytes,
+                device=device,
+                unload_fn=unload_fn,
+                pinned=pinned or self._is_pinned_by_config(key, name)
+            )
+            self._entries[key] = entry
+            self._stats["loads"] += 1
+
+        logger.info(
+            "模型已登记常驻: key=%s, size=%.1fMB, device=%s, pinned=%s",
+            key,
+            entry.size_bytes / 1024 / 1024,
+            device,
+            entry.pinned
+        )
+        self.enforce(exclude=key)
+
+    def touch(self, key: str) -> None:
+        """记录一次命中，刷新 LRU 时间"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            entry.last_used = time.time()
+            entry.hits += 1
+            self._stats["hits"] += 1
+
+    def unregister(self, key: str) -> None:
+        """模型已被所属服务自行卸载时移除记录（不调用卸载回调）"""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def is_resident(self, key: str) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def pin(self, key: str, pinned: bool = True) -> bool:
+        """固定/取消固定常驻"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False
+            entry.pinned = pinned
+            return True
+
+    @contextmanager
+    def use(self, key: str) -> Iterator[None]:
+        """使用期间禁止淘汰该模型（如 LLM 生成过程中）"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.in_use += 1
+                entry.last_used = time.time()
+        try:
+            yield
+        finally:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    entry.in_use = max(0, entry.in_use - 1)
+                    entry.last_used = time.time()
+
+    # ==================== 淘汰 ====================
+
+    def _used_bytes(self) -> int:
+        return sum(entry.size_bytes for entry in self._entries.values())
+
+    def _available_system_bytes(self) -> Optional[int]:
+        try:
+            import psutil
+            return int(psutil.virtual_memory().available)
+        except Exception:
+            return None
+
+    def _is_evictable(self, entry: _ResidentModel, exclude: Optional[str]) -> bool:
+        return not entry.pinned and entry.in_use == 0 and entry.key != exclude
+
+    def _select_victims(self, exclude: Optional[str]) -> List[_ResidentModel]:
+        now = time.time()
+        victims: List[_ResidentModel] = []
+        candidates = sorted(
+            (entry for entry in self._entries.values() if self._is_evictable(entry, exclude)),
+            key=lambda entry: entry.last_used
+        )
+
+        if self.idle_ttl_seconds > 0:
+            for entry in candidates:
+                if now - entry.last_used >= self.idle_ttl_seconds:
+                    victims.append(entry)
+                    self._stats["ttl_evictions"] += 1
+
+        used_bytes = self._used_bytes() - sum(entry.size_bytes for entry in victims)
+        available_bytes = self._available_system_bytes() if self.min_available_bytes > 0 else None
+        freed_bytes = 0
+
+        for entry in candidates:
+            if entry in victims:
+                continue
+            over_budget = self.memory_budget_bytes > 0 and used_bytes > self.memory_budget_bytes
+            low_memory = available_bytes is not None and (available_bytes + freed_bytes) < self.min_available_bytes
+            if not over_budget and not low_memory:
+                break
+            victims.append(entry)
+            used_bytes -= entry.size_bytes
+            freed_bytes += entry.size_bytes
+            self._stats["pressure_evictions"] += 1
+
+        for entry in victims:
+            self._entries.pop(entry.key, None)
+        self._stats["evictions"] += len(victims)
+        return victims
+
+    def enforce(self, exclude: Optional[str] = None) -> List[str]:
+        """
+        检查预算与 TTL，必要时淘汰模型
+
+        Args:
+            exclude: 本次不参与淘汰的键（通常是刚加载的模型）
+
+        Returns:
+            被淘汰的模型键
+        """
+        with self._lock:
+            victims = self._select_victims(exclude)
+
+        evicted: List[str] = []
+        for entry in victims:
+            try:
+                entry.unload_fn()
+                evicted.append(entry.key)
+                logger.info(
+                    "淘汰常驻模型: key=%s, size=%.1fMB, idle=%.0fs",
+                    entry.key,
+                    entry.size_bytes / 1024 / 1024,
+                    time.time() - entry.last_used
+                )
+            except Exception as error:
+                logger.warning("卸载常驻模型失败: key=%s, error=%s", entry.key, str(error))
+
+        if evicted:
+            self._empty_cuda_cache()
+        return evicted
+
+    def evict(self, key: str) -> bool:
+        """手动卸载指定模型（忽略 pinned）"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.in_use > 0:
+                return False
+            self._entries.pop(key, None)
+            self._stats["evictions"] += 1
+        entry.unload_fn()
+        self._empty_cuda_cache()
+        return True
+
+    def _empty_cuda_cache(self) -> None:
+        try:
+            import torch
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+        except Exception:
+            pass
+
+    # ==================== 指标 ====================
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取常驻模型列表与内存占用"""
+        now = time.time()
+        with self._lock:
+            entries = sorted(self._entries.values(), key=lambda entry: entry.last_used, reverse=True)
+            models = [
+                {
+                    "key": entry.key,
+                    "kind": entry.kind,
+                    "name": entry.name,
+                    "device": entry.device,
+                    "size_mb": round(entry.size_bytes / 1024 / 1024, 1),
+                    "pinned": entry.pinned,
+                    "in_use": entry.in_use,
+                    "hits": entry.hits,
+                    "loaded_seconds_ago": round(now - entry.loaded_at, 1),
+                    "idle_seconds": round(now - entry.last_used, 1)
+                }
+                for entry in entries
+            ]
+            used_bytes = self._used_bytes()
+            stats = dict(self._stats)
+
+        payload: Dict[str, Any] = {
+            **stats,
+            "resident_count": len(models),
+            "used_mb": round(used_bytes / 1024 / 1024, 1),
+            "budget_mb": int(self.config.memory_budget_mb or 0),
+            "idle_ttl_seconds": self.idle_ttl_seconds,
+            "models": models
+        }
+
+        try:
+            import psutil
+            process = psutil.Process()
+            payload["process_rss_mb"] = round(process.memory_info().rss / 1024 / 1024, 1)
+            payload["system_available_mb"] = round(psutil.virtual_memory().available / 1024 / 1024, 1)
+        except Exception:
+            pass
+        return payload
+
+
+def get_model_residency_manager() -> ModelResidencyManager:
+    """获取 ModelResidencyManager 单例"""
+    global _model_residency_manager_instance
+    if _model_residency_manager_instance is None:
+        _model_residency_manager_instance = ModelResidencyManager()
+    return _model_residency_manager_instance
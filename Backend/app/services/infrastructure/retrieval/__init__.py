@@ -1,8 +1,14 @@
 """检索服务"""
+from app.services.infrastructure.retrieval.metadata_registry import MetadataRegistry, get_metadata_registry
 from app.services.infrastructure.retrieval.vector_store_service import VectorStoreService, get_vector_store_service
+from app.services.infrastructure.retrieval.keyword_index_service import KeywordIndexService, get_keyword_index_service
 from app.services.infrastructure.retrieval.hybrid_retrieval_service import HybridRetrievalService, get_hybrid_retrieval_service
+from app.services.infrastructure.retrieval.reranker_service import RerankerService, get_reranker_service
 
 __all__ = [
+    'MetadataRegistry', 'get_metadata_registry',
     'VectorStoreService', 'get_vector_store_service',
+    'KeywordIndexService', 'get_keyword_index_service',
     'HybridRetrievalService', 'get_hybrid_retrieval_service',
+    'RerankerService', 'get_reranker_service',
 ]
@@ -1,19 +1,23 @@
 """混合检索服务 - 结合向量、关键词和图谱检索"""
+import asyncio
 import hashlib
-import json
 from datetime import datetime
-from pathlib import Path
 import re
+import time
 import unicodedata
 from typing import List, Dict, Any, Optional, Tuple
 from app.services.infrastructure.retrieval.vector_store_service import VectorStoreService
+from app.services.infrastructure.retrieval.keyword_index_service import get_keyword_index_service
 from app.services.domain.knowledge_graph.neo4j_graph_service import Neo4jGraphService
 from app.services.domain.knowledge_graph.entity_extraction_service import EntityExtractionService
+from app.services.domain.knowledge_graph.entity_linker import get_entity_linker, normalize_entity_text
 from app.services.infrastructure.embedding.embedding_service import EmbeddingService
+from app.services.infrastructure.telemetry.telemetry_sink import get_telemetry_sink
+from app.services.infrastructure.telemetry.tracing import current_trace_id, span, traced
 from app.core.config import settings
 from app.core.database import db_manager
 from app.utils.logger import get_logger
-from app.utils.similarity import normalize_l2_distance_to_similarity
+from app.utils.similarity import distance_to_similarity
 
 logger = get_logger(__name__)
 
@@ -51,6 +55,7 @@ class HybridRetrievalService:
         self._kb_service = KnowledgeBaseService(db_manager)
         
         self.config = settings.hybrid_retrieval
+        self._background_tasks: set = set()
         
         logger.info(
             "混合检索服务初始化: vector_weight=%s, keyword_weight=%s, graph_weight=%s",
@@ -63,15 +68,15 @@ class HybridRetrievalService:
         if not getattr(self.config, "monitoring_enabled", True):
             return
         metrics_file_raw = str(getattr(self.config, "hybrid_metrics_log_file", "") or "").strip()
-        if not metrics_file_raw:
-            return
-        try:
-            metrics_file = Path(metrics_file_raw)
-            metrics_file.parent.mkdir(parents=True, exist_ok=True)
-            with metrics_file.open("a", encoding="utf-8") as handle:
-                handle.write(json.dumps(payload, ensure_ascii=False) + "\n")
-        except Exception as error:
-            logger.warning("记录混合检索指标失败: %s", str(error))
+        trace_id = current_trace_id()
+        if trace_id:
+            payload = {**payload, "trace_id": trace_id}
+        get_telemetry_sink().record(
+            "hybrid",
+            metrics_file_raw,
+            payload,
+            observations={"hybrid.search": payload.get("elapsed_ms")}
+        )
 
     def _is_question_complex(self, query: str) -> bool:
         text = (query or "").strip()
@@ -221,6 +226,7 @@ class HybridRetrievalService:
         
         import asyncio as _asyncio
 
+        start_time = time.perf_counter()
         logger.info(f"开始混合检索: kb_id={kb_id}, query={query[:50]}..., "
                    f"enable_graph={enable_graph}")
         
@@ -271,16 +277,17 @@ class HybridRetrievalService:
                 logger.error(f"图谱检索失败: {str(result)}")
         
         # 3. 结果融合 + 轻量重排
-        fused_results = self._fuse_results(
-            vector_results,
-            keyword_results,
-            graph_results,
-            vector_weight,
-            keyword_weight,
-            graph_weight,
-            query,
-            top_k
-        )
+        with span("fusion"):
+            fused_results = self._fuse_results(
+                vector_results,
+                keyword_results,
+                graph_results,
+                vector_weight,
+                keyword_weight,
+                graph_weight,
+                query,
+                top_k
+            )
         
         logger.info(
             "混合检索完成: vector=%s, keyword=%s, graph=%s, fused=%s",
@@ -302,7 +309,8 @@ class HybridRetrievalService:
             "fused_result_count": len(fused_results),
             "graph_matched_entities": len(graph_diagnostics.get("matched_entities", [])),
             "graph_unmatched_entities": len(graph_diagnostics.get("unmatched_entities", [])),
-            "fallback_used": graph_diagnostics.get("fallback_used", False)
+            "fallback_used": graph_diagnostics.get("fallback_used", False),
+            "elapsed_ms": round((time.perf_counter() - start_time) * 1000, 2)
         })
         
         return {
@@ -331,13 +339,23 @@ class HybridRetrievalService:
         return tokens
 
     def _normalize_entity_text(self, value: str) -> str:
-        if not value:
-            return ""
+        return normalize_entity_text(value)
 
-        text = unicodedata.normalize("NFKC", str(value)).strip().lower()
-        text = text.replace("（", "(").replace("）", ")")
-        text = re.sub(r"[\s\-_/\\|·•,，。！？!?:：;；'\"“”‘’()（）\[\]{}<>《》、]+", "", text)
-        return text
+    @traced("graph_entity_link")
+    async def _link_query_entities(self, kb_id: int, query: str) -> List[Dict[str, Any]]:
+        linker = get_entity_linker()
+        try:
+            if linker.is_loaded(kb_id):
+                linked = linker.link(kb_id, query)
+            else:
+                # 首次加载需要读 Neo4j，放到线程中避免阻塞事件循环
+                linked = await asyncio.to_thread(linker.link, kb_id, query)
+        except Exception as error:
+            logger.warning("[图谱检索] 实体词典链接失败，回退 LLM 抽取: %s", str(error))
+            return []
+        if linked:
+            logger.info(f"[图谱检索] 词典链接到实体: {[item['name'] for item in linked]}")
+        return linked
 
     def _is_all_cjk(self, value: str) -> bool:
         if not value:
@@ -436,43 +454,50 @@ class HybridRetrievalService:
                 logger.error(f"知识库不存在: {kb_id}")
                 return []
             
-            query_variants = self._build_query_variants(query)
+            with span("query_rewrite"):
+                query_variants = self._build_query_variants(query)
             if not query_variants:
                 return []
 
             collection_name = f"kb_{kb_id}"
             variant_results: List[List[Dict[str, Any]]] = []
 
-            for variant_query in query_variants:
-                query_embedding = self.embedding_service.encode_single(
-                    variant_query,
-                    model_name=kb.embedding_model,
-                    provider=kb.embedding_provider,
-                    text_role='query'
-                )
+            # 变体批量编码 + 多行 query_embeddings 单次检索；编码与 Chroma 查询放到线程中，
+            # 多知识库并发检索时互不阻塞，单库超时也能按时生效
+            query_embeddings = await asyncio.to_thread(
+                self.embedding_service.encode_array,
+                query_variants,
+                model_name=kb.embedding_model,
+                provider=kb.embedding_provider,
+                text_role='query'
+            )
 
-                search_results = self.vector_store.search(
+            index_profile = await asyncio.to_thread(self.vector_store.get_index_profile, collection_name)
+            with span("chroma"):
+                search_results = await asyncio.to_thread(
+                    self.vector_store.search,
                     collection_name=collection_name,
-                    query_embeddings=[query_embedding],
+                    query_embeddings=query_embeddings,
                     n_results=top_k
                 )
 
+            for row in range(len(query_variants)):
                 results: List[Dict[str, Any]] = []
-                if search_results and 'documents' in search_results and len(search_results['documents']) > 0:
-                    for i in range(len(search_results['documents'][0])):
-                        distance = search_results['distances'][0][i] if 'distances' in search_results else 0
-                        similarity = normalize_l2_distance_to_similarity(distance)
+                if search_results and 'documents' in search_results and len(search_results['documents']) > row:
+                    for i in range(len(search_results['documents'][row])):
+                        distance = search_results['distances'][row][i] if 'distances' in search_results else 0
+                        similarity = distance_to_similarity(distance, index_profile.space)
 
-                        metadata = search_results['metadatas'][0][i] if 'metadatas' in search_results else {}
+                        metadata = search_results['metadatas'][row][i] if 'metadatas' in search_results else {}
                         metadata = dict(metadata or {})
                         metadata['kb_id'] = kb_id
 
                         results.append({
-                            'content': search_results['documents'][0][i],
+                            'content': search_results['documents'][row][i],
                             'score': max(0.0, float(similarity)),
                             'metadata': metadata,
                             'source': 'vector',
-                            'chunk_id': search_results['ids'][0][i] if 'ids' in search_results else None
+                            'chunk_id': search_results['ids'][row][i] if 'ids' in search_results else None
                         })
                 variant_results.append(results)
 
@@ -484,9 +509,54 @@ class HybridRetrievalService:
             logger.error(f"向量检索失败: {str(e)}")
             return []
 
+    async def _keyword_search_indexed(self, kb_id: int, query: str, top_k: int) -> Optional[List[Dict[str, Any]]]:
+        """BM25 倒排索引召回；索引未就绪时触发后台重建并返回 None（调用方回退 MySQL）。"""
+        index_service = get_keyword_index_service()
+        if not await asyncio.to_thread(index_service.is_ready, kb_id):
+            if not index_service.is_rebuilding(kb_id):
+                task = asyncio.create_task(asyncio.to_thread(index_service.rebuild, kb_id))
+                self._background_tasks.add(task)
+                task.add_done_callback(self._background_tasks.discard)
+            return None
+
+        rows = await asyncio.to_thread(index_service.search, kb_id, query, top_k)
+        if not rows:
+            return []
+
+        max_bm25 = max(float(row["bm25"]) for row in rows)
+        if max_bm25 <= 0:
+            return []
+        score_power = max(0.5, float(getattr(self.config, "keyword_score_power", 1.0) or 1.0))
+        results: List[Dict[str, Any]] = []
+        for row in rows:
+            score = max(0.0, min(1.0, float(row["bm25"]) / max_bm25)) ** score_power
+            results.append({
+                "content": row.get("content") or "",
+                "score": round(score, 6),
+                "metadata": {
+                    "kb_id": kb_id,
+                    "file_id": row.get("file_id"),
+                    "chunk_index": row.get("chunk_index"),
+                    "bm25": round(float(row["bm25"]), 4),
+                    "matched_terms": row.get("matched_terms", 0)
+                },
+                "source": "keyword",
+                "chunk_id": row.get("chunk_id")
+            })
+        return results
+
+    @traced("keyword_search")
     async def _keyword_search(self, kb_id: int, query: str, top_k: int) -> List[Dict[str, Any]]:
-        """关键词召回（轻量实现，基于text_chunks内容匹配）。"""
+        """关键词召回：优先 BM25 倒排索引，未就绪时回退 text_chunks 内容匹配。"""
         try:
+            if getattr(self.config, "keyword_index_enabled", True):
+                try:
+                    indexed_results = await self._keyword_search_indexed(kb_id, query, top_k)
+                    if indexed_results is not None:
+                        return indexed_results
+                except Exception as error:
+                    logger.warning("BM25 关键词索引检索失败，回退 MySQL: %s", str(error))
+
             tokens = self._tokenize_query(query)
             if not tokens:
                 return []
@@ -614,14 +684,28 @@ class HybridRetrievalService:
                 "fallback_used": False
             }
 
-            # 1. 从查询中提取实体（查询通常较短，降低长度限制）
-            logger.info(f"[图谱检索] 开始实体提取: query='{query}'")
-            extraction_min_length = self._resolve_query_extraction_min_length(query)
-            extraction_result = await self.entity_service.extract_from_text(
-                query,
-                min_length_override=extraction_min_length
-            )
-            entities = extraction_result.get('entities', [])
+            # 1. 识别查询实体：优先词典链接（微秒级），未命中时可回退 LLM 抽取
+            entities: List[Dict[str, Any]] = []
+            diagnostics["entity_source"] = "none"
+            linker_enabled = bool(getattr(self.config, 'entity_linker_enabled', True))
+            if linker_enabled:
+                linked = await self._link_query_entities(kb_id, query)
+                if linked:
+                    entities = [{'name': item['name']} for item in linked]
+                    diagnostics["entity_source"] = "linker"
+                    diagnostics["linked_entities"] = linked
+
+            if not entities and (not linker_enabled or getattr(self.config, 'entity_linker_llm_fallback', True)):
+                logger.info(f"[图谱检索] 开始实体提取: query='{query}'")
+                extraction_min_length = self._resolve_query_extraction_min_length(query)
+                with span("graph_entity_extraction"):
+                    extraction_result = await self.entity_service.extract_from_text(
+                        query,
+                        min_length_override=extraction_min_length
+                    )
+                entities = extraction_result.get('entities', [])
+                if entities:
+                    diagnostics["entity_source"] = "llm"
 
             # 若LLM未抽到实体，尝试从原查询补充代码型实体（如 N-47 / P-1127）。
             code_like_entities = self._extract_code_like_entities_from_query(query)
@@ -645,7 +729,8 @@ class HybridRetrievalService:
             # 2. 对每个实体进行图遍历
             graph_results = []
             max_hops = settings.knowledge_graph.max_hops
-            
+
+            resolve_queries: List[Dict[str, Any]] = []
             for entity_info in entities:
                 entity = entity_info['name']
                 normalized_entity = self._normalize_entity_text(entity)
@@ -657,11 +742,23 @@ class HybridRetrievalService:
                     fallback_candidates = self._build_entity_fallback_candidates(entity)
                     if fallback_candidates:
                         diagnostics["fallback_used"] = True
+                resolve_queries.append({'entity': entity, 'candidates': fallback_candidates})
+
+            # 所有实体的匹配与邻居展开在一个读事务中完成，放到线程中避免阻塞事件循环
+            with span("neo4j"):
+                resolved_entities = await asyncio.to_thread(
+                    self.graph_service.resolve_entities,
+                    kb_id,
+                    resolve_queries,
+                    max_hops,
+                    5
+                )
 
+            for resolve_query, entity_data in zip(resolve_queries, resolved_entities):
+                entity = resolve_query['entity']
+                fallback_candidates = resolve_query['candidates']
                 logger.debug(f"[图谱检索] 查询实体: {entity}")
-                
-                # 获取实体详细信息
-                entity_data = self.graph_service.get_entity_info(kb_id, entity, candidates=fallback_candidates)
+
                 if entity_data:
                     match_stage = entity_data.get('match_stage', 'exact')
                     matched_entity = entity_data.get('matched_entity') or entity_data.get('name')
@@ -718,14 +815,9 @@ class HybridRetrievalService:
                     logger.warning(f"[图谱检索] 未找到实体: {entity} in kb_{kb_id}")
                     continue
                 
-                # 查找相关实体
+                # 相关实体（已随批量解析一并返回）
                 traversal_anchor = entity_data.get('name')
-                related = self.graph_service.find_related_entities(
-                    kb_id=kb_id,
-                    entity=traversal_anchor,
-                    max_hops=max_hops,
-                    max_results=5
-                )
+                related = entity_data.get('related') or []
                 
                 if related:
                     logger.info(f"[图谱检索] 找到 {len(related)} 个相关实体: {[r['entity'] for r in related[:3]]}")
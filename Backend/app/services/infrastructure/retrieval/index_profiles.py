@@ -0,0 +1,63 @@
+"""向量集合 HNSW 索引档位（fast / balanced / high_recall）：建库时写入集合元数据，查询时可按次调高 ef"""
+from dataclasses import dataclass
+from typing import Any, Dict, Mapping, Optional
+from app.core.config import settings
+
+PROFILE_METADATA_KEY = "index_profile"
+LEGACY_PROFILE_NAME = "legacy"
+
+# Chroma 未指定参数时的 HNSW 默认值（早期创建的集合即为此配置）
+_CHROMA_DEFAULTS = {"space": "l2", "m": 16, "construction_ef": 100, "search_ef": 100}
+
+
+@dataclass(frozen=True)
+class IndexProfile:
+    """
+    HNSW 索引档位
+
+    - space / m / construction_ef 只能在建集合时确定，修改需重建集合
+    - search_ef 为集合默认的查询 ef；HNSW 实际使用 max(ef, n_results)，
+      因此单次查询可以通过多取候选（再截断）临时调高 ef，但不能低于集合默认值
+    """
+    name: str
+    space: str = "cosine"
+    m: int = 16
+    construction_ef: int = 100
+    search_ef: int = 100
+
+    def to_metadata(self) -> Dict[str, Any]:
+        return {
+            PROFILE_METADATA_KEY: self.name,
+            "hnsw:space": self.space,
+            "hnsw:M": int(self.m),
+            "hnsw:construction_ef": int(self.construction_ef),
+            "hnsw:search_ef": int(self.search_ef),
+        }
+
+    @classmethod
+    def from_metadata(cls, metadata: Optional[Mapping[str, Any]]) -> "IndexProfile":
+        metadata = metadata or {}
+        return cls(
+            name=str(metadata.get(PROFILE_METADATA_KEY) or LEGACY_PROFILE_NAME),
+            space=str(metadata.get("hnsw:space") or _CHROMA_DEFAULTS["space"]),
+            m=int(metadata.get("hnsw:M") or _CHROMA_DEFAULTS["m"]),
+            construction_ef=int(metadata.get("hnsw:construction_ef") or _CHROMA_DEFAULTS["construction_ef"]),
+            search_ef=int(metadata.get("hnsw:search_ef") or _CHROMA_DEFAULTS["search_ef"]),
+        )
+
+
+def list_index_profiles() -> Dict[str, IndexProfile]:
+    """配置中的全部档位"""
+    return {
+        name: IndexProfile(name=name, **dict(params or {}))
+        for name, params in (settings.vector_db.index_profiles or {}).items()
+    }
+
+
+def get_index_profile(name: Optional[str] = None) -> IndexProfile:
+    """按名称获取档位，为空时使用默认档位"""
+    profiles = list_index_profiles()
+    profile_name = (name or settings.vector_db.default_index_profile or "").strip()
+    if profile_name not in profiles:
+        raise ValueError(f"未知的索引档位: {profile_name}，可选: {', '.join(profiles)}")
+    return profiles[profile_name]
@@ -0,0 +1,499 @@
+"""知识库 BM25 关键词倒排索引（SQLite 持久化，增量维护）"""
+import math
+import os
+import re
+import sqlite3
+import threading
+import unicodedata
+from collections import Counter, OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+import numpy as np
+from app.core.config import settings
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+# 全局单例实例
+_keyword_index_service_instance = None
+
+# 单条 SQL 参数上限（SQLite 默认 999）
+_SQL_BATCH_SIZE = 500
+# 每个知识库缓存的词项倒排数组数量
+_TERM_CACHE_SIZE = 4096
+
+_CJK_RANGES = r"㐀-䶿一-鿿豈-﫿"
+_TOKEN_PATTERN = re.compile(rf"[{_CJK_RANGES}]+|[a-z0-9]+(?:[._+#-][a-z0-9]+)*")
+
+
+def tokenize_for_index(text: str) -> List[str]:
+    """
+    索引/查询共用分词
+
+    - 中文连续片段切成重叠二元组（单字片段保留单字）
+    - 英文/数字按词切分，保留 v1.2、c++ 这类内部连接符
+    """
+    if not text:
+        return []
+
+    normalized = unicodedata.normalize("NFKC", str(text)).lower()
+    tokens: List[str] = []
+    for match in _TOKEN_PATTERN.finditer(normalized):
+        piece = match.group(0)
+        if "㐀" <= piece[0] <= "﫿":
+            if len(piece) == 1:
+                tokens.append(piece)
+            else:
+                tokens.extend(piece[index:index + 2] for index in range(len(piece) - 1))
+        elif len(piece) > 1 or piece.isdigit():
+            tokens.append(piece)
+    return tokens
+
+
+class _KBKeywordIndex:
+    """
+    单个知识库的倒排索引
+
+    - docs: 文本块（含原文，查询不依赖 MySQL）；postings: term -> (doc, 词频, 文档长度)
+    - meta: 文档数/总长度/是否完整/版本号（每次写入递增）
+    - 查询时按词项把倒排表读成 numpy 数组并预先算好 BM25 分量，按版本号失效
+    - WAL 模式 + 每线程连接，入库线程写、检索线程读互不阻塞
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        self._cache_lock = threading.Lock()
+        self._cache_key: Optional[Tuple[int, float, float]] = None
+        self._term_cache: "OrderedDict[str, Tuple[np.ndarray, np.ndarray]]" = OrderedDict()
+        self._init_schema()
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("PRAGMA busy_timeout=30000")
+            self._local.connection = connection
+        return connection
+
+    def _init_schema(self) -> None:
+        connection = self._connect()
+        connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS docs (
+                doc_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chunk_id TEXT NOT NULL UNIQUE,
+                file_id INTEGER,
+                chunk_index INTEGER,
+                content TEXT NOT NULL,
+                length INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_docs_file ON docs(file_id);
+            CREATE TABLE IF NOT EXISTS postings (
+                term TEXT NOT NULL,
+                doc_id INTEGER NOT NULL,
+                tf INTEGER NOT NULL,
+                length INTEGER NOT NULL,
+                PRIMARY KEY (term, doc_id)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS idx_postings_doc ON postings(doc_id);
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            );
+            INSERT OR IGNORE INTO meta (key, value)
+            VALUES ('doc_count', 0), ('total_length', 0), ('ready', 0), ('version', 0);
+            """
+        )
+
+    # ==================== 元数据 ====================
+
+    def _meta(self, connection: sqlite3.Connection) -> Dict[str, int]:
+        return {key: int(value) for key, value in connection.execute("SELECT key, value FROM meta")}
+
+    def _bump_meta(self, connection: sqlite3.Connection, doc_delta: int, length_delta: int) -> None:
+        connection.executemany(
+            "UPDATE meta SET value = value + ? WHERE key = ?",
+            [(doc_delta, "doc_count"), (length_delta, "total_length"), (1, "version")]
+        )
+
+    def is_ready(self) -> bool:
+        try:
+            return self._meta(self._connect()).get("ready", 0) == 1
+        except Exception:
+            return False
+
+    def set_ready(self, ready: bool) -> None:
+        self._connect().execute("UPDATE meta SET value = ? WHERE key = 'ready'", (1 if ready else 0,))
+
+    # ==================== 写入 ====================
+
+    def _delete_doc_ids(self, connection: sqlite3.Connection, doc_ids: Sequence[int]) -> int:
+        removed = 0
+        for start in range(0, len(doc_ids), _SQL_BATCH_SIZE):
+            batch = list(doc_ids[start:start + _SQL_BATCH_SIZE])
+            placeholders = ",".join("?" * len(batch))
+            length_row = connection.execute(
+                f"SELECT COUNT(*), COALESCE(SUM(length), 0) FROM docs WHERE doc_id IN ({placeholders})",
+                batch
+            ).fetchone()
+            connection.execute(f"DELETE FROM postings WHERE doc_id IN ({placeholders})", batch)
+            connection.execute(f"DELETE FROM docs WHERE doc_id IN ({placeholders})", batch)
+            self._bump_meta(connection, -int(length_row[0]), -int(length_row[1]))
+            removed += int(length_row[0])
+        return removed
+
+    def _select_doc_ids(self, connection: sqlite3.Connection, column: str, values: Sequence[Any]) -> List[int]:
+        doc_ids: List[int] = []
+        for start in range(0, len(values), _SQL_BATCH_SIZE):
+            batch = list(values[start:start + _SQL_BATCH_SIZE])
+            placeholders = ",".join("?" * len(batch))
+            doc_ids.extend(
+                row[0] for row in connection.execute(f"SELECT doc_id FROM docs WHERE {column} IN ({placeholders})", batch)
+            )
+        return doc_ids
+
+    def add_documents(self, documents: Iterable[Dict[str, Any]]) -> int:
+        """写入文本块（chunk_id 已存在时先移除旧版本，保证幂等）"""
+        prepared: List[Tuple[Dict[str, Any], Counter, int]] = []
+        for document in documents:
+            chunk_id = str(document.get("chunk_id") or "")
+            content = str(document.get("content") or "")
+            if not chunk_id or not content:
+                continue
+            tokens = tokenize_for_index(content)
+            prepared.append((document, Counter(tokens), len(tokens)))
+        if not prepared:
+            return 0
+
+        with self._write_lock:
+            connection = self._connect()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                existing = self._select_doc_ids(connection, "chunk_id", [str(item[0]["chunk_id"]) for item in prepared])
+                if existing:
+                    self._delete_doc_ids(connection, existing)
+
+                postings: List[Tuple[str, int, int, int]] = []
+                total_length = 0
+                for document, term_counts, length in prepared:
+                    cursor = connection.execute(
+                        "INSERT INTO docs (chunk_id, file_id, chunk_index, content, length) VALUES (?, ?, ?, ?, ?)",
+                        (
+                            str(document["chunk_id"]),
+                            document.get("file_id"),
+                            document.get("chunk_index"),
+                            str(document["content"]),
+                            length
+                        )
+                    )
+                    doc_id = cursor.lastrowid
+                    postings.extend((term, doc_id, tf, length) for term, tf in term_counts.items())
+                    total_length += length
+
+                connection.executemany("INSERT INTO postings (term, doc_id, tf, length) VALUES (?, ?, ?, ?)", postings)
+                self._bump_meta(connection, len(prepared), total_length)
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+        return len(prepared)
+
+    def remove_by(self, column: str, values: Sequence[Any]) -> int:
+        if not values:
+            return 0
+        with self._write_lock:
+            connection = self._connect()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                removed = self._delete_doc_ids(connection, self._select_doc_ids(connection, column, values))
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+        return removed
+
+    def clear(self) -> None:
+        with self._write_lock:
+            connection = self._connect()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                connection.execute("DELETE FROM postings")
+                connection.execute("DELETE FROM docs")
+                connection.execute("UPDATE meta SET value = 0 WHERE key != 'version'")
+                connection.execute("UPDATE meta SET value = value + 1 WHERE key = 'version'")
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+
+    # ==================== 检索 ====================
+
+    def _term_scores(
+        self,
+        connection: sqlite3.Connection,
+        term: str,
+        doc_count: int,
+        avg_length: float,
+        k1: float,
+        b: float
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """读取词项倒排表，返回 (doc_ids, 该词项的 BM25 分量)"""
+        cached = self._term_cache.get(term)
+        if cached is not None:
+            self._term_cache.move_to_end(term)
+            return cached
+
+        rows = connection.execute("SELECT doc_id, tf, length FROM postings WHERE term = ?", (term,)).fetchall()
+        if rows:
+            postings = np.asarray(rows, dtype=np.float64)
+            doc_ids = postings[:, 0].astype(np.int64)
+            tf = postings[:, 1]
+            norm = k1 * (1.0 - b + b * postings[:, 2] / avg_length)
+            # BM25+ 风格的非负 idf
+            idf = math.log(1.0 + (doc_count - len(rows) + 0.5) / (len(rows) + 0.5))
+            scores = idf * tf * (k1 + 1.0) / (tf + norm)
+        else:
+            doc_ids = np.empty(0, dtype=np.int64)
+            scores = np.empty(0, dtype=np.float64)
+
+        self._term_cache[term] = (doc_ids, scores)
+        while len(self._term_cache) > _TERM_CACHE_SIZE:
+            self._term_cache.popitem(last=False)
+        return doc_ids, scores
+
+    def search(self, query_terms: List[str], top_k: int, k1: float, b: float) -> List[Dict[str, Any]]:
+        unique_terms = list(dict.fromkeys(query_terms))
+        if not unique_terms or top_k <= 0:
+            return []
+
+        connection = self._connect()
+        meta = self._meta(connection)
+        doc_count = meta.get("doc_count", 0)
+        if doc_count <= 0:
+            return []
+        avg_length = max(1.0, meta.get("total_length", 0) / doc_count)
+
+        with self._cache_lock:
+            cache_key = (meta.get("version", 0), k1, b)
+            if cache_key != self._cache_key:
+                self._term_cache.clear()
+                self._cache_key = cache_key
+            term_postings = [
+                self._term_scores(connection, term, doc_count, avg_length, k1, b)
+                for term in unique_terms
+            ]
+
+        term_postings = [item for item in term_postings if item[0].size]
+        if not term_postings:
+            return []
+
+        all_doc_ids = np.concatenate([item[0] for item in term_postings])
+        all_scores = np.concatenate([item[1] for item in term_postings])
+        doc_ids, inverse = np.unique(all_doc_ids, return_inverse=True)
+        totals = np.bincount(inverse, weights=all_scores)
+        hits = np.bincount(inverse)
+
+        limit = min(top_k, len(doc_ids))
+        top_positions = np.argpartition(-totals, limit - 1)[:limit]
+        top_positions = top_positions[np.argsort(-totals[top_positions], kind="stable")]
+        best = [(int(doc_ids[position]), float(totals[position]), int(hits[position])) for position in top_positions]
+
+        placeholders = ",".join("?" * len(best))
+        details = {
+            row[0]: row
+            for row in connection.execute(
+                f"SELECT doc_id, chunk_id, file_id, chunk_index, content FROM docs WHERE doc_id IN ({placeholders})",
+                [doc_id for doc_id, _, _ in best]
+            )
+        }
+        results: List[Dict[str, Any]] = []
+        for doc_id, score, hit_count in best:
+            detail = details.get(doc_id)
+            if detail is None:
+                continue
+            results.append({
+                "chunk_id": detail[1],
+                "file_id": detail[2],
+                "chunk_index": detail[3],
+                "content": detail[4],
+                "bm25": score,
+                "matched_terms": hit_count,
+                "query_terms": len(unique_terms)
+            })
+        return results
+
+    def get_stats(self) -> Dict[str, Any]:
+        connection = self._connect()
+        meta = self._meta(connection)
+        return {
+            "doc_count": meta.get("doc_count", 0),
+            "version": meta.get("version", 0),
+            "avg_length": round(meta.get("total_length", 0) / max(1, meta.get("doc_count", 0)), 1),
+            "ready": meta.get("ready", 0) == 1,
+            "size_mb": round(os.path.getsize(self.path) / 1024 / 1024, 2) if os.path.exists(self.path) else 0.0
+        }
+
+    def close(self) -> None:
+        connection: Optional[sqlite3.Connection] = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+
+class KeywordIndexService:
+    """
+    关键词索引服务
+
+    - 每个知识库一个 SQLite 倒排索引文件（index_dir/kb_{id}.sqlite3）
+    - 入库时增量写入、删除文件/回滚时增量移除
+    - 历史知识库首次检索时从 text_chunks 后台重建，重建完成前调用方回退 MySQL 检索
+    """
+
+    def __init__(self, index_dir: Optional[str] = None):
+        config = settings.hybrid_retrieval
+        self.index_dir = index_dir or config.keyword_index_dir
+        self.k1 = float(getattr(config, "keyword_bm25_k1", 1.2) or 1.2)
+        self.b = float(getattr(config, "keyword_bm25_b", 0.75))
+        os.makedirs(self.index_dir, exist_ok=True)
+        self._indexes: Dict[int, _KBKeywordIndex] = {}
+        self._lock = threading.Lock()
+        self._rebuilding: set = set()
+        logger.info(f"关键词索引服务初始化: dir={self.index_dir}, k1={self.k1}, b={self.b}")
+
+    def _index_path(self, kb_id: int) -> str:
+        return os.path.join(self.index_dir, f"kb_{int(kb_id)}.sqlite3")
+
+    def _get_index(self, kb_id: int) -> _KBKeywordIndex:
+        with self._lock:
+            index = self._indexes.get(kb_id)
+            if index is None:
+                index = _KBKeywordIndex(self._index_path(kb_id))
+                self._indexes[kb_id] = index
+            return index
+
+    # ==================== 增量维护 ====================
+
+    def add_chunks(self, kb_id: int, chunks: List[Dict[str, Any]]) -> int:
+        """写入文本块 [{'chunk_id', 'file_id', 'chunk_index', 'content'}]；失败时标记索引待重建"""
+        try:
+            return self._get_index(kb_id).add_documents(chunks)
+        except Exception as error:
+            logger.warning("关键词索引写入失败，标记重建: kb_id=%s, error=%s", kb_id, str(error))
+            self._mark_stale(kb_id)
+            return 0
+
+    def remove_chunks(self, kb_id: int, chunk_ids: List[str]) -> int:
+        try:
+            return self._get_index(kb_id).remove_by("chunk_id", [str(item) for item in chunk_ids])
+        except Exception as error:
+            logger.warning("关键词索引移除文本块失败，标记重建: kb_id=%s, error=%s", kb_id, str(error))
+            self._mark_stale(kb_id)
+            return 0
+
+    def remove_file(self, kb_id: int, file_id: int) -> int:
+        try:
+            removed = self._get_index(kb_id).remove_by("file_id", [int(file_id)])
+            logger.info("关键词索引移除文件: kb_id=%s, file_id=%s, chunks=%s", kb_id, file_id, removed)
+            return removed
+        except Exception as error:
+            logger.warning("关键词索引移除文件失败，标记重建: kb_id=%s, error=%s", kb_id, str(error))
+            self._mark_stale(kb_id)
+            return 0
+
+    def drop_index(self, kb_id: int) -> None:
+        """删除知识库的索引文件"""
+        with self._lock:
+            index = self._indexes.pop(kb_id, None)
+        if index is not None:
+            index.close()
+        for suffix in ("", "-wal", "-shm"):
+            path = self._index_path(kb_id) + suffix
+            try:
+                if os.path.exists(path):
+                    os.remove(path)
+            except OSError as error:
+                logger.warning("删除关键词索引文件失败: path=%s, error=%s", path, str(error))
+
+    def _mark_stale(self, kb_id: int) -> None:
+        try:
+            self._get_index(kb_id).set_ready(False)
+        except Exception:
+            pass
+
+    # ==================== 重建 ====================
+
+    def is_ready(self, kb_id: int) -> bool:
+        return self._get_index(kb_id).is_ready()
+
+    def rebuild(self, kb_id: int, page_size: int = 1000) -> int:
+        """从 MySQL text_chunks 全量重建（同步，应在线程中调用）"""
+        from app.core.database import db_manager
+
+        with self._lock:
+            if kb_id in self._rebuilding:
+                return 0
+            self._rebuilding.add(kb_id)
+        try:
+            index = self._get_index(kb_id)
+            index.set_ready(False)
+            index.clear()
+            total = 0
+            last_id = 0
+            while True:
+                with db_manager.get_cursor() as cursor:
+                    cursor.execute(
+                        """SELECT id, vector_id, file_id, chunk_index, content
+                           FROM text_chunks
+                           WHERE kb_id = %s AND id > %s
+                           ORDER BY id ASC
+                           LIMIT %s""",
+                        (kb_id, last_id, page_size)
+                    )
+                    rows = cursor.fetchall()
+                if not rows:
+                    break
+                last_id = int(rows[-1]["id"])
+                total += index.add_documents(
+                    {
+                        "chunk_id": row.get("vector_id"),
+                        "file_id": row.get("file_id"),
+                        "chunk_index": row.get("chunk_index"),
+                        "content": row.get("content")
+                    }
+                    for row in rows
+                )
+            index.set_ready(True)
+            logger.info("关键词索引重建完成: kb_id=%s, chunks=%s", kb_id, total)
+            return total
+        except Exception as error:
+            logger.error("关键词索引重建失败: kb_id=%s, error=%s", kb_id, str(error))
+            return 0
+        finally:
+            with self._lock:
+                self._rebuilding.discard(kb_id)
+
+    def is_rebuilding(self, kb_id: int) -> bool:
+        with self._lock:
+            return kb_id in self._rebuilding
+
+    # ==================== 检索 ====================
+
+    def search(self, kb_id: int, query: str, top_k: int) -> List[Dict[str, Any]]:
+        """BM25 检索，返回按得分降序的文本块"""
+        return self._get_index(kb_id).search(tokenize_for_index(query), top_k, self.k1, self.b)
+
+    def get_stats(self, kb_id: int) -> Dict[str, Any]:
+        stats = self._get_index(kb_id).get_stats()
+        stats["rebuilding"] = self.is_rebuilding(kb_id)
+        return stats
+
+
+def get_keyword_index_service() -> KeywordIndexService:
+    """获取关键词索引服务单例"""
+    global _keyword_index_service_instance
+    if _keyword_index_service_instance is None:
+        _keyword_index_service_instance = KeywordIndexService()
+    return _keyword_index_service_instance
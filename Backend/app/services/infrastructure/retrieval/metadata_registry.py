@@ -0,0 +1,142 @@
+"""检索热路径元数据注册表：进程内缓存向量集合句柄与知识库记录（版本号失效 + TTL + LRU）"""
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, Hashable, Optional, Tuple
+from app.core.config import settings
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+# 全局单例实例
+_metadata_registry_instance = None
+
+NAMESPACE_COLLECTION = "collection"
+NAMESPACE_KNOWLEDGE_BASE = "knowledge_base"
+
+
+@dataclass
+class _RegistryEntry:
+    value: Any
+    version: int
+    created_at: float
+
+
+class MetadataRegistry:
+    """
+    元数据注册表
+
+    - 键: (命名空间, 键)，如 ("collection", "kb_1")、("knowledge_base", 1)
+    - 每个键维护进程内版本号：invalidate 递增版本并移除条目；
+      读取方在回源前记下版本号，回源期间若发生失效，put 会拒绝写入旧值
+    - 各命名空间可单独设置 TTL（多 worker 部署时限制其他进程修改的可见延迟），超过上限按 LRU 淘汰
+    """
+
+    def __init__(
+        self,
+        enabled: bool = True,
+        max_entries: int = 1024,
+        ttl_seconds: Optional[Dict[str, float]] = None
+    ):
+        self.enabled = bool(enabled)
+        self.max_entries = max(1, int(max_entries))
+        self.ttl_seconds = {namespace: float(ttl or 0) for namespace, ttl in (ttl_seconds or {}).items()}
+        self._entries: "OrderedDict[Tuple[str, Hashable], _RegistryEntry]" = OrderedDict()
+        self._versions: Dict[Tuple[str, Hashable], int] = {}
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Dict[str, int]] = {}
+
+    def _record(self, namespace: str, name: str) -> None:
+        bucket = self._stats.setdefault(namespace, {"hits": 0, "misses": 0, "stores": 0, "stale_stores": 0, "invalidations": 0, "evictions": 0})
+        bucket[name] = bucket.get(name, 0) + 1
+
+    def version(self, namespace: str, key: Hashable) -> int:
+        with self._lock:
+            return self._versions.get((namespace, key), 0)
+
+    def get(self, namespace: str, key: Hashable) -> Optional[Any]:
+        if not self.enabled:
+            return None
+        ttl = self.ttl_seconds.get(namespace, 0)
+        with self._lock:
+            entry = self._entries.get((namespace, key))
+            if entry is not None and ttl > 0 and time.time() - entry.created_at > ttl:
+                self._entries.pop((namespace, key), None)
+                entry = None
+            if entry is None:
+                self._record(namespace, "misses")
+                return None
+            self._entries.move_to_end((namespace, key))
+            self._record(namespace, "hits")
+            return entry.value
+
+    def put(self, namespace: str, key: Hashable, value: Any, version: Optional[int] = None) -> bool:
+        """写入条目；version 为回源前读取的版本号，期间发生过失效时放弃写入"""
+        if not self.enabled or value is None:
+            return False
+        with self._lock:
+            current = self._versions.get((namespace, key), 0)
+            if version is not None and version != current:
+                self._record(namespace, "stale_stores")
+                return False
+            self._entries[(namespace, key)] = _RegistryEntry(value=value, version=current, created_at=time.time())
+            self._entries.move_to_end((namespace, key))
+            self._record(namespace, "stores")
+            while len(self._entries) > self.max_entries:
+                (evicted_namespace, _), _ = self._entries.popitem(last=False)
+                self._record(evicted_namespace, "evictions")
+        return True
+
+    def invalidate(self, namespace: str, key: Hashable) -> bool:
+        """递增版本号并移除条目，返回是否存在已缓存的值"""
+        with self._lock:
+            self._versions[(namespace, key)] = self._versions.get((namespace, key), 0) + 1
+            removed = self._entries.pop((namespace, key), None) is not None
+            self._record(namespace, "invalidations")
+        if removed:
+            logger.debug(f"元数据缓存失效: namespace={namespace}, key={key}")
+        return removed
+
+    def clear(self) -> None:
+        with self._lock:
+            for namespace, key in list(self._entries.keys()):
+                self._versions[(namespace, key)] = self._versions.get((namespace, key), 0) + 1
+            self._entries.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            namespaces: Dict[str, Dict[str, Any]] = {}
+            for namespace, bucket in self._stats.items():
+                stats = dict(bucket)
+                lookups = stats.get("hits", 0) + stats.get("misses", 0)
+                stats["hit_rate"] = round(stats.get("hits", 0) / lookups, 4) if lookups else 0.0
+                namespaces[namespace] = stats
+            size_by_namespace: Dict[str, int] = {}
+            for namespace, _ in self._entries.keys():
+                size_by_namespace[namespace] = size_by_namespace.get(namespace, 0) + 1
+        for namespace, size in size_by_namespace.items():
+            namespaces.setdefault(namespace, {})["size"] = size
+        return {
+            "enabled": self.enabled,
+            "entries": sum(size_by_namespace.values()),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "namespaces": namespaces
+        }
+
+
+def get_metadata_registry() -> MetadataRegistry:
+    """获取元数据注册表单例"""
+    global _metadata_registry_instance
+    if _metadata_registry_instance is None:
+        config = settings.metadata_cache
+        _metadata_registry_instance = MetadataRegistry(
+            enabled=config.enabled,
+            max_entries=config.max_entries,
+            ttl_seconds={
+                NAMESPACE_COLLECTION: config.collection_ttl_seconds,
+                NAMESPACE_KNOWLEDGE_BASE: config.kb_ttl_seconds
+            }
+        )
+    return _metadata_registry_instance
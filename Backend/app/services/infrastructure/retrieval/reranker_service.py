@@ -0,0 +1,481 @@
+"""交叉编码重排服务：后台线程合并并发查询的 (query, passage) 对批量打分，支持 int8 / ONNX CPU 后端、分数缓存与分段提前退出"""
+import asyncio
+import hashlib
+import math
+import queue
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+from app.core.config import settings
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+# 全局单例实例
+_reranker_service_instance = None
+
+# 加载失败后的冷却时间，避免每次检索都重新尝试加载模型
+_LOAD_RETRY_SECONDS = 60.0
+
+
+def _sigmoid(value: float) -> float:
+    if value >= 0:
+        return 1.0 / (1.0 + math.exp(-value))
+    exp_value = math.exp(value)
+    return exp_value / (1.0 + exp_value)
+
+
+@dataclass
+class RerankOutcome:
+    """一次重排的打分结果（与输入候选一一对应）"""
+    cross_scores: List[Optional[float]]  # sigmoid 归一化的交叉编码分；提前退出未打分的为 None
+    final_scores: List[Optional[float]]  # alpha * 交叉编码分 + (1 - alpha) * 一阶段分
+    scored: int
+    cache_hits: int
+    early_exit: bool
+
+
+class _ScoreJob:
+    """一次查询提交的待打分 pair，由后台线程完成后回填到所属事件循环的 Future"""
+    __slots__ = ("pairs", "future", "loop")
+
+    def __init__(self, pairs: List[Tuple[str, str]], future: asyncio.Future, loop: asyncio.AbstractEventLoop):
+        self.pairs = pairs
+        self.future = future
+        self.loop = loop
+
+    def resolve(self, scores: Optional[List[float]] = None, error: Optional[BaseException] = None) -> None:
+        def _set() -> None:
+            if self.future.done():
+                return
+            if error is not None:
+                self.future.set_exception(error)
+            else:
+                self.future.set_result(scores)
+
+        try:
+            self.loop.call_soon_threadsafe(_set)
+        except RuntimeError:
+            # 事件循环已关闭（请求已结束），丢弃结果
+            pass
+
+
+class RerankerService:
+    """
+    交叉编码重排服务
+
+    - 模型只在后台工作线程中执行，检索协程提交 pair 后等待结果，不阻塞事件循环
+    - 工作线程把队列中已到达（及 batch_wait_ms 内到达）的多个查询合并为一批，按文本长度排序后前向以减少 padding
+    - 后端: torch / int8（CPU 上对 Linear 层做动态量化）/ onnx（需 optimum，不可用时回退 int8）；auto 在 CPU 上使用 int8
+    - (查询哈希, chunk_id) -> 分数 LRU 缓存，相同问题重复检索或多轮追问时不再重复打分
+    - 分段打分：第 k 名的融合分已不低于任一未打分候选可能达到的上限（交叉分上限为 1）时提前退出
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        backend: str = "auto",
+        device: Optional[str] = None,
+        max_batch_size: int = 64,
+        batch_wait_ms: float = 2.0,
+        max_chars: int = 1500,
+        cache_size: int = 20000,
+        stage_size: int = 8,
+        early_exit_margin: float = 0.0
+    ):
+        self.model_name = model_name
+        self.backend = (backend or "auto").lower()
+        self.device = device
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.batch_wait_seconds = max(0.0, float(batch_wait_ms or 0)) / 1000
+        self.max_chars = max(1, int(max_chars))
+        self.cache_size = max(0, int(cache_size))
+        self.stage_size = max(0, int(stage_size))
+        self.early_exit_margin = max(0.0, float(early_exit_margin or 0))
+        self.active_backend: Optional[str] = None
+
+        self._model: Any = None
+        self._model_lock = threading.Lock()
+        self._load_failed_at = 0.0
+        self._queue: "queue.Queue[Optional[_ScoreJob]]" = queue.Queue()
+        self._worker: Optional[threading.Thread] = None
+        self._worker_lock = threading.Lock()
+        self._closed = False
+        self._cache: "OrderedDict[Tuple[str, str], float]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+        # 事件循环（score/rerank）与后台线程（_score_jobs）都会更新指标
+        self._stats_lock = threading.Lock()
+        self._stats: Dict[str, float] = {
+            "requests": 0,
+            "batches": 0,
+            "batched_pairs": 0,
+            "max_batch_pairs": 0,
+            "cache_hits": 0,
+            "cache_misses": 0,
+            "early_exits": 0,
+            "skipped_pairs": 0,
+            "inference_ms": 0.0,
+            "errors": 0
+        }
+
+    @property
+    def residency_key(self) -> str:
+        return f"cross_encoder:{self.model_name}"
+
+    # ==================== 模型加载 ====================
+
+    def _resolve_device(self) -> str:
+        if self.device:
+            return self.device
+        try:
+            import torch
+            if torch.cuda.is_available():
+                return "cuda"
+        except Exception:
+            pass
+        return "cpu"
+
+    def _load_model(self) -> Tuple[Any, str]:
+        """加载模型，返回 (模型, 设备)；常驻登记由调用方在模型锁外完成"""
+        from sentence_transformers import CrossEncoder
+
+        device = self._resolve_device()
+        backend = self.backend
+        if backend == "auto":
+            backend = "int8" if device == "cpu" else "torch"
+        if device != "cpu" and backend in ("int8", "onnx"):
+            logger.info(f"CrossEncoder 运行在 {device} 上，{backend} 后端仅用于 CPU，改用 torch")
+            backend = "torch"
+
+        model = None
+        if backend == "onnx":
+            try:
+                model = CrossEncoder(self.model_name, device=device, backend="onnx")
+            except Exception as error:
+                logger.warning(f"CrossEncoder ONNX 后端不可用，回退 int8: {str(error)}")
+                backend = "int8"
+
+        if model is None:
+            model = CrossEncoder(self.model_name, device=device)
+            if backend == "int8":
+                import torch
+                from torch.ao.quantization import quantize_dynamic
+                quantize_dynamic(model.model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+        self.active_backend = backend
+        logger.info(f"CrossEncoder加载成功: model={self.model_name}, device={device}, backend={backend}")
+        return model, device
+
+    def _ensure_model(self) -> Any:
+        with self._model_lock:
+            if self._model is not None:
+                return self._model
+            if self._load_failed_at and time.time() - self._load_failed_at < _LOAD_RETRY_SECONDS:
+                raise RuntimeError(f"CrossEncoder 加载失败，{_LOAD_RETRY_SECONDS:.0f}s 内不再重试")
+            try:
+                model, device = self._load_model()
+                self._model = model
+                self._load_failed_at = 0.0
+            except Exception:
+                self._load_failed_at = time.time()
+                raise
+
+        # 在模型锁外登记常驻：register 会同步调用其它模型的卸载回调（各自持有模型锁），
+        # 持锁调用时与嵌入模型同时加载会互相等待对方的锁而死锁
+        from app.services.infrastructure.model.residency_manager import get_model_residency_manager
+        get_model_residency_manager().register(
+            key=self.residency_key,
+            kind="cross_encoder",
+            name=self.model_name,
+            model=model.model if self.active_backend != "onnx" else model,
+            unload_fn=self._unload_model,
+            device=device
+        )
+        return model
+
+    def _unload_model(self) -> None:
+        with self._model_lock:
+            self._model = None
+
+    # ==================== 后台批处理 ====================
+
+    def _ensure_worker(self) -> None:
+        if self._worker is not None and self._worker.is_alive():
+            return
+        with self._worker_lock:
+            if self._closed:
+                raise RuntimeError("重排服务已关闭")
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name="cross-encoder-reranker", daemon=True)
+                self._worker.start()
+
+    def _run(self) -> None:
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            jobs = [job]
+            pair_count = len(job.pairs)
+            deadline = time.perf_counter() + self.batch_wait_seconds
+            stop = False
+            while pair_count < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                try:
+                    next_job = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if next_job is None:
+                    stop = True
+                    break
+                jobs.append(next_job)
+                pair_count += len(next_job.pairs)
+            self._score_jobs(jobs)
+            if stop:
+                return
+
+    def _score_jobs(self, jobs: List[_ScoreJob]) -> None:
+        pairs = [pair for job in jobs for pair in job.pairs]
+        # 按长度排序后前向，同一小批内的 padding 更少；结果再按原顺序还原
+        order = sorted(range(len(pairs)), key=lambda index: len(pairs[index][1]))
+        start = time.perf_counter()
+        try:
+            import torch
+            from app.services.infrastructure.model.residency_manager import get_model_residency_manager
+
+            model = self._ensure_model()
+            with get_model_residency_manager().use(self.residency_key):
+                logits = model.predict(
+                    [pairs[index] for index in order],
+                    batch_size=self.max_batch_size,
+                    show_progress_bar=False,
+                    activation_fn=torch.nn.Identity(),
+                    convert_to_numpy=True
+                )
+            scores = [0.0] * len(pairs)
+            for position, index in enumerate(order):
+                scores[index] = _sigmoid(float(logits[position]))
+        except Exception as error:
+            with self._stats_lock:
+                self._stats["errors"] += 1
+            for job in jobs:
+                job.resolve(error=error)
+            return
+
+        with self._stats_lock:
+            self._stats["batches"] += 1
+            self._stats["batched_pairs"] += len(pairs)
+            self._stats["max_batch_pairs"] = max(self._stats["max_batch_pairs"], len(pairs))
+            self._stats["inference_ms"] += (time.perf_counter() - start) * 1000
+        offset = 0
+        for job in jobs:
+            job.resolve(scores=scores[offset:offset + len(job.pairs)])
+            offset += len(job.pairs)
+
+    # ==================== 缓存 ====================
+
+    def _query_hash(self, query: str) -> str:
+        raw = f"{self.model_name}\n{self.max_chars}\n{query}"
+        return hashlib.sha1(raw.encode("utf-8", errors="ignore")).hexdigest()
+
+    @staticmethod
+    def _passage_key(key: Optional[str], text: str) -> str:
+        if key:
+            return str(key)
+        return hashlib.sha1(text.encode("utf-8", errors="ignore")).hexdigest()
+
+    def _cache_get(self, key: Tuple[str, str]) -> Optional[float]:
+        if self.cache_size <= 0:
+            return None
+        with self._cache_lock:
+            score = self._cache.get(key)
+            if score is not None:
+                self._cache.move_to_end(key)
+            return score
+
+    def _cache_put(self, key: Tuple[str, str], score: float) -> None:
+        if self.cache_size <= 0:
+            return
+        with self._cache_lock:
+            self._cache[key] = score
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    # ==================== 打分接口 ====================
+
+    async def score(
+        self,
+        query: str,
+        passages: Sequence[str],
+        keys: Optional[Sequence[Optional[str]]] = None
+    ) -> Tuple[List[float], int]:
+        """
+        为 (query, passage) 打分
+
+        Args:
+            query: 查询文本
+            passages: 候选文本
+            keys: 候选的缓存键（chunk_id），为空时使用文本摘要
+
+        Returns:
+            (sigmoid 归一化分数列表, 缓存命中数)
+        """
+        query_hash = self._query_hash(query)
+        scores: List[Optional[float]] = [None] * len(passages)
+        cache_keys: List[Tuple[str, str]] = []
+        missing: List[int] = []
+        for index, text in enumerate(passages):
+            text = str(text or "")[:self.max_chars]
+            cache_key = (query_hash, self._passage_key(keys[index] if keys else None, text))
+            cache_keys.append(cache_key)
+            cached = self._cache_get(cache_key)
+            if cached is None:
+                missing.append(index)
+            else:
+                scores[index] = cached
+
+        with self._stats_lock:
+            self._stats["requests"] += 1
+            self._stats["cache_hits"] += len(passages) - len(missing)
+            self._stats["cache_misses"] += len(missing)
+        if missing:
+            self._ensure_worker()
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self._queue.put(_ScoreJob(
+                [(query, str(passages[index] or "")[:self.max_chars]) for index in missing],
+                future,
+                loop
+            ))
+            fresh = await future
+            for index, score in zip(missing, fresh):
+                scores[index] = score
+                self._cache_put(cache_keys[index], score)
+
+        return [float(score) for score in scores], len(passages) - len(missing)
+
+    async def rerank(
+        self,
+        query: str,
+        passages: Sequence[str],
+        base_scores: Sequence[float],
+        alpha: float,
+        top_k: int,
+        keys: Optional[Sequence[Optional[str]]] = None
+    ) -> RerankOutcome:
+        """
+        按一阶段顺序分段打分并融合，满足提前退出条件时停止
+
+        第一段至少覆盖 top_k 个候选；之后每打完一段，若当前第 top_k 名的融合分
+        >= alpha * 1 + (1 - alpha) * 未打分候选的最高一阶段分 - early_exit_margin，
+        则剩余候选不可能（margin 为 0 时）进入前 top_k，直接跳过
+        """
+        total = len(passages)
+        cross_scores: List[Optional[float]] = [None] * total
+        final_scores: List[Optional[float]] = [None] * total
+        if total == 0:
+            return RerankOutcome(cross_scores, final_scores, scored=0, cache_hits=0, early_exit=False)
+
+        top_k = max(1, min(int(top_k), total))
+        stage = self.stage_size if self.stage_size > 0 else total
+        cursor = 0
+        cache_hits = 0
+        early_exit = False
+        while cursor < total:
+            end = min(total, max(stage, top_k)) if cursor == 0 else min(total, cursor + stage)
+            scores, hits = await self.score(
+                query,
+                passages[cursor:end],
+                keys[cursor:end] if keys else None
+            )
+            cache_hits += hits
+            for offset, score in enumerate(scores):
+                index = cursor + offset
+                cross_scores[index] = score
+                final_scores[index] = alpha * score + (1 - alpha) * float(base_scores[index])
+            cursor = end
+            if cursor >= total:
+                break
+
+            kth_score = sorted((score for score in final_scores if score is not None), reverse=True)[top_k - 1]
+            upper_bound = alpha + (1 - alpha) * max(float(score) for score in base_scores[cursor:])
+            if kth_score >= upper_bound - self.early_exit_margin:
+                early_exit = True
+                with self._stats_lock:
+                    self._stats["early_exits"] += 1
+                    self._stats["skipped_pairs"] += total - cursor
+                break
+
+        return RerankOutcome(
+            cross_scores=cross_scores,
+            final_scores=final_scores,
+            scored=cursor,
+            cache_hits=cache_hits,
+            early_exit=early_exit
+        )
+
+    # ==================== 管理 ====================
+
+    def shutdown(self) -> None:
+        with self._worker_lock:
+            self._closed = True
+            if self._worker is not None and self._worker.is_alive():
+                self._queue.put(None)
+        self._unload_model()
+        from app.services.infrastructure.model.residency_manager import get_model_residency_manager
+        get_model_residency_manager().unregister(self.residency_key)
+
+    def clear_cache(self) -> None:
+        with self._cache_lock:
+            self._cache.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            stats = dict(self._stats)
+        batches = stats["batches"] or 0
+        lookups = stats["cache_hits"] + stats["cache_misses"]
+        with self._cache_lock:
+            cache_entries = len(self._cache)
+        return {
+            "model": self.model_name,
+            "backend": self.backend,
+            "active_backend": self.active_backend,
+            "loaded": self._model is not None,
+            "max_batch_size": self.max_batch_size,
+            "batch_wait_ms": round(self.batch_wait_seconds * 1000, 2),
+            "stage_size": self.stage_size,
+            "early_exit_margin": self.early_exit_margin,
+            "queue_depth": self._queue.qsize(),
+            "cache_entries": cache_entries,
+            "cache_hit_rate": round(stats["cache_hits"] / lookups, 4) if lookups else 0.0,
+            "avg_batch_pairs": round(stats["batched_pairs"] / batches, 2) if batches else 0.0,
+            "avg_inference_ms": round(stats["inference_ms"] / batches, 2) if batches else 0.0,
+            **{key: int(value) for key, value in stats.items() if key != "inference_ms"}
+        }
+
+
+def get_reranker_service() -> RerankerService:
+    """获取重排服务单例（配置中的模型或后端变化时重建）"""
+    global _reranker_service_instance
+    config = settings.vector_retrieval
+    model_name = str(config.cross_encoder_model or "").strip()
+    backend = str(getattr(config, "cross_encoder_backend", "auto") or "auto").lower()
+    instance = _reranker_service_instance
+    if instance is not None and (instance.model_name != model_name or instance.backend != backend):
+        instance.shutdown()
+        instance = None
+    if instance is None:
+        instance = RerankerService(
+            model_name=model_name,
+            backend=backend,
+            max_batch_size=getattr(config, "cross_encoder_max_batch_size", 64),
+            batch_wait_ms=getattr(config, "cross_encoder_batch_wait_ms", 2.0),
+            max_chars=getattr(config, "cross_encoder_max_chars", 1500),
+            cache_size=getattr(config, "cross_encoder_cache_size", 20000),
+            stage_size=getattr(config, "cross_encoder_stage_size", 8),
+            early_exit_margin=getattr(config, "cross_encoder_early_exit_margin", 0.0)
+        )
+        _reranker_service_instance = instance
+    return instance
@@ -1,9 +1,11 @@
 """向量存储服务"""
 import os
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Callable
 import chromadb
 from chromadb.config import Settings as ChromaSettings
 from app.core.config import settings
+from app.services.infrastructure.retrieval.index_profiles import IndexProfile
+from app.services.infrastructure.retrieval.metadata_registry import NAMESPACE_COLLECTION, get_metadata_registry
 from app.utils.logger import get_logger
 
 logger = get_logger(__name__)
@@ -29,6 +31,9 @@ class VectorStoreService:
             )
         )
         
+        # 集合句柄缓存：热路径上不再每次访问 Chroma 目录
+        self.registry = get_metadata_registry()
+        
         logger.info(f"向量存储初始化: persist_dir={self.persist_dir}")
     
     def get_or_create_collection(
@@ -37,7 +42,7 @@ class VectorStoreService:
         metadata: Optional[Dict[str, Any]] = None
     ):
         """
-        获取或创建集合
+        获取或创建集合（未指定 metadata 时优先使用缓存的集合句柄）
         
         Args:
             collection_name: 集合名称
@@ -46,20 +51,78 @@ class VectorStoreService:
         Returns:
             集合对象
         """
+        if not metadata:
+            collection = self.registry.get(NAMESPACE_COLLECTION, collection_name)
+            if collection is not None:
+                return collection
+        return self._fetch_collection(collection_name, metadata)
+    
+    def _fetch_collection(
+        self,
+        collection_name: str,
+        metadata: Optional[Dict[str, Any]] = None
+    ):
+        """从 Chroma 目录获取或创建集合，并刷新缓存的句柄"""
         try:
+            version = self.registry.version(NAMESPACE_COLLECTION, collection_name)
             # ChromaDB 不接受空字典作为 metadata,使用 None 代替
             collection = self.client.get_or_create_collection(
                 name=collection_name,
                 metadata=metadata if metadata else None
             )
+            self.registry.put(NAMESPACE_COLLECTION, collection_name, collection, version=version)
             
-            logger.debug(f"获取集合: {collection_name}, count={collection.count()}")
+            logger.debug(f"获取集合: {collection_name}")
             return collection
             
         except Exception as e:
             logger.error(f"获取集合失败: {str(e)}")
             raise
     
+    def ensure_collection(self, collection_name: str, profile: IndexProfile):
+        """
+        按索引档位创建集合（已存在时保持原有索引参数不变）
+        
+        Args:
+            collection_name: 集合名称
+            profile: HNSW 索引档位
+            
+        Returns:
+            集合对象
+        """
+        collection = self._fetch_collection(collection_name, profile.to_metadata())
+        logger.info(
+            f"集合索引档位: {collection_name}, profile={IndexProfile.from_metadata(collection.metadata).name}"
+        )
+        return collection
+    
+    def get_index_profile(self, collection_name: str) -> IndexProfile:
+        """读取集合的索引档位（未记录档位的早期集合返回 Chroma 默认参数）"""
+        return self._run_on_collection(
+            collection_name,
+            lambda collection: IndexProfile.from_metadata(collection.metadata)
+        )
+    
+    def _run_on_collection(self, collection_name: str, action: Callable[[Any], Any]) -> Any:
+        """
+        在集合上执行操作
+        
+        使用缓存句柄失败时重新获取集合；若集合已被其他进程删除/重建（ID 变化），用新句柄重试一次
+        """
+        cached = self.registry.get(NAMESPACE_COLLECTION, collection_name)
+        collection = cached if cached is not None else self._fetch_collection(collection_name)
+        try:
+            return action(collection)
+        except Exception:
+            if cached is None:
+                raise
+            self.registry.invalidate(NAMESPACE_COLLECTION, collection_name)
+            fresh = self._fetch_collection(collection_name)
+            if getattr(fresh, "id", None) == getattr(cached, "id", None):
+                raise
+            logger.warning(f"集合句柄已失效，重新获取后重试: {collection_name}")
+            return action(fresh)
+    
     def add_vectors(
         self,
         collection_name: str,
@@ -74,7 +137,7 @@ class VectorStoreService:
         Args:
             collection_name: 集合名称
             ids: ID列表
-            embeddings: 向量列表
+            embeddings: 向量列表或 float32 矩阵 (n, d)
             documents: 文档列表
             metadatas: 元数据列表
             
@@ -82,8 +145,6 @@ class VectorStoreService:
             是否成功
         """
         try:
-            collection = self.get_or_create_collection(collection_name)
-            
             # 确保元数据中的所有值都是字符串类型(ChromaDB要求)
             if metadatas:
                 processed_metadatas = [
@@ -93,11 +154,14 @@ class VectorStoreService:
             else:
                 processed_metadatas = None
             
-            collection.add(
-                ids=ids,
-                embeddings=embeddings,
-                documents=documents,
-                metadatas=processed_metadatas
+            self._run_on_collection(
+                collection_name,
+                lambda collection: collection.add(
+                    ids=ids,
+                    embeddings=embeddings,
+                    documents=documents,
+                    metadatas=processed_metadatas
+                )
             )
             
             logger.info(f"向量添加成功: collection={collection_name}, count={len(ids)}")
@@ -114,35 +178,41 @@ class VectorStoreService:
         n_results: int = 5,
         where: Optional[Dict[str, Any]] = None,
         where_document: Optional[Dict[str, Any]] = None,
-        include: Optional[List[str]] = None
+        include: Optional[List[str]] = None,
+        search_ef: Optional[int] = None
     ) -> Dict[str, Any]:
         """
         搜索相似向量
         
         Args:
             collection_name: 集合名称
-            query_embeddings: 查询向量列表
+            query_embeddings: 查询向量列表或 float32 矩阵 (n, d)
             n_results: 返回结果数量
             where: 元数据过滤条件
             where_document: 文档过滤条件
             include: 返回字段控制（如 embeddings）
+            search_ef: 单次查询的 HNSW ef；大于 n_results 时多取候选后截断（HNSW 按 max(ef, k) 搜索）
             
         Returns:
             搜索结果
         """
         try:
-            collection = self.get_or_create_collection(collection_name)
-
+            candidate_count = max(n_results, int(search_ef or 0))
             query_kwargs = {
                 "query_embeddings": query_embeddings,
-                "n_results": n_results,
+                "n_results": candidate_count,
                 "where": where,
                 "where_document": where_document,
             }
             if include is not None:
                 query_kwargs["include"] = include
 
-            results = collection.query(**query_kwargs)
+            results = self._run_on_collection(
+                collection_name,
+                lambda collection: collection.query(**query_kwargs)
+            )
+            if candidate_count > n_results:
+                results = self._truncate_query_results(results, n_results)
             
             logger.info(f"向量搜索完成: collection={collection_name}, "
                        f"queries={len(query_embeddings)}, n_results={n_results}")
@@ -153,6 +223,16 @@ class VectorStoreService:
             logger.error(f"向量搜索失败: {str(e)}")
             raise
     
+    @staticmethod
+    def _truncate_query_results(results: Dict[str, Any], n_results: int) -> Dict[str, Any]:
+        """将按查询行组织的检索结果每行截断为前 n_results 条"""
+        truncated = dict(results)
+        for key, rows in results.items():
+            if key == "included" or rows is None:
+                continue
+            truncated[key] = [row[:n_results] if row is not None else None for row in rows]
+        return truncated
+    
     def delete_by_ids(
         self,
         collection_name: str,
@@ -169,9 +249,7 @@ class VectorStoreService:
             是否成功
         """
         try:
-            collection = self.get_or_create_collection(collection_name)
-            
-            collection.delete(ids=ids)
+            self._run_on_collection(collection_name, lambda collection: collection.delete(ids=ids))
             
             logger.info(f"向量删除成功: collection={collection_name}, count={len(ids)}")
             return True
@@ -191,7 +269,10 @@ class VectorStoreService:
             是否成功
         """
         try:
+            self.registry.invalidate(NAMESPACE_COLLECTION, collection_name)
             self.client.delete_collection(name=collection_name)
+            # 删除期间并发获取到的句柄同样作废
+            self.registry.invalidate(NAMESPACE_COLLECTION, collection_name)
             
             logger.info(f"集合删除成功: {collection_name}")
             return True
@@ -200,6 +281,83 @@ class VectorStoreService:
             logger.error(f"删除集合失败: {str(e)}")
             raise
     
+    def rebuild_collection(
+        self,
+        collection_name: str,
+        profile: IndexProfile,
+        batch_size: int = 1000
+    ) -> Dict[str, Any]:
+        """
+        离线重建集合索引（更换索引档位 / 距离空间）
+        
+        将全部向量复制到按新档位创建的临时集合，删除原集合后把临时集合改为原名。
+        重建期间该集合不可检索与写入，应在停止入库与检索的窗口内执行。
+        
+        Args:
+            collection_name: 集合名称
+            profile: 目标索引档位
+            batch_size: 每批复制的向量数
+            
+        Returns:
+            重建统计
+        """
+        if collection_name not in self.list_collections():
+            raise ValueError(f"集合不存在: {collection_name}")
+        
+        source = self.client.get_collection(name=collection_name)
+        previous = IndexProfile.from_metadata(source.metadata)
+        temp_name = f"{collection_name}__rebuild"
+        if temp_name in self.list_collections():
+            self.client.delete_collection(name=temp_name)
+        
+        metadata = {
+            key: value for key, value in (source.metadata or {}).items()
+            if not key.startswith("hnsw:")
+        }
+        metadata.update(profile.to_metadata())
+        target = self.client.create_collection(name=temp_name, metadata=metadata)
+        
+        total = source.count()
+        copied = 0
+        try:
+            while copied < total:
+                batch = source.get(
+                    limit=batch_size,
+                    offset=copied,
+                    include=["embeddings", "documents", "metadatas"]
+                )
+                if not batch["ids"]:
+                    break
+                target.add(
+                    ids=batch["ids"],
+                    embeddings=batch["embeddings"],
+                    documents=batch["documents"],
+                    metadatas=batch["metadatas"]
+                )
+                copied += len(batch["ids"])
+            if copied != total:
+                raise RuntimeError(f"复制数量不一致: expected={total}, copied={copied}")
+        except Exception:
+            self.client.delete_collection(name=temp_name)
+            raise
+        
+        self.registry.invalidate(NAMESPACE_COLLECTION, collection_name)
+        self.client.delete_collection(name=collection_name)
+        target.modify(name=collection_name)
+        self.registry.invalidate(NAMESPACE_COLLECTION, collection_name)
+        
+        logger.info(
+            f"集合索引重建完成: {collection_name}, {previous.name} -> {profile.name}, count={copied}"
+        )
+        return {
+            "collection": collection_name,
+            "count": copied,
+            "previous_profile": previous.name,
+            "previous_space": previous.space,
+            "profile": profile.name,
+            "space": profile.space
+        }
+    
     def get_collection_stats(self, collection_name: str) -> Dict[str, Any]:
         """
         获取集合统计信息
@@ -211,13 +369,14 @@ class VectorStoreService:
             统计信息
         """
         try:
-            collection = self.get_or_create_collection(collection_name)
-            
-            return {
-                'name': collection_name,
-                'count': collection.count(),
-                'metadata': collection.metadata
-            }
+            return self._run_on_collection(
+                collection_name,
+                lambda collection: {
+                    'name': collection_name,
+                    'count': collection.count(),
+                    'metadata': collection.metadata
+                }
+            )
             
         except Exception as e:
             logger.error(f"获取集合统计失败: {str(e)}")
@@ -256,11 +415,12 @@ class VectorStoreService:
             是否成功
         """
         try:
-            collection = self.get_or_create_collection(collection_name)
-            
-            collection.update(
-                ids=ids,
-                metadatas=metadatas
+            self._run_on_collection(
+                collection_name,
+                lambda collection: collection.update(
+                    ids=ids,
+                    metadatas=metadatas
+                )
             )
             
             logger.info(f"元数据更新成功: collection={collection_name}, count={len(ids)}")
@@ -286,9 +446,7 @@ class VectorStoreService:
             向量数据
         """
         try:
-            collection = self.get_or_create_collection(collection_name)
-            
-            results = collection.get(ids=ids)
+            results = self._run_on_collection(collection_name, lambda collection: collection.get(ids=ids))
             
             logger.debug(f"获取向量: collection={collection_name}, count={len(ids)}")
             return results
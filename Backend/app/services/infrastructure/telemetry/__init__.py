@@ -0,0 +1,16 @@
+"""遥测服务"""
+from app.services.infrastructure.telemetry.telemetry_sink import TelemetrySink, get_telemetry_sink
+from app.services.infrastructure.telemetry.tracing import (
+    Trace,
+    TraceMiddleware,
+    current_trace,
+    record_span,
+    span,
+    trace_diagnostics,
+    traced,
+)
+
+__all__ = [
+    'TelemetrySink', 'get_telemetry_sink',
+    'Trace', 'TraceMiddleware', 'current_trace', 'record_span', 'span', 'trace_diagnostics', 'traced',
+]
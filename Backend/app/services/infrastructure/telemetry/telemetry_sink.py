@@ -0,0 +1,329 @@
+"""遥测汇聚：内存环形缓冲 + 后台线程批量写 JSONL（按大小/时间轮转、按流采样），并维护进程内分阶段延迟直方图"""
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+from pathlib import Path
+from typing import Any, Deque, Dict, List, Mapping, Optional, Tuple
+from app.core.config import settings
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+# 全局单例实例
+_telemetry_sink_instance = None
+
+# Prometheus 直方图桶上界（毫秒）
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000)
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class _LatencyHistogram:
+    """单个阶段的延迟分布：累计桶计数（导出用）+ 最近窗口样本（分位数用）"""
+
+    def __init__(self, window: int):
+        self.count = 0
+        self.total = 0.0
+        self.max_value = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.recent: Deque[float] = deque(maxlen=max(1, window))
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.total += value
+        self.max_value = max(self.max_value, value)
+        self.recent.append(value)
+        for index, bound in enumerate(LATENCY_BUCKETS_MS):
+            if value <= bound:
+                self.buckets[index] += 1
+                return
+        self.buckets[-1] += 1
+
+    def quantiles(self) -> Dict[str, float]:
+        ordered = sorted(self.recent)
+        if not ordered:
+            return {f"p{int(q * 100)}": 0.0 for q in QUANTILES}
+        return {
+            f"p{int(q * 100)}": round(ordered[min(len(ordered) - 1, int(len(ordered) * q))], 2)
+            for q in QUANTILES
+        }
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total / self.count, 2) if self.count else 0.0,
+            "max_ms": round(self.max_value, 2),
+            **self.quantiles()
+        }
+
+
+class TelemetrySink:
+    """
+    遥测汇聚
+
+    - record() 只做采样判断、入环形缓冲和直方图更新，不在请求路径上做磁盘 I/O
+    - 后台线程按 flush_interval_seconds 或缓冲达到 flush_batch_size 时取出事件，每个文件打开一次批量追加
+    - 文件超过 max_file_bytes 或当前文件写入超过 rotate_interval_hours 时轮转为 .1 ~ .N，保留 backup_count 份
+    - 缓冲满时丢弃最旧事件并计数；被采样掉的事件仍计入直方图
+    - buffered=False 时退化为请求路径同步追加（与旧实现一致），直方图照常维护
+    """
+
+    def __init__(
+        self,
+        buffered: bool = True,
+        buffer_size: int = 10000,
+        flush_interval_seconds: float = 2.0,
+        flush_batch_size: int = 500,
+        max_file_bytes: int = 50 * 1024 * 1024,
+        backup_count: int = 5,
+        rotate_interval_hours: float = 24.0,
+        sample_rates: Optional[Mapping[str, float]] = None,
+        histogram_window: int = 2048
+    ):
+        self.buffered = bool(buffered)
+        self.flush_interval_seconds = max(0.05, float(flush_interval_seconds or 0))
+        self.flush_batch_size = max(1, int(flush_batch_size))
+        self.max_file_bytes = max(0, int(max_file_bytes or 0))
+        self.backup_count = max(0, int(backup_count or 0))
+        self.rotate_interval_seconds = max(0.0, float(rotate_interval_hours or 0)) * 3600
+        self.sample_rates = {str(key): float(value) for key, value in dict(sample_rates or {}).items()}
+        self.histogram_window = max(1, int(histogram_window))
+
+        self._buffer: Deque[Tuple[str, str]] = deque(maxlen=max(1, int(buffer_size)))
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._worker: Optional[threading.Thread] = None
+        self._file_started: Dict[str, float] = {}
+        self._histograms: Dict[str, _LatencyHistogram] = {}
+        self._stream_counts: Dict[str, int] = {}
+        self._stats: Dict[str, int] = {
+            "recorded": 0,
+            "sampled_out": 0,
+            "dropped": 0,
+            "written": 0,
+            "flushes": 0,
+            "rotations": 0,
+            "write_errors": 0
+        }
+
+    # ==================== 记录 ====================
+
+    def observe(self, stage: str, value_ms: float) -> None:
+        """记录一个阶段耗时（毫秒）"""
+        try:
+            value = float(value_ms)
+        except (TypeError, ValueError):
+            return
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = _LatencyHistogram(self.histogram_window)
+                self._histograms[stage] = histogram
+            histogram.observe(value)
+
+    def record(
+        self,
+        stream: str,
+        file_path: Optional[str],
+        payload: Dict[str, Any],
+        observations: Optional[Mapping[str, float]] = None
+    ) -> None:
+        """
+        记录一条遥测事件
+
+        Args:
+            stream: 事件流名称（决定采样率）
+            file_path: 目标 JSONL 文件，为空时只更新直方图
+            payload: 事件内容
+            observations: 随事件上报的阶段耗时 {stage: ms}
+        """
+        for stage, value in (observations or {}).items():
+            if value is not None:
+                self.observe(stage, value)
+
+        path = str(file_path or "").strip()
+        if not path:
+            return
+        sample_rate = self.sample_rates.get(stream, 1.0)
+        with self._lock:
+            self._stream_counts[stream] = self._stream_counts.get(stream, 0) + 1
+            if sample_rate < 1.0 and random.random() >= sample_rate:
+                self._stats["sampled_out"] += 1
+                return
+            self._stats["recorded"] += 1
+
+        try:
+            line = json.dumps(payload, ensure_ascii=False, default=str)
+        except Exception as error:
+            logger.warning(f"遥测事件序列化失败: stream={stream}, error={str(error)}")
+            return
+
+        if not self.buffered or self._stopped:
+            self._write_batch([(path, line)])
+            return
+
+        with self._lock:
+            if len(self._buffer) == self._buffer.maxlen:
+                self._stats["dropped"] += 1
+            self._buffer.append((path, line))
+            pending = len(self._buffer)
+        self._ensure_worker()
+        if pending >= self.flush_batch_size:
+            self._wakeup.set()
+
+    # ==================== 后台刷盘 ====================
+
+    def _ensure_worker(self) -> None:
+        if self._worker is not None and self._worker.is_alive():
+            return
+        with self._lock:
+            if self._stopped or (self._worker is not None and self._worker.is_alive()):
+                return
+            self._worker = threading.Thread(target=self._run, name="telemetry-flusher", daemon=True)
+            self._worker.start()
+
+    def _run(self) -> None:
+        while not self._stopped:
+            self._wakeup.wait(self.flush_interval_seconds)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self) -> int:
+        """把缓冲中的事件写入文件，返回写入条数"""
+        with self._lock:
+            events = list(self._buffer)
+            self._buffer.clear()
+        if not events:
+            return 0
+        return self._write_batch(events)
+
+    def _write_batch(self, events: List[Tuple[str, str]]) -> int:
+        grouped: Dict[str, List[str]] = {}
+        for path, line in events:
+            grouped.setdefault(path, []).append(line)
+
+        written = 0
+        with self._write_lock:
+            for path, lines in grouped.items():
+                data = "\n".join(lines) + "\n"
+                try:
+                    target = Path(path)
+                    target.parent.mkdir(parents=True, exist_ok=True)
+                    self._maybe_rotate(target, len(data.encode("utf-8")))
+                    with target.open("a", encoding="utf-8") as handle:
+                        handle.write(data)
+                    written += len(lines)
+                except Exception as error:
+                    self._stats["write_errors"] += 1
+                    logger.warning(f"遥测写入失败: file={path}, error={str(error)}")
+            self._stats["written"] += written
+            self._stats["flushes"] += 1
+        return written
+
+    def _maybe_rotate(self, target: Path, incoming_bytes: int) -> None:
+        key = str(target)
+        now = time.time()
+        started = self._file_started.setdefault(key, now)
+        if not target.exists():
+            self._file_started[key] = now
+            return
+        size = target.stat().st_size
+        too_large = self.max_file_bytes > 0 and size > 0 and size + incoming_bytes > self.max_file_bytes
+        too_old = self.rotate_interval_seconds > 0 and now - started >= self.rotate_interval_seconds
+        if not (too_large or too_old):
+            return
+
+        if self.backup_count <= 0:
+            target.unlink()
+        else:
+            oldest = target.with_name(f"{target.name}.{self.backup_count}")
+            if oldest.exists():
+                oldest.unlink()
+            for index in range(self.backup_count - 1, 0, -1):
+                source = target.with_name(f"{target.name}.{index}")
+                if source.exists():
+                    os.replace(source, target.with_name(f"{target.name}.{index + 1}"))
+            os.replace(target, target.with_name(f"{target.name}.1"))
+        self._file_started[key] = now
+        self._stats["rotations"] += 1
+
+    def shutdown(self) -> None:
+        """停止后台线程并写出剩余事件"""
+        self._stopped = True
+        self._wakeup.set()
+        if self._worker is not None and self._worker.is_alive():
+            self._worker.join(timeout=5)
+        self.flush()
+
+    # ==================== 导出 ====================
+
+    def get_histograms(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return {stage: histogram.summary() for stage, histogram in sorted(self._histograms.items())}
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["buffered"] = len(self._buffer)
+            stats["buffer_size"] = self._buffer.maxlen
+            stats["streams"] = dict(self._stream_counts)
+        stats["mode"] = "buffered" if self.buffered else "sync"
+        stats["sample_rates"] = dict(self.sample_rates)
+        return stats
+
+    def render_prometheus(self) -> str:
+        """以 Prometheus 文本格式导出阶段延迟直方图与汇聚统计"""
+        lines = [
+            "# HELP myrag_stage_latency_ms Stage latency in milliseconds.",
+            "# TYPE myrag_stage_latency_ms histogram"
+        ]
+        quantile_lines = [
+            "# HELP myrag_stage_latency_ms_recent Stage latency quantiles over the recent window.",
+            "# TYPE myrag_stage_latency_ms_recent summary"
+        ]
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            for stage, histogram in histograms:
+                label = stage.replace("\\", "\\\\").replace('"', '\\"')
+                cumulative = 0
+                for bound, bucket in zip(LATENCY_BUCKETS_MS, histogram.buckets):
+                    cumulative += bucket
+                    lines.append(f'myrag_stage_latency_ms_bucket{{stage="{label}",le="{bound}"}} {cumulative}')
+                lines.append(f'myrag_stage_latency_ms_bucket{{stage="{label}",le="+Inf"}} {histogram.count}')
+                lines.append(f'myrag_stage_latency_ms_sum{{stage="{label}"}} {histogram.total:.3f}')
+                lines.append(f'myrag_stage_latency_ms_count{{stage="{label}"}} {histogram.count}')
+                for quantile, value in zip(QUANTILES, histogram.quantiles().values()):
+                    quantile_lines.append(f'myrag_stage_latency_ms_recent{{stage="{label}",quantile="{quantile}"}} {value}')
+            stats = dict(self._stats)
+            buffered = len(self._buffer)
+
+        lines.extend(quantile_lines)
+        lines.append("# TYPE myrag_telemetry_events_total counter")
+        for key in ("recorded", "sampled_out", "dropped", "written", "write_errors", "rotations"):
+            lines.append(f'myrag_telemetry_events_total{{result="{key}"}} {stats[key]}')
+        lines.append("# TYPE myrag_telemetry_buffered gauge")
+        lines.append(f"myrag_telemetry_buffered {buffered}")
+        return "\n".join(lines) + "\n"
+
+
+def get_telemetry_sink() -> TelemetrySink:
+    """获取遥测汇聚单例"""
+    global _telemetry_sink_instance
+    if _telemetry_sink_instance is None:
+        config = settings.telemetry
+        _telemetry_sink_instance = TelemetrySink(
+            buffered=config.buffered,
+            buffer_size=config.buffer_size,
+            flush_interval_seconds=config.flush_interval_seconds,
+            flush_batch_size=config.flush_batch_size,
+            max_file_bytes=int(config.max_file_mb * 1024 * 1024),
+            backup_count=config.backup_count,
+            rotate_interval_hours=config.rotate_interval_hours,
+            sample_rates=config.sample_rates,
+            histogram_window=config.histogram_window
+        )
+    return _telemetry_sink_instance
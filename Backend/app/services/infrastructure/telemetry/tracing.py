@@ -0,0 +1,272 @@
+"""请求级分阶段耗时追踪：contextvars 传递当前 trace，未开启或不在请求内时 span() 返回共享的空操作对象"""
+import functools
+import inspect
+import time
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from uuid import uuid4
+from app.core.config import settings
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+TRACE_ID_HEADER = "x-trace-id"
+
+_current_trace: ContextVar[Optional["Trace"]] = ContextVar("myrag_trace", default=None)
+
+
+class _NoopSpan:
+    """未处于追踪中时使用的空 span（全局共享，无分配）"""
+    __slots__ = ()
+
+    def __enter__(self) -> "_NoopSpan":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class Span:
+    """一次阶段计时；退出时写入所属 trace"""
+    __slots__ = ("trace", "name", "start")
+
+    def __init__(self, trace: "Trace", name: str):
+        self.trace = trace
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self) -> "Span":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        self.trace.add(self.name, self.start, time.perf_counter(), error=exc_type is not None)
+        return False
+
+
+class Trace:
+    """
+    单个请求的阶段耗时记录
+
+    - 并行阶段（如向量/关键词/图谱三路召回）的 span 会在时间上重叠，各阶段耗时之和可能大于总耗时
+    - 同名阶段多次出现时在 stages 中累加，spans 保留每一次的起始偏移与耗时
+    """
+
+    def __init__(self, name: str, trace_id: Optional[str] = None, max_spans: int = 256):
+        self.name = name
+        self.trace_id = trace_id or uuid4().hex
+        self.max_spans = max(1, int(max_spans))
+        self.started = time.perf_counter()
+        self.finished: Optional[float] = None
+        self.spans: List[Tuple[str, float, float, bool]] = []
+        self.dropped_spans = 0
+
+    def span(self, name: str) -> Span:
+        return Span(self, name)
+
+    def add(self, name: str, start: float, end: float, error: bool = False) -> None:
+        if len(self.spans) >= self.max_spans:
+            self.dropped_spans += 1
+            return
+        self.spans.append((name, start, end, error))
+
+    def finish(self) -> None:
+        if self.finished is None:
+            self.finished = time.perf_counter()
+
+    @property
+    def total_ms(self) -> float:
+        end = self.finished if self.finished is not None else time.perf_counter()
+        return (end - self.started) * 1000
+
+    def stage_totals(self) -> Dict[str, Dict[str, float]]:
+        stages: Dict[str, Dict[str, float]] = {}
+        for name, start, end, _ in list(self.spans):
+            duration = (end - start) * 1000
+            stage = stages.setdefault(name, {"count": 0, "total_ms": 0.0, "max_ms": 0.0})
+            stage["count"] += 1
+            stage["total_ms"] += duration
+            stage["max_ms"] = max(stage["max_ms"], duration)
+        for stage in stages.values():
+            stage["total_ms"] = round(stage["total_ms"], 2)
+            stage["max_ms"] = round(stage["max_ms"], 2)
+        return stages
+
+    def breakdown(self) -> Dict[str, Any]:
+        """阶段耗时明细（用于响应诊断块与慢请求日志）"""
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "total_ms": round(self.total_ms, 2),
+            "stages": self.stage_totals(),
+            "spans": [
+                {
+                    "name": name,
+                    "start_ms": round((start - self.started) * 1000, 2),
+                    "duration_ms": round((end - start) * 1000, 2),
+                    **({"error": True} if error else {})
+                }
+                for name, start, end, error in sorted(list(self.spans), key=lambda item: item[1])
+            ],
+            "dropped_spans": self.dropped_spans
+        }
+
+    def server_timing(self) -> str:
+        """Server-Timing 响应头（每个阶段累计耗时 + 总耗时）"""
+        entries = [
+            f"{_server_timing_token(name)};dur={stage['total_ms']:.1f}"
+            for name, stage in self.stage_totals().items()
+        ]
+        entries.append(f"total;dur={self.total_ms:.1f}")
+        return ", ".join(entries)
+
+
+def _server_timing_token(name: str) -> str:
+    return "".join(ch if ch.isalnum() or ch in "-_" else "_" for ch in name) or "stage"
+
+
+def tracing_enabled() -> bool:
+    return bool(getattr(settings.tracing, "enabled", False))
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+def current_trace_id() -> Optional[str]:
+    trace = _current_trace.get()
+    return trace.trace_id if trace is not None else None
+
+
+def span(name: str):
+    """
+    阶段计时上下文（同步/异步代码均可用 with）
+
+    不在追踪中时返回共享空对象，开销为一次 ContextVar 读取
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        return _NOOP_SPAN
+    return Span(trace, name)
+
+
+def record_span(name: str, start: float, end: Optional[float] = None) -> None:
+    """记录已知起止时间（time.perf_counter()）的阶段，如首 token 延迟"""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add(name, start, end if end is not None else time.perf_counter())
+
+
+def traced(name: str) -> Callable:
+    """把整个函数（同步或协程）记为一个阶段"""
+    def decorator(func: Callable) -> Callable:
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                trace = _current_trace.get()
+                if trace is None:
+                    return await func(*args, **kwargs)
+                with Span(trace, name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            trace = _current_trace.get()
+            if trace is None:
+                return func(*args, **kwargs)
+            with Span(trace, name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def trace_diagnostics() -> Optional[Dict[str, Any]]:
+    """当前请求的阶段明细；未开启追踪或配置不输出诊断块时返回 None"""
+    trace = _current_trace.get()
+    if trace is None or not getattr(settings.tracing, "include_diagnostics", True):
+        return None
+    return trace.breakdown()
+
+
+def start_trace(name: str, trace_id: Optional[str] = None) -> Tuple[Optional[Trace], Any]:
+    """开启追踪并设为当前 trace，返回 (trace, token)；未开启追踪时返回 (None, None)"""
+    if not tracing_enabled():
+        return None, None
+    trace = Trace(name, trace_id=trace_id, max_spans=getattr(settings.tracing, "max_spans_per_trace", 256))
+    return trace, _current_trace.set(trace)
+
+
+def end_trace(trace: Optional[Trace], token: Any) -> None:
+    """结束追踪：阶段耗时写入遥测直方图，超过慢请求阈值时记录明细"""
+    if trace is None:
+        return
+    _current_trace.reset(token)
+    trace.finish()
+    try:
+        from app.services.infrastructure.telemetry.telemetry_sink import get_telemetry_sink
+        sink = get_telemetry_sink()
+        for name, start, end, _ in list(trace.spans):
+            sink.observe(f"stage.{name}", (end - start) * 1000)
+    except Exception as error:
+        logger.warning(f"阶段耗时写入直方图失败: {str(error)}")
+
+    slow_ms = float(getattr(settings.tracing, "slow_trace_log_ms", 0) or 0)
+    if slow_ms > 0 and trace.total_ms >= slow_ms:
+        stages = ", ".join(
+            f"{name}={stage['total_ms']}ms" for name, stage in
+            sorted(trace.stage_totals().items(), key=lambda item: item[1]["total_ms"], reverse=True)
+        )
+        logger.info(f"慢请求: trace_id={trace.trace_id}, {trace.name}, total={trace.total_ms:.1f}ms, {stages}")
+
+
+class TraceMiddleware:
+    """
+    ASGI 中间件：为匹配前缀的 HTTP 请求开启 trace
+
+    - 请求头 X-Trace-Id 存在时沿用，否则生成
+    - 响应头返回 X-Trace-Id 与 Server-Timing；非流式响应发送响应头时各阶段均已完成
+    - 流式响应的 Server-Timing 只含响应头发出前完成的阶段，trace 持续到响应体发送完毕（完整明细由 done 事件携带）
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope.get("type") != "http" or not tracing_enabled():
+            await self.app(scope, receive, send)
+            return
+        path = scope.get("path", "")
+        prefixes = getattr(settings.tracing, "path_prefixes", None) or ["/api/"]
+        if not any(path.startswith(prefix) for prefix in prefixes):
+            await self.app(scope, receive, send)
+            return
+
+        incoming_id = None
+        for key, value in scope.get("headers", []):
+            if key.decode("latin-1").lower() == TRACE_ID_HEADER:
+                incoming_id = value.decode("latin-1").strip()[:64] or None
+                break
+        trace, token = start_trace(f"{scope.get('method', 'GET')} {path}", trace_id=incoming_id)
+        if trace is None:
+            await self.app(scope, receive, send)
+            return
+
+        response_header = bool(getattr(settings.tracing, "response_header", True))
+
+        async def send_with_trace(message):
+            if message["type"] == "http.response.start" and response_header:
+                headers = list(message.get("headers", []))
+                headers.append((TRACE_ID_HEADER.encode("latin-1"), trace.trace_id.encode("latin-1")))
+                if trace.spans:
+                    headers.append((b"server-timing", trace.server_timing().encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_trace)
+        finally:
+            end_trace(trace, token)
@@ -1,6 +1,6 @@
 """向量相似度计算工具"""
-import math
-from typing import List
+from typing import Any, List, Sequence
+import numpy as np
 
 
 def normalize_l2_distance_to_similarity(distance: float) -> float:
@@ -25,6 +25,23 @@ def normalize_l2_distance_to_similarity(distance: float) -> float:
     return max(0.0, min(1.0, similarity))
 
 
+def distance_to_similarity(distance: float, space: str = "l2") -> float:
+    """
+    按集合的距离空间将 Chroma 距离转换为相似度分数
+    
+    Args:
+        distance: Chroma 返回的距离
+        space: 集合的 hnsw:space（l2 / cosine / ip）
+        
+    Returns:
+        相似度分数，范围 [0, 1]
+    """
+    if space in ("cosine", "ip"):
+        # cosine 距离 = 1 - 余弦相似度；ip 距离 = 1 - 内积（归一化向量下即余弦相似度）
+        return max(0.0, min(1.0, 1.0 - float(distance)))
+    return normalize_l2_distance_to_similarity(distance)
+
+
 def cosine_similarity(vec_a: List[float], vec_b: List[float]) -> float:
     """
     计算两个向量的余弦相似度
@@ -38,8 +55,6 @@ def cosine_similarity(vec_a: List[float], vec_b: List[float]) -> float:
     Returns:
         余弦相似度，范围 [-1, 1]
     """
-    import numpy as np
-    
     a = np.array(vec_a)
     b = np.array(vec_b)
     
@@ -53,11 +68,97 @@ def cosine_similarity(vec_a: List[float], vec_b: List[float]) -> float:
     return dot_product / (norm_a * norm_b)
 
 
+def build_embedding_matrix(vectors: Sequence[Any]) -> np.ndarray:
+    """
+    将向量列表堆叠为 float32 矩阵 (n, d)
+
+    维度与第一条向量不一致（或为空）的行置零，使其与任何向量的内积为 0，
+    与逐对计算时"维度不匹配视为 0"的约定一致。
+    """
+    if vectors is None or len(vectors) == 0:
+        return np.zeros((0, 0), dtype=np.float32)
+
+    # 常见情况：等长向量（或已是矩阵）直接整体转换，float32 矩阵无需复制
+    try:
+        matrix = np.asarray(vectors, dtype=np.float32)
+        if matrix.ndim == 2:
+            return matrix
+    except ValueError:
+        pass
+
+    dimension = 0
+    for vector in vectors:
+        if vector is not None and len(vector) > 0:
+            dimension = len(vector)
+            break
+
+    matrix = np.zeros((len(vectors), dimension), dtype=np.float32)
+    for row, vector in enumerate(vectors):
+        if vector is not None and len(vector) == dimension:
+            matrix[row] = vector
+    return matrix
+
+
+def mmr_select(
+    relevance: Sequence[float],
+    embeddings: Sequence[Any],
+    lambda_value: float,
+    target_count: int
+) -> List[int]:
+    """
+    最大边际相关性（MMR）选择，返回候选下标的新顺序
+
+    score_i = λ·relevance_i - (1-λ)·max_{j∈selected} cos(e_i, e_j)
+
+    候选两两相似度由一次矩阵乘得到（向量需已归一化），每轮只用新选中行
+    增量更新各候选的最大相似度，整体 O(n²·d + k·n)。未被选中的候选按原顺序
+    追加在末尾；同分时取原顺序中靠前者。
+
+    Args:
+        relevance: 候选相关性分数
+        embeddings: 候选向量（list 或 ndarray）
+        lambda_value: 相关性权重 λ ∈ [0, 1]
+        target_count: 需要按 MMR 排序的数量
+
+    Returns:
+        下标列表（长度等于候选数）
+    """
+    count = len(relevance)
+    if count == 0:
+        return []
+
+    matrix = build_embedding_matrix(embeddings)
+    similarity = np.clip(matrix @ matrix.T, -1.0, 1.0)
+
+    relevance_scores = lambda_value * np.asarray(relevance, dtype=np.float32)
+    diversity_weight = 1.0 - lambda_value
+
+    max_similarity = np.zeros(count, dtype=np.float32)
+    available = np.ones(count, dtype=bool)
+    order: List[int] = []
+
+    for step in range(min(max(0, target_count), count)):
+        scores = relevance_scores - diversity_weight * max_similarity if step else relevance_scores.copy()
+        scores = np.where(available, scores, -np.inf)
+        best = int(np.argmax(scores))
+        order.append(best)
+        available[best] = False
+        if step == 0:
+            max_similarity = similarity[best].copy()
+        else:
+            np.maximum(max_similarity, similarity[best], out=max_similarity)
+
+    order.extend(int(index) for index in np.flatnonzero(available))
+    return order
+
+
 def format_search_results(
     results: dict,
     file_info_map: dict,
     kb_id: int,
-    score_threshold: float = 0.0
+    score_threshold: float = 0.0,
+    query_index: int = 0,
+    space: str = "l2"
 ) -> List[dict]:
     """
     格式化ChromaDB检索结果
@@ -67,33 +168,39 @@ def format_search_results(
         file_info_map: 文件ID到文件名的映射
         kb_id: 知识库ID
         score_threshold: 相似度阈值
+        query_index: 多查询向量批量检索时的行号（对应 query_embeddings 的下标）
+        space: 集合的距离空间
         
     Returns:
-        格式化后的结果列表
+        格式化后的结果列表（若请求包含 embeddings，写入 float32 行向量 '_embedding'）
     """
     formatted_results = []
     
-    if not results.get('ids') or len(results['ids']) == 0:
+    if not results.get('ids') or len(results['ids']) <= query_index:
         return formatted_results
     
-    distances = results['distances'][0]
+    distances = results['distances'][query_index]
+    metadatas = results.get('metadatas')
+    embeddings = results.get('embeddings')
+    row_embeddings = embeddings[query_index] if embeddings is not None and len(embeddings) > query_index else None
+    row_matrix = build_embedding_matrix(row_embeddings) if row_embeddings is not None else None
     
-    for i, doc_id in enumerate(results['ids'][0]):
+    for i, doc_id in enumerate(results['ids'][query_index]):
         distance = distances[i]
         
-        # 将L2距离转换为相似度（假设向量已归一化）
-        similarity = normalize_l2_distance_to_similarity(distance)
+        # 按距离空间转换为相似度（L2 假设向量已归一化）
+        similarity = distance_to_similarity(distance, space)
         
         # 应用阈值过滤
         if similarity < score_threshold:
             continue
         
-        metadata = results['metadatas'][0][i] if results.get('metadatas') else {}
+        metadata = (metadatas[query_index][i] or {}) if metadatas else {}
         file_id = int(metadata.get('file_id', 0))
         
-        formatted_results.append({
+        item = {
             'chunk_id': doc_id,
-            'content': results['documents'][0][i],
+            'content': results['documents'][query_index][i],
             'similarity': round(similarity, 4),
             'metadata': {
                 'kb_id': int(metadata.get('kb_id', kb_id)),
@@ -102,6 +209,44 @@ def format_search_results(
                 'chunk_index': int(metadata.get('chunk_index', 0))
             },
             '_distance': round(distance, 4)  # 调试用
-        })
+        }
+        if row_matrix is not None and i < row_matrix.shape[0]:
+            # 各候选共享同一 float32 矩阵的行视图，dict 复制时不复制向量
+            item['_embedding'] = row_matrix[i]
+        formatted_results.append(item)
     
     return formatted_results
+
+
+def format_multi_query_results(
+    results: dict,
+    file_info_map: dict,
+    kb_id: int,
+    score_threshold: float = 0.0,
+    space: str = "l2"
+) -> List[List[dict]]:
+    """
+    将一次多行 query_embeddings 检索的结果按查询行拆分并格式化
+    
+    Args:
+        results: ChromaDB返回的原始结果（每个字段均为按查询行组织的二维列表）
+        file_info_map: 文件ID到文件名的映射
+        kb_id: 知识库ID
+        score_threshold: 相似度阈值
+        space: 集合的距离空间
+        
+    Returns:
+        每个查询向量对应一组格式化结果
+    """
+    row_count = len(results.get('ids') or [])
+    return [
+        format_search_results(
+            results=results,
+            file_info_map=file_info_map,
+            kb_id=kb_id,
+            score_threshold=score_threshold,
+            query_index=query_index,
+            space=space
+        )
+        for query_index in range(row_count)
+    ]
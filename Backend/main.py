@@ -2,7 +2,7 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import RedirectResponse
+from fastapi.responses import PlainTextResponse, RedirectResponse
 from contextlib import asynccontextmanager
 from pathlib import Path
 from app.core.config import settings
@@ -11,6 +11,7 @@ from app.api import kb_router, ws_router, assistant_router, conversation_router
 from app.api.models import router as models_router
 from app.api.agent import router as agent_router
 from app.api.lora import router as lora_router
+from app.services.infrastructure.telemetry.tracing import TraceMiddleware
 from app.utils.logger import get_logger
 
 logger = get_logger(__name__)
@@ -46,6 +47,13 @@ async def lifespan(app: FastAPI):
     
     # 关闭
     logger.info("应用关闭中...")
+    from app.services.domain.knowledge_base.ingestion_service import get_ingestion_service
+    await get_ingestion_service().shutdown()
+    from app.services.infrastructure.llm.ollama_http_client import close_ollama_http_clients
+    await close_ollama_http_clients()
+    from app.services.infrastructure.telemetry.telemetry_sink import get_telemetry_sink
+    get_telemetry_sink().shutdown()
+    db_manager.close()
 
 
 # 创建FastAPI应用
@@ -63,8 +71,12 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Trace-Id", "Server-Timing"],
 )
 
+# 请求分阶段耗时追踪（tracing.enabled 关闭时直接透传）
+app.add_middleware(TraceMiddleware)
+
 # 注册路由
 app.include_router(kb_router)
 app.include_router(ws_router)
@@ -93,18 +105,27 @@ async def model_management_redirect():
     return RedirectResponse(url="/static/pages/model-management.html")
 
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Prometheus 指标：分阶段延迟直方图与遥测写入统计"""
+    from app.services.infrastructure.telemetry.telemetry_sink import get_telemetry_sink
+    return PlainTextResponse(
+        get_telemetry_sink().render_prometheus(),
+        media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
 @app.get("/health")
 async def health_check():
     """健康检查"""
     try:
         # 检查数据库连接
-        with db_manager.get_connection() as conn:
-            with conn.cursor() as cursor:
-                cursor.execute("SELECT 1")
+        await db_manager.execute_query("SELECT 1")
         
         return {
             "status": "healthy",
-            "database": "connected"
+            "database": "connected",
+            "database_pool": db_manager.get_pool_stats()
         }
     except Exception as e:
         logger.error(f"健康检查失败: {str(e)}")
@@ -0,0 +1,77 @@
+"""
+向量索引重建工具
+查看各知识库集合的 HNSW 索引档位，或离线按新档位重建集合（需停止该知识库的入库与检索）
+
+用法:
+  python rebuild_vector_index.py --list
+  python rebuild_vector_index.py --kb-id 3 --profile high_recall
+  python rebuild_vector_index.py --all --profile balanced
+"""
+import argparse
+import sys
+from pathlib import Path
+
+# 添加Backend到路径
+backend_dir = Path(__file__).parent.parent.parent / "Backend"
+sys.path.insert(0, str(backend_dir))
+
+from app.core.config import settings
+from app.services.infrastructure.retrieval.index_profiles import get_index_profile, list_index_profiles
+from app.services.infrastructure.retrieval.vector_store_service import get_vector_store_service
+
+
+def list_collections(vector_store) -> None:
+    """列出知识库集合及其索引档位"""
+    prefix = settings.vector_db.collection_name_prefix
+    print(f"{'collection':<24} {'profile':<12} {'space':<8} {'M':>4} {'ef_c':>6} {'ef_s':>6} {'count':>8}")
+    for name in sorted(vector_store.list_collections()):
+        if not name.startswith(prefix) or name.endswith("__rebuild"):
+            continue
+        profile = vector_store.get_index_profile(name)
+        count = vector_store.get_collection_stats(name)["count"]
+        print(f"{name:<24} {profile.name:<12} {profile.space:<8} {profile.m:>4} "
+              f"{profile.construction_ef:>6} {profile.search_ef:>6} {count:>8}")
+    print("\n可选档位: " + ", ".join(
+        f"{name}(M={profile.m}, ef_c={profile.construction_ef}, ef_s={profile.search_ef}, {profile.space})"
+        for name, profile in list_index_profiles().items()
+    ))
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="向量索引档位查看与离线重建")
+    parser.add_argument("--list", action="store_true", help="列出知识库集合及其索引档位")
+    parser.add_argument("--kb-id", type=int, action="append", default=[], help="要重建的知识库ID（可重复）")
+    parser.add_argument("--all", action="store_true", help="重建全部知识库集合")
+    parser.add_argument("--profile", help="目标索引档位（默认使用配置中的默认档位）")
+    parser.add_argument("--batch-size", type=int, default=1000, help="每批复制的向量数")
+    args = parser.parse_args()
+
+    vector_store = get_vector_store_service()
+    if args.list or not (args.kb_id or args.all):
+        list_collections(vector_store)
+        return 0
+
+    profile = get_index_profile(args.profile)
+    prefix = settings.vector_db.collection_name_prefix
+    if args.all:
+        names = sorted(
+            name for name in vector_store.list_collections()
+            if name.startswith(prefix) and not name.endswith("__rebuild")
+        )
+    else:
+        names = [f"{prefix}{kb_id}" for kb_id in args.kb_id]
+
+    failed = 0
+    for name in names:
+        try:
+            result = vector_store.rebuild_collection(name, profile, batch_size=args.batch_size)
+            print(f"✓ {name}: {result['previous_profile']}({result['previous_space']}) -> "
+                  f"{result['profile']}({result['space']}), count={result['count']}")
+        except Exception as e:
+            failed += 1
+            print(f"✗ {name}: {e}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
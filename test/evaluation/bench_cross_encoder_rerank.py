@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""交叉编码重排基准：逐查询同步 predict 与后台微批重排服务的吞吐/延迟对比。
+
+未指定模型时构造一个 MiniLM-L6 规模的随机权重 BERT 交叉编码器（只用于测速，分数无语义）：
+1) 基线：每个查询在调用方线程内单独 predict（原实现，阻塞事件循环）；
+2) RerankerService（torch / int8）：并发查询由后台线程合并成批，统计 qps、p50/p95 延迟与平均批大小，
+   并给出 int8 与 fp32 的分数偏差和前 k 一致率；
+3) 分数缓存：同一批查询再跑一遍的命中率与 qps；
+4) 分段提前退出：不同 early_exit_margin 下跳过的 pair 比例及前 k 与全部打分的一致率。
+
+用法: python bench_cross_encoder_rerank.py [queries] [concurrency] [top_n] [model_name_or_path]
+示例: python bench_cross_encoder_rerank.py 32 8 20
+"""
+
+import asyncio
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+backend_path = Path(__file__).parent.parent.parent / "Backend"
+sys.path.insert(0, str(backend_path))
+
+from app.services.infrastructure.retrieval.reranker_service import RerankerService
+
+TOP_K = 5
+ALPHA = 0.7
+WORDS = [f"w{index}" for index in range(2000)]
+
+
+def build_random_cross_encoder(path: str) -> None:
+    from transformers import BertConfig, BertForSequenceClassification, BertTokenizerFast
+
+    vocab_file = Path(path) / "vocab.txt"
+    vocab_file.write_text("\n".join(["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"] + WORDS), encoding="utf-8")
+    tokenizer = BertTokenizerFast(vocab_file=str(vocab_file))
+    config = BertConfig(
+        vocab_size=len(WORDS) + 5,
+        hidden_size=384,
+        num_hidden_layers=6,
+        num_attention_heads=12,
+        intermediate_size=1536,
+        max_position_embeddings=512,
+        num_labels=1
+    )
+    BertForSequenceClassification(config).save_pretrained(path)
+    tokenizer.save_pretrained(path)
+
+
+def build_workload(queries: int, top_n: int, seed: int = 11) -> List[Tuple[str, List[str], List[str], List[float]]]:
+    rng = random.Random(seed)
+    workload = []
+    for query_index in range(queries):
+        query = " ".join(rng.choice(WORDS) for _ in range(rng.randint(6, 16)))
+        passages = [" ".join(rng.choice(WORDS) for _ in range(rng.randint(40, 220))) for _ in range(top_n)]
+        keys = [f"q{query_index}_c{index}" for index in range(top_n)]
+        base_scores = sorted((rng.uniform(0.3, 0.9) for _ in range(top_n)), reverse=True)
+        workload.append((query, passages, keys, base_scores))
+    return workload
+
+
+def percentile(values: List[float], ratio: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * ratio))]
+
+
+def top_indices(final_scores: List[Optional[float]], k: int) -> List[int]:
+    scored = [(score, index) for index, score in enumerate(final_scores) if score is not None]
+    return [index for _, index in sorted(scored, reverse=True)[:k]]
+
+
+def run_baseline(model_path: str, workload) -> Dict[str, float]:
+    from sentence_transformers import CrossEncoder
+
+    model = CrossEncoder(model_path, device="cpu")
+    model.predict([["warm", "up"]], show_progress_bar=False)
+    latencies = []
+    start = time.perf_counter()
+    for query, passages, _, _ in workload:
+        begin = time.perf_counter()
+        model.predict([[query, passage[:1500]] for passage in passages], show_progress_bar=False)
+        latencies.append((time.perf_counter() - begin) * 1000)
+    elapsed = time.perf_counter() - start
+    return {"qps": len(workload) / elapsed, "p50": percentile(latencies, 0.5), "p95": percentile(latencies, 0.95)}
+
+
+async def run_service(service: RerankerService, workload, concurrency: int) -> Tuple[Dict[str, float], List]:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+    outcomes: List = [None] * len(workload)
+
+    async def one(index: int) -> None:
+        query, passages, keys, base_scores = workload[index]
+        async with semaphore:
+            begin = time.perf_counter()
+            outcomes[index] = await service.rerank(query, passages, base_scores, ALPHA, TOP_K, keys=keys)
+            latencies.append((time.perf_counter() - begin) * 1000)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(index) for index in range(len(workload))))
+    elapsed = time.perf_counter() - start
+    return {"qps": len(workload) / elapsed, "p50": percentile(latencies, 0.5), "p95": percentile(latencies, 0.95)}, outcomes
+
+
+def make_service(model_path: str, backend: str, cache_size: int = 0, stage_size: int = 0, margin: float = 0.0) -> RerankerService:
+    return RerankerService(
+        model_name=model_path,
+        backend=backend,
+        device="cpu",
+        max_batch_size=64,
+        batch_wait_ms=2.0,
+        cache_size=cache_size,
+        stage_size=stage_size,
+        early_exit_margin=margin
+    )
+
+
+async def main() -> None:
+    query_count = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    top_n = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+    model_path = sys.argv[4] if len(sys.argv) > 4 else None
+
+    temp_dir = None
+    if model_path is None:
+        temp_dir = tempfile.mkdtemp(prefix="bench_cross_encoder_")
+        build_random_cross_encoder(temp_dir)
+        model_path = temp_dir
+    workload = build_workload(query_count, top_n)
+    print(f"queries={query_count}, concurrency={concurrency}, top_n={top_n}, top_k={TOP_K}, model={model_path}")
+
+    try:
+        baseline = run_baseline(model_path, workload)
+        print(f"\n{'mode':<22} {'qps':>7} {'p50_ms':>8} {'p95_ms':>8} {'avg_batch':>10}")
+        print(f"{'sequential predict':<22} {baseline['qps']:>7.1f} {baseline['p50']:>8.1f} {baseline['p95']:>8.1f} {top_n:>10}")
+
+        reference = None
+        for backend in ("torch", "int8"):
+            service = make_service(model_path, backend)
+            await service.score("warm", ["up"])
+            stats, outcomes = await run_service(service, workload, concurrency)
+            avg_batch = service.get_stats()["avg_batch_pairs"]
+            print(f"{'service ' + backend:<22} {stats['qps']:>7.1f} {stats['p50']:>8.1f} {stats['p95']:>8.1f} {avg_batch:>10.1f}")
+            if reference is None:
+                reference = outcomes
+            else:
+                max_diff = max(
+                    abs(left - right)
+                    for ref, out in zip(reference, outcomes)
+                    for left, right in zip(ref.cross_scores, out.cross_scores)
+                )
+                agreement = statistics.mean(
+                    len(set(top_indices(ref.final_scores, TOP_K)) & set(top_indices(out.final_scores, TOP_K))) / TOP_K
+                    for ref, out in zip(reference, outcomes)
+                )
+                print(f"  int8 vs fp32: max |Δscore|={max_diff:.4f}, top-{TOP_K} 一致率={agreement:.3f}")
+            service.shutdown()
+
+        service = make_service(model_path, "int8", cache_size=100000)
+        await run_service(service, workload, concurrency)
+        cold = service.get_stats()
+        stats, _ = await run_service(service, workload, concurrency)
+        warm = service.get_stats()
+        hits = warm["cache_hits"] - cold["cache_hits"]
+        lookups = hits + warm["cache_misses"] - cold["cache_misses"]
+        print(f"{'int8 + cache (warm)':<22} {stats['qps']:>7.1f} {stats['p50']:>8.2f} {stats['p95']:>8.2f} "
+              f"{'':>10}  hit_rate={hits / max(1, lookups):.2f}")
+        service.shutdown()
+
+        print(f"\n{'early_exit_margin':<18} {'skipped_pairs':>14} {'early_exits':>12} {'top-k 一致率':>12} {'qps':>7}")
+        for margin in (0.0, 0.1, 0.2, 0.3):
+            service = make_service(model_path, "int8", stage_size=8, margin=margin)
+            stats, outcomes = await run_service(service, workload, concurrency)
+            service_stats = service.get_stats()
+            agreement = statistics.mean(
+                len(set(top_indices(ref.final_scores, TOP_K)) & set(top_indices(out.final_scores, TOP_K))) / TOP_K
+                for ref, out in zip(reference, outcomes)
+            )
+            skipped_ratio = service_stats["skipped_pairs"] / (query_count * top_n)
+            print(f"{margin:<18.2f} {skipped_ratio:>14.1%} {service_stats['early_exits']:>12} {agreement:>12.3f} {stats['qps']:>7.1f}")
+            service.shutdown()
+        print("* top-k 一致率以 fp32 全部打分为基准，包含 int8 量化误差")
+    finally:
+        if temp_dir:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
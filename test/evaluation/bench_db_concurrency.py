@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""数据库访问层并发基准测试。
+
+两种模式：
+1. db   : 直接对比 DatabaseManager 的阻塞式调用（旧实现：在事件循环线程里执行 pymysql）
+          与线程池调用（新实现：execute_query）在并发协程下的吞吐。
+          用法: python bench_db_concurrency.py db [concurrency] [requests] [sleep_seconds]
+2. http : 并发请求 /api/knowledge-bases/{kb_id}/search，统计吞吐与延迟分位数。
+          在改造前后的代码上各运行一次即可得到对比数据。
+          用法: python bench_db_concurrency.py http <kb_id> [concurrency] [requests] [query]
+          环境变量 BENCH_BASE_URL 指定服务地址（默认 http://127.0.0.1:8000）
+"""
+
+import asyncio
+import os
+import sys
+import time
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List
+
+backend_path = Path(__file__).parent.parent.parent / "Backend"
+sys.path.insert(0, str(backend_path))
+
+BASE_URL = os.getenv("BENCH_BASE_URL", "http://127.0.0.1:8000")
+
+
+def percentile(values: List[float], ratio: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(ratio * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+async def run_concurrent(
+    worker: Callable[[], Awaitable[None]],
+    concurrency: int,
+    total_requests: int
+) -> Dict[str, float]:
+    latencies: List[float] = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def _one() -> None:
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await worker()
+            except Exception:
+                errors += 1
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    wall_start = time.perf_counter()
+    await asyncio.gather(*[_one() for _ in range(total_requests)])
+    wall_seconds = max(1e-6, time.perf_counter() - wall_start)
+
+    return {
+        "requests": total_requests,
+        "errors": errors,
+        "wall_seconds": round(wall_seconds, 3),
+        "throughput_rps": round(total_requests / wall_seconds, 2),
+        "p50_ms": round(percentile(latencies, 0.5), 2),
+        "p95_ms": round(percentile(latencies, 0.95), 2),
+        "max_ms": round(max(latencies) if latencies else 0.0, 2)
+    }
+
+
+def print_report(title: str, report: Dict[str, float]) -> None:
+    print(f"\n===== {title} =====")
+    for key, value in report.items():
+        print(f"{key}: {value}")
+
+
+async def bench_db(concurrency: int, total_requests: int, sleep_seconds: float) -> None:
+    from app.core.database import db_manager
+
+    sql = "SELECT SLEEP(%s) AS slept"
+
+    async def blocking_worker() -> None:
+        # 旧实现：async 方法内部直接同步执行 pymysql
+        db_manager._execute_query_sync(sql, (sleep_seconds,))
+
+    async def executor_worker() -> None:
+        await db_manager.execute_query(sql, (sleep_seconds,))
+
+    blocking_report = await run_concurrent(blocking_worker, concurrency, total_requests)
+    print_report("阻塞式（事件循环线程内执行）", blocking_report)
+
+    executor_report = await run_concurrent(executor_worker, concurrency, total_requests)
+    print_report(f"线程池（pool_size={db_manager.pool_size}）", executor_report)
+
+    speedup = executor_report["throughput_rps"] / max(1e-6, blocking_report["throughput_rps"])
+    print(f"\n吞吐提升: {speedup:.2f}x")
+    print_report("连接池指标", db_manager.get_pool_stats())
+    db_manager.close()
+
+
+async def bench_http(kb_id: int, concurrency: int, total_requests: int, query: str) -> None:
+    import httpx
+
+    url = f"{BASE_URL}/api/knowledge-bases/{kb_id}/search"
+    async with httpx.AsyncClient(timeout=120) as client:
+        async def worker() -> None:
+            response = await client.post(url, json={"query": query, "top_k": 5})
+            response.raise_for_status()
+
+        report = await run_concurrent(worker, concurrency, total_requests)
+        print_report(f"/search 并发基准 (kb_id={kb_id}, concurrency={concurrency})", report)
+
+        health = await client.get(f"{BASE_URL}/health")
+        if health.status_code == 200:
+            print_report("服务端连接池指标", health.json().get("database_pool", {}) or {})
+
+
+def main() -> None:
+    if len(sys.argv) < 2 or sys.argv[1] not in ("db", "http"):
+        print(__doc__)
+        sys.exit(1)
+
+    mode = sys.argv[1]
+    if mode == "db":
+        concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+        total_requests = int(sys.argv[3]) if len(sys.argv) > 3 else 100
+        sleep_seconds = float(sys.argv[4]) if len(sys.argv) > 4 else 0.02
+        asyncio.run(bench_db(concurrency, total_requests, sleep_seconds))
+        return
+
+    if len(sys.argv) < 3:
+        print(__doc__)
+        sys.exit(1)
+    kb_id = int(sys.argv[2])
+    concurrency = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+    total_requests = int(sys.argv[4]) if len(sys.argv) > 4 else 100
+    query = sys.argv[5] if len(sys.argv) > 5 else "如何开机"
+    asyncio.run(bench_http(kb_id, concurrency, total_requests, query))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""本地模型生成调度基准：逐请求 generate vs 连续批处理调度器。
+
+用随机初始化的小型 Llama 模型（CPU 即可运行），对同一组不同长度的 prompt：
+1) 串行逐个调用 model.generate（当前 TransformersService 在并发下的实际效果）；
+2) N 个并发会话同时提交到 GenerationScheduler。
+贪心解码下校验两种方式输出的 token 完全一致，并对比总耗时与聚合 tokens/s。
+同时验证：会话中途取消后批次继续运行；排队超过上限时直接拒绝。
+
+用法: python bench_generation_scheduler.py [sessions] [max_new_tokens] [max_batch_size]
+示例: python bench_generation_scheduler.py 8 64 8
+"""
+
+import asyncio
+import random
+import sys
+import time
+from pathlib import Path
+from typing import List
+
+import torch
+
+backend_path = Path(__file__).parent.parent.parent / "Backend"
+sys.path.insert(0, str(backend_path))
+
+from app.services.infrastructure.llm.generation_scheduler import (
+    GenerationParams,
+    GenerationScheduler,
+    SchedulerQueueFullError
+)
+
+VOCAB_SIZE = 4000
+EOS_ID = 2
+
+
+class CharTokenizer:
+    """每个 token 对应一个汉字，便于逐 token 校验输出"""
+
+    eos_token_id = EOS_ID
+
+    def decode(self, ids: List[int], skip_special_tokens: bool = True) -> str:
+        return "".join(chr(0x4E00 + int(token_id)) for token_id in ids if int(token_id) != EOS_ID)
+
+
+def build_model():
+    from transformers import LlamaConfig, LlamaForCausalLM
+
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=VOCAB_SIZE,
+        hidden_size=256,
+        intermediate_size=688,
+        num_hidden_layers=4,
+        num_attention_heads=8,
+        num_key_value_heads=4,
+        max_position_embeddings=1024,
+        eos_token_id=EOS_ID,
+        pad_token_id=EOS_ID
+    )
+    return LlamaForCausalLM(config).eval()
+
+
+def build_prompts(count: int, seed: int = 11) -> List[List[int]]:
+    rng = random.Random(seed)
+    return [[rng.randint(3, VOCAB_SIZE - 1) for _ in range(rng.randint(24, 160))] for _ in range(count)]
+
+
+def run_sequential(model, prompts: List[List[int]], max_new_tokens: int) -> List[List[int]]:
+    outputs = []
+    with torch.inference_mode():
+        for prompt in prompts:
+            input_ids = torch.tensor([prompt])
+            generated = model.generate(
+                input_ids,
+                attention_mask=torch.ones_like(input_ids),
+                max_new_tokens=max_new_tokens,
+                do_sample=False,
+                repetition_penalty=1.1,
+                pad_token_id=EOS_ID,
+                eos_token_id=EOS_ID
+            )
+            outputs.append([token for token in generated[0, len(prompt):].tolist() if token != EOS_ID])
+    return outputs
+
+
+async def run_scheduled(scheduler: GenerationScheduler, prompts: List[List[int]], max_new_tokens: int) -> List[List[int]]:
+    params = GenerationParams(max_new_tokens=max_new_tokens, temperature=0.0, repetition_penalty=1.1)
+
+    async def session(index: int, prompt: List[int]) -> List[int]:
+        # 错开到达时间，模拟会话在其他请求解码过程中加入
+        await asyncio.sleep(0.005 * index)
+        text = await scheduler.generate(prompt, params)
+        return [ord(char) - 0x4E00 for char in text]
+
+    return await asyncio.gather(*(session(index, prompt) for index, prompt in enumerate(prompts)))
+
+
+async def check_cancel_and_admission(model, max_new_tokens: int) -> None:
+    scheduler = GenerationScheduler(model, CharTokenizer(), max_batch_size=2, max_queue_depth=2, name="bench")
+    prompts = build_prompts(6, seed=5)
+    params = GenerationParams(max_new_tokens=max_new_tokens, temperature=0.7)
+
+    # 运行批次 2 + 等待队列 2：持续提交直到被拒绝
+    requests, rejected = [], 0
+    for prompt in prompts:
+        try:
+            requests.append(scheduler.submit(prompt, params))
+        except SchedulerQueueFullError:
+            rejected += 1
+
+    async def consume(request, stop_after: int = 0) -> int:
+        chunks = 0
+        stream = scheduler.stream(request)
+        async for _ in stream:
+            chunks += 1
+            if stop_after and chunks >= stop_after:
+                break
+        await stream.aclose()
+        return chunks
+
+    await asyncio.gather(consume(requests[0], stop_after=3), *(consume(request) for request in requests[1:]))
+    stats = scheduler.get_stats()
+    scheduler.shutdown("bench finished", wait=True)
+    print(f"cancel_and_admission: rejected={rejected}, cancelled={stats['cancelled']}, "
+          f"completed={stats['completed']}, queue_wait_ms_p95={stats['queue_wait_ms_p95']}")
+
+
+def main() -> None:
+    sessions = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    max_new_tokens = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+    max_batch_size = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+
+    model = build_model()
+    prompts = build_prompts(sessions)
+    run_sequential(model, prompts[:1], 4)  # 预热
+
+    start = time.perf_counter()
+    sequential = run_sequential(model, prompts, max_new_tokens)
+    sequential_seconds = time.perf_counter() - start
+    sequential_tokens = sum(len(tokens) for tokens in sequential)
+
+    scheduler = GenerationScheduler(model, CharTokenizer(), max_batch_size=max_batch_size, max_queue_depth=64, name="bench")
+    start = time.perf_counter()
+    scheduled = asyncio.run(run_scheduled(scheduler, prompts, max_new_tokens))
+    scheduled_seconds = time.perf_counter() - start
+    stats = scheduler.get_stats()
+    scheduler.shutdown("bench finished", wait=True)
+
+    matched = sum(1 for left, right in zip(sequential, scheduled) if left == right)
+    print(f"sessions={sessions}, max_new_tokens={max_new_tokens}, max_batch_size={max_batch_size}, "
+          f"threads={torch.get_num_threads()}")
+    print(f"{'mode':<12} {'seconds':>9} {'tokens':>8} {'tokens/s':>10}")
+    print(f"{'sequential':<12} {sequential_seconds:>9.2f} {sequential_tokens:>8} {sequential_tokens / sequential_seconds:>10.1f}")
+    print(f"{'scheduler':<12} {scheduled_seconds:>9.2f} {stats['generated_tokens']:>8} "
+          f"{stats['generated_tokens'] / scheduled_seconds:>10.1f}")
+    print(f"speedup={sequential_seconds / max(1e-6, scheduled_seconds):.1f}x, greedy_match={matched}/{sessions}, "
+          f"avg_batch_size={stats['avg_batch_size']}, ttft_ms_p50={stats['ttft_ms_p50']}, "
+          f"queue_wait_ms_p95={stats['queue_wait_ms_p95']}")
+
+    asyncio.run(check_cancel_and_admission(model, max_new_tokens))
+
+
+if __name__ == "__main__":
+    main()
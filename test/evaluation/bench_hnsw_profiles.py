@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""HNSW 索引档位基准：合成语料上的 recall@k 与查询延迟。
+
+用带聚类结构的随机单位向量模拟文本嵌入（同主题文本彼此接近），以暴力余弦 Top-k 为真值：
+1) 每个档位（含 Chroma 默认参数的早期集合 legacy）各建一个集合，记录建索引耗时；
+2) 以检索链路实际使用的 n_results（recall_k）查询，统计 recall@k 与单次查询 p50/p95 延迟；
+3) 对每个档位按次调高 search_ef（多取候选后截断），观察召回/延迟的变化，用于按知识库规模选择档位。
+
+用法: python bench_hnsw_profiles.py [corpus_size] [dim] [queries] [recall_k]
+示例: python bench_hnsw_profiles.py 20000 384 200 30
+"""
+
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+
+backend_path = Path(__file__).parent.parent.parent / "Backend"
+sys.path.insert(0, str(backend_path))
+
+from app.core.config import settings
+from app.services.infrastructure.retrieval.index_profiles import IndexProfile, list_index_profiles
+
+EF_SWEEP = [None, 128, 256, 512]
+
+
+def build_corpus(size: int, dim: int, queries: int, clusters: int = 200, seed: int = 7):
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim)).astype(np.float32)
+    labels = rng.integers(0, clusters, size=size)
+    corpus = centers[labels] + 0.9 * rng.standard_normal((size, dim)).astype(np.float32)
+    corpus /= np.linalg.norm(corpus, axis=1, keepdims=True)
+    picks = rng.integers(0, size, size=queries)
+    query_vectors = corpus[picks] + 0.6 * rng.standard_normal((queries, dim)).astype(np.float32) / np.sqrt(dim) * 4
+    query_vectors /= np.linalg.norm(query_vectors, axis=1, keepdims=True)
+    return corpus, query_vectors
+
+
+def exact_top_k(corpus: np.ndarray, queries: np.ndarray, k: int) -> List[set]:
+    scores = queries @ corpus.T
+    top = np.argpartition(-scores, k, axis=1)[:, :k]
+    return [set(int(index) for index in row) for row in top]
+
+
+def run_queries(vector_store, name: str, queries: np.ndarray, k: int, truth: List[set], search_ef: Optional[int]) -> Dict:
+    latencies = []
+    hits = 0
+    for row, query in enumerate(queries):
+        start = time.perf_counter()
+        result = vector_store.search(name, [query.tolist()], n_results=k, include=["distances"], search_ef=search_ef)
+        latencies.append((time.perf_counter() - start) * 1000)
+        hits += len({int(item) for item in result["ids"][0]} & truth[row])
+    latencies.sort()
+    return {
+        "recall": hits / (len(queries) * k),
+        "p50_ms": latencies[len(latencies) // 2],
+        "p95_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+    }
+
+
+def main() -> None:
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    dim = int(sys.argv[2]) if len(sys.argv) > 2 else 384
+    query_count = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+    recall_k = int(sys.argv[4]) if len(sys.argv) > 4 else 30
+
+    corpus, queries = build_corpus(size, dim, query_count)
+    truth = exact_top_k(corpus, queries, recall_k)
+
+    persist_dir = tempfile.mkdtemp(prefix="bench_hnsw_")
+    settings.vector_db.persist_dir = persist_dir
+    from app.services.infrastructure.retrieval.vector_store_service import VectorStoreService
+    vector_store = VectorStoreService()
+
+    profiles: Dict[str, Optional[IndexProfile]] = {"legacy": None}
+    profiles.update(list_index_profiles())
+    ids = [str(index) for index in range(size)]
+    print(f"corpus={size}, dim={dim}, queries={query_count}, recall_k={recall_k}")
+    print(f"{'profile':<12} {'M':>3} {'ef_c':>5} {'search_ef':>9} {'build_s':>8} {'recall@k':>9} {'p50_ms':>7} {'p95_ms':>7}")
+    try:
+        for profile_name, profile in profiles.items():
+            name = f"bench_{profile_name}"
+            start = time.perf_counter()
+            if profile is not None:
+                vector_store.ensure_collection(name, profile)
+            for offset in range(0, size, 2000):
+                vector_store.add_vectors(
+                    name,
+                    ids[offset:offset + 2000],
+                    corpus[offset:offset + 2000].tolist(),
+                    [""] * len(ids[offset:offset + 2000])
+                )
+            build_seconds = time.perf_counter() - start
+            actual = vector_store.get_index_profile(name)
+            run_queries(vector_store, name, queries[:10], recall_k, truth[:10], None)  # 预热
+            for search_ef in EF_SWEEP:
+                if search_ef is not None and search_ef <= max(actual.search_ef, recall_k):
+                    continue
+                stats = run_queries(vector_store, name, queries, recall_k, truth, search_ef)
+                ef_label = f"{search_ef}" if search_ef else f"{actual.search_ef}*"
+                print(f"{profile_name:<12} {actual.m:>3} {actual.construction_ef:>5} {ef_label:>9} "
+                      f"{build_seconds:>8.1f} {stats['recall']:>9.4f} {stats['p50_ms']:>7.2f} {stats['p95_ms']:>7.2f}")
+        print("* 集合默认 search_ef；其余行为单次查询调高的 ef")
+    finally:
+        shutil.rmtree(persist_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""关键词召回基准：LIKE 全表扫描 + Python 重打分 vs BM25 倒排索引。
+
+旧路径模拟 `_keyword_search` 的 LIKE 回退分支（逐行判断是否包含任一查询词，
+再对命中行做 count 重打分）；新路径为 KeywordIndexService（SQLite 倒排索引）。
+
+用法: python bench_keyword_index.py [chunks] [repeats]
+示例: python bench_keyword_index.py 20000 20
+"""
+
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+
+backend_path = Path(__file__).parent.parent.parent / "Backend"
+sys.path.insert(0, str(backend_path))
+
+from app.services.infrastructure.retrieval.keyword_index_service import KeywordIndexService
+
+VOCABULARY = [
+    "电源键", "开机", "指示灯", "充电", "电池", "蓝牙", "配对", "固件", "升级", "重置",
+    "网络", "连接", "设置", "屏幕", "亮度", "音量", "故障", "维修", "保修", "说明书",
+    "firmware", "bluetooth", "reset", "battery", "wifi", "v1.2", "error", "code", "p1127", "n47"
+]
+QUERIES = ["电源键 开机", "蓝牙配对失败", "固件升级 v1.2", "battery 充电 指示灯", "error code p1127"]
+
+
+def build_corpus(count: int, seed: int = 5) -> List[Dict[str, Any]]:
+    rng = random.Random(seed)
+    corpus = []
+    for index in range(count):
+        words = [rng.choice(VOCABULARY) for _ in range(rng.randint(20, 80))]
+        corpus.append({
+            "chunk_id": f"chunk_{index}",
+            "file_id": index // 200,
+            "chunk_index": index % 200,
+            "content": "，".join(words)
+        })
+    return corpus
+
+
+def legacy_keyword_search(corpus: List[Dict[str, Any]], query: str, top_k: int) -> List[str]:
+    tokens = [token for token in query.lower().split() if token]
+    scored = []
+    for row in corpus:
+        content_lower = row["content"].lower()
+        if not any(token in content_lower for token in tokens):
+            continue
+        hit_count = 0
+        tf_sum = 0.0
+        for token in tokens:
+            count = content_lower.count(token)
+            if count > 0:
+                hit_count += 1
+                tf_sum += min(3, count)
+        coverage = hit_count / len(tokens)
+        length_penalty = max(0.6, min(1.0, 300.0 / max(300.0, len(row["content"]))))
+        score = (0.7 * coverage + 0.3 * (tf_sum / (tf_sum + 2.0))) * length_penalty
+        scored.append((score, row["chunk_id"]))
+    scored.sort(reverse=True)
+    return [chunk_id for _, chunk_id in scored[:top_k]]
+
+
+def time_ms(func, repeats: int) -> float:
+    samples = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return samples[len(samples) // 2]
+
+
+def main() -> None:
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    top_k = 20
+    corpus = build_corpus(count)
+
+    service = KeywordIndexService(index_dir=tempfile.mkdtemp(prefix="bench_bm25_"))
+    start = time.perf_counter()
+    for offset in range(0, count, 500):
+        service.add_chunks(1, corpus[offset:offset + 500])
+    build_seconds = time.perf_counter() - start
+    print(f"chunks={count}, build={build_seconds:.2f}s, index={service.get_stats(1)}")
+
+    print(f"{'query':<24} {'legacy_p50_ms':>14} {'bm25_p50_ms':>12} {'speedup':>9}")
+    for query in QUERIES:
+        legacy_ms = time_ms(lambda: legacy_keyword_search(corpus, query, top_k), repeats)
+        bm25_ms = time_ms(lambda: service.search(1, query, top_k), repeats)
+        print(f"{query:<24} {legacy_ms:>14.2f} {bm25_ms:>12.2f} {legacy_ms / max(1e-6, bm25_ms):>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
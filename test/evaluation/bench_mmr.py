@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""MMR 重排微基准。
+
+对比旧实现（纯 Python 循环，逐对计算余弦）与 app.utils.similarity.mmr_select
+（一次矩阵乘 + 增量最大相似度）在不同候选规模下的耗时，并校验两者排序一致。
+旧实现随候选数近似立方增长（n=200 单次约 100s），因此只计时一次，且超过 LEGACY_MAX_COUNT 时跳过。
+
+用法: python bench_mmr.py [dimension] [repeats] [sizes...]
+示例: python bench_mmr.py 1024 5 25 50 100 400
+"""
+
+import sys
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+
+backend_path = Path(__file__).parent.parent.parent / "Backend"
+sys.path.insert(0, str(backend_path))
+
+import numpy as np
+
+import app.core.config  # noqa: F401  先初始化 app.core，避免 app.utils -> logger -> app.core 循环导入
+from app.utils.similarity import mmr_select
+
+LAMBDA = 0.7
+LEGACY_MAX_COUNT = 100
+
+
+def legacy_mmr(candidates: List[Dict[str, Any]], lambda_value: float, target_count: int) -> List[int]:
+    """改造前的 KnowledgeBaseService._apply_mmr 核心循环"""
+
+    def cosine(vec_a: List[float], vec_b: List[float]) -> float:
+        if len(vec_a) == 0 or len(vec_b) == 0 or len(vec_a) != len(vec_b):
+            return 0.0
+        dot = sum(a * b for a, b in zip(vec_a, vec_b))
+        return max(-1.0, min(1.0, dot))
+
+    selected: List[Dict[str, Any]] = []
+    remaining = candidates.copy()
+    while remaining and len(selected) < target_count:
+        best_idx = 0
+        best_score = -1e9
+        for index, candidate in enumerate(remaining):
+            relevance = candidate['similarity']
+            diversity_penalty = 0.0
+            if selected:
+                diversity_penalty = max(cosine(candidate['_embedding'], chosen['_embedding']) for chosen in selected)
+            mmr_score = lambda_value * relevance - (1 - lambda_value) * diversity_penalty
+            if mmr_score > best_score:
+                best_score = mmr_score
+                best_idx = index
+        selected.append(remaining.pop(best_idx))
+    selected.extend(remaining)
+    return [item['index'] for item in selected]
+
+
+def build_candidates(count: int, dimension: int, seed: int = 7) -> List[Dict[str, Any]]:
+    rng = np.random.default_rng(seed)
+    vectors = rng.standard_normal((count, dimension)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    relevance = rng.uniform(0.2, 0.9, size=count)
+    return [
+        {'index': index, 'similarity': float(relevance[index]), '_embedding': vectors[index].tolist()}
+        for index in range(count)
+    ]
+
+
+def time_ms(func, repeats: int) -> float:
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        best = min(best, (time.perf_counter() - start) * 1000)
+    return best
+
+
+def main() -> None:
+    dimension = int(sys.argv[1]) if len(sys.argv) > 1 else 1024
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    sizes = [int(value) for value in sys.argv[3:]] or [25, 50, 100, 400]
+
+    print(f"dimension={dimension}, lambda={LAMBDA}, repeats={repeats} (numpy 取最优，旧实现单次，n>{LEGACY_MAX_COUNT} 跳过)")
+    print(f"{'n':>6} {'target':>7} {'legacy_ms':>11} {'numpy_ms':>10} {'speedup':>9} {'same_order':>11}")
+    for count in sizes:
+        candidates = build_candidates(count, dimension)
+        target_count = count
+        relevance = [item['similarity'] for item in candidates]
+        embeddings = [item['_embedding'] for item in candidates]
+
+        numpy_order = mmr_select(relevance, embeddings, LAMBDA, target_count)
+        numpy_ms = time_ms(lambda: mmr_select(relevance, embeddings, LAMBDA, target_count), repeats)
+        if count > LEGACY_MAX_COUNT:
+            print(f"{count:>6} {target_count:>7} {'-':>11} {numpy_ms:>10.2f} {'-':>9} {'-':>11}")
+            continue
+
+        start = time.perf_counter()
+        legacy_order = legacy_mmr(candidates, LAMBDA, target_count)
+        legacy_ms = (time.perf_counter() - start) * 1000
+        speedup = legacy_ms / max(1e-6, numpy_ms)
+        print(
+            f"{count:>6} {target_count:>7} {legacy_ms:>11.2f} {numpy_ms:>10.2f} "
+            f"{speedup:>8.1f}x {str(legacy_order == numpy_order):>11}"
+        )
+
+
+if __name__ == "__main__":
+    main()
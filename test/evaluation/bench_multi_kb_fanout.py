@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""多知识库混合检索并发基准：N 个知识库并发检索的总耗时应接近最慢的单库，而不是各库之和。
+
+用带阻塞延迟的假嵌入/假向量库替换真实依赖（time.sleep 模拟模型编码与 Chroma 查询），
+按 ChatService._hybrid_search 的方式对每个知识库 asyncio.gather + wait_for：
+1) 无超时：总耗时与各库耗时之和、最慢单库耗时对比；
+2) 最后一个知识库设为慢库且开启单库超时：慢库应在超时附近被丢弃，其余结果照常返回。
+
+用法: python bench_multi_kb_fanout.py [kb_count] [embed_ms] [search_ms] [slow_search_ms] [timeout_s]
+示例: python bench_multi_kb_fanout.py 5 40 80 2000 0.5
+"""
+
+import asyncio
+import sys
+import time
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Dict, List
+
+import numpy as np
+
+backend_path = Path(__file__).parent.parent.parent / "Backend"
+sys.path.insert(0, str(backend_path))
+
+from app.services.infrastructure.retrieval.hybrid_retrieval_service import HybridRetrievalService
+from app.services.infrastructure.retrieval.index_profiles import IndexProfile
+
+
+class SleepyEmbedding:
+    def __init__(self, delay_s: float):
+        self.delay_s = delay_s
+
+    def encode_array(self, texts: List[str], model_name=None, provider=None, text_role=None) -> np.ndarray:
+        time.sleep(self.delay_s)
+        return np.zeros((len(texts), 8), dtype=np.float32)
+
+
+class SleepyVectorStore:
+    def __init__(self, delays: Dict[str, float]):
+        self.delays = delays
+
+    def get_index_profile(self, collection_name: str) -> IndexProfile:
+        return IndexProfile.from_metadata(None)
+
+    def search(self, collection_name: str, query_embeddings, n_results: int = 5) -> Dict[str, Any]:
+        time.sleep(self.delays[collection_name])
+        rows = len(query_embeddings)
+        return {
+            "ids": [[f"{collection_name}_{row}_{i}" for i in range(n_results)] for row in range(rows)],
+            "documents": [[f"{collection_name} 文本块 {i}" for i in range(n_results)] for _ in range(rows)],
+            "metadatas": [[{"chunk_index": i} for i in range(n_results)] for _ in range(rows)],
+            "distances": [[0.1 * (i + 1) for i in range(n_results)] for _ in range(rows)],
+        }
+
+
+class FakeKbService:
+    async def get_knowledge_base(self, kb_id: int):
+        return SimpleNamespace(id=kb_id, embedding_model="fake", embedding_provider="fake")
+
+
+def build_service(kb_count: int, embed_s: float, search_s: float, slow_search_s: float) -> HybridRetrievalService:
+    delays = {f"kb_{kb_id}": search_s for kb_id in range(1, kb_count + 1)}
+    if slow_search_s > 0:
+        delays[f"kb_{kb_count}"] = slow_search_s
+    service = HybridRetrievalService(
+        vector_store=SleepyVectorStore(delays),
+        graph_service=object(),
+        entity_service=object(),
+        embedding_service=SleepyEmbedding(embed_s)
+    )
+    service._kb_service = FakeKbService()
+
+    async def no_keyword(kb_id: int, query: str, top_k: int) -> List[Dict[str, Any]]:
+        return []
+
+    service._keyword_search = no_keyword
+    service._record_hybrid_metrics = lambda payload: None
+    return service
+
+
+async def fan_out(service: HybridRetrievalService, kb_ids: List[int], timeout: float):
+    """与 ChatService._hybrid_search 相同的并发/超时策略"""
+
+    async def search_one(kb_id: int) -> Dict[str, Any]:
+        search = service.hybrid_search(kb_id=kb_id, query="如何配置混合检索", top_k=5, enable_graph=False)
+        if timeout > 0:
+            return await asyncio.wait_for(search, timeout=timeout)
+        return await search
+
+    start = time.perf_counter()
+    payloads = await asyncio.gather(*[search_one(kb_id) for kb_id in kb_ids], return_exceptions=True)
+    elapsed = time.perf_counter() - start
+    dropped = [kb_id for kb_id, payload in zip(kb_ids, payloads) if isinstance(payload, BaseException)]
+    returned = sum(len(payload.get("results", [])) for payload in payloads if not isinstance(payload, BaseException))
+    return elapsed, dropped, returned
+
+
+async def main() -> None:
+    kb_count = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    embed_s = (float(sys.argv[2]) if len(sys.argv) > 2 else 40) / 1000
+    search_s = (float(sys.argv[3]) if len(sys.argv) > 3 else 80) / 1000
+    slow_search_s = (float(sys.argv[4]) if len(sys.argv) > 4 else 2000) / 1000
+    timeout = float(sys.argv[5]) if len(sys.argv) > 5 else 0.5
+    kb_ids = list(range(1, kb_count + 1))
+    per_kb_s = embed_s + search_s
+    print(f"kb_count={kb_count}, embed={embed_s * 1000:.0f}ms, search={search_s * 1000:.0f}ms, "
+          f"slow_search={slow_search_s * 1000:.0f}ms, timeout={timeout}s")
+
+    service = build_service(kb_count, embed_s, search_s, 0)
+    await fan_out(service, kb_ids[:1], 0)
+    elapsed, dropped, returned = await fan_out(service, kb_ids, 0)
+    print(f"\n[无超时] total={elapsed * 1000:.0f}ms, 单库≈{per_kb_s * 1000:.0f}ms, "
+          f"串行之和≈{per_kb_s * kb_count * 1000:.0f}ms, results={returned}")
+    parallel_ok = elapsed < per_kb_s * min(kb_count, 2)
+    print(f"  总耗时接近最慢单库: {'通过' if parallel_ok else '未通过'}")
+
+    service = build_service(kb_count, embed_s, search_s, slow_search_s)
+    elapsed, dropped, returned = await fan_out(service, kb_ids, timeout)
+    print(f"\n[慢库 + 超时] total={elapsed * 1000:.0f}ms, dropped={dropped}, results={returned}")
+    timeout_ok = dropped == [kb_count] and elapsed < timeout + per_kb_s
+    print(f"  慢库在超时附近被丢弃: {'通过' if timeout_ok else '未通过'}")
+
+    if not (parallel_ok and timeout_ok):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
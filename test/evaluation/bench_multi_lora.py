@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""多 LoRA 共享基座模型基准：内存占用、Adapter 切换耗时与混合批次吞吐。
+
+用随机初始化的小型 Llama 模型与 N 个随机 LoRA Adapter：
+1) 对比"每个 LoRA 独占一份基座模型"与"N 个 Adapter 共享一个基座模型"的参数内存；
+2) 首次加载 Adapter 与已加载 Adapter 再次使用（切换）的耗时；
+3) 不同 Adapter 的并发请求在同一批次解码（PEFT adapter_names），贪心输出与各自独立模型逐个生成一致；
+4) Adapter 数超过上限时只淘汰 Adapter 权重，基座模型保持不变。
+
+用法: python bench_multi_lora.py [adapters] [max_new_tokens]
+示例: python bench_multi_lora.py 4 32
+"""
+
+import asyncio
+import copy
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import List
+
+import torch
+
+backend_path = Path(__file__).parent.parent.parent / "Backend"
+sys.path.insert(0, str(backend_path))
+
+from peft import LoraConfig, PeftModel, get_peft_model
+
+from app.services.infrastructure.llm.generation_scheduler import GenerationParams
+from app.services.infrastructure.lora.multi_adapter_manager import MultiAdapterModel
+from bench_generation_scheduler import EOS_ID, CharTokenizer, build_model, build_prompts
+
+
+def module_bytes(module) -> int:
+    return sum(parameter.numel() * parameter.element_size() for parameter in module.parameters())
+
+
+def save_random_adapters(base, count: int, root: Path) -> List[str]:
+    paths = []
+    for index in range(count):
+        torch.manual_seed(100 + index)
+        config = LoraConfig(
+            r=16,
+            lora_alpha=32,
+            target_modules=["q_proj", "k_proj", "v_proj", "o_proj"],
+            init_lora_weights=False
+        )
+        peft_model = get_peft_model(copy.deepcopy(base), config)
+        path = root / f"lora_{index}"
+        peft_model.save_pretrained(str(path))
+        paths.append(str(path))
+    return paths
+
+
+def reference_outputs(base, paths: List[str], prompts: List[List[int]], max_new_tokens: int) -> List[List[int]]:
+    """每个 LoRA 独占一份基座模型，逐个生成（原有方式的等价实现）"""
+    outputs = []
+    with torch.inference_mode():
+        for path, prompt in zip(paths, prompts):
+            model = PeftModel.from_pretrained(copy.deepcopy(base), path).eval()
+            input_ids = torch.tensor([prompt])
+            generated = model.generate(
+                input_ids=input_ids,
+                attention_mask=torch.ones_like(input_ids),
+                max_new_tokens=max_new_tokens,
+                do_sample=False,
+                repetition_penalty=1.1,
+                pad_token_id=EOS_ID,
+                eos_token_id=EOS_ID
+            )
+            outputs.append([token for token in generated[0, len(prompt):].tolist() if token != EOS_ID])
+    return outputs
+
+
+async def mixed_batch_outputs(shared: MultiAdapterModel, slots, prompts, max_new_tokens: int) -> List[List[int]]:
+    params = GenerationParams(max_new_tokens=max_new_tokens, temperature=0.0, repetition_penalty=1.1)
+    scheduler = shared.get_scheduler()
+
+    async def one(slot, prompt):
+        with shared.lease(slot):
+            text = await scheduler.generate(prompt, params, adapter_name=slot.name, cache_namespace=slot.cache_namespace)
+        return [ord(char) - 0x4E00 for char in text]
+
+    return await asyncio.gather(*(one(slot, prompt) for slot, prompt in zip(slots, prompts)))
+
+
+def main() -> None:
+    adapters = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    max_new_tokens = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+
+    base = build_model()
+    base_bytes = module_bytes(base)
+    prompts = build_prompts(adapters, seed=21)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = save_random_adapters(base, adapters, Path(tmp))
+        expected = reference_outputs(base, paths, prompts, max_new_tokens)
+
+        shared = MultiAdapterModel("bench-base", copy.deepcopy(base), CharTokenizer(), max_adapters=adapters, max_batch_size=adapters)
+        load_ms = []
+        for index, path in enumerate(paths):
+            start = time.perf_counter()
+            shared.release_adapter(shared.ensure_adapter(index, path))
+            load_ms.append((time.perf_counter() - start) * 1000)
+        start = time.perf_counter()
+        slots = [shared.ensure_adapter(index, path) for index, path in enumerate(paths)]
+        switch_ms = (time.perf_counter() - start) * 1000 / adapters
+        for slot in slots:
+            shared.release_adapter(slot)
+
+        adapter_bytes = sum(slot.nbytes for slot in slots)
+        print(f"adapters={adapters}, base_mb={base_bytes / 1024 ** 2:.1f}, adapters_mb={adapter_bytes / 1024 ** 2:.2f}")
+        print(f"memory: one_base_per_lora={(adapters * base_bytes + adapter_bytes) / 1024 ** 2:.1f}MB, "
+              f"shared_base={(base_bytes + adapter_bytes) / 1024 ** 2:.1f}MB")
+        print(f"adapter_first_load_ms_avg={sum(load_ms) / len(load_ms):.1f}, adapter_switch_ms_avg={switch_ms:.3f}")
+
+        start = time.perf_counter()
+        reference_outputs(base, paths, prompts, max_new_tokens)
+        sequential_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        mixed = asyncio.run(mixed_batch_outputs(shared, slots, prompts, max_new_tokens))
+        mixed_seconds = time.perf_counter() - start
+        stats = shared.get_stats()["scheduler"]
+        matched = sum(1 for left, right in zip(expected, mixed) if left == right)
+        print(f"sequential_per_lora_s={sequential_seconds:.2f} (含逐个包装模型), mixed_batch_s={mixed_seconds:.2f}, "
+              f"avg_batch_size={stats['avg_batch_size']}, greedy_match={matched}/{adapters}")
+
+        # 超过上限：只淘汰最久未用的 Adapter 权重，基座参数不变
+        base_params_before = sum(1 for name, _ in shared.peft_model.named_parameters() if "lora_" not in name)
+        shared.max_adapters = max(1, adapters - 1)
+        extra = shared.ensure_adapter(adapters, paths[0])
+        shared.release_adapter(extra)
+        base_params_after = sum(1 for name, _ in shared.peft_model.named_parameters() if "lora_" not in name)
+        print(f"eviction: loaded={[slot['name'] for slot in shared.get_stats()['adapters']]}, "
+              f"evictions={shared.evictions}, base_params_unchanged={base_params_before == base_params_after}, "
+              f"new_adapter={extra.name}")
+        shared.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Ollama 嵌入吞吐基准：逐条 /api/embeddings vs 批量 /api/embed。
+
+在本地启动一个模拟 Ollama 的 HTTP 服务（每次请求固定开销 request_ms + 每条文本计算 per_text_ms），
+分别用逐条模式与批量模式编码同一批文本，对比耗时、请求数，并校验两种模式的向量一致。
+同时验证：旧版服务（无 /api/embed）自动回退逐条接口；子批次 500 时只重试该子批次；
+模型不存在（404 + {"error": ...}）时直接报错，且不会因此关闭批量接口。
+
+用法: python bench_ollama_embed_batch.py [texts] [request_ms] [per_text_ms]
+示例: python bench_ollama_embed_batch.py 5000 3 0.2
+"""
+
+import hashlib
+import json
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+
+backend_path = Path(__file__).parent.parent.parent / "Backend"
+sys.path.insert(0, str(backend_path))
+
+from app.services.infrastructure.embedding.ollama_embedding_service import OllamaEmbeddingService
+from app.services.infrastructure.llm.ollama_http_client import get_ollama_http_client
+
+DIMENSION = 256
+MISSING_MODEL = "not-pulled-embed"
+WORDS = ["电源键", "开机", "指示灯", "充电", "蓝牙", "配对", "固件", "升级", "battery", "reset", "wifi", "error"]
+
+
+def fake_embedding(text: str) -> List[float]:
+    seed = int(hashlib.md5(text.encode("utf-8")).hexdigest()[:8], 16)
+    return np.random.default_rng(seed).standard_normal(DIMENSION).astype(np.float32).tolist()
+
+
+def start_stand_in_server(request_ms: float, per_text_ms: float, legacy: bool = False, fail_batches: int = 0):
+    stats: Dict[str, int] = {"embed": 0, "embeddings": 0, "failed": 0}
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        def _reply(self, status: int, payload: Dict) -> None:
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _reply_text(self, status: int, text: str) -> None:
+            body = text.encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "text/plain")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            self._reply(200, {"models": []})
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            if self.path == "/api/embed" and legacy:
+                # 旧版 Ollama 的路由器对未知路由返回纯文本 404
+                self._reply_text(404, "404 page not found")
+                return
+            if body.get("model") == MISSING_MODEL:
+                self._reply(404, {"error": f'model "{MISSING_MODEL}" not found, try pulling it first'})
+                return
+            if self.path == "/api/embed":
+                with lock:
+                    stats["embed"] += 1
+                    should_fail = stats["failed"] < fail_batches
+                    if should_fail:
+                        stats["failed"] += 1
+                if should_fail:
+                    self._reply(500, {"error": "injected failure"})
+                    return
+                inputs = body["input"]
+                time.sleep((request_ms + per_text_ms * len(inputs)) / 1000)
+                self._reply(200, {"embeddings": [fake_embedding(text) for text in inputs]})
+            elif self.path == "/api/embeddings":
+                with lock:
+                    stats["embeddings"] += 1
+                time.sleep((request_ms + per_text_ms) / 1000)
+                self._reply(200, {"embedding": fake_embedding(body["prompt"])})
+            else:
+                self._reply_text(404, "404 page not found")
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, stats
+
+
+def make_service(port: int, batch_enabled: bool) -> OllamaEmbeddingService:
+    service = OllamaEmbeddingService()
+    service.base_url = f"http://127.0.0.1:{port}"
+    service.http = get_ollama_http_client(service.base_url, timeout=30)
+    service.batch_enabled = batch_enabled
+    service._batch_supported = None
+    return service
+
+
+def build_texts(count: int, seed: int = 7) -> List[str]:
+    rng = random.Random(seed)
+    return ["，".join(rng.choice(WORDS) for _ in range(rng.randint(20, 120))) + f" #{index}" for index in range(count)]
+
+
+def main() -> None:
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    request_ms = float(sys.argv[2]) if len(sys.argv) > 2 else 3.0
+    per_text_ms = float(sys.argv[3]) if len(sys.argv) > 3 else 0.2
+    texts = build_texts(count)
+
+    server, stats = start_stand_in_server(request_ms, per_text_ms)
+    port = server.server_address[1]
+
+    rows = []
+    matrices = {}
+    for mode, batch_enabled in (("per_text", False), ("batch", True)):
+        service = make_service(port, batch_enabled)
+        before = dict(stats)
+        start = time.perf_counter()
+        matrices[mode] = service.encode_array(texts, "stand-in-embed", batch_size=64)
+        seconds = time.perf_counter() - start
+        requests_sent = (stats["embed"] - before["embed"]) + (stats["embeddings"] - before["embeddings"])
+        rows.append((mode, seconds, requests_sent, count / seconds))
+    server.shutdown()
+
+    print(f"texts={count}, request_ms={request_ms}, per_text_ms={per_text_ms}")
+    print(f"{'mode':<10} {'seconds':>9} {'requests':>9} {'texts/s':>10}")
+    for mode, seconds, requests_sent, throughput in rows:
+        print(f"{mode:<10} {seconds:>9.2f} {requests_sent:>9} {throughput:>10.1f}")
+    print(f"speedup={rows[0][1] / max(1e-6, rows[1][1]):.1f}x, "
+          f"max_abs_diff={float(np.max(np.abs(matrices['per_text'] - matrices['batch']))):.2e}")
+
+    # 旧版服务：/api/embed 返回 404，自动回退逐条接口
+    legacy_server, legacy_stats = start_stand_in_server(request_ms, per_text_ms, legacy=True)
+    legacy_service = make_service(legacy_server.server_address[1], True)
+    legacy_matrix = legacy_service.encode_array(texts[:50], "stand-in-embed", batch_size=64)
+    legacy_server.shutdown()
+    print(f"legacy_fallback: ok={np.allclose(legacy_matrix, matrices['batch'][:50])}, "
+          f"per_text_requests={legacy_stats['embeddings']}, batch_supported={legacy_service._batch_supported}")
+
+    # 模型不存在：404 + {"error": ...} 直接报错，批量接口保持可用
+    missing_server, missing_stats = start_stand_in_server(request_ms, per_text_ms)
+    missing_service = make_service(missing_server.server_address[1], True)
+    try:
+        missing_service.encode_array(texts[:10], MISSING_MODEL, batch_size=64)
+        missing_raised = False
+    except RuntimeError:
+        missing_raised = True
+    missing_matrix = missing_service.encode_array(texts[:10], "stand-in-embed", batch_size=64)
+    missing_server.shutdown()
+    print(f"missing_model: raised={missing_raised}, batch_supported={missing_service._batch_supported}, "
+          f"next_model_ok={np.allclose(missing_matrix, matrices['batch'][:10])}, "
+          f"per_text_requests={missing_stats['embeddings']}")
+
+    # 子批次失败：只重试失败的子批次
+    flaky_server, flaky_stats = start_stand_in_server(request_ms, per_text_ms, fail_batches=1)
+    flaky_service = make_service(flaky_server.server_address[1], True)
+    flaky_matrix = flaky_service.encode_array(texts[:640], "stand-in-embed", batch_size=64)
+    flaky_server.shutdown()
+    planned = len(flaky_service._plan_batches(texts[:640], 64))
+    print(f"retry_failed_sub_batch: ok={np.allclose(flaky_matrix, matrices['batch'][:640])}, "
+          f"sub_batches={planned}, embed_requests={flaky_stats['embed']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""前缀 KV Cache 基准：多轮对话下 prefill 耗时（首 token 延迟）对比。
+
+用随机初始化的小型 Llama 模型模拟多轮会话：每轮 prompt = 系统提示词 + 历史问答 + 本轮问题，
+历史回答后追加轮次分隔 token（模拟对话模板）。分别在关闭/开启前缀缓存的调度器上运行，
+按轮次统计 prompt 长度、复用 token 数与首 token 延迟，并校验贪心解码输出一致。
+
+用法: python bench_prefix_cache.py [sessions] [turns] [system_tokens]
+示例: python bench_prefix_cache.py 2 6 512
+"""
+
+import asyncio
+import random
+import sys
+from pathlib import Path
+from typing import Dict, List
+
+backend_path = Path(__file__).parent.parent.parent / "Backend"
+sys.path.insert(0, str(backend_path))
+
+from app.services.infrastructure.llm.generation_scheduler import GenerationParams, GenerationScheduler
+from app.services.infrastructure.llm.prefix_cache import PrefixKVCache
+from bench_generation_scheduler import VOCAB_SIZE, CharTokenizer, build_model
+
+QUESTION_TOKENS = 48
+ANSWER_TOKENS = 32
+TURN_SEPARATOR = [7, 8]
+
+
+async def run_conversations(
+    scheduler: GenerationScheduler,
+    sessions: int,
+    turns: int,
+    system_tokens: int
+) -> Dict[str, List]:
+    params = GenerationParams(max_new_tokens=ANSWER_TOKENS, temperature=0.0, repetition_penalty=1.1)
+    rng = random.Random(3)
+    system_prompt = [rng.randint(10, VOCAB_SIZE - 1) for _ in range(system_tokens)]
+    questions = [
+        [[rng.randint(10, VOCAB_SIZE - 1) for _ in range(QUESTION_TOKENS)] for _ in range(turns)]
+        for _ in range(sessions)
+    ]
+    per_turn: Dict[int, List[Dict]] = {turn: [] for turn in range(turns)}
+    answers: List[List[List[int]]] = [[] for _ in range(sessions)]
+
+    async def conversation(session: int) -> None:
+        history: List[int] = []
+        for turn in range(turns):
+            prompt = system_prompt + history + questions[session][turn]
+            request = scheduler.submit(prompt, params)
+            text = "".join([chunk async for chunk in scheduler.stream(request)])
+            answer = [ord(char) - 0x4E00 for char in text]
+            answers[session].append(answer)
+            per_turn[turn].append(request.metrics())
+            history = history + questions[session][turn] + answer + TURN_SEPARATOR
+
+    await asyncio.gather(*(conversation(session) for session in range(sessions)))
+    return {"per_turn": per_turn, "answers": answers}
+
+
+def main() -> None:
+    sessions = int(sys.argv[1]) if len(sys.argv) > 1 else 2
+    turns = int(sys.argv[2]) if len(sys.argv) > 2 else 6
+    system_tokens = int(sys.argv[3]) if len(sys.argv) > 3 else 512
+
+    model = build_model()
+    results = {}
+    stats = {}
+    for mode in ("no_cache", "prefix_cache"):
+        prefix_cache = PrefixKVCache(max_bytes=256 * 1024 ** 2, block_size=32, min_prefix_tokens=64) \
+            if mode == "prefix_cache" else None
+        scheduler = GenerationScheduler(model, CharTokenizer(), max_batch_size=4, name=mode, prefix_cache=prefix_cache)
+        asyncio.run(run_conversations(scheduler, 1, 1, 64))  # 预热，随后清空缓存
+        if prefix_cache is not None:
+            prefix_cache.clear()
+        results[mode] = asyncio.run(run_conversations(scheduler, sessions, turns, system_tokens))
+        stats[mode] = scheduler.get_stats()
+        scheduler.shutdown("bench finished", wait=True)
+
+    print(f"sessions={sessions}, turns={turns}, system_tokens={system_tokens}")
+    print(f"{'turn':>4} {'prompt':>7} {'cached':>7} {'ttft_no_cache_ms':>17} {'ttft_cached_ms':>15} {'speedup':>8}")
+    for turn in range(turns):
+        base = results["no_cache"]["per_turn"][turn]
+        cached = results["prefix_cache"]["per_turn"][turn]
+        prompt = sum(item["prompt_tokens"] for item in cached) / len(cached)
+        reused = sum(item["cached_tokens"] for item in cached) / len(cached)
+        base_ttft = sum(item["ttft_ms"] for item in base) / len(base)
+        cached_ttft = sum(item["ttft_ms"] for item in cached) / len(cached)
+        print(f"{turn + 1:>4} {prompt:>7.0f} {reused:>7.0f} {base_ttft:>17.1f} {cached_ttft:>15.1f} "
+              f"{base_ttft / max(1e-6, cached_ttft):>7.1f}x")
+
+    matched = results["no_cache"]["answers"] == results["prefix_cache"]["answers"]
+    cache_stats = stats["prefix_cache"]["prefix_cache"]
+    print(f"greedy_match={matched}, hit_rate={cache_stats['hit_rate']}, "
+          f"reused_token_ratio={cache_stats['reused_token_ratio']}, entries={cache_stats['entries']}, "
+          f"memory_mb={cache_stats['memory_mb']}")
+
+
+if __name__ == "__main__":
+    main()
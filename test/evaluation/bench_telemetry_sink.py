@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""遥测写入基准：请求路径同步追加 JSONL 与缓冲遥测汇聚的单次记录耗时对比。
+
+多个线程模拟并发请求，每个请求记录一条与检索指标同规模的事件：
+1) sync：每条事件打开文件、追加一行、关闭（原实现）；
+2) buffered：TelemetrySink.record 入环形缓冲，由后台线程批量写入；
+统计单次记录 p50/p99（微秒）、总吞吐，并核对写入行数（含轮转文件）。
+
+用法: python bench_telemetry_sink.py [threads] [events_per_thread]
+示例: python bench_telemetry_sink.py 8 5000
+"""
+
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List
+
+backend_path = Path(__file__).parent.parent.parent / "Backend"
+sys.path.insert(0, str(backend_path))
+
+from app.services.infrastructure.telemetry.telemetry_sink import TelemetrySink
+
+
+def make_payload(index: int) -> Dict:
+    return {
+        "timestamp": "2026-01-01T00:00:00",
+        "scope": "single_kb",
+        "kb_id": index % 7,
+        "query": "如何配置混合检索的关键词权重" * 2,
+        "query_variants": ["如何配置混合检索的关键词权重", "混合检索 关键词权重 配置"],
+        "top_k": 5,
+        "candidate_count": 40,
+        "returned_count": 5,
+        "elapsed_ms": 120 + index % 50,
+    }
+
+
+def run(threads: int, events: int, record) -> Dict[str, float]:
+    latencies: List[List[float]] = [[] for _ in range(threads)]
+
+    def worker(slot: int) -> None:
+        for index in range(events):
+            payload = make_payload(index)
+            start = time.perf_counter()
+            record(payload)
+            latencies[slot].append((time.perf_counter() - start) * 1e6)
+
+    start = time.perf_counter()
+    pool = [threading.Thread(target=worker, args=(slot,)) for slot in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    merged = sorted(value for chunk in latencies for value in chunk)
+    return {
+        "events_per_s": len(merged) / elapsed,
+        "p50_us": merged[len(merged) // 2],
+        "p99_us": merged[min(len(merged) - 1, int(len(merged) * 0.99))],
+    }
+
+
+def count_lines(directory: str) -> int:
+    return sum(sum(1 for _ in path.open(encoding="utf-8")) for path in Path(directory).glob("*.jsonl*"))
+
+
+def main() -> None:
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    events = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    print(f"threads={threads}, events_per_thread={events}")
+    print(f"{'mode':<10} {'events/s':>10} {'p50_us':>8} {'p99_us':>8} {'lines':>8} {'dropped':>8}")
+
+    sync_dir = tempfile.mkdtemp(prefix="bench_telemetry_sync_")
+    buffered_dir = tempfile.mkdtemp(prefix="bench_telemetry_buffered_")
+    try:
+        sync_sink = TelemetrySink(buffered=False, max_file_bytes=0, rotate_interval_hours=0)
+        sync_file = str(Path(sync_dir) / "retrieval_metrics.jsonl")
+        stats = run(threads, events, lambda payload: sync_sink.record("retrieval", sync_file, payload))
+        print(f"{'sync':<10} {stats['events_per_s']:>10.0f} {stats['p50_us']:>8.1f} {stats['p99_us']:>8.1f} "
+              f"{count_lines(sync_dir):>8} {0:>8}")
+
+        sink = TelemetrySink(buffered=True, buffer_size=threads * events, max_file_bytes=4 * 1024 * 1024, backup_count=10)
+        buffered_file = str(Path(buffered_dir) / "retrieval_metrics.jsonl")
+        stats = run(
+            threads,
+            events,
+            lambda payload: sink.record("retrieval", buffered_file, payload, observations={"retrieval.single_kb": payload["elapsed_ms"]})
+        )
+        sink.shutdown()
+        sink_stats = sink.get_stats()
+        print(f"{'buffered':<10} {stats['events_per_s']:>10.0f} {stats['p50_us']:>8.1f} {stats['p99_us']:>8.1f} "
+              f"{count_lines(buffered_dir):>8} {sink_stats['dropped']:>8}")
+        print(f"flushes={sink_stats['flushes']}, rotations={sink_stats['rotations']}, "
+              f"latency={sink.get_histograms()['retrieval.single_kb']}")
+    finally:
+        shutil.rmtree(sync_dir, ignore_errors=True)
+        shutil.rmtree(buffered_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""候选向量表示基准：Python float 列表 vs float32 矩阵行视图。
+
+模拟一次检索后处理：格式化候选（挂载 _embedding）-> 重排阶段 dict 复制 -> MMR，
+分别统计两种表示的内存占用（tracemalloc 峰值）与耗时。
+
+用法: python bench_vector_repr.py [candidates] [dimension] [repeats]
+示例: python bench_vector_repr.py 200 1024 20
+"""
+
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+
+backend_path = Path(__file__).parent.parent.parent / "Backend"
+sys.path.insert(0, str(backend_path))
+
+import numpy as np
+
+import app.core.config  # noqa: F401  先初始化 app.core，避免 app.utils -> logger -> app.core 循环导入
+from app.utils.similarity import mmr_select
+
+
+def fake_chroma_rows(count: int, dimension: int, seed: int = 11) -> Dict[str, Any]:
+    rng = np.random.default_rng(seed)
+    vectors = rng.standard_normal((count, dimension)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return {
+        "ids": [f"chunk_{index}" for index in range(count)],
+        "documents": [f"文档内容 {index}" for index in range(count)],
+        "distances": rng.uniform(0.3, 1.2, size=count).tolist(),
+        "embeddings": vectors
+    }
+
+
+def build_candidates(rows: Dict[str, Any], as_float32: bool) -> List[Dict[str, Any]]:
+    embeddings = rows["embeddings"]
+    if as_float32:
+        row_source = np.asarray(embeddings, dtype=np.float32)
+    else:
+        # 旧表示：每个候选持有独立的 Python float 列表
+        row_source = embeddings.tolist()
+    return [
+        {
+            "chunk_id": rows["ids"][index],
+            "content": rows["documents"][index],
+            "similarity": 1 - rows["distances"][index] ** 2 / 2,
+            "metadata": {"kb_id": 1, "file_id": 1, "chunk_index": index},
+            "_embedding": row_source[index]
+        }
+        for index in range(len(rows["ids"]))
+    ]
+
+
+def postprocess(candidates: List[Dict[str, Any]], top_k: int) -> List[int]:
+    # 轻量重排与聚类阶段各复制一次候选
+    reranked = [dict(item) for item in candidates]
+    clustered = [dict(item) for item in reranked]
+    return mmr_select(
+        relevance=[item["similarity"] for item in clustered],
+        embeddings=[item["_embedding"] for item in clustered],
+        lambda_value=0.7,
+        target_count=top_k
+    )
+
+
+def measure_memory(func: Callable[[], Any]) -> float:
+    tracemalloc.start()
+    result = func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return peak / 1024 / 1024
+
+
+def measure_latency(func: Callable[[], Any], repeats: int) -> Dict[str, float]:
+    samples = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return {
+        "p50_ms": round(samples[len(samples) // 2], 3),
+        "min_ms": round(samples[0], 3)
+    }
+
+
+def main() -> None:
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    dimension = int(sys.argv[2]) if len(sys.argv) > 2 else 1024
+    repeats = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+    top_k = min(count, 40)
+    rows = fake_chroma_rows(count, dimension)
+
+    print(f"candidates={count}, dimension={dimension}, repeats={repeats}, mmr_target={top_k}")
+    print(f"{'repr':<10} {'build_mb':>9} {'build_p50_ms':>13} {'post_p50_ms':>12} {'total_p50_ms':>13}")
+    orders = {}
+    for label, as_float32 in (("list", False), ("float32", True)):
+        build_mb = measure_memory(lambda: build_candidates(rows, as_float32))
+        build_latency = measure_latency(lambda: build_candidates(rows, as_float32), repeats)
+        candidates = build_candidates(rows, as_float32)
+        post_latency = measure_latency(lambda: postprocess(candidates, top_k), repeats)
+        total_latency = measure_latency(lambda: postprocess(build_candidates(rows, as_float32), top_k), repeats)
+        orders[label] = postprocess(candidates, top_k)
+        print(
+            f"{label:<10} {build_mb:>9.2f} {build_latency['p50_ms']:>13.3f} "
+            f"{post_latency['p50_ms']:>12.3f} {total_latency['p50_ms']:>13.3f}"
+        )
+
+    print(f"\nMMR 排序一致: {orders['list'] == orders['float32']}")
+
+
+if __name__ == "__main__":
+    main()
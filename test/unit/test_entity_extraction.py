@@ -7,7 +7,7 @@ import json
 from pathlib import Path
 
 # 添加Backend到路径
-backend_path = Path(__file__).parent.parent / "Backend"
+backend_path = Path(__file__).parent.parent.parent / "Backend"
 sys.path.insert(0, str(backend_path))
 
 
@@ -166,6 +166,40 @@ def test_entity_extraction_enhanced():
     return True
 
 
+def test_entity_linker():
+    """测试查询实体词典链接（别名/最长匹配/英文词边界/增量更新）。"""
+    print("\n测试查询实体词典链接...")
+    try:
+        from app.services.domain.knowledge_graph.entity_linker import EntityLinker
+
+        dictionary = [
+            {"name": "电源键", "canonical_name": "电源键", "aliases": ["开机键"]},
+            {"name": "开机", "canonical_name": "开机"},
+            {"name": "GPT-4", "canonical_name": "GPT-4"},
+            {"name": "AI", "canonical_name": "AI"}
+        ]
+        linker = EntityLinker(loader=lambda kb_id: dictionary)
+        linked = [item["name"] for item in linker.link(1, "长按开机键多久可以开机？gpt4 said")]
+        if linked != ["电源键", "开机", "GPT-4"]:
+            print(f"   ❌ 词典链接结果异常: {linked}")
+            return False
+
+        linker.add_entities(1, [{"name": "指示灯", "canonical_name": "指示灯"}])
+        if [item["name"] for item in linker.link(1, "指示灯不亮")] != ["指示灯"]:
+            print("   ❌ 增量加入实体未生效")
+            return False
+
+        print("   ✓ 实体词典链接正常（别名/最长匹配/英文词边界/增量更新）")
+    except Exception as e:
+        print(f"   ❌ 实体词典链接测试失败: {e}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+    return True
+
+
 if __name__ == "__main__":
     success = test_entity_extraction_enhanced()
+    success = test_entity_linker() and success
     exit(0 if success else 1)
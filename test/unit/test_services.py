@@ -6,7 +6,7 @@ import sys
 from pathlib import Path
 
 # 添加Backend到路径
-backend_path = Path(__file__).parent.parent / "Backend"
+backend_path = Path(__file__).parent.parent.parent / "Backend"
 sys.path.insert(0, str(backend_path))
 
 
@@ -83,6 +83,46 @@ def test_services():
         return False
 
 
+def test_semantic_cache():
+    """测试对话语义缓存：精确/近似匹配、回答层仅精确命中与知识库失效"""
+    print("\n测试对话语义缓存...")
+    
+    try:
+        import numpy as np
+        from app.services.core.semantic_cache import SemanticCache, get_semantic_cache
+        
+        if get_semantic_cache() is not get_semantic_cache():
+            print("   ❌ get_semantic_cache 返回了不同的实例")
+            return False
+        
+        cache = SemanticCache(max_entries=8, ttl_seconds=60, semantic_match_enabled=True, similarity_threshold=0.95)
+        scope = cache.make_scope([1], "1:0:2:10", {"top_k": 5})
+        cache.put("retrieval", scope, "电源键怎么开机？", {"results": []}, kb_ids=[1], query_vector=np.array([1.0, 0.0, 0.01]))
+        cache.put("answer", scope, "电源键怎么开机？", {"answer": "长按3秒"}, kb_ids=[1], query_vector=np.array([1.0, 0.0, 0.01]))
+        exact = cache.get("answer", scope, "  电源键怎么开机 ")
+        similar = cache.get("retrieval", scope, "如何用电源键开机", np.array([1.0, 0.02, 0.0]))
+        similar_answer = cache.get("answer", scope, "电源键怎么关机", np.array([1.0, 0.02, 0.0]))
+        other_scope = cache.get("answer", cache.make_scope([1], "1:0:3:12", {"top_k": 5}), "电源键怎么开机？")
+        if not exact or exact.match != "exact" or not similar or similar.match != "semantic" or similar_answer or other_scope:
+            print(f"   ❌ 缓存匹配异常: exact={exact}, similar={similar}, similar_answer={similar_answer}, other_scope={other_scope}")
+            return False
+        
+        cache.invalidate_kb(1)
+        if cache.get("answer", scope, "电源键怎么开机？") is not None:
+            print("   ❌ 知识库失效后仍命中缓存")
+            return False
+        
+        print("   ✓ 语义缓存精确/近似匹配与失效正常")
+        return True
+        
+    except Exception as e:
+        print(f"\n❌ 语义缓存测试失败: {e}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+
 if __name__ == "__main__":
     success = test_services()
+    success = test_semantic_cache() and success
     exit(0 if success else 1)